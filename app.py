@@ -1,97 +1,629 @@
+# imported first, so the startup is timed from here
+from src.startup import STARTUP
 import configparser
-from telebot import TeleBot
-from src.graph_ql_client import GraphQLClient
-from src.open_ai_api import OpenAIAPI
-from src.telegram_bot import TelegramBot
+import os
+from src.message_store import AsyncMessageStore, MessageStore, copy_messages
 from src.azure_speech_recognizer import AzureSpeechRecognizer
+from src.speech_cache import SpeechCache
+from src.image_cache import ImageCache
+from src.audio import Transcoder
+from src.chat_scheduler import AsyncChatScheduler, ChatScheduler
+from src.rate_limiter import RateLimiter
+from src.history_cache import HistoryCache
+from src.metrics import TraceIdFilter, new_trace_id
+from src.message_coalescer import AsyncMessageCoalescer, MessageCoalescer
 import logging
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
 
-cfg = configparser.ConfigParser()
-cfg.read(".env")
+# the modules of a single mode, such as the OpenAI client, the stores and the bots, are imported
+# where that mode starts, so the others do not slow the startup
+if TYPE_CHECKING:
+    import multiprocessing
+    from telebot import TeleBot
+    from telebot.async_telebot import AsyncTeleBot
+    from src.async_open_ai_api import AsyncOpenAIAPI
+    from src.async_telegram_bot import AsyncTelegramBot
+    from src.metrics import MetricsServer
+    from src.retention import FileArchive, RetentionJob
+    from src.telegram_bot import TelegramBot
 
-logging.basicConfig(level=logging.WARNING)
+SOURCE_CODE_EXPLANATION = "O projeto Gepeto é um chatbot que utiliza o modelo OpenAI GPT-3 e integra com um bot do Telegram. " \
+                          "Ele pode manter conversas com os usuários e gerar respostas com base nas previsões do modelo " \
+                          "OpenAI.\n\nAlém disso, o Gepeto também oferece recursos adicionais, como reconhecimento de voz e " \
+                          "conversão de texto para discurso usando o SDK Speech da Azure, e geração de imagens com o modelo " \
+                          "DALL-E 2 da OpenAI.\n\nO código-fonte do projeto está disponível em um repositório de código aberto " \
+                          "no GitHub. Você pode acessar o repositório em: " \
+                          "https://github.com/jnthnklvn/gepeto.\n\nFique à vontade para explorar o código e contribuir com o " \
+                          "projeto se desejar!"
 
-api_key = cfg.get("CHAT_GPT", "API_KEY")
-mongo_api_url = cfg.get("MONGO", "API_URL")
-mongo_api_key = cfg.get("MONGO", "API_KEY")
+HELP_MESSAGE = "Olá! Eu sou o Gepeto, um chatbot desenvolvido com o modelo OpenAI GPT-3. " \
+               "Aqui estão os comandos que você pode usar:" \
+               "\n\n/audio - Converte o texto de uma mensagem em um áudio e envia como mensagem de voz." \
+               "\n/codigofonte - Retorna uma breve explicação sobre o projeto e um link para o código-fonte." \
+               "\n/imagem - Gera imagens com base em uma frase e envia como uma sequência de fotos." \
+               "\n/limpar - Deleta todas as suas mensagens enviadas para o bot (inclusive as criadas por ele) do banco de dados." \
+               "\n\nFique à vontade para explorar e conversar comigo!"
 
-speech_key = cfg.get("AZURE", "SPEECH_KEY")
-speech_region = cfg.get("AZURE", "SPEECH_REGION")
+# the token encodings are read from here, where the Docker image saves them, instead of downloaded on every start
+ENCODING_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tiktoken_cache")
 
-speech_recognizer = AzureSpeechRecognizer(speech_key, speech_region)
-gqlClient = GraphQLClient(mongo_api_url, mongo_api_key)
-openai_api = OpenAIAPI(gqlClient, api_key)
+BUSY_MESSAGE = "Estou recebendo muitas mensagens agora, por favor, tente novamente em alguns instantes."
 
-telegram_token = cfg.get("TELEGRAM", "TOKEN")
+INTRO_MESSAGE = "Olá! Eu sou o Gepeto, um chatbot desenvolvido com o modelo OpenAI GPT-3. " \
+                "Estou aqui para conversar com você e responder às suas perguntas.\n\n" \
+                "Além disso, posso ajudar nas seguintes tarefas:\n" \
+                "- Gerar e enviar imagens com base nas frases fornecidas.\n" \
+                "- Converter o texto de uma mensagem em áudio.\n" \
+                "- Deletar todas as mensagens dessa conversa do nosso banco de dados.\n\n" \
+                "Para conhecer todos os comandos disponíveis, por favor, utilize o comando /help.\n\n" \
+                "Lembre-se de não enviar informações sensíveis, como senhas ou dados pessoais, para garantir sua segurança."
 
-tele_bot = TeleBot(telegram_token, parse_mode=None)
-telegram_bot = TelegramBot(tele_bot, openai_api)
 
+def register_handlers(tele_bot: "TeleBot", telegram_bot: "TelegramBot", speech_recognizer: AzureSpeechRecognizer,
+                      message_store: MessageStore, scheduler: ChatScheduler, coalesce_interval: float = 0.0,
+                      coalesce_max_wait: float = 5.0) -> Optional[MessageCoalescer]:
+    def submit(message, lane: str, handler, *args) -> bool:
+        # the stages of the handler are traced under a new ID
+        new_trace_id()
+        if not scheduler.submit(message.chat.id, lane, handler, *args):
+            tele_bot.reply_to(message, BUSY_MESSAGE)
+            return False
+        return True
 
-@tele_bot.message_handler(commands=['audio'])
-def audio_command(message):
-    telegram_bot.convert_text_to_speech(message, speech_recognizer)
+    coalescer = None
+    if coalesce_interval > 0:
+        coalescer = MessageCoalescer(lambda batch: submit(batch.last, "text", telegram_bot.handle_message_batch, batch),
+                                     coalesce_interval, coalesce_max_wait)
 
+    def schedule(message, lane: str, handler, *args) -> None:
+        if coalescer is not None:
+            # the text messages received before are handled first
+            coalescer.flush(message.chat.id)
+        submit(message, lane, handler, *args)
 
-@tele_bot.message_handler(commands=['imagem'])
-def generate_images(message):
-    telegram_bot.generate_images(message)
+    @tele_bot.message_handler(commands=['audio'])
+    def audio_command(message):
+        schedule(message, "audio", telegram_bot.convert_text_to_speech, message, speech_recognizer)
 
+    @tele_bot.message_handler(commands=['imagem'])
+    def generate_images(message):
+        schedule(message, "image", telegram_bot.generate_images, message)
 
-@tele_bot.message_handler(commands=['codigofonte'])
-def explain_source_code(message):
-    explanation = "O projeto Gepeto é um chatbot que utiliza o modelo OpenAI GPT-3 e integra com um bot do Telegram. " \
-                  "Ele pode manter conversas com os usuários e gerar respostas com base nas previsões do modelo " \
-                  "OpenAI.\n\nAlém disso, o Gepeto também oferece recursos adicionais, como reconhecimento de voz e " \
-                  "conversão de texto para discurso usando o SDK Speech da Azure, e geração de imagens com o modelo " \
-                  "DALL-E 2 da OpenAI.\n\nO código-fonte do projeto está disponível em um repositório de código aberto " \
-                  "no GitHub. Você pode acessar o repositório em: " \
-                  "https://github.com/jnthnklvn/gepeto.\n\nFique à vontade para explorar o código e contribuir com o " \
-                  "projeto se desejar!"
+    @tele_bot.message_handler(commands=['codigofonte'])
+    def explain_source_code(message):
+        tele_bot.reply_to(message, SOURCE_CODE_EXPLANATION)
 
-    tele_bot.reply_to(message, explanation)
+    @tele_bot.message_handler(commands=['help'])
+    def help_command(message):
+        tele_bot.reply_to(message, HELP_MESSAGE)
 
+    @tele_bot.message_handler(commands=['start'])
+    def start_command(message):
+        tele_bot.reply_to(message, INTRO_MESSAGE)
 
-@tele_bot.message_handler(commands=['help'])
-def help_command(message):
-    help_message = "Olá! Eu sou o Gepeto, um chatbot desenvolvido com o modelo OpenAI GPT-3. " \
-                   "Aqui estão os comandos que você pode usar:" \
-                   "\n\n/audio - Converte o texto de uma mensagem em um áudio e envia como mensagem de voz." \
-                   "\n/codigofonte - Retorna uma breve explicação sobre o projeto e um link para o código-fonte." \
-                   "\n/imagem - Gera imagens com base em uma frase e envia como uma sequência de fotos." \
-                   "\n/limpar - Deleta todas as suas mensagens enviadas para o bot (inclusive as criadas por ele) do banco de dados." \
-                   "\n\nFique à vontade para explorar e conversar comigo!"
+    @tele_bot.message_handler(commands=['limpar'])
+    def clear_command(message):
+        schedule(message, "text", telegram_bot.delete_user_messages, message, message_store)
 
-    tele_bot.reply_to(message, help_message)
+    @tele_bot.message_handler(content_types=['voice'])
+    def handle_voice_message(message) -> None:
+        schedule(message, "voice", telegram_bot.handle_voice_message, message, speech_recognizer)
 
+    @tele_bot.message_handler(func=lambda _: True)
+    def handle_message(message):
+        if coalescer is not None and message.text is not None:
+            coalescer.add(message)
+        else:
+            schedule(message, "text", telegram_bot.handle_text_message, message)
 
-@tele_bot.message_handler(commands=['start'])
-def start_command(message):
-    intro_message = "Olá! Eu sou o Gepeto, um chatbot desenvolvido com o modelo OpenAI GPT-3. " \
-                    "Estou aqui para conversar com você e responder às suas perguntas.\n\n" \
-                    "Além disso, posso ajudar nas seguintes tarefas:\n" \
-                    "- Gerar e enviar imagens com base nas frases fornecidas.\n" \
-                    "- Converter o texto de uma mensagem em áudio.\n" \
-                    "- Deletar todas as mensagens dessa conversa do nosso banco de dados.\n\n" \
-                    "Para conhecer todos os comandos disponíveis, por favor, utilize o comando /help.\n\n" \
-                    "Lembre-se de não enviar informações sensíveis, como senhas ou dados pessoais, para garantir sua segurança."
+    return coalescer
 
-    tele_bot.reply_to(message, intro_message)
 
+def register_async_handlers(tele_bot: "AsyncTeleBot", telegram_bot: "AsyncTelegramBot",
+                            speech_recognizer: AzureSpeechRecognizer, message_store: MessageStore,
+                            scheduler: AsyncChatScheduler, coalesce_interval: float = 0.0,
+                            coalesce_max_wait: float = 5.0) -> Optional[AsyncMessageCoalescer]:
+    async def submit(message, lane: str, handler, *args) -> bool:
+        # the stages of the handler are traced under a new ID
+        new_trace_id()
+        if not scheduler.submit(message.chat.id, lane, handler, *args):
+            await tele_bot.reply_to(message, BUSY_MESSAGE)
+            return False
+        return True
 
-@tele_bot.message_handler(commands=['limpar'])
-def clear_command(message):
-    telegram_bot.delete_user_messages(message, gqlClient)
+    coalescer = None
+    if coalesce_interval > 0:
+        coalescer = AsyncMessageCoalescer(
+            lambda batch: submit(batch.last, "text", telegram_bot.handle_message_batch, batch),
+            coalesce_interval, coalesce_max_wait)
 
+    async def schedule(message, lane: str, handler, *args) -> None:
+        if coalescer is not None:
+            # the text messages received before are handled first
+            await coalescer.flush(message.chat.id)
+        await submit(message, lane, handler, *args)
 
-@tele_bot.message_handler(content_types=['voice'])
-def handle_voice_message(message) -> None:
-    telegram_bot.handle_voice_message(message, speech_recognizer)
+    @tele_bot.message_handler(commands=['audio'])
+    async def audio_command(message):
+        await schedule(message, "audio", telegram_bot.convert_text_to_speech, message, speech_recognizer)
 
+    @tele_bot.message_handler(commands=['imagem'])
+    async def generate_images(message):
+        await schedule(message, "image", telegram_bot.generate_images, message)
 
-@tele_bot.message_handler(func=lambda _: True)
-def handle_message(message):
-    telegram_bot.handle_text_message(message)
+    @tele_bot.message_handler(commands=['codigofonte'])
+    async def explain_source_code(message):
+        await tele_bot.reply_to(message, SOURCE_CODE_EXPLANATION)
 
+    @tele_bot.message_handler(commands=['help'])
+    async def help_command(message):
+        await tele_bot.reply_to(message, HELP_MESSAGE)
 
-tele_bot.infinity_polling()
+    @tele_bot.message_handler(commands=['start'])
+    async def start_command(message):
+        await tele_bot.reply_to(message, INTRO_MESSAGE)
+
+    @tele_bot.message_handler(commands=['limpar'])
+    async def clear_command(message):
+        await schedule(message, "text", telegram_bot.delete_user_messages, message, message_store)
+
+    @tele_bot.message_handler(content_types=['voice'])
+    async def handle_voice_message(message) -> None:
+        await schedule(message, "voice", telegram_bot.handle_voice_message, message, speech_recognizer)
+
+    @tele_bot.message_handler(func=lambda _: True)
+    async def handle_message(message):
+        if coalescer is not None and message.text is not None:
+            coalescer.add(message)
+        else:
+            await schedule(message, "text", telegram_bot.handle_text_message, message)
+
+    return coalescer
+
+
+def scheduler_lanes(cfg: configparser.ConfigParser, text_workers: int = 8) -> Dict[str, int]:
+    return {
+        "text": cfg.getint("BOT", "TEXT_WORKERS", fallback=text_workers),
+        "voice": cfg.getint("BOT", "VOICE_WORKERS", fallback=4),
+        "image": cfg.getint("BOT", "IMAGE_WORKERS", fallback=2),
+        "audio": cfg.getint("BOT", "AUDIO_WORKERS", fallback=2),
+    }
+
+
+def create_speech_cache(cfg: configparser.ConfigParser, shard: Optional[int] = None) -> SpeechCache:
+    megabyte = 1024 * 1024
+    directory = cfg.get("AZURE", "SPEECH_CACHE_DIR", fallback=None)
+    if directory is not None and shard is not None:
+        # each webhook worker owns its part of the cache
+        directory = os.path.join(directory, "shard-{}".format(shard))
+    return SpeechCache(directory,
+                       max_memory_bytes=cfg.getint("AZURE", "SPEECH_CACHE_MEMORY_MB", fallback=32) * megabyte,
+                       max_disk_bytes=cfg.getint("AZURE", "SPEECH_CACHE_DISK_MB", fallback=512) * megabyte)
+
+
+def create_transcoder(cfg: configparser.ConfigParser, shards: int = 1) -> Transcoder:
+    # decoding is bound by the CPUs, which the webhook workers share
+    processes = cfg.getint("AZURE", "TRANSCODE_PROCESSES", fallback=os.cpu_count() or 1)
+    return Transcoder(max(processes // shards, 1), cfg.getfloat("AZURE", "TRANSCODE_TIMEOUT", fallback=60))
+
+
+def openai_limits(cfg: configparser.ConfigParser, shards: int = 1) -> Dict:
+    # the quota of the account is split between the webhook workers
+    return {
+        "chat_limiter": RateLimiter(cfg.getint("CHAT_GPT", "REQUESTS_PER_MINUTE", fallback=3500),
+                                    cfg.getint("CHAT_GPT", "TOKENS_PER_MINUTE", fallback=90000), shares=shards),
+        "image_limiter": RateLimiter(cfg.getint("CHAT_GPT", "IMAGES_PER_MINUTE", fallback=50), shares=shards),
+        "max_retries": cfg.getint("CHAT_GPT", "MAX_RETRIES", fallback=5),
+    }
+
+
+def conversation_summary(cfg: configparser.ConfigParser) -> Dict:
+    return {
+        # a summary costs a completion and changes the prompt, so it is off unless it is set
+        "summary_every": cfg.getint("CHAT_GPT", "SUMMARY_EVERY", fallback=0),
+        "recent_messages": cfg.getint("CHAT_GPT", "RECENT_MESSAGES", fallback=6),
+        "summary_tokens": cfg.getint("CHAT_GPT", "SUMMARY_TOKENS", fallback=250),
+    }
+
+
+def conversation_memory(cfg: configparser.ConfigParser) -> Dict:
+    directory = cfg.get("MEMORY", "DIR", fallback="")
+    if directory == "":
+        return {}
+    # numpy takes a while to import, so it is only imported when the memory is on
+    from src.conversation_memory import ConversationMemory
+    return {
+        "memory": ConversationMemory(directory, top_k=cfg.getint("MEMORY", "TOP_K", fallback=3),
+                                     min_score=cfg.getfloat("MEMORY", "MIN_SCORE", fallback=0.3),
+                                     max_open_users=cfg.getint("MEMORY", "OPEN_USERS", fallback=256)),
+        "recall_tokens": cfg.getint("MEMORY", "RECALL_TOKENS", fallback=500),
+    }
+
+
+def image_generation(cfg: configparser.ConfigParser) -> Dict:
+    image_sets = [(cfg.get("CHAT_GPT", "IMAGE_SIZE", fallback="1024x1024"), cfg.getint("CHAT_GPT", "IMAGE_COUNT", fallback=2))]
+    preview_size = cfg.get("CHAT_GPT", "PREVIEW_SIZE", fallback="")
+    if preview_size != "":
+        image_sets.insert(0, (preview_size, cfg.getint("CHAT_GPT", "PREVIEW_COUNT", fallback=1)))
+    cache_size = cfg.getint("CHAT_GPT", "IMAGE_CACHE_SIZE", fallback=1000)
+    return {
+        "image_sets": image_sets,
+        "image_cache": ImageCache(cache_size) if cache_size > 0 else None,
+    }
+
+
+def coalescing(cfg: configparser.ConfigParser) -> Dict:
+    return {
+        # waiting for a burst delays every answer, so it is off unless an interval is set
+        "coalesce_interval": cfg.getfloat("BOT", "COALESCE_INTERVAL", fallback=0.0),
+        "coalesce_max_wait": cfg.getfloat("BOT", "COALESCE_MAX_WAIT", fallback=5.0),
+    }
+
+
+def configure_logging(cfg: configparser.ConfigParser) -> None:
+    logging.basicConfig(level=cfg.get("BOT", "LOG_LEVEL", fallback="WARNING"),
+                        format="%(levelname)s:%(name)s:%(trace_id)s:%(message)s")
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(TraceIdFilter())
+
+
+def serve_metrics(cfg: configparser.ConfigParser, scheduler: ChatScheduler, limiters: Dict[str, RateLimiter],
+                  history_cache: HistoryCache, shard: Optional[int] = None) -> Optional["MetricsServer"]:
+    port = cfg.getint("BOT", "METRICS_PORT", fallback=0)
+    if port == 0:
+        return None
+    from src.metrics import REGISTRY, MetricsServer
+    REGISTRY.collect("gepeto_lane_depth", "Requests queued or running in each lane.", "gauge", ["lane"],
+                     lambda: {(lane,): stats["depth"] for lane, stats in scheduler.stats().items()})
+    REGISTRY.collect("gepeto_lane_rejected_total", "Requests refused because their lane or chat was full.",
+                     "counter", ["lane"],
+                     lambda: {(lane,): stats["rejected"] for lane, stats in scheduler.stats().items()})
+    REGISTRY.collect("gepeto_rate_limit_available", "Budget left under each rate limit.", "gauge",
+                     ["limiter", "budget"],
+                     lambda: {(name, budget): value for name, limiter in limiters.items()
+                              for budget, value in limiter.available().items()})
+    REGISTRY.collect("gepeto_history_cache_lookups_total", "Lookups of the message history cache.", "counter",
+                     ["result"], lambda: {("hit",): history_cache.hits, ("miss",): history_cache.misses})
+    # each webhook worker serves its own metrics, on the ports after the first one
+    return MetricsServer(port + (shard or 0), cfg.get("BOT", "METRICS_HOST", fallback="127.0.0.1")).start()
+
+
+def startup_budget(cfg: configparser.ConfigParser) -> float:
+    return cfg.getfloat("BOT", "STARTUP_BUDGET", fallback=10.0)
+
+
+def webhook_workers(cfg: configparser.ConfigParser) -> int:
+    return cfg.getint("WEBHOOK", "WORKERS", fallback=os.cpu_count() or 1)
+
+
+def storage_backend(cfg: configparser.ConfigParser, backend: Optional[str] = None) -> str:
+    backend = backend or cfg.get("BOT", "STORAGE", fallback="atlas")
+    if backend not in ("atlas", "sqlite"):
+        raise ValueError("Unknown storage backend: {}".format(backend))
+    return backend
+
+
+def message_archive(cfg: configparser.ConfigParser) -> Optional["FileArchive"]:
+    # by default the messages are archived next to the others, in the same database
+    directory = cfg.get("RETENTION", "ARCHIVE_DIR", fallback="")
+    if directory == "":
+        return None
+    from src.retention import FileArchive
+    return FileArchive(directory)
+
+
+def create_message_store(cfg: configparser.ConfigParser, backend: Optional[str] = None) -> MessageStore:
+    if storage_backend(cfg, backend) == "sqlite":
+        from src.sqlite_message_store import SQLiteMessageStore
+        return SQLiteMessageStore(cfg.get("SQLITE", "PATH", fallback="gepeto.db"),
+                                  write_batch_size=cfg.getint("SQLITE", "WRITE_BATCH_SIZE", fallback=50),
+                                  write_interval=cfg.getfloat("SQLITE", "WRITE_INTERVAL", fallback=0.1),
+                                  archive=message_archive(cfg))
+    from src.graph_ql_client import GraphQLClient
+    return GraphQLClient(cfg.get("MONGO", "API_URL"), cfg.get("MONGO", "API_KEY"),
+                         fetch_schema=cfg.getboolean("MONGO", "FETCH_SCHEMA", fallback=False),
+                         schema_path=cfg.get("MONGO", "SCHEMA_PATH", fallback=None),
+                         write_batch_size=cfg.getint("MONGO", "WRITE_BATCH_SIZE", fallback=50),
+                         write_interval=cfg.getfloat("MONGO", "WRITE_INTERVAL", fallback=0.5),
+                         archive=message_archive(cfg))
+
+
+def create_async_message_store(cfg: configparser.ConfigParser, backend: Optional[str] = None) -> MessageStore:
+    if storage_backend(cfg, backend) == "sqlite":
+        from src.sqlite_message_store import AsyncSQLiteMessageStore
+        return AsyncSQLiteMessageStore(cfg.get("SQLITE", "PATH", fallback="gepeto.db"),
+                                       write_batch_size=cfg.getint("SQLITE", "WRITE_BATCH_SIZE", fallback=50),
+                                       write_interval=cfg.getfloat("SQLITE", "WRITE_INTERVAL", fallback=0.1),
+                                       archive=message_archive(cfg))
+    from src.async_graph_ql_client import AsyncGraphQLClient
+    return AsyncGraphQLClient(cfg.get("MONGO", "API_URL"), cfg.get("MONGO", "API_KEY"),
+                              fetch_schema=cfg.getboolean("MONGO", "FETCH_SCHEMA", fallback=False),
+                              schema_path=cfg.get("MONGO", "SCHEMA_PATH", fallback=None),
+                              write_batch_size=cfg.getint("MONGO", "WRITE_BATCH_SIZE", fallback=50),
+                              write_interval=cfg.getfloat("MONGO", "WRITE_INTERVAL", fallback=0.5),
+                              archive=message_archive(cfg))
+
+
+def create_retention_job(cfg: configparser.ConfigParser, message_store: MessageStore,
+                         shard: Optional[int] = None) -> Optional["RetentionJob"]:
+    max_age_days = cfg.getfloat("RETENTION", "MAX_AGE_DAYS", fallback=0)
+    keep_latest = cfg.getint("RETENTION", "KEEP_LATEST", fallback=0)
+    if shard is not None and shard > 0:
+        # the webhook workers share the old messages, so only the first one archives them by age,
+        # while each one trims the histories of its own chats
+        max_age_days = 0
+    if max_age_days <= 0 and keep_latest <= 0:
+        return None
+    from src.retention import RetentionJob
+    return RetentionJob(message_store, max_age_days if max_age_days > 0 else None,
+                        keep_latest if keep_latest > 0 else None,
+                        interval=cfg.getfloat("RETENTION", "INTERVAL", fallback=3600),
+                        page_size=cfg.getint("RETENTION", "PAGE_SIZE", fallback=500))
+
+
+def migrate_messages(source: str, target: str, page_size: int = 500) -> int:
+    """
+    Copy the messages from a storage backend to another, with the settings in .env, such as with
+    python -c "from app import migrate_messages; migrate_messages('atlas', 'sqlite')".
+    The bot should be stopped, so no message is written during the copy.
+
+    Args:
+        source: The backend the messages are read from, atlas or sqlite.
+        target: The backend the messages are written to, atlas or sqlite.
+        page_size: The number of messages read and written at once.
+
+    Returns:
+        The number of messages copied.
+    """
+    cfg = configparser.ConfigParser()
+    cfg.read(".env")
+    configure_logging(cfg)
+    source_store = create_message_store(cfg, source)
+    target_store = create_message_store(cfg, target)
+    try:
+        return copy_messages(source_store, target_store, page_size)
+    finally:
+        source_store.close()
+        target_store.close()
+
+
+def index_messages(page_size: int = 500) -> int:
+    """
+    Build the conversation memory from the stored messages, with the settings in .env, such as with
+    python -c "from app import index_messages; index_messages()". The bot should be stopped meanwhile.
+    An interrupted build goes on from where it stopped.
+
+    Args:
+        page_size: The number of messages read at once.
+
+    Returns:
+        The number of messages added to the memory.
+    """
+    cfg = configparser.ConfigParser()
+    cfg.read(".env")
+    configure_logging(cfg)
+    memory = conversation_memory(cfg).get("memory")
+    if memory is None:
+        raise ValueError("The conversation memory is off, set DIR in the MEMORY section")
+    message_store = create_message_store(cfg)
+    try:
+        return memory.index_messages(message_store, page_size)
+    finally:
+        memory.close()
+        message_store.close()
+
+
+def create_bot(cfg: configparser.ConfigParser, shard: Optional[int] = None,
+               shards: int = 1) -> Tuple["TeleBot", MessageStore, ChatScheduler, Optional[MessageCoalescer]]:
+    from telebot import TeleBot
+    from src.open_ai_api import OpenAIAPI
+    from src.telegram_bot import TelegramBot
+
+    api_key = cfg.get("CHAT_GPT", "API_KEY")
+
+    speech_key = cfg.get("AZURE", "SPEECH_KEY")
+    speech_region = cfg.get("AZURE", "SPEECH_REGION")
+
+    speech_limiter = RateLimiter(cfg.getint("AZURE", "REQUESTS_PER_MINUTE", fallback=1200), shares=shards)
+    speech_recognizer = AzureSpeechRecognizer(speech_key, speech_region,
+                                              pool_size=cfg.getint("AZURE", "POOL_SIZE", fallback=2),
+                                              rate_limiter=speech_limiter,
+                                              max_retries=cfg.getint("AZURE", "MAX_RETRIES", fallback=3))
+    # the connections are opened once the bot serves updates, so they do not delay the startup
+    STARTUP.defer("speech service connections", speech_recognizer.warm_up)
+    STARTUP.mark("speech")
+    message_store = create_message_store(cfg)
+    retention = create_retention_job(cfg, message_store, shard)
+    if retention is not None:
+        # the job stops when the store is closed
+        STARTUP.defer("message retention", retention.start)
+    STARTUP.mark("storage")
+    limits = openai_limits(cfg, shards)
+    openai_api = OpenAIAPI(message_store, api_key, **limits, **conversation_summary(cfg), **conversation_memory(cfg))
+    STARTUP.defer("token encoding", openai_api.warm_up)
+    STARTUP.mark("openai")
+    speech_cache = create_speech_cache(cfg, shard)
+    STARTUP.mark("speech_cache")
+
+    telegram_token = cfg.get("TELEGRAM", "TOKEN")
+
+    # the handlers only hand the messages to the scheduler, in the order they arrive
+    tele_bot = TeleBot(telegram_token, parse_mode=None, threaded=False)
+    telegram_bot = TelegramBot(tele_bot, openai_api,
+                               stream=cfg.getboolean("CHAT_GPT", "STREAM", fallback=False),
+                               edit_interval=cfg.getfloat("CHAT_GPT", "EDIT_INTERVAL", fallback=1.0),
+                               speech_cache=speech_cache,
+                               max_voice_duration=cfg.getfloat("AZURE", "MAX_VOICE_DURATION", fallback=600),
+                               transcoder=create_transcoder(cfg, shards),
+                               **image_generation(cfg))
+    scheduler = ChatScheduler(scheduler_lanes(cfg), max_queue=cfg.getint("BOT", "MAX_QUEUE", fallback=100),
+                              max_chat_queue=cfg.getint("BOT", "MAX_CHAT_QUEUE", fallback=10))
+    coalescer = register_handlers(tele_bot, telegram_bot, speech_recognizer, message_store, scheduler,
+                                  **coalescing(cfg))
+    serve_metrics(cfg, scheduler, {"openai_chat": limits["chat_limiter"], "openai_image": limits["image_limiter"],
+                                   "azure_speech": speech_limiter}, message_store.history_cache, shard)
+    STARTUP.mark("telegram")
+    return tele_bot, message_store, scheduler, coalescer
+
+
+def run_polling(tele_bot: "TeleBot", message_store: MessageStore, scheduler: ChatScheduler,
+                coalescer: Optional[MessageCoalescer] = None, **polling_args) -> None:
+    try:
+        tele_bot.infinity_polling(**polling_args)
+    finally:
+        close_bot(message_store, scheduler, coalescer)
+
+
+def close_bot(message_store: MessageStore, scheduler: ChatScheduler, coalescer: Optional[MessageCoalescer]) -> None:
+    if coalescer is not None:
+        coalescer.close()
+    scheduler.shutdown()
+    # writes the messages still queued
+    message_store.close()
+
+
+def run_webhook_worker(config: Dict[str, Dict[str, str]], shard: int, updates: "multiprocessing.Queue") -> None:
+    from src.webhook import consume_updates
+    STARTUP.mark("imports")
+    cfg = configparser.ConfigParser()
+    cfg.read_dict(config)
+    configure_logging(cfg)
+    STARTUP.mark("config")
+
+    tele_bot, message_store, scheduler, coalescer = create_bot(cfg, shard, webhook_workers(cfg))
+    STARTUP.ready(startup_budget(cfg))
+    try:
+        consume_updates(tele_bot, updates)
+    finally:
+        close_bot(message_store, scheduler, coalescer)
+
+
+def run_webhook(cfg: configparser.ConfigParser) -> None:
+    from aiohttp import web
+    from telebot import TeleBot
+    from src.webhook import WebhookReceiver
+
+    secret_token = cfg.get("WEBHOOK", "SECRET_TOKEN", fallback=None)
+    # the workers are spawned, so they get the settings instead of the parser
+    config = {section: dict(cfg.items(section, raw=True)) for section in cfg.sections()}
+    receiver = WebhookReceiver(run_webhook_worker, (config,), webhook_workers(cfg), secret_token,
+                               max_queue=cfg.getint("WEBHOOK", "MAX_QUEUE", fallback=1000))
+    url = cfg.get("WEBHOOK", "URL", fallback=None)
+    if url is not None:
+        max_connections = cfg.getint("WEBHOOK", "MAX_CONNECTIONS", fallback=40)
+        TeleBot(cfg.get("TELEGRAM", "TOKEN")).set_webhook(url, max_connections=max_connections, secret_token=secret_token)
+    STARTUP.ready(startup_budget(cfg))
+    web.run_app(receiver.application(cfg.get("WEBHOOK", "PATH", fallback="/webhook")),
+                host=cfg.get("WEBHOOK", "HOST", fallback="0.0.0.0"), port=cfg.getint("WEBHOOK", "PORT", fallback=8080),
+                access_log=None)
+
+
+def create_async_bot(cfg: configparser.ConfigParser) -> Tuple["AsyncTeleBot", MessageStore, AsyncChatScheduler,
+                                                              "AsyncOpenAIAPI", Optional[AsyncMessageCoalescer]]:
+    from telebot.async_telebot import AsyncTeleBot
+    from src.async_open_ai_api import AsyncOpenAIAPI
+    from src.async_telegram_bot import AsyncTelegramBot
+
+    api_key = cfg.get("CHAT_GPT", "API_KEY")
+
+    speech_key = cfg.get("AZURE", "SPEECH_KEY")
+    speech_region = cfg.get("AZURE", "SPEECH_REGION")
+
+    max_concurrency = cfg.getint("BOT", "MAX_CONCURRENCY", fallback=32)
+
+    speech_limiter = RateLimiter(cfg.getint("AZURE", "REQUESTS_PER_MINUTE", fallback=1200))
+    speech_recognizer = AzureSpeechRecognizer(speech_key, speech_region,
+                                              pool_size=cfg.getint("AZURE", "POOL_SIZE", fallback=2),
+                                              rate_limiter=speech_limiter,
+                                              max_retries=cfg.getint("AZURE", "MAX_RETRIES", fallback=3))
+    # the connections are opened once the bot serves updates, so they do not delay the startup
+    STARTUP.defer("speech service connections", speech_recognizer.warm_up)
+    STARTUP.mark("speech")
+    message_store = create_async_message_store(cfg)
+    retention = create_retention_job(cfg, message_store)
+    if retention is not None:
+        # the job stops when the store is closed
+        STARTUP.defer("message retention", retention.start)
+    STARTUP.mark("storage")
+    limits = openai_limits(cfg)
+    openai_api = AsyncOpenAIAPI(message_store, api_key, **limits, **conversation_summary(cfg),
+                                **conversation_memory(cfg))
+    STARTUP.defer("token encoding", openai_api.warm_up)
+    STARTUP.mark("openai")
+    speech_cache = create_speech_cache(cfg)
+    STARTUP.mark("speech_cache")
+
+    telegram_token = cfg.get("TELEGRAM", "TOKEN")
+
+    tele_bot = AsyncTeleBot(telegram_token, parse_mode=None)
+    telegram_bot = AsyncTelegramBot(tele_bot, openai_api,
+                                    stream=cfg.getboolean("CHAT_GPT", "STREAM", fallback=False),
+                                    edit_interval=cfg.getfloat("CHAT_GPT", "EDIT_INTERVAL", fallback=1.0),
+                                    speech_cache=speech_cache,
+                                    max_voice_duration=cfg.getfloat("AZURE", "MAX_VOICE_DURATION", fallback=600),
+                                    transcoder=create_transcoder(cfg),
+                                    **image_generation(cfg))
+    # handlers waiting on the network cost little in the async bot, so the text lane can be as wide as the bot
+    scheduler = AsyncChatScheduler(scheduler_lanes(cfg, max_concurrency), max_queue=cfg.getint("BOT", "MAX_QUEUE", fallback=100),
+                                   max_chat_queue=cfg.getint("BOT", "MAX_CHAT_QUEUE", fallback=10))
+    coalescer = register_async_handlers(tele_bot, telegram_bot, speech_recognizer, message_store, scheduler,
+                                        **coalescing(cfg))
+    serve_metrics(cfg, scheduler, {"openai_chat": limits["chat_limiter"], "openai_image": limits["image_limiter"],
+                                   "azure_speech": speech_limiter}, message_store.history_cache)
+    STARTUP.mark("telegram")
+    return tele_bot, message_store, scheduler, openai_api, coalescer
+
+
+async def run_async_polling(tele_bot: "AsyncTeleBot", message_store: AsyncMessageStore, scheduler: AsyncChatScheduler,
+                            openai_api: "AsyncOpenAIAPI", coalescer: Optional[AsyncMessageCoalescer] = None,
+                            **polling_args) -> None:
+    import aiohttp
+    import openai
+
+    # every OpenAI request reuses the connections of a single session
+    openai_session = aiohttp.ClientSession()
+    openai.aiosession.set(openai_session)
+    await message_store.connect()
+    try:
+        await tele_bot.infinity_polling(**polling_args)
+    finally:
+        if coalescer is not None:
+            await coalescer.close()
+        await scheduler.shutdown()
+        # the summaries being refreshed still use the session and queue their messages
+        await openai_api.aclose()
+        await message_store.aclose()
+        await openai_session.close()
+        await tele_bot.close_session()
+
+
+def serve(cfg: configparser.ConfigParser) -> None:
+    configure_logging(cfg)
+    # the webhook workers inherit it
+    os.environ.setdefault("TIKTOKEN_CACHE_DIR", ENCODING_CACHE_DIR)
+    STARTUP.mark("config")
+
+    mode = cfg.get("BOT", "MODE", fallback="polling")
+    if mode == "async":
+        import asyncio
+        bot = create_async_bot(cfg)
+        STARTUP.ready(startup_budget(cfg))
+        asyncio.run(run_async_polling(*bot))
+    elif mode == "webhook":
+        run_webhook(cfg)
+    else:
+        bot = create_bot(cfg)
+        # the warm-ups start along with the polling
+        STARTUP.ready(startup_budget(cfg))
+        run_polling(*bot)
+
+
+def main() -> None:
+    STARTUP.mark("imports")
+    cfg = configparser.ConfigParser()
+    cfg.read(".env")
+    serve(cfg)
+
+
+if __name__ == "__main__":
+    main()
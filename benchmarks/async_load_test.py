@@ -0,0 +1,104 @@
+"""
+Load test of the text message path of the polling bot and the async bot against local stubs.
+
+Every simulated user sends a message and waits for the reply before sending the next one,
+and the test reports the throughput and the p50/p99 latency from update to reply.
+
+Usage: python -m benchmarks.async_load_test [--users 50] [--messages 5] [--latency 0.2]
+"""
+import argparse
+import asyncio
+import configparser
+import statistics
+import threading
+import time
+import openai
+import telebot
+from telebot import apihelper, asyncio_helper
+from typing import List
+from app import create_async_bot, create_bot, run_async_polling, run_polling
+from benchmarks.stubs import GraphQLStub, OpenAIStub, StubServers, TelegramStub
+
+
+def stub_config(servers: StubServers, max_concurrency: int) -> configparser.ConfigParser:
+    cfg = configparser.ConfigParser()
+    cfg.read_dict({
+        "CHAT_GPT": {"API_KEY": "stub"},
+        "TELEGRAM": {"TOKEN": "123:stub"},
+        "MONGO": {"API_KEY": "stub", "API_URL": servers.base_url + "/graphql"},
+        "AZURE": {"SPEECH_KEY": "stub", "SPEECH_REGION": "stub"},
+        # every user waits for the answer before the next message, so there are no bursts to coalesce
+        "BOT": {"MAX_CONCURRENCY": str(max_concurrency), "COALESCE_INTERVAL": "0"},
+    })
+    return cfg
+
+
+async def simulate_users(telegram: TelegramStub, users: int, messages: int, first_chat_id: int) -> List[float]:
+    latencies = []
+
+    async def user(chat_id: int) -> None:
+        for i in range(messages):
+            start = time.perf_counter()
+            message_id = telegram.push_message(chat_id, "mensagem {}".format(i))
+            await telegram.wait_reply(message_id)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(user(first_chat_id + i) for i in range(users)))
+    return latencies
+
+
+def report(name: str, latencies: List[float], elapsed: float) -> None:
+    quantiles = statistics.quantiles(latencies, n=100)
+    print("{:<8} {:>8.1f} msg/s   p50 {:>7.1f} ms   p99 {:>7.1f} ms".format(
+        name, len(latencies) / elapsed, quantiles[49] * 1000, quantiles[98] * 1000))
+
+
+def run_sync_bot(servers: StubServers, args: argparse.Namespace) -> None:
+    bot, gql_client, scheduler, coalescer = create_bot(stub_config(servers, args.concurrency))
+    thread = threading.Thread(target=run_polling, args=(bot, gql_client, scheduler, coalescer),
+                              kwargs={"timeout": 1, "long_polling_timeout": 1})
+    thread.start()
+    start = time.perf_counter()
+    latencies = servers.run(simulate_users(servers.telegram, args.users, args.messages, 1000))
+    report("polling", latencies, time.perf_counter() - start)
+    bot.stop_polling()
+    thread.join()
+
+
+def run_async_bot(servers: StubServers, args: argparse.Namespace) -> None:
+    bot, gql_client, scheduler, openai_api, coalescer = create_async_bot(stub_config(servers, args.concurrency))
+    loop = asyncio.new_event_loop()
+    polling = loop.create_task(run_async_polling(bot, gql_client, scheduler, openai_api, coalescer, timeout=1))
+    thread = threading.Thread(target=loop.run_until_complete, args=(polling,))
+    thread.start()
+    start = time.perf_counter()
+    latencies = servers.run(simulate_users(servers.telegram, args.users, args.messages, 2000))
+    report("async", latencies, time.perf_counter() - start)
+    loop.call_soon_threadsafe(polling.cancel)
+    thread.join()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.2, help="OpenAI stub latency in seconds")
+    parser.add_argument("--db-latency", type=float, default=0.02, help="GraphQL stub latency in seconds")
+    parser.add_argument("--concurrency", type=int, default=32, help="async bot concurrency limit")
+    args = parser.parse_args()
+
+    servers = StubServers(TelegramStub(0.005), GraphQLStub(args.db_latency), OpenAIStub(args.latency)).start()
+    telebot.logger.setLevel("CRITICAL")
+    apihelper.API_URL = servers.base_url + "/bot{0}/{1}"
+    asyncio_helper.API_URL = servers.base_url + "/bot{0}/{1}"
+    openai.api_base = servers.base_url + "/v1"
+
+    print("{} users x {} messages, OpenAI latency {} s, GraphQL latency {} s".format(
+        args.users, args.messages, args.latency, args.db_latency))
+    run_sync_bot(servers, args)
+    run_async_bot(servers, args)
+    servers.stop()
+
+
+if __name__ == "__main__":
+    main()
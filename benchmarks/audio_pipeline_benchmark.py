@@ -0,0 +1,72 @@
+"""
+Compare the preparation of a voice message for speech recognition on disk, as done before,
+with the in-memory pipeline. Needs ffmpeg (and ffprobe for the disk pipeline) on the PATH.
+
+Usage: python -m benchmarks.audio_pipeline_benchmark [--seconds 20] [--runs 20]
+"""
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+import wave
+from pydub import AudioSegment
+from typing import Callable
+from src.audio import decode_to_pcm, ogg_opus_duration
+
+
+def voice_message(seconds: float) -> bytes:
+    """
+    Encode a tone as OGG/Opus, like the voice messages sent by Telegram.
+    """
+    return subprocess.run(
+        ["ffmpeg", "-loglevel", "error", "-f", "lavfi", "-i", "sine=frequency=440:duration={}".format(seconds),
+         "-ac", "1", "-c:a", "libopus", "-b:a", "24k", "-f", "ogg", "-"],
+        check=True, capture_output=True).stdout
+
+
+def on_disk(data: bytes) -> float:
+    filename = os.path.join(tempfile.gettempdir(), "voice.oga")
+    with open(filename, "wb") as new_file:
+        new_file.write(data)
+    AudioSegment.from_file(filename).export(filename, format="wav")
+    with wave.open(filename) as audio:
+        duration_seconds = audio.getnframes() / audio.getframerate()
+    # the speech SDK read the file back from disk
+    with open(filename, "rb") as file:
+        file.read()
+    os.remove(filename)
+    return duration_seconds
+
+
+def in_memory(data: bytes) -> float:
+    duration_seconds = ogg_opus_duration(data)
+    decode_to_pcm(data)
+    return duration_seconds
+
+
+def measure(name: str, prepare: Callable[[bytes], float], data: bytes, runs: int) -> None:
+    start = time.perf_counter()
+    for _ in range(runs):
+        prepare(data)
+    print("{:<10} {:7.1f} ms per message".format(name, (time.perf_counter() - start) / runs * 1000))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    data = voice_message(args.seconds)
+    start = time.perf_counter()
+    for _ in range(1000):
+        ogg_opus_duration(data)
+    print("{} s voice message, {} bytes, duration read from the headers in {:.1f} us".format(
+        args.seconds, len(data), (time.perf_counter() - start) * 1000))
+    measure("on disk", on_disk, data, args.runs)
+    measure("in memory", in_memory, data, args.runs)
+
+
+if __name__ == "__main__":
+    main()
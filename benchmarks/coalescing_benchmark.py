@@ -0,0 +1,91 @@
+"""
+Measure the completions, stored messages and replies caused by users sending bursts of short
+messages, with every message answered on its own, as before, and with the bursts coalesced.
+
+Usage: python -m benchmarks.coalescing_benchmark [--users 10] [--bursts 3] [--burst-size 3] [--interval 1]
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import threading
+import time
+import openai
+import telebot
+from telebot import TeleBot, apihelper
+from typing import Dict, List
+from app import register_handlers, run_polling
+from benchmarks.stubs import GraphQLStub, OpenAIStub, SpeechStub, StubServers, TelegramStub
+from src.chat_scheduler import ChatScheduler
+from src.graph_ql_client import GraphQLClient
+from src.open_ai_api import OpenAIAPI
+from src.telegram_bot import TelegramBot
+
+
+async def simulate_users(telegram: TelegramStub, args: argparse.Namespace, first_chat_id: int) -> Dict[str, List]:
+    results = {"latencies": [], "replies": []}
+
+    async def user(chat_id: int) -> None:
+        generator = random.Random(chat_id - first_chat_id)
+        for burst in range(args.bursts):
+            message_ids = []
+            for i in range(args.burst_size):
+                if i > 0:
+                    # most messages follow quickly, some come while the answer is on its way
+                    await asyncio.sleep(generator.choice((0.3, 0.3, 0.5, 1.5)))
+                message_ids.append(telegram.push_message(chat_id, "parte {} da mensagem {}".format(i, burst)))
+            start = time.perf_counter()
+            await telegram.wait_reply(message_ids[-1], timeout=120)
+            results["latencies"].append(time.perf_counter() - start)
+            # the replies to the earlier messages of the burst are sent before the last one
+            results["replies"].append(1 + sum(len(telegram.take_replies(message_id))
+                                              for message_id in message_ids[:-1]))
+
+    await asyncio.gather(*(user(first_chat_id + i) for i in range(args.users)))
+    return results
+
+
+def run(servers: StubServers, args: argparse.Namespace, name: str, interval: float, first_chat_id: int) -> None:
+    gql_client = GraphQLClient(servers.base_url + "/graphql", "stub")
+    tele_bot = TeleBot("123:stub", parse_mode=None, threaded=False)
+    scheduler = ChatScheduler({"text": 8, "voice": 1, "image": 1, "audio": 1})
+    coalescer = register_handlers(tele_bot, TelegramBot(tele_bot, OpenAIAPI(gql_client, "stub")), SpeechStub(),
+                                  gql_client, scheduler, coalesce_interval=interval)
+    thread = threading.Thread(target=run_polling, args=(tele_bot, gql_client, scheduler, coalescer),
+                              kwargs={"timeout": 1, "long_polling_timeout": 1})
+    thread.start()
+    completions, stored = len(servers.openai.prompts), len(servers.graphql._messages)
+    results = servers.run(simulate_users(servers.telegram, args, first_chat_id))
+    tele_bot.stop_polling()
+    thread.join()
+    bursts = args.users * args.bursts
+    print("{:<10} completions {:>4}  stored messages {:>4}  replies per burst {:>4.2f}  "
+          "last message answered in p50 {:>6.0f} ms  p90 {:>6.0f} ms".format(
+              name, len(servers.openai.prompts) - completions, len(servers.graphql._messages) - stored,
+              sum(results["replies"]) / bursts, statistics.median(results["latencies"]) * 1000,
+              statistics.quantiles(results["latencies"], n=10)[8] * 1000))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--bursts", type=int, default=3)
+    parser.add_argument("--burst-size", type=int, default=3)
+    parser.add_argument("--interval", type=float, default=1.0, help="coalescing interval in seconds")
+    parser.add_argument("--latency", type=float, default=1.0, help="OpenAI stub chat latency in seconds")
+    args = parser.parse_args()
+
+    servers = StubServers(TelegramStub(0.005), GraphQLStub(0.02), OpenAIStub(args.latency)).start()
+    telebot.logger.setLevel("CRITICAL")
+    apihelper.API_URL = servers.base_url + "/bot{0}/{1}"
+    openai.api_base = servers.base_url + "/v1"
+
+    print("{} users x {} bursts of {} messages ({} s per completion)".format(
+        args.users, args.bursts, args.burst_size, args.latency))
+    run(servers, args, "each", 0, 1000)
+    run(servers, args, "coalesced", args.interval, 2000)
+    servers.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Compare the startup time and per-call overhead of the GraphQL client against the previous
+implementation, which parsed every document and opened a new transport session on each call
+after fetching the schema, using a local GraphQL stub.
+
+Usage: python -m benchmarks.graphql_session_benchmark [--calls 200] [--latency 0]
+"""
+import argparse
+import datetime
+import os
+import tempfile
+import time
+from gql import gql, Client
+from gql.transport.aiohttp import AIOHTTPTransport
+from typing import Callable
+from benchmarks.stubs import GRAPHQL_SCHEMA, GraphQLStub, OpenAIStub, StubServers, TelegramStub
+from src.graph_ql_client import GraphQLClient
+
+
+class LegacyGraphQLClient:
+    """
+    The previous client, kept here as the baseline.
+    """
+
+    def __init__(self, url: str, api_key: str) -> None:
+        transport = AIOHTTPTransport(url=url, headers={'apiKey': api_key})
+        self._client = Client(transport=transport, fetch_schema_from_transport=True)
+
+    def insert_message(self, user_sid: str, role: str, content: str, content_source: str) -> None:
+        insert_query = gql('''
+            mutation ($data: MessageInsertInput!) {
+                insertOneMessage(data: $data) {
+                    _id
+                    user_sid
+                    role
+                    content
+                    content_source
+                    created_at
+                }
+            }
+        ''')
+        variables = {
+            'data': {
+                'user_sid': user_sid,
+                'role': role,
+                'content': content,
+                'content_source': content_source,
+                'created_at': datetime.datetime.utcnow().isoformat()
+            }
+        }
+        self._client.execute(insert_query, variable_values=variables)
+
+    def get_messages(self, user_sid: str) -> None:
+        get_query = gql('''
+            query ($query: MessageQueryInput!) {
+                messages(query: $query, sortBy: CREATED_AT_ASC) {
+                    role
+                    content
+                }
+            }
+        ''')
+        self._client.execute(get_query, variable_values={'query': {'user_sid': user_sid}})
+
+
+def measure(name: str, create_client: Callable, calls: int) -> None:
+    start = time.perf_counter()
+    client = create_client()
+    client.insert_message("warmup", "user", "olá", "text")
+    startup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(calls):
+        client.insert_message("user-{}".format(i), "user", "olá", "text")
+    insert = (time.perf_counter() - start) / calls
+
+    start = time.perf_counter()
+    for i in range(calls):
+        # a different user on every call, so the history cache never answers
+        client.get_messages("reader-{}".format(i))
+    get = (time.perf_counter() - start) / calls
+
+    print("{:<22} startup {:7.1f} ms   insert {:6.2f} ms/call   get {:6.2f} ms/call".format(
+        name, startup * 1000, insert * 1000, get * 1000))
+    if hasattr(client, "close"):
+        client.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.0, help="GraphQL stub latency in seconds")
+    args = parser.parse_args()
+
+    servers = StubServers(TelegramStub(), GraphQLStub(args.latency), OpenAIStub()).start()
+    url = servers.base_url + "/graphql"
+    schema_file = tempfile.NamedTemporaryFile("w", suffix=".graphql", delete=False)
+    schema_file.write(GRAPHQL_SCHEMA)
+    schema_file.close()
+
+    measure("legacy", lambda: LegacyGraphQLClient(url, "stub"), args.calls)
+    measure("pooled, no validation", lambda: GraphQLClient(url, "stub"), args.calls)
+    measure("pooled, local schema", lambda: GraphQLClient(url, "stub", schema_path=schema_file.name), args.calls)
+    measure("pooled, remote schema", lambda: GraphQLClient(url, "stub", fetch_schema=True), args.calls)
+
+    os.remove(schema_file.name)
+    servers.stop()
+
+
+if __name__ == "__main__":
+    main()
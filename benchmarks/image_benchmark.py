@@ -0,0 +1,120 @@
+"""
+Measure /imagem requests for a few popular prompts, as before, with both images generated by a
+single request and sent as a media group once both are ready, and with the image pipeline, which
+requests the images in parallel, sends each one as it is ready, optionally after a cheap preview,
+and sends the images of a repeated prompt again by their Telegram file IDs. Runs the bot against
+local stubs where an image of 1024x1024 takes a fixed delay, and less for smaller sizes.
+
+Usage: python -m benchmarks.image_benchmark [--requests 30] [--prompts 5] [--latency 2]
+"""
+import argparse
+import logging
+import statistics
+import threading
+import time
+import openai
+import telebot
+from telebot import TeleBot, apihelper, types
+from typing import Callable, List, Optional, Tuple
+from app import register_handlers, run_polling
+from benchmarks.stubs import GraphQLStub, OpenAIStub, SpeechStub, StubServers, TelegramStub
+from src.chat_scheduler import ChatScheduler
+from src.graph_ql_client import GraphQLClient
+from src.image_cache import ImageCache
+from src.metrics import report_error
+from src.open_ai_api import OpenAIAPI
+from src.telegram_bot import TelegramBot
+
+
+class LegacyTelegramBot(TelegramBot):
+    """
+    The previous image generation, kept here as the baseline.
+    """
+
+    def generate_images(self, message: types.Message) -> None:
+        try:
+            try:
+                images = openai.Image.create(prompt=str(message.text), n=2, size="1024x1024")['data']
+            except Exception as e:
+                logging.error("Error generating images: {}".format(str(e)))
+                self._bot.reply_to(message, "Desculpe, não foi possível gerar as imagens agora.")
+                return
+            self._bot.send_media_group(message.chat.id, [types.InputMediaPhoto(image["url"]) for image in images])
+        except Exception as e:
+            report_error("generate_images", e)
+
+
+async def request_images(telegram: TelegramStub, requests: int, prompts: int,
+                         expected: Callable[[bool], int]) -> List[Tuple[bool, float, float]]:
+    latencies = []
+    seen = set()
+    for i in range(requests):
+        prompt = i % prompts
+        start = time.perf_counter()
+        message_id = telegram.push_message(4000, "/imagem um gato número {} pintado a óleo".format(prompt))
+        new = prompt not in seen
+        # waits for the number of photos or media groups sent for the request
+        replies = await telegram.wait_reply(message_id, lambda sent, count=expected(new): len(sent) >= count)
+        seen.add(prompt)
+        latencies.append((new, replies[0][0] - start, replies[-1][0] - start))
+    return latencies
+
+
+def run(servers: StubServers, args: argparse.Namespace, name: str, legacy: bool = False,
+        image_cache: Optional[ImageCache] = None, preview_size: Optional[str] = None) -> None:
+    gql_client = GraphQLClient(servers.base_url + "/graphql", "stub")
+    tele_bot = TeleBot("123:stub", parse_mode=None, threaded=False)
+    image_sets = [("1024x1024", 2)] if preview_size is None else [(preview_size, 1), ("1024x1024", 2)]
+    bot_class = LegacyTelegramBot if legacy else TelegramBot
+    telegram_bot = bot_class(tele_bot, OpenAIAPI(gql_client, "stub"), image_cache=image_cache, image_sets=image_sets)
+    scheduler = ChatScheduler({"text": 1, "voice": 1, "image": 1, "audio": 1})
+    register_handlers(tele_bot, telegram_bot, SpeechStub(), gql_client, scheduler)
+    thread = threading.Thread(target=run_polling, args=(tele_bot, gql_client, scheduler),
+                              kwargs={"timeout": 1, "long_polling_timeout": 1})
+    thread.start()
+
+    def expected(first_time: bool) -> int:
+        if legacy or (image_cache is not None and not first_time):
+            return 1
+        return sum(count for _, count in image_sets)
+
+    generated = servers.openai.requests
+    start = time.perf_counter()
+    latencies = servers.run(request_images(servers.telegram, args.requests, args.prompts, expected))
+    elapsed = time.perf_counter() - start
+    first = [first for new, first, _ in latencies if new]
+    last = [last for new, _, last in latencies if new]
+    repeated = [last for new, _, last in latencies if not new]
+    print("{:<16} {:>5.2f} req/s   new prompt: first image {:>6.0f} ms, all {:>6.0f} ms   repeated prompt: all {:>6.0f} ms"
+          "   {} requests to OpenAI".format(name, len(latencies) / elapsed, statistics.median(first) * 1000,
+                                            statistics.median(last) * 1000, statistics.median(repeated) * 1000,
+                                            servers.openai.requests - generated))
+    tele_bot.stop_polling()
+    thread.join()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=30)
+    parser.add_argument("--prompts", type=int, default=5, help="number of distinct prompts requested")
+    parser.add_argument("--latency", type=float, default=2.0, help="seconds per image of 1024x1024")
+    args = parser.parse_args()
+
+    servers = StubServers(TelegramStub(0.005), GraphQLStub(), OpenAIStub(image_latency=args.latency)).start()
+    telebot.logger.setLevel("CRITICAL")
+    apihelper.API_URL = servers.base_url + "/bot{0}/{1}"
+    openai.api_base = servers.base_url + "/v1"
+
+    print("{} /imagem requests for {} prompts, {} s per image".format(args.requests, args.prompts, args.latency))
+    run(servers, args, "before", legacy=True)
+    run(servers, args, "parallel")
+    run(servers, args, "parallel, cached", image_cache=ImageCache())
+    run(servers, args, "with a preview", image_cache=ImageCache(), preview_size="256x256")
+    with_command = sum(1 for prompt, _ in servers.openai.image_prompts if prompt.startswith("/imagem"))
+    print("{} of {} prompts sent to OpenAI with the command, all from the baseline".format(
+        with_command, len(servers.openai.image_prompts)))
+    servers.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Measure the conversation memory on long histories stored in SQLite: building its index from the stored
+messages and adding messages one at a time as the bot does, reopening it after a restart, and recalling
+the turns relevant to a question. Then ask about facts told early in each history and compare the prompt
+tokens and the facts found in the prompts with the conversation window only, with the window and the
+recalled turns, and with a window long enough to reach back to each fact.
+
+Usage: python -m benchmarks.memory_benchmark [--histories 10000,20000] [--facts 20] [--words 12]
+"""
+import argparse
+import datetime
+import os
+import random
+import statistics
+import tempfile
+import time
+from typing import Dict, List, Tuple
+from src.conversation_memory import ConversationMemory
+from src.message_store import new_message
+from src.open_ai_api import OpenAIAPI
+from src.sqlite_message_store import SQLiteMessageStore
+from src.token_ledger import TokenLedger
+
+WORDS = "casa viagem receita futebol livro música trabalho escola cidade praia filme jogo código projeto " \
+        "banco conta saúde corrida jantar presente aniversário férias carro ônibus chuva sol café bolo".split()
+THINGS = "cachorro gato chefe vizinho professor dentista sobrinho afilhado papagaio cavalo peixe tartaruga " \
+         "coelho médico barbeiro personal padrinho hamster treinador advogado".split()
+NAMES = "Bolinha Tobias Marcela Rogério Juventino Zuleica Pipoca Teodoro Iracema Florisbela Gumercindo " \
+        "Clotilde Anacleto Berenice Epaminondas Filomena Heráclito Jurema Leopoldina Nestor".split()
+
+
+def history(user_sid: str, count: int, facts: int, words: int,
+            generator: random.Random) -> Tuple[List[Dict[str, str]], List[Tuple[int, str, str]]]:
+    start = datetime.datetime(2023, 1, 1)
+    # the facts are told in the first half of the history, long before the window
+    positions = sorted(generator.sample(range(0, count // 2, 2), facts))
+    told = {position: (THINGS[i], NAMES[i]) for i, position in enumerate(positions)}
+    messages = []
+    for i in range(count):
+        if i in told:
+            thing, name = told[i]
+            content = "Anota aí: o nome do meu {} é {}.".format(thing, name)
+        elif i - 1 in told:
+            thing, name = told[i - 1]
+            content = "Anotado! Seu {} se chama {}.".format(thing, name)
+        else:
+            content = " ".join(generator.choice(WORDS) for _ in range(words))
+            if generator.random() < 0.05:
+                # the things come up again without their names, so not every mention is the fact
+                content = "Meu {} e {}".format(generator.choice(THINGS), content)
+        messages.append(new_message(user_sid, "user" if i % 2 == 0 else "assistant", content, "text",
+                                    (start + datetime.timedelta(minutes=i)).isoformat()))
+    return messages, [(position, thing, name) for position, (thing, name) in told.items()]
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    return sorted(values)[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def prompt_tokens(ledger: TokenLedger, prompt: List[Dict[str, str]]) -> int:
+    return sum(ledger.count_message_tokens(message) for message in prompt)
+
+
+def run(count: int, args: argparse.Namespace, directory: str) -> None:
+    user_sid = str(count)
+    messages, facts = history(user_sid, count, args.facts, args.words, random.Random(count))
+    store = SQLiteMessageStore(os.path.join(directory, "gepeto.db"), cache_size=0)
+    for i in range(0, len(messages), 500):
+        store.insert_messages(messages[i:i + 500])
+
+    memory_directory = os.path.join(directory, "memory")
+    memory = ConversationMemory(memory_directory)
+    started = time.perf_counter()
+    memory.index_messages(store)
+    build = time.perf_counter() - started
+    memory.close()
+    files = os.path.join(memory_directory, user_sid)
+    size = sum(os.path.getsize(os.path.join(files, name)) for name in os.listdir(files))
+
+    live = ConversationMemory(os.path.join(directory, "live"))
+    started = time.perf_counter()
+    for message in messages:
+        live.add(user_sid, message)
+    live.flush()
+    adds = time.perf_counter() - started
+    live.close()
+
+    # a restart only reads the dates of the messages and maps the vectors
+    memory = ConversationMemory(memory_directory)
+    started = time.perf_counter()
+    memory.recall(user_sid, "primeira pergunta", "9999")
+    reopen = time.perf_counter() - started
+    questions = ["Qual é o nome do meu {}?".format(thing) for _, thing, _ in facts]
+    times = []
+    for question in questions * 5:
+        started = time.perf_counter()
+        memory.recall(user_sid, question, messages[-100]["created_at"])
+        times.append(time.perf_counter() - started)
+    print("{:6} messages   build {:5.2f} s ({:6.0f} messages/s)   one at a time {:5.2f} s   {:5.1f} MB on disk   "
+          "reopen {:5.1f} ms   recall p50 {:5.2f} ms  p99 {:5.2f} ms".format(
+              count, build, count / build, adds, size / 1024 / 1024, reopen * 1000,
+              statistics.median(times) * 1000, percentile(times, 0.99) * 1000))
+
+    ledger = TokenLedger()
+    counts = [ledger.count_message_tokens(message) for message in messages]
+    for name, openai_api in (("window", OpenAIAPI(store, "stub", summary_every=0)),
+                             ("recall", OpenAIAPI(store, "stub", summary_every=0, memory=memory))):
+        tokens, found = [], 0
+        for question, (position, _, fact_name) in zip(questions, facts):
+            prompt = openai_api._insert_initial_data(user_sid, question, "text")
+            tokens.append(prompt_tokens(ledger, prompt))
+            found += any(fact_name in message["content"] for message in prompt)
+        print("  {:<8} mean prompt {:5.0f} tokens   facts found {:3}/{}".format(
+            name, statistics.mean(tokens), found, len(facts)))
+    # sending the whole conversation since each fact, as a longer window would
+    reach = [sum(counts[position:]) for position, _, _ in facts]
+    print("  {:<8} mean prompt {:7.0f} tokens   facts found {:3}/{}".format(
+        "since", statistics.mean(reach), len(facts), len(facts)))
+    memory.close()
+    store.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--histories", default="10000,20000", help="numbers of messages in each history")
+    parser.add_argument("--facts", type=int, default=20, help="facts told in each history, at most 20")
+    parser.add_argument("--words", type=int, default=12, help="words per message")
+    args = parser.parse_args()
+
+    for count in (int(count) for count in args.histories.split(",")):
+        with tempfile.TemporaryDirectory() as directory:
+            run(count, args, directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Measure how many text messages get an answer when the users send more requests than the OpenAI
+quota allows, without retries, as before, and with the adaptive rate limiter and retries.
+
+Usage: python -m benchmarks.rate_limit_benchmark [--users 20] [--messages 5] [--quota 300]
+"""
+import argparse
+import asyncio
+import statistics
+import threading
+import time
+import openai
+import telebot
+from telebot import TeleBot, apihelper
+from typing import List, Optional, Tuple
+from app import register_handlers, run_polling
+from benchmarks.stubs import GraphQLStub, OpenAIStub, SpeechStub, StubServers, TelegramStub
+from src.chat_scheduler import ChatScheduler
+from src.graph_ql_client import GraphQLClient
+from src.open_ai_api import OpenAIAPI
+from src.rate_limiter import RateLimiter
+from src.telegram_bot import TelegramBot
+
+
+class UnlimitedRateLimiter(RateLimiter):
+    """
+    Never delays a request, like the bot did before it had a rate limiter.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(float("inf"))
+
+    def reserve(self, tokens: int = 0) -> float:
+        return 0.0
+
+    def update(self, headers) -> None:
+        pass
+
+
+async def simulate_users(telegram: TelegramStub, args: argparse.Namespace,
+                         first_chat_id: int) -> List[Tuple[bool, float]]:
+    results = []
+
+    async def user(chat_id: int) -> None:
+        for i in range(args.messages):
+            start = time.perf_counter()
+            message_id = telegram.push_message(chat_id, "mensagem {}".format(i))
+            replies = await telegram.wait_reply(message_id, timeout=300)
+            results.append((replies[0][2].startswith("Resposta para"), time.perf_counter() - start))
+
+    await asyncio.gather(*(user(first_chat_id + i) for i in range(args.users)))
+    return results
+
+
+def run(servers: StubServers, args: argparse.Namespace, name: str, chat_limiter: Optional[RateLimiter],
+        max_retries: int, first_chat_id: int) -> None:
+    gql_client = GraphQLClient(servers.base_url + "/graphql", "stub")
+    openai_api = OpenAIAPI(gql_client, "stub", chat_limiter=chat_limiter, max_retries=max_retries)
+    tele_bot = TeleBot("123:stub", parse_mode=None, threaded=False)
+    scheduler = ChatScheduler({"text": args.users, "voice": 1, "image": 1, "audio": 1})
+    register_handlers(tele_bot, TelegramBot(tele_bot, openai_api), SpeechStub(), gql_client, scheduler)
+    thread = threading.Thread(target=run_polling, args=(tele_bot, gql_client, scheduler),
+                              kwargs={"timeout": 1, "long_polling_timeout": 1})
+    thread.start()
+    requests, rejected = servers.openai.requests, servers.openai.rejected
+    start = time.perf_counter()
+    results = servers.run(simulate_users(servers.telegram, args, first_chat_id))
+    elapsed = time.perf_counter() - start
+    answered = [latency for ok, latency in results if ok]
+    print("{:<9} answered {:>3}/{}  {:>5.1f} answers/s ({:.1f} allowed)  p50 {:>6.0f} ms  "
+          "requests {:>4}  refused {:>4}".format(
+              name, len(answered), len(results), len(answered) / elapsed, args.quota / 60,
+              statistics.median(answered) * 1000 if answered else 0,
+              servers.openai.requests - requests, servers.openai.rejected - rejected))
+    tele_bot.stop_polling()
+    thread.join()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=5)
+    parser.add_argument("--quota", type=float, default=300, help="OpenAI stub requests per minute")
+    parser.add_argument("--latency", type=float, default=0.2, help="OpenAI stub chat latency in seconds")
+    args = parser.parse_args()
+
+    servers = StubServers(TelegramStub(0.005), GraphQLStub(0.005),
+                          OpenAIStub(args.latency, requests_per_minute=args.quota)).start()
+    telebot.logger.setLevel("CRITICAL")
+    apihelper.API_URL = servers.base_url + "/bot{0}/{1}"
+    openai.api_base = servers.base_url + "/v1"
+
+    print("{} users x {} text messages against a quota of {:.0f} requests per minute".format(
+        args.users, args.messages, args.quota))
+    run(servers, args, "no retry", UnlimitedRateLimiter(), 0, 1000)
+    # the quota is refilled between the runs
+    servers.openai.reset_quota()
+    # the limiter starts from the default limits and learns the quota from the headers
+    run(servers, args, "adaptive", None, 5, 2000)
+    servers.stop()
+
+
+if __name__ == "__main__":
+    main()
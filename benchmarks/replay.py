@@ -0,0 +1,332 @@
+"""
+Replay a stream of Telegram updates, recorded or synthetic, through the handlers of app.py
+against local stubs of Telegram, MongoDB Atlas, OpenAI and Azure Speech, and report the
+throughput, the latency percentiles of each command and the CPU and memory used per request.
+
+The bot runs in its own process, created with the same functions as in production, so its CPU
+time and memory are measured apart from the stubs. The chats are replayed in parallel, each one
+sending its messages at their recorded times, but never before the previous one is answered.
+
+A trace is a JSON Lines file with an event per line, as saved with --save:
+
+    {"at": 1.5, "chat_id": 1000, "kind": "text", "text": "Olá"}
+
+where kind is text, voice (with the duration in "seconds"), imagem, audio (with the text of the
+message it answers) or limpar. Lines with the updates returned by getUpdates are read as well.
+Needs ffmpeg on the PATH for voice messages.
+
+Usage: python -m benchmarks.replay [--trace FILE | --users 20 --requests 10] [--mode polling]
+    [--set SECTION.KEY=VALUE ...] [--save FILE] [--output FILE]
+"""
+import argparse
+import asyncio
+import configparser
+import json
+import multiprocessing
+import random
+import sys
+import threading
+import time
+import telebot
+from typing import Any, Dict, List, Optional, Tuple
+from benchmarks.audio_pipeline_benchmark import voice_message
+from benchmarks.stubs import GraphQLStub, OpenAIStub, SpeechStub, StubServers, TelegramStub, use_stubs
+
+KINDS = ("text", "voice", "imagem", "audio", "limpar")
+
+# the first words of the replies sent when a handler fails or the bot is busy
+ERROR_REPLY = "Desculpe, ocorreu um erro"
+BUSY_REPLY = "Estou recebendo muitas mensagens agora"
+
+
+def synthetic_trace(users: int, requests: int, mix: Dict[str, float], think_time: float,
+                    seed: int = 0) -> List[Dict[str, Any]]:
+    """
+    Generate the requests of users that send them after a random think time.
+
+    Args:
+        users: The number of users, each one in its own chat.
+        requests: The number of requests sent by each user.
+        mix: The relative frequency of each kind of request.
+        think_time: The mean time in seconds between two requests of a user.
+        seed: The seed of the random choices.
+
+    Returns:
+        The events, in the order they are sent.
+    """
+    generator = random.Random(seed)
+    kinds = list(mix)
+    events = []
+    for user in range(users):
+        chat_id = 1000 + user
+        at = generator.uniform(0, think_time)
+        for i in range(requests):
+            kind = generator.choices(kinds, [mix[kind] for kind in kinds])[0]
+            event = {"at": round(at, 3), "chat_id": chat_id, "kind": kind}
+            if kind == "text":
+                event["text"] = "Mensagem {} do usuário {}, com uma pergunta qualquer?".format(i, user)
+            elif kind == "voice":
+                # a few durations, so the audio is encoded only once for each
+                event["seconds"] = generator.choice((3, 8, 15))
+            elif kind == "imagem":
+                event["text"] = "/imagem um gato {} pintado a óleo".format(i)
+            elif kind == "audio":
+                event["text"] = "Resposta para a mensagem {} do usuário {}.".format(i, user)
+            else:
+                event["text"] = "/limpar"
+            events.append(event)
+            at += generator.expovariate(1 / think_time)
+    return sorted(events, key=lambda event: event["at"])
+
+
+def event_from_update(update: Dict[str, Any], first_date: int) -> Optional[Dict[str, Any]]:
+    """
+    Read the event of an update returned by getUpdates.
+
+    Returns:
+        The event, or None for updates other than messages.
+    """
+    message = update.get("message")
+    if message is None:
+        return None
+    event = {"at": message["date"] - first_date, "chat_id": message["chat"]["id"]}
+    text = message.get("text") or ""
+    if "voice" in message:
+        event.update(kind="voice", seconds=message["voice"].get("duration", 5))
+    elif text.startswith("/imagem"):
+        event.update(kind="imagem", text=text)
+    elif text.startswith("/audio"):
+        event.update(kind="audio", text=(message.get("reply_to_message") or {}).get("text", ""))
+    elif text.startswith("/limpar"):
+        event.update(kind="limpar", text=text)
+    else:
+        event.update(kind="text", text=text)
+    return event
+
+
+def load_trace(path: str) -> List[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as file:
+        lines = [json.loads(line) for line in file if line.strip() != ""]
+    dates = [line["message"]["date"] for line in lines if "message" in line]
+    first_date = min(dates) if dates else 0
+    events = [line if "kind" in line else event_from_update(line, first_date) for line in lines]
+    return sorted((event for event in events if event is not None), key=lambda event: event["at"])
+
+
+def save_trace(path: str, events: List[Dict[str, Any]]) -> None:
+    with open(path, "w", encoding="utf-8") as file:
+        for event in events:
+            file.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+
+def push_event(telegram: TelegramStub, event: Dict[str, Any]) -> int:
+    chat_id = event["chat_id"]
+    if event["kind"] == "voice":
+        file_id = "voice-{}s".format(event["seconds"])
+        voice = {"file_id": file_id, "file_unique_id": file_id, "duration": event["seconds"],
+                 "mime_type": "audio/ogg"}
+        return telegram.push_message(chat_id, voice=voice)
+    if event["kind"] == "audio":
+        answered = {"message_id": 0, "from": {"id": 1, "is_bot": True, "first_name": "Gepeto"},
+                    "chat": {"id": chat_id, "type": "private"}, "date": int(time.time()), "text": event["text"]}
+        return telegram.push_message(chat_id, "/audio", reply_to_message=answered)
+    return telegram.push_message(chat_id, event["text"])
+
+
+async def replay(telegram: TelegramStub, events: List[Dict[str, Any]], speed: float,
+                 timeout: float) -> Tuple[float, List[Dict[str, Any]]]:
+    """
+    Send the events to the bot and wait for the replies. Must run in the stub loop.
+
+    Returns:
+        The time taken and the result of each request: its kind, its latency in seconds and its outcome.
+    """
+    chats: Dict[int, List[Dict[str, Any]]] = {}
+    for event in events:
+        chats.setdefault(event["chat_id"], []).append(event)
+    results = []
+    start = time.perf_counter()
+
+    async def chat(chat_events: List[Dict[str, Any]]) -> None:
+        for event in chat_events:
+            await asyncio.sleep(max(0.0, start + event["at"] / speed - time.perf_counter()))
+            sent = time.perf_counter()
+            try:
+                replies = await telegram.wait_reply(push_event(telegram, event), timeout=timeout)
+            except asyncio.TimeoutError:
+                results.append({"kind": event["kind"], "latency": None, "outcome": "timeout"})
+                continue
+            reply_time, _, text = replies[0]
+            outcome = "error" if text.startswith(ERROR_REPLY) else "busy" if text.startswith(BUSY_REPLY) else "ok"
+            results.append({"kind": event["kind"], "latency": reply_time - sent, "outcome": outcome})
+
+    await asyncio.gather(*(chat(chat_events) for chat_events in chats.values()))
+    return time.perf_counter() - start, results
+
+
+def _max_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    # in kilobytes on Linux, in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_bot(config: Dict[str, Dict[str, str]], base_url: str, speech_latency: float,
+            stop: multiprocessing.Event, usage: multiprocessing.Queue) -> None:
+    """
+    Run the bot against the stubs until stop is set, and put the CPU time and memory it used on usage.
+    Runs in its own process, so the stubs are not measured.
+    """
+    import app
+
+    telebot.logger.setLevel("CRITICAL")
+    use_stubs(base_url)
+    # Azure Speech has no local endpoint, so its client is replaced by a stand-in
+    app.AzureSpeechRecognizer = lambda *args, **kwargs: SpeechStub(speech_latency)
+    cfg = configparser.ConfigParser()
+    cfg.read_dict(config)
+    app.configure_logging(cfg)
+
+    if cfg.get("BOT", "MODE", fallback="polling") == "async":
+        loop = asyncio.new_event_loop()
+        polling = loop.create_task(app.run_async_polling(*app.create_async_bot(cfg), timeout=1))
+        thread = threading.Thread(target=loop.run_until_complete, args=(polling,))
+        stop_polling = lambda: loop.call_soon_threadsafe(polling.cancel)
+    else:
+        tele_bot, gql_client, scheduler, coalescer = app.create_bot(cfg)
+        thread = threading.Thread(target=app.run_polling, args=(tele_bot, gql_client, scheduler, coalescer),
+                                  kwargs={"timeout": 1, "long_polling_timeout": 1})
+        stop_polling = tele_bot.stop_polling
+    thread.start()
+
+    cpu, rss = time.process_time(), _max_rss_mb()
+    usage.put(None)
+    stop.wait()
+    usage.put({"cpu_seconds": time.process_time() - cpu, "start_rss_mb": rss, "max_rss_mb": _max_rss_mb()})
+    stop_polling()
+    thread.join()
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))]
+
+
+def summarize(elapsed: float, results: List[Dict[str, Any]], usage: Dict[str, float]) -> Dict[str, Any]:
+    answered = [result for result in results if result["outcome"] != "timeout"]
+    summary = {
+        "requests": len(results),
+        "elapsed_seconds": elapsed,
+        "throughput": len(answered) / elapsed,
+        "cpu_ms_per_request": usage["cpu_seconds"] * 1000 / max(len(results), 1),
+        "max_rss_mb": usage["max_rss_mb"],
+        "rss_growth_kb_per_request": (usage["max_rss_mb"] - usage["start_rss_mb"]) * 1024 / max(len(results), 1),
+        "commands": {},
+    }
+    for kind in KINDS:
+        kind_results = [result for result in results if result["kind"] == kind]
+        if len(kind_results) == 0:
+            continue
+        latencies = [result["latency"] * 1000 for result in kind_results if result["latency"] is not None]
+        outcomes = [result["outcome"] for result in kind_results]
+        summary["commands"][kind] = dict(
+            count=len(kind_results), errors=outcomes.count("error"), busy=outcomes.count("busy"),
+            timeouts=outcomes.count("timeout"),
+            **{name: percentile(latencies, q) if latencies else None
+               for name, q in (("p50_ms", 50), ("p90_ms", 90), ("p99_ms", 99), ("max_ms", 100))})
+    return summary
+
+
+def report(summary: Dict[str, Any]) -> None:
+    print("{} requests in {:.1f} s  {:.1f} requests/s  CPU {:.1f} ms/request  max RSS {:.1f} MB "
+          "(+{:.1f} KB/request)".format(summary["requests"], summary["elapsed_seconds"], summary["throughput"],
+                                        summary["cpu_ms_per_request"], summary["max_rss_mb"],
+                                        summary["rss_growth_kb_per_request"]))
+    print("{:<8} {:>6} {:>9} {:>9} {:>9} {:>9} {:>7} {:>5} {:>9}".format(
+        "command", "count", "p50 ms", "p90 ms", "p99 ms", "max ms", "errors", "busy", "timeouts"))
+    for kind, stats in summary["commands"].items():
+        latencies = ["{:>9.0f}".format(stats[name]) if stats[name] is not None else "{:>9}".format("-")
+                     for name in ("p50_ms", "p90_ms", "p99_ms", "max_ms")]
+        print("{:<8} {:>6} {} {:>7} {:>5} {:>9}".format(kind, stats["count"], " ".join(latencies), stats["errors"],
+                                                        stats["busy"], stats["timeouts"]))
+
+
+def bot_config(servers: StubServers, args: argparse.Namespace) -> Dict[str, Dict[str, str]]:
+    config = {
+        "CHAT_GPT": {"API_KEY": "stub"},
+        "TELEGRAM": {"TOKEN": "123:stub"},
+        "MONGO": {"API_URL": servers.base_url + "/graphql", "API_KEY": "stub"},
+        "AZURE": {"SPEECH_KEY": "stub", "SPEECH_REGION": "stub"},
+        # every message is answered on its own, so the latency of each one is measured
+        "BOT": {"MODE": args.mode, "COALESCE_INTERVAL": "0", "LOG_LEVEL": "CRITICAL"},
+    }
+    for setting in args.set:
+        key, value = setting.split("=", 1)
+        section, option = key.split(".", 1)
+        config.setdefault(section.upper(), {})[option.upper()] = value
+    return config
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trace", help="JSON Lines file with the events or updates to replay")
+    parser.add_argument("--users", type=int, default=20, help="users of the synthetic trace")
+    parser.add_argument("--requests", type=int, default=10, help="requests of each user of the synthetic trace")
+    parser.add_argument("--mix", default="text=70,voice=10,imagem=5,audio=10,limpar=5",
+                        help="relative frequency of each kind of request in the synthetic trace")
+    parser.add_argument("--think-time", type=float, default=2.0, help="mean seconds between requests of a user")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="save the trace replayed to this file")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay the trace this many times faster")
+    parser.add_argument("--mode", choices=("polling", "async"), default="polling")
+    parser.add_argument("--set", action="append", default=[], metavar="SECTION.KEY=VALUE",
+                        help="a setting of the bot, such as CHAT_GPT.STREAM=true")
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--graphql-latency", type=float, default=0.03)
+    parser.add_argument("--openai-latency", type=float, default=0.5, help="seconds per chat completion")
+    parser.add_argument("--image-latency", type=float, default=3.0, help="seconds per image generation")
+    parser.add_argument("--speech-latency", type=float, default=0.3, help="seconds per recognition or synthesis")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for each reply")
+    parser.add_argument("--output", help="write the results as JSON to this file, to compare runs")
+    args = parser.parse_args()
+
+    if args.trace is not None:
+        events = load_trace(args.trace)
+    else:
+        mix = {kind: float(weight) for kind, weight in (item.split("=") for item in args.mix.split(","))}
+        events = synthetic_trace(args.users, args.requests, mix, args.think_time, args.seed)
+    if args.save is not None:
+        save_trace(args.save, events)
+
+    servers = StubServers(TelegramStub(args.telegram_latency), GraphQLStub(args.graphql_latency),
+                          OpenAIStub(args.openai_latency, image_latency=args.image_latency)).start()
+    for seconds in sorted({event["seconds"] for event in events if event["kind"] == "voice"}):
+        servers.telegram.add_file("voice-{}s".format(seconds), voice_message(seconds))
+
+    context = multiprocessing.get_context("spawn")
+    stop, usage = context.Event(), context.Queue()
+    bot = context.Process(target=run_bot, args=(bot_config(servers, args), servers.base_url, args.speech_latency,
+                                                stop, usage))
+    bot.start()
+    # the bot is measured once it is up
+    usage.get()
+
+    print("{} requests from {} chats, {} bot".format(len(events), len({event["chat_id"] for event in events}),
+                                                    args.mode))
+    elapsed, results = servers.run(replay(servers.telegram, events, args.speed, args.timeout))
+    stop.set()
+    summary = summarize(elapsed, results, usage.get())
+    bot.join()
+    servers.stop()
+
+    report(summary)
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(summary, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Measure /limpar on long histories, as before, deleting the messages while the user waits and
+holding up the next messages of the chat, and with the deletion in the background, through the
+bot against local stubs where MongoDB Atlas takes longer to delete more messages. Then measure a
+retention pass over a year of messages in MongoDB Atlas, through a local GraphQL stub, and in
+SQLite: the messages left in the store, the size of the archive and the reads of the newest messages.
+
+Usage: python -m benchmarks.retention_benchmark [--histories 1000,10000] [--users 50] [--days 400]
+"""
+import argparse
+import base64
+import datetime
+import json
+import os
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+import openai
+import telebot
+from telebot import TeleBot, apihelper, types
+from typing import Callable, Dict, List
+from app import register_handlers, run_polling
+from benchmarks.stubs import GraphQLStub, OpenAIStub, SpeechStub, StubServers, TelegramStub
+from src.chat_scheduler import ChatScheduler
+from src.conversation_summary import summary_sid
+from src.graph_ql_client import GraphQLClient
+from src.message_store import MessageStore, new_message
+from src.metrics import report_error
+from src.open_ai_api import OpenAIAPI
+from src.retention import RetentionJob
+from src.sqlite_message_store import SQLiteMessageStore
+from src.telegram_bot import TelegramBot
+
+CHAT_ID = 5000
+
+
+class LegacyTelegramBot(TelegramBot):
+    """
+    The previous deletion, kept here as the baseline.
+    """
+
+    def delete_user_messages(self, message: types.Message, client: MessageStore) -> None:
+        try:
+            response = client.delete_user_messages(str(message.chat.id))
+            self._openai_api.forget_user(str(message.chat.id))
+            client.delete_user_messages(summary_sid(str(message.chat.id)))
+            self._bot.reply_to(message, self._deletion_reply(response))
+        except Exception as e:
+            report_error("delete_user_messages", e)
+            self._bot.reply_to(message, "Desculpe, ocorreu um erro ao deletar as mensagens.")
+
+
+def old_messages(user_sid: str, count: int, start: datetime.datetime,
+                 step: datetime.timedelta) -> List[Dict[str, str]]:
+    return [new_message(user_sid, "user" if i % 2 == 0 else "assistant",
+                        "Mensagem antiga {} sobre um assunto qualquer".format(i), "text",
+                        (start + step * i).isoformat()) for i in range(count)]
+
+
+def clear_history(servers: StubServers, history: int, name: str, legacy: bool) -> None:
+    gql_client = GraphQLClient(servers.base_url + "/graphql", "stub")
+    messages = old_messages(str(CHAT_ID), history, datetime.datetime(2023, 1, 1), datetime.timedelta(minutes=1))
+    for i in range(0, len(messages), 500):
+        gql_client.insert_messages(messages[i:i + 500])
+    tele_bot = TeleBot("123:stub", parse_mode=None, threaded=False)
+    bot_class = LegacyTelegramBot if legacy else TelegramBot
+    telegram_bot = bot_class(tele_bot, OpenAIAPI(gql_client, "stub"))
+    scheduler = ChatScheduler({"text": 2, "voice": 1, "image": 1, "audio": 1})
+    register_handlers(tele_bot, telegram_bot, SpeechStub(), gql_client, scheduler)
+    thread = threading.Thread(target=run_polling, args=(tele_bot, gql_client, scheduler),
+                              kwargs={"timeout": 1, "long_polling_timeout": 1})
+    thread.start()
+
+    async def clear_and_talk() -> List[float]:
+        telegram = servers.telegram
+        start = time.perf_counter()
+        clear_id = telegram.push_message(CHAT_ID, "/limpar")
+        question_id = telegram.push_message(CHAT_ID, "Do que falamos antes?")
+        answer = await telegram.wait_reply(question_id)
+        replies = await telegram.wait_reply(clear_id, lambda sent: len(sent) >= (1 if legacy else 2))
+        return [replies[0][0] - start, replies[-1][0] - start, answer[0][0] - start]
+
+    first, done, answered = servers.run(clear_and_talk())
+    leaked = any("Mensagem antiga" in message["content"] for message in servers.openai.prompts[-1])
+    print("{:<10} {:6} messages   first reply {:6.0f} ms   deleted after {:6.0f} ms   next message answered "
+          "after {:6.0f} ms{}".format(name, history, first * 1000, done * 1000, answered * 1000,
+                                      "   OLD MESSAGES IN THE PROMPT" if leaked else ""))
+    tele_bot.stop_polling()
+    thread.join()
+
+
+def timed_reads(store: MessageStore, users: int) -> float:
+    times = []
+    for user in range(users):
+        start = time.perf_counter()
+        store.get_messages(str(user), limit=50)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def archived_size(batches: List[Dict[str, str]]) -> int:
+    return sum(len(base64.b64decode(batch['data'])) for batch in batches)
+
+
+def retention_pass(name: str, store: MessageStore, count: Callable[[], int], archive_size: Callable[[], int],
+                   args: argparse.Namespace) -> None:
+    start = datetime.datetime.utcnow() - datetime.timedelta(days=args.days)
+    step = datetime.timedelta(days=1) / args.messages_per_day
+    raw_bytes = 0
+    for user in range(args.users):
+        messages = old_messages(str(user), args.days * args.messages_per_day, start, step)
+        raw_bytes += len(json.dumps(messages, ensure_ascii=False).encode())
+        for i in range(0, len(messages), 500):
+            store.insert_messages(messages[i:i + 500])
+        # every user wrote since the last run, so their histories are trimmed too
+        store.queue_message(str(user), "user", "Mensagem nova", "text")
+    store.flush()
+    before = count()
+    read_before = timed_reads(store, args.users)
+
+    job = RetentionJob(store, max_age_days=args.max_age, keep_latest=args.keep)
+    started = time.perf_counter()
+    archived = job.run_once()
+    elapsed = time.perf_counter() - started
+    print("{:<7} {:6} messages -> {:5} left, {:6} archived in {:5.1f} s ({:4.0f} messages/s)   archive {:5.0f} KB "
+          "for {:5.0f} KB of JSON   tail read {:6.2f} ms -> {:6.2f} ms".format(
+              name, before, count(), archived, elapsed, archived / elapsed, archive_size() / 1024, raw_bytes / 1024,
+              read_before * 1000, timed_reads(store, args.users) * 1000))
+    store.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--histories", default="1000,10000", help="numbers of messages in the history cleared")
+    parser.add_argument("--delete-latency", type=float, default=0.0002,
+                        help="seconds Atlas takes per message deleted")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--days", type=int, default=400, help="days of messages of each user")
+    parser.add_argument("--messages-per-day", type=int, default=1)
+    parser.add_argument("--max-age", type=float, default=90, help="days after which the messages are archived")
+    parser.add_argument("--keep", type=int, default=60, help="newest messages kept for each user")
+    args = parser.parse_args()
+
+    servers = StubServers(TelegramStub(0.005), GraphQLStub(0.02, args.delete_latency), OpenAIStub(0.2)).start()
+    telebot.logger.setLevel("CRITICAL")
+    apihelper.API_URL = servers.base_url + "/bot{0}/{1}"
+    openai.api_base = servers.base_url + "/v1"
+
+    print("/limpar followed by a question, Atlas deleting {:.1f} ms per message".format(args.delete_latency * 1000))
+    for history in (int(history) for history in args.histories.split(",")):
+        clear_history(servers, history, "before", legacy=True)
+        clear_history(servers, history, "background", legacy=False)
+
+    print("retention of {} users x {} days, archiving after {} days or past the newest {} messages".format(
+        args.users, args.days, args.max_age, args.keep))
+    servers.graphql.delete_latency = 0
+    atlas = GraphQLClient(servers.base_url + "/graphql", "stub", cache_size=0)
+    retention_pass("atlas", atlas, lambda: servers.graphql.message_count,
+                   lambda: archived_size(servers.graphql.archives), args)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "gepeto.db")
+
+        def sqlite_archive_size() -> int:
+            with sqlite3.connect(path) as connection:
+                return archived_size([{'data': data} for data, in connection.execute("SELECT data FROM message_archives")])
+
+        def sqlite_count() -> int:
+            with sqlite3.connect(path) as connection:
+                return connection.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+        retention_pass("sqlite", SQLiteMessageStore(path, cache_size=0), sqlite_count, sqlite_archive_size, args)
+    servers.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Measure the latency of text messages while other users generate images, with the handlers run
+directly by telebot's two worker threads, as before, and through the chat scheduler.
+
+Usage: python -m benchmarks.scheduler_benchmark [--users 10] [--messages 5] [--image-users 4] [--image-latency 3]
+"""
+import argparse
+import asyncio
+import statistics
+import threading
+import time
+import openai
+import telebot
+from telebot import TeleBot, apihelper
+from typing import List, Optional
+from app import register_handlers, run_polling
+from benchmarks.stubs import GraphQLStub, OpenAIStub, SpeechStub, StubServers, TelegramStub
+from src.chat_scheduler import ChatScheduler
+from src.graph_ql_client import GraphQLClient
+from src.open_ai_api import OpenAIAPI
+from src.telegram_bot import TelegramBot
+
+
+async def simulate_users(telegram: TelegramStub, args: argparse.Namespace, first_chat_id: int) -> List[float]:
+    latencies = []
+
+    async def text_user(chat_id: int) -> None:
+        for i in range(args.messages):
+            start = time.perf_counter()
+            message_id = telegram.push_message(chat_id, "mensagem {}".format(i))
+            await telegram.wait_reply(message_id)
+            latencies.append(time.perf_counter() - start)
+
+    async def image_user(chat_id: int) -> None:
+        for i in range(3):
+            message_id = telegram.push_message(chat_id, "/imagem um gato número {}".format(i))
+            await telegram.wait_reply(message_id)
+
+    image_users = [image_user(first_chat_id + 500 + i) for i in range(args.image_users)]
+    await asyncio.sleep(0)
+    await asyncio.gather(*image_users, *(text_user(first_chat_id + i) for i in range(args.users)))
+    return latencies
+
+
+def run(servers: StubServers, args: argparse.Namespace, name: str, scheduler: Optional[ChatScheduler],
+        first_chat_id: int) -> None:
+    gql_client = GraphQLClient(servers.base_url + "/graphql", "stub")
+    telegram_bot = TelegramBot(None, OpenAIAPI(gql_client, "stub"))
+    if scheduler is None:
+        tele_bot = TeleBot("123:stub", parse_mode=None)
+        tele_bot.message_handler(commands=['imagem'])(telegram_bot.generate_images)
+        tele_bot.message_handler(func=lambda _: True)(telegram_bot.handle_text_message)
+        scheduler = ChatScheduler({})
+    else:
+        tele_bot = TeleBot("123:stub", parse_mode=None, threaded=False)
+        register_handlers(tele_bot, telegram_bot, SpeechStub(), gql_client, scheduler)
+    telegram_bot._bot = tele_bot
+    thread = threading.Thread(target=run_polling, args=(tele_bot, gql_client, scheduler),
+                              kwargs={"timeout": 1, "long_polling_timeout": 1})
+    thread.start()
+    latencies = servers.run(simulate_users(servers.telegram, args, first_chat_id))
+    print("{:<10} text p50 {:>7.1f} ms   p99 {:>7.1f} ms".format(
+        name, statistics.median(latencies) * 1000, statistics.quantiles(latencies, n=100)[98] * 1000))
+    for lane, stats in scheduler.stats().items():
+        print("  {:<6} lane: {} started, max depth {}, mean wait {:.1f} ms, max wait {:.1f} ms".format(
+            lane, stats["started"], stats["max_depth"], stats["mean_wait"] * 1000, stats["max_wait"] * 1000))
+    tele_bot.stop_polling()
+    thread.join()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=5)
+    parser.add_argument("--image-users", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.2, help="OpenAI stub chat latency in seconds")
+    parser.add_argument("--image-latency", type=float, default=3.0, help="OpenAI stub image latency in seconds")
+    args = parser.parse_args()
+
+    servers = StubServers(TelegramStub(0.005), GraphQLStub(0.01),
+                          OpenAIStub(args.latency, image_latency=args.image_latency)).start()
+    telebot.logger.setLevel("CRITICAL")
+    apihelper.API_URL = servers.base_url + "/bot{0}/{1}"
+    openai.api_base = servers.base_url + "/v1"
+
+    print("{} users x {} text messages while {} users generate 3 images each ({} s per request)".format(
+        args.users, args.messages, args.image_users, args.image_latency))
+    run(servers, args, "direct", None, 1000)
+    run(servers, args, "scheduler", ChatScheduler({"text": 8, "voice": 4, "image": 2, "audio": 2}), 2000)
+    servers.stop()
+
+
+if __name__ == "__main__":
+    main()
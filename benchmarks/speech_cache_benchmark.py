@@ -0,0 +1,81 @@
+"""
+Measure /audio requests for a few popular texts, with and without the speech cache, running the
+bot against local stubs where every synthesis takes a fixed delay.
+
+Usage: python -m benchmarks.speech_cache_benchmark [--requests 100] [--texts 5] [--latency 0.5]
+"""
+import argparse
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import openai
+import telebot
+from telebot import TeleBot, apihelper
+from typing import Optional
+from app import register_handlers, run_polling
+from benchmarks.stubs import GraphQLStub, OpenAIStub, SpeechStub, StubServers, TelegramStub
+from src.chat_scheduler import ChatScheduler
+from src.graph_ql_client import GraphQLClient
+from src.open_ai_api import OpenAIAPI
+from src.speech_cache import SpeechCache
+from src.telegram_bot import TelegramBot
+
+
+async def request_audio(telegram: TelegramStub, requests: int, texts: int) -> list:
+    latencies = []
+    for i in range(requests):
+        text = "Texto popular número {}. ".format(i % texts) * 20
+        start = time.perf_counter()
+        message_id = telegram.push_message(3000, "/audio", reply_to_message=telegram._message(3000, text=text))
+        await telegram.wait_reply(message_id)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def run(servers: StubServers, args: argparse.Namespace, name: str, speech_cache: Optional[SpeechCache]) -> None:
+    gql_client = GraphQLClient(servers.base_url + "/graphql", "stub")
+    tele_bot = TeleBot("123:stub", parse_mode=None, threaded=False)
+    speech = SpeechStub(args.latency)
+    telegram_bot = TelegramBot(tele_bot, OpenAIAPI(gql_client, "stub"), speech_cache=speech_cache)
+    scheduler = ChatScheduler({"text": 1, "voice": 1, "image": 1, "audio": 1})
+    register_handlers(tele_bot, telegram_bot, speech, gql_client, scheduler)
+    thread = threading.Thread(target=run_polling, args=(tele_bot, gql_client, scheduler),
+                              kwargs={"timeout": 1, "long_polling_timeout": 1})
+    thread.start()
+    start = time.perf_counter()
+    latencies = servers.run(request_audio(servers.telegram, args.requests, args.texts))
+    elapsed = time.perf_counter() - start
+    print("{:<14} {:>6.1f} req/s   p50 {:>7.1f} ms   p90 {:>7.1f} ms   {} syntheses".format(
+        name, len(latencies) / elapsed, statistics.median(latencies) * 1000,
+        statistics.quantiles(latencies, n=10)[8] * 1000, speech.syntheses))
+    tele_bot.stop_polling()
+    thread.join()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--texts", type=int, default=5, help="number of distinct texts requested")
+    parser.add_argument("--latency", type=float, default=0.5, help="synthesis time in seconds")
+    args = parser.parse_args()
+
+    servers = StubServers(TelegramStub(0.005), GraphQLStub(), OpenAIStub()).start()
+    telebot.logger.setLevel("CRITICAL")
+    apihelper.API_URL = servers.base_url + "/bot{0}/{1}"
+    openai.api_base = servers.base_url + "/v1"
+
+    print("{} /audio requests for {} texts, {} s per synthesis".format(args.requests, args.texts, args.latency))
+    run(servers, args, "no cache", None)
+    run(servers, args, "memory cache", SpeechCache())
+    directory = tempfile.mkdtemp()
+    run(servers, args, "disk cache", SpeechCache(directory))
+    # a new cache over the same directory, as after a restart
+    run(servers, args, "after restart", SpeechCache(directory))
+    shutil.rmtree(directory)
+    servers.stop()
+
+
+if __name__ == "__main__":
+    main()
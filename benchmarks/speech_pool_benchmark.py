@@ -0,0 +1,54 @@
+"""
+Measure the latency of the Azure speech service with cold and warm connections, and the
+transcription time of voice notes of growing length. Unlike the other benchmarks it calls the
+real service, so it needs Azure credentials and ffmpeg on the PATH.
+
+Usage: python -m benchmarks.speech_pool_benchmark --key KEY --region REGION [--runs 5]
+"""
+import argparse
+import subprocess
+import time
+from src.audio import iter_pcm
+from src.azure_speech_recognizer import AzureSpeechRecognizer
+
+
+def voice_message(text: str, speech_recognizer: AzureSpeechRecognizer) -> bytes:
+    """
+    Synthesize a text and encode it like the voice messages sent by Telegram.
+    """
+    audio = speech_recognizer.convert_text_to_speech(text)
+    return subprocess.run(["ffmpeg", "-loglevel", "error", "-i", "pipe:0", "-ac", "1", "-c:a", "libopus",
+                           "-b:a", "24k", "-f", "ogg", "-"], input=audio, check=True, capture_output=True).stdout
+
+
+def measure(name: str, speech_recognizer: AzureSpeechRecognizer, data: bytes, runs: int, warm: bool) -> None:
+    latencies = []
+    for _ in range(runs):
+        if warm:
+            speech_recognizer.warm_up()
+        start = time.perf_counter()
+        speech_recognizer.convert_speech_to_text(iter_pcm(data))
+        latencies.append(time.perf_counter() - start)
+    print("{:<28} {:7.0f} ms".format(name, sum(latencies) / runs * 1000))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--key", required=True)
+    parser.add_argument("--region", required=True)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    speech_recognizer = AzureSpeechRecognizer(args.key, args.region)
+    sentence = "Olá, esta é uma mensagem de voz gravada para medir o tempo da transcrição. "
+    short = voice_message(sentence, speech_recognizer)
+    measure("short note, cold connection", AzureSpeechRecognizer(args.key, args.region, pool_size=0),
+            short, args.runs, False)
+    measure("short note, warm connection", speech_recognizer, short, args.runs, True)
+    for repeats in (4, 16, 32):
+        data = voice_message(sentence * repeats, speech_recognizer)
+        measure("{} sentence note".format(repeats), speech_recognizer, data, args.runs, True)
+
+
+if __name__ == "__main__":
+    main()
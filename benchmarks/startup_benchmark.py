@@ -0,0 +1,90 @@
+"""
+Measure the cold start of the bot: the time from starting its process to its first poll of
+Telegram and to its first answer, against local stubs, along with the startup timings it logs.
+
+Usage: python -m benchmarks.startup_benchmark [--runs 5] [--mode polling]
+"""
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+# the bot process imports app before anything else, so these are the only imports at module level,
+# and the benchmark imports its stubs once it runs
+
+
+def serve_stubbed(base_url: str, mode: str) -> None:
+    import app
+    app.STARTUP.mark("imports")
+    import configparser
+    from benchmarks.stubs import SpeechStub, use_stubs
+    app.STARTUP.mark("stubs")
+
+    use_stubs(base_url)
+    # Azure Speech has no local endpoint, so its client is replaced by a stand-in
+    app.AzureSpeechRecognizer = lambda *args, **kwargs: SpeechStub()
+    cfg = configparser.ConfigParser()
+    cfg.read_dict({
+        "CHAT_GPT": {"API_KEY": "stub"},
+        "TELEGRAM": {"TOKEN": "123:stub"},
+        "MONGO": {"API_URL": base_url + "/graphql", "API_KEY": "stub"},
+        "AZURE": {"SPEECH_KEY": "stub", "SPEECH_REGION": "stub"},
+        "BOT": {"MODE": mode, "COALESCE_INTERVAL": "0", "LOG_LEVEL": "INFO"},
+    })
+    app.serve(cfg)
+
+
+def cold_start(servers, mode: str, chat_id: int) -> Tuple[float, float, str]:
+    polls = len(servers.telegram.polls)
+    start = time.perf_counter()
+    bot = subprocess.Popen([sys.executable, "-m", "benchmarks.startup_benchmark", "--serve", servers.base_url,
+                            "--mode", mode], stderr=subprocess.PIPE, text=True)
+    try:
+        while len(servers.telegram.polls) == polls:
+            if bot.poll() is not None:
+                raise Exception("The bot exited with code {}: {}".format(bot.returncode, bot.stderr.read()))
+            time.sleep(0.001)
+        first_poll = servers.telegram.polls[polls] - start
+
+        async def ask() -> None:
+            await servers.telegram.wait_reply(servers.telegram.push_message(chat_id, "Olá"), timeout=60)
+
+        servers.run(ask())
+        first_answer = time.perf_counter() - start
+    finally:
+        bot.terminate()
+        _, logs = bot.communicate()
+    timings = re.search(r"Startup timings: (.*)", logs)
+    return first_poll, first_answer, timings.group(1) if timings else "not logged"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--mode", choices=("polling", "async"), default="polling")
+    parser.add_argument("--serve", metavar="BASE_URL", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve is not None:
+        serve_stubbed(args.serve, args.mode)
+        return
+
+    from benchmarks.stubs import GraphQLStub, OpenAIStub, StubServers, TelegramStub
+
+    servers = StubServers(TelegramStub(), GraphQLStub(), OpenAIStub()).start()
+    results: Dict[str, List[float]] = {"first poll": [], "first answer": []}
+    for run in range(args.runs):
+        first_poll, first_answer, timings = cold_start(servers, args.mode, 1000 + run)
+        results["first poll"].append(first_poll)
+        results["first answer"].append(first_answer)
+        print("run {}: first poll {:6.0f} ms  first answer {:6.0f} ms  ({})".format(
+            run + 1, first_poll * 1000, first_answer * 1000, timings))
+    print("median: {}".format("  ".join("{} {:.0f} ms".format(name, statistics.median(times) * 1000)
+                                        for name, times in results.items())))
+    servers.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Compare the storage latency of a conversation turn with the messages in MongoDB Atlas, through a
+local GraphQL stub with a WAN-like latency, and in a local SQLite database: the reads of the newest
+messages of a user, the writes of a turn, the deletion of a history and the migration between them.
+The history cache is disabled, so every read reaches the storage.
+
+Usage: python -m benchmarks.storage_benchmark [--users 50] [--messages 100] [--turns 200] [--latency 0.05]
+"""
+import argparse
+import datetime
+import os
+import statistics
+import tempfile
+import time
+from typing import Callable, Dict, List
+from benchmarks.stubs import GraphQLStub, OpenAIStub, StubServers, TelegramStub
+from src.graph_ql_client import GraphQLClient
+from src.message_store import MessageStore, copy_messages, new_message
+from src.sqlite_message_store import SQLiteMessageStore
+
+PAGE_SIZE = 50
+
+
+def history(users: int, messages: int) -> List[Dict[str, str]]:
+    start = datetime.datetime(2023, 1, 1)
+    return [new_message(str(user), "user" if i % 2 == 0 else "assistant", "Mensagem {} de {}".format(i, user),
+                        "text", (start + datetime.timedelta(seconds=i, microseconds=user)).isoformat())
+            for i in range(messages) for user in range(users)]
+
+
+def timed(call: Callable[[], None]) -> float:
+    start = time.perf_counter()
+    call()
+    return time.perf_counter() - start
+
+
+def summarize(times: List[float]) -> str:
+    times = sorted(times)
+    p99 = times[min(len(times) - 1, int(len(times) * 0.99))]
+    return "p50 {:7.2f} ms  p99 {:7.2f} ms".format(statistics.median(times) * 1000, p99 * 1000)
+
+
+def measure(name: str, store: MessageStore, args: argparse.Namespace) -> Dict[str, float]:
+    messages = history(args.users, args.messages)
+    start = time.perf_counter()
+    for i in range(0, len(messages), 500):
+        store.insert_messages(messages[i:i + 500])
+    prefill = time.perf_counter() - start
+
+    # a turn queues the question, reads the newest page of the history for the prompt and queues the answer
+    turns = []
+    for turn in range(args.turns):
+        user_sid = str(turn % args.users)
+
+        def conversation_turn() -> None:
+            store.queue_message(user_sid, "user", "Pergunta {}".format(turn), "text")
+            next(store.iter_message_pages(user_sid, PAGE_SIZE))
+            store.queue_message(user_sid, "assistant", "Resposta {}".format(turn), "text")
+
+        turns.append(timed(conversation_turn))
+    store.flush()
+
+    tail_reads = [timed(lambda: store.get_messages(str(user), limit=PAGE_SIZE)) for user in range(args.users)]
+    deletes = [timed(lambda: store.delete_user_messages(str(user))) for user in range(args.users // 2)]
+    print("{:<7} prefill {:6.0f} ms  turn {}  tail read {}  delete {}".format(
+        name, prefill * 1000, summarize(turns), summarize(tail_reads), summarize(deletes)))
+    return {"turn": statistics.median(turns), "tail_read": statistics.median(tail_reads)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=100, help="messages stored per user")
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05, help="round trip of the GraphQL API in seconds")
+    args = parser.parse_args()
+
+    servers = StubServers(TelegramStub(), GraphQLStub(args.latency), OpenAIStub()).start()
+    print("{} users x {} messages, {} turns, GraphQL round trip {:.0f} ms".format(
+        args.users, args.messages, args.turns, args.latency * 1000))
+    with tempfile.TemporaryDirectory() as directory:
+        atlas = GraphQLClient(servers.base_url + "/graphql", "stub", cache_size=0)
+        sqlite = SQLiteMessageStore(os.path.join(directory, "gepeto.db"), cache_size=0)
+        atlas_times = measure("atlas", atlas, args)
+        sqlite_times = measure("sqlite", sqlite, args)
+        print("median turn {:.0f}x faster, tail read {:.0f}x faster on SQLite".format(
+            atlas_times["turn"] / sqlite_times["turn"], atlas_times["tail_read"] / sqlite_times["tail_read"]))
+
+        migrated = SQLiteMessageStore(os.path.join(directory, "migrated.db"), cache_size=0)
+        start = time.perf_counter()
+        copied = copy_messages(atlas, migrated)
+        elapsed = time.perf_counter() - start
+        stored = sum(len(page) for page in sqlite.iter_all_messages())
+        print("migrated {} messages from Atlas to SQLite in {:.0f} ms, the other store has {}".format(
+            copied, elapsed * 1000, stored))
+        for store in (atlas, sqlite, migrated):
+            store.close()
+    servers.stop()
+
+
+if __name__ == "__main__":
+    main()
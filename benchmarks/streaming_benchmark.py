@@ -0,0 +1,97 @@
+"""
+Compare the time until the user sees the first words of the answer, and until the whole answer
+is shown, with and without streaming, using local stubs where the OpenAI stub generates the
+answer token by token.
+
+Usage: python -m benchmarks.streaming_benchmark [--users 2] [--messages 4] [--latency 0.3] [--token-delay 0.02]
+"""
+import argparse
+import asyncio
+import configparser
+import statistics
+import threading
+import time
+import openai
+import telebot
+from telebot import apihelper
+from typing import List, Tuple
+from app import create_bot, run_polling
+from benchmarks.stubs import GraphQLStub, OpenAIStub, StubServers, TelegramStub
+
+
+def stub_config(servers: StubServers, stream: bool, edit_interval: float) -> configparser.ConfigParser:
+    cfg = configparser.ConfigParser()
+    cfg.read_dict({
+        "CHAT_GPT": {"API_KEY": "stub", "STREAM": str(stream), "EDIT_INTERVAL": str(edit_interval)},
+        "TELEGRAM": {"TOKEN": "123:stub"},
+        "MONGO": {"API_KEY": "stub", "API_URL": servers.base_url + "/graphql"},
+        "AZURE": {"SPEECH_KEY": "stub", "SPEECH_REGION": "stub"},
+        # every user waits for the answer before the next message, so there are no bursts to coalesce
+        "BOT": {"COALESCE_INTERVAL": "0"},
+    })
+    return cfg
+
+
+async def simulate_users(servers: StubServers, users: int, messages: int,
+                         first_chat_id: int) -> List[Tuple[float, float]]:
+    """
+    Returns the time until the first words of each answer are visible and until the whole answer is.
+    """
+    timings = []
+
+    async def user(chat_id: int) -> None:
+        for i in range(messages):
+            text = "mensagem {}".format(i)
+            answer = servers.openai.answer(text)
+            start = time.perf_counter()
+            message_id = servers.telegram.push_message(chat_id, text)
+            replies = await servers.telegram.wait_reply(
+                message_id, until=lambda replies: any(reply[2] == answer for reply in replies))
+            # the placeholder of a streamed answer does not count as visible text
+            visible = next(reply[0] for reply in replies if reply[2] != "...")
+            timings.append((visible - start, replies[-1][0] - start))
+
+    await asyncio.gather(*(user(first_chat_id + i) for i in range(users)))
+    return timings
+
+
+def run(servers: StubServers, args: argparse.Namespace, stream: bool, first_chat_id: int) -> None:
+    bot, gql_client, scheduler, coalescer = create_bot(stub_config(servers, stream, args.edit_interval))
+    thread = threading.Thread(target=run_polling, args=(bot, gql_client, scheduler, coalescer),
+                              kwargs={"timeout": 1, "long_polling_timeout": 1})
+    thread.start()
+    timings = servers.run(simulate_users(servers, args.users, args.messages, first_chat_id))
+    first = [timing[0] for timing in timings]
+    full = [timing[1] for timing in timings]
+    print("{:<10} first visible token p50 {:>7.1f} ms  p90 {:>7.1f} ms   full answer p50 {:>7.1f} ms".format(
+        "stream" if stream else "blocking", statistics.median(first) * 1000,
+        statistics.quantiles(first, n=10)[8] * 1000, statistics.median(full) * 1000))
+    bot.stop_polling()
+    thread.join()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=2, help="the polling bot handles two updates at a time")
+    parser.add_argument("--messages", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.3, help="OpenAI stub time to the first token in seconds")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="OpenAI stub time per token in seconds")
+    parser.add_argument("--words", type=int, default=100, help="number of words of each answer")
+    parser.add_argument("--edit-interval", type=float, default=1.0)
+    args = parser.parse_args()
+
+    servers = StubServers(TelegramStub(0.005), GraphQLStub(0.01),
+                          OpenAIStub(args.latency, args.token_delay, args.words)).start()
+    telebot.logger.setLevel("CRITICAL")
+    apihelper.API_URL = servers.base_url + "/bot{0}/{1}"
+    openai.api_base = servers.base_url + "/v1"
+
+    print("{} users x {} messages, {} words per answer, {} s to the first token, {} s per token".format(
+        args.users, args.messages, args.words, args.latency, args.token_delay))
+    run(servers, args, False, 1000)
+    run(servers, args, True, 2000)
+    servers.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,560 @@
+"""
+Local stand-ins for the Telegram Bot API, the MongoDB Atlas GraphQL API, the OpenAI API and
+Azure Speech, used by the benchmarks so they run offline with configurable latencies.
+"""
+import asyncio
+import itertools
+import json
+import openai
+import re
+import threading
+import tiktoken
+import time
+from aiohttp import web
+from graphql import build_schema, graphql
+from telebot import apihelper, asyncio_helper
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+GRAPHQL_SCHEMA = '''
+    scalar ObjectId
+
+    type Message {
+        _id: ObjectId
+        user_sid: String
+        role: String
+        content: String
+        content_source: String
+        created_at: String
+    }
+
+    input MessageInsertInput {
+        _id: ObjectId
+        user_sid: String
+        role: String
+        content: String
+        content_source: String
+        created_at: String
+    }
+
+    input MessageQueryInput {
+        user_sid: String
+        user_sid_in: [String]
+        created_at_lt: String
+        created_at_lte: String
+        created_at_gt: String
+    }
+
+    input MessageArchiveInsertInput {
+        user_sid: String
+        first_created_at: String
+        last_created_at: String
+        count: Int
+        data: String
+    }
+
+    input MessageArchiveQueryInput {
+        user_sid: String
+    }
+
+    enum MessageSortByInput {
+        CREATED_AT_ASC
+        CREATED_AT_DESC
+    }
+
+    type DeleteManyPayload {
+        deletedCount: Int!
+    }
+
+    type InsertManyPayload {
+        insertedIds: [ObjectId]!
+    }
+
+    type Query {
+        messages(query: MessageQueryInput, limit: Int = 100, sortBy: MessageSortByInput): [Message]!
+    }
+
+    type Mutation {
+        insertOneMessage(data: MessageInsertInput!): Message
+        insertManyMessages(data: [MessageInsertInput!]!): InsertManyPayload
+        deleteManyMessages(query: MessageQueryInput): DeleteManyPayload
+        insertManyMessageArchives(data: [MessageArchiveInsertInput!]!): InsertManyPayload
+        deleteManyMessageArchives(query: MessageArchiveQueryInput): DeleteManyPayload
+    }
+'''
+
+
+class GraphQLStub:
+    """
+    In-memory message and message archive collections served with the schema generated by Atlas
+    App Services. Deleting messages takes delete_latency more per message deleted.
+    """
+
+    def __init__(self, latency: float = 0.0, delete_latency: float = 0.0) -> None:
+        self.latency = latency
+        self.delete_latency = delete_latency
+        self.requests = 0
+        self.archives: List[Dict[str, Any]] = []
+        self._schema = build_schema(GRAPHQL_SCHEMA)
+        self._messages: List[Dict[str, Any]] = []
+        self._ids = itertools.count(1)
+
+    @property
+    def message_count(self) -> int:
+        return len(self._messages)
+
+    def _matches(self, message: Dict[str, Any], query: Optional[Dict[str, Any]]) -> bool:
+        query = query or {}
+        if "user_sid" in query and message["user_sid"] != query["user_sid"]:
+            return False
+        if "user_sid_in" in query and message["user_sid"] not in query["user_sid_in"]:
+            return False
+        if "created_at_lt" in query and not message["created_at"] < query["created_at_lt"]:
+            return False
+        if "created_at_lte" in query and not message["created_at"] <= query["created_at_lte"]:
+            return False
+        if "created_at_gt" in query and not message["created_at"] > query["created_at_gt"]:
+            return False
+        return True
+
+    def messages(self, info, query=None, limit=100, sortBy=None) -> List[Dict[str, Any]]:
+        found = [message for message in self._messages if self._matches(message, query)]
+        found.sort(key=lambda message: message["created_at"], reverse=sortBy == "CREATED_AT_DESC")
+        return found[:limit]
+
+    def insertOneMessage(self, info, data) -> Dict[str, Any]:
+        message = dict(data, _id="{:024x}".format(next(self._ids)))
+        self._messages.append(message)
+        return message
+
+    def insertManyMessages(self, info, data) -> Dict[str, Any]:
+        return {"insertedIds": [self.insertOneMessage(info, item)["_id"] for item in data]}
+
+    async def deleteManyMessages(self, info, query=None) -> Dict[str, int]:
+        kept = [message for message in self._messages if not self._matches(message, query)]
+        deleted_count = len(self._messages) - len(kept)
+        self._messages = kept
+        await asyncio.sleep(self.delete_latency * deleted_count)
+        return {"deletedCount": deleted_count}
+
+    def insertManyMessageArchives(self, info, data) -> Dict[str, Any]:
+        self.archives.extend(data)
+        return {"insertedIds": ["{:024x}".format(next(self._ids)) for _ in data]}
+
+    def deleteManyMessageArchives(self, info, query=None) -> Dict[str, int]:
+        kept = [batch for batch in self.archives if batch["user_sid"] != (query or {}).get("user_sid")]
+        deleted_count = len(self.archives) - len(kept)
+        self.archives = kept
+        return {"deletedCount": deleted_count}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        body = await request.json()
+        await asyncio.sleep(self.latency)
+        result = await graphql(self._schema, body["query"], root_value=self,
+                               variable_values=body.get("variables"), operation_name=body.get("operationName"))
+        response = {"data": result.data}
+        if result.errors:
+            response["errors"] = [{"message": error.message} for error in result.errors]
+        return web.json_response(response)
+
+
+class OpenAIStub:
+    """
+    Answers chat completions and image generations after a fixed delay. Chat completions take
+    token_delay seconds more per generated token, and are sent token by token when streamed.
+    Image generations take image_latency at 1024x1024, and less for smaller images.
+    With a quota, chat completions over requests_per_minute are refused with 429, enforced over
+    each second like the API does, and every answer carries the rate limit headers.
+    """
+
+    def __init__(self, latency: float = 0.0, token_delay: float = 0.0, answer_words: int = 0,
+                 image_latency: Optional[float] = None, requests_per_minute: Optional[float] = None) -> None:
+        self.latency = latency
+        self.image_latency = latency if image_latency is None else image_latency
+        self.token_delay = token_delay
+        self.answer_words = answer_words
+        self.requests = 0
+        self.rejected = 0
+        # the messages of every chat completion answered
+        self.prompts: List[List[Dict[str, str]]] = []
+        # the prompt and size of every image generation
+        self.image_prompts: List[Tuple[str, str]] = []
+        self.requests_per_minute = requests_per_minute
+        self._burst = None if requests_per_minute is None else max(1.0, requests_per_minute / 60)
+        self.reset_quota()
+
+    def reset_quota(self) -> None:
+        """
+        Refill the whole quota, as if no request was sent in the last minute.
+        """
+        self._available = self._burst
+        self._updated = time.monotonic()
+
+    def answer(self, question: str) -> str:
+        """
+        The answer given to a question.
+        """
+        return "Resposta para: {}".format(question) + " palavra" * self.answer_words
+
+    def _chunk(self, model: str, delta: Dict[str, str], finish_reason: Optional[str] = None) -> bytes:
+        chunk = {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+        return "data: {}\n\n".format(json.dumps(chunk)).encode()
+
+    async def _stream(self, request: web.Request, model: str, tokens: List[str],
+                      headers: Dict[str, str]) -> web.StreamResponse:
+        response = web.StreamResponse(headers=dict(headers, **{"Content-Type": "text/event-stream"}))
+        await response.prepare(request)
+        await response.write(self._chunk(model, {"role": "assistant"}))
+        for token in tokens:
+            await asyncio.sleep(self.token_delay)
+            await response.write(self._chunk(model, {"content": token}))
+        await response.write(self._chunk(model, {}, "stop"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def _take_quota(self) -> Tuple[bool, Dict[str, str]]:
+        if self.requests_per_minute is None:
+            return True, {}
+        now = time.monotonic()
+        self._available = min(self._burst, self._available + (now - self._updated) * self.requests_per_minute / 60)
+        self._updated = now
+        allowed = self._available >= 1
+        if allowed:
+            self._available -= 1
+        headers = {"x-ratelimit-limit-requests": str(int(self.requests_per_minute)),
+                   "x-ratelimit-remaining-requests": str(int(self._available))}
+        if not allowed:
+            headers["retry-after"] = "{:.3f}".format((1 - self._available) * 60 / self.requests_per_minute)
+        return allowed, headers
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.json()
+        allowed, headers = self._take_quota()
+        if not allowed:
+            self.rejected += 1
+            error = {"message": "Rate limit reached for requests", "type": "requests", "param": None,
+                     "code": "rate_limit_exceeded"}
+            return web.json_response({"error": error}, status=429, headers=headers)
+        self.prompts.append(body["messages"])
+        await asyncio.sleep(self.latency)
+        content = self.answer(body["messages"][-1]["content"])
+        # counted like the API does, with the encoding the token ledger counts with
+        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+        if body.get("max_tokens") is not None:
+            content = encoding.decode(encoding.encode(content)[:body["max_tokens"]])
+        tokens = re.findall(r"\S+\s*", content)
+        if body.get("stream"):
+            return await self._stream(request, body["model"], tokens, headers)
+        await asyncio.sleep(self.token_delay * len(tokens))
+        prompt_tokens = sum(4 + len(encoding.encode(message["content"])) for message in body["messages"]) + 2
+        completion_tokens = len(encoding.encode(content))
+        return web.json_response(headers=headers, data={
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens}
+        })
+
+    async def image_generations(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        body = await request.json()
+        size = body.get("size", "1024x1024")
+        self.image_prompts.append((body["prompt"], size))
+        await asyncio.sleep(self.image_latency * int(size.split("x")[0]) / 1024)
+        data = [{"url": "https://example.com/image-{}-{}.png".format(self.requests, i)} for i in range(body.get("n", 1))]
+        return web.json_response({"created": int(time.time()), "data": data})
+
+
+class TelegramStub:
+    """
+    Serves getUpdates from a queue of simulated user messages and records the bot replies,
+    including the later edits of a reply.
+    """
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self._updates: List[Dict[str, Any]] = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._new_update: Optional[asyncio.Event] = None
+        self._new_reply: Optional[asyncio.Condition] = None
+        # the replies to each user message, as (time, method, text), and the message each bot message replies to
+        self._replies: Dict[int, List[Tuple[float, str, str]]] = {}
+        self._replied: Dict[int, int] = {}
+        self._last_message: Dict[int, int] = {}
+        # the files the bot can download, such as the audio of voice messages
+        self._files: Dict[str, bytes] = {}
+        # when each getUpdates was received, as time.perf_counter()
+        self.polls: List[float] = []
+
+    def add_file(self, file_id: str, data: bytes) -> None:
+        """
+        Make a file available to getFile and its download, such as the audio of a voice message.
+        """
+        self._files[file_id] = data
+
+    def push_message(self, chat_id: int, text: Optional[str] = None, chat_type: str = "private",
+                     **fields) -> int:
+        """
+        Queue a message from a user, to be delivered by getUpdates. Must run in the stub loop.
+
+        Returns:
+            The message ID, to wait for its reply with wait_reply().
+        """
+        update = self.make_update(chat_id, text, chat_type, **fields)
+        self._updates.append(update)
+        self._new_update.set()
+        return update["message"]["message_id"]
+
+    def make_update(self, chat_id: int, text: Optional[str] = None, chat_type: str = "private",
+                    **fields) -> Dict[str, Any]:
+        """
+        Create the update of a message from a user, to be delivered some other way, such as a webhook.
+        Must run in the stub loop.
+
+        Returns:
+            The update, with the message ID to wait for its reply with wait_reply().
+        """
+        message_id = next(self._message_ids)
+        message = {
+            "message_id": message_id,
+            "from": {"id": chat_id, "is_bot": False, "first_name": "User"},
+            "chat": {"id": chat_id, "type": chat_type},
+            "date": int(time.time()),
+        }
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        message.update(fields)
+        self._replies[message_id] = []
+        self._last_message[chat_id] = message_id
+        return {"update_id": next(self._update_ids), "message": message}
+
+    async def wait_reply(self, message_id: int, until: Optional[Callable[[List[Tuple[float, str, str]]], bool]] = None,
+                         timeout: float = 60.0) -> List[Tuple[float, str, str]]:
+        """
+        Wait for the reply to a user message. Must run in the stub loop.
+
+        Args:
+            message_id: The ID of the user message.
+            until: Keep waiting until it returns True for the replies so far, by default until the first one.
+            timeout: The maximum time to wait in seconds.
+
+        Returns:
+            The replies and edits, as (time.perf_counter(), method, text).
+        """
+        until = until or (lambda replies: len(replies) > 0)
+        replies = self._replies[message_id]
+        try:
+            async with self._new_reply:
+                await asyncio.wait_for(self._new_reply.wait_for(lambda: until(replies)), timeout)
+            return list(replies)
+        finally:
+            del self._replies[message_id]
+
+    def take_replies(self, message_id: int) -> List[Tuple[float, str, str]]:
+        """
+        Get the replies to a user message so far and stop recording them. Must run in the stub loop.
+
+        Args:
+            message_id: The ID of the user message.
+
+        Returns:
+            The replies and edits, as (time.perf_counter(), method, text).
+        """
+        return self._replies.pop(message_id, [])
+
+    def _message(self, chat_id: int, **fields) -> Dict[str, Any]:
+        message = {
+            "message_id": next(self._message_ids),
+            "from": {"id": 1, "is_bot": True, "first_name": "Gepeto"},
+            "chat": {"id": chat_id, "type": "private"},
+            "date": int(time.time()),
+        }
+        message.update(fields)
+        return message
+
+    async def _record_reply(self, params: Dict[str, str], method: str, reply: Dict[str, Any]) -> None:
+        if method == "editMessageText":
+            replied = self._replied.get(int(params["message_id"]))
+        else:
+            # a message sent without replying to one answers the last message of the chat
+            replied = params.get("reply_to_message_id", self._last_message.get(int(params["chat_id"])))
+        if replied is None or int(replied) not in self._replies:
+            return
+        self._replied[reply["message_id"]] = int(replied)
+        self._replies[int(replied)].append((time.perf_counter(), method, params.get("text", "")))
+        async with self._new_reply:
+            self._new_reply.notify_all()
+
+    @staticmethod
+    async def _read_params(request: web.Request) -> Dict[str, Any]:
+        # telebot sends the parameters in the query string, or as a form body even on GET requests
+        params: Dict[str, Any] = dict(request.query)
+        if not request.body_exists:
+            return params
+        if request.content_type.startswith("multipart/"):
+            reader = await request.multipart()
+            async for part in reader:
+                params[part.name] = await part.read() if part.filename else await part.text()
+        else:
+            params.update(parse_qsl(await request.text()))
+        return params
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._read_params(request)
+
+        if method == "getUpdates":
+            self.polls.append(time.perf_counter())
+            offset = int(params.get("offset", 0) or 0)
+            self._updates = [update for update in self._updates if update["update_id"] >= offset]
+            if not self._updates:
+                self._new_update.clear()
+                try:
+                    await asyncio.wait_for(self._new_update.wait(), min(float(params.get("timeout", 1)), 1.0))
+                except asyncio.TimeoutError:
+                    pass
+            return web.json_response({"ok": True, "result": self._updates})
+
+        await asyncio.sleep(self.latency)
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Gepeto", "username": "gepeto_stub_bot"}
+        elif method == "getFile":
+            result = {"file_id": params["file_id"], "file_unique_id": params["file_id"],
+                      "file_path": "voice/{}.oga".format(params["file_id"])}
+            if params["file_id"] in self._files:
+                result["file_size"] = len(self._files[params["file_id"]])
+        elif method in ("sendMessage", "sendVoice", "sendPhoto", "editMessageText"):
+            result = self._message(int(params["chat_id"]), text=params.get("text", ""))
+            if method == "editMessageText":
+                result["message_id"] = int(params["message_id"])
+            elif method == "sendVoice":
+                # a voice sent by file ID keeps it, an uploaded one gets a new one
+                file_id = params["voice"] if isinstance(params["voice"], str) else "voice-{}".format(result["message_id"])
+                result["voice"] = {"file_id": file_id, "file_unique_id": file_id, "duration": 1}
+            elif method == "sendPhoto":
+                result["photo"] = [self._photo(params["photo"], result["message_id"])]
+            await self._record_reply(params, method, result)
+        elif method == "sendMediaGroup":
+            result = [self._message(int(params["chat_id"]), photo=[self._photo(media["media"], 0)])
+                      for media in json.loads(params["media"])]
+            await self._record_reply(params, method, result[0])
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    @staticmethod
+    def _photo(photo: Any, message_id: int) -> Dict[str, Any]:
+        # a photo sent by file ID keeps it, one sent by URL or uploaded gets a new one
+        if isinstance(photo, str) and not photo.startswith("http"):
+            file_id = photo
+        else:
+            file_id = "photo-{}".format(message_id)
+        return {"file_id": file_id, "file_unique_id": file_id, "width": 1024, "height": 1024}
+
+    async def download(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency)
+        file_id = request.match_info["path"].split("/")[-1].rsplit(".", 1)[0]
+        if file_id not in self._files:
+            return web.Response(status=404)
+        return web.Response(body=self._files[file_id], content_type="application/octet-stream")
+
+
+class SpeechStub:
+    """
+    Stands in for the AzureSpeechRecognizer, taking a fixed delay per request.
+    """
+
+    voice_name = "pt-BR-AntonioNeural"
+    output_format = "Ogg16Khz16BitMonoOpus"
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.syntheses = 0
+        self.recognitions = 0
+
+    def warm_up(self) -> None:
+        pass
+
+    def convert_text_to_speech(self, text: str) -> bytes:
+        self.syntheses += 1
+        time.sleep(self.latency)
+        # about the size of 16 kbit/s Opus for the time it takes to speak the text
+        return bytes(len(text) * 150)
+
+    def convert_speech_to_text(self, audio: Iterable[bytes]) -> str:
+        self.recognitions += 1
+        size = sum(len(chunk) for chunk in audio)
+        time.sleep(self.latency)
+        return "transcrição de {} bytes".format(size)
+
+
+class StubServers:
+    """
+    Runs the stubs on a local port in a background thread with its own event loop.
+    """
+
+    def __init__(self, telegram: TelegramStub, graphql_stub: GraphQLStub, openai_stub: OpenAIStub) -> None:
+        self.telegram = telegram
+        self.graphql = graphql_stub
+        self.openai = openai_stub
+        self.loop = asyncio.new_event_loop()
+        self.port = None
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return "http://127.0.0.1:{}".format(self.port)
+
+    async def _start(self) -> None:
+        self.telegram._new_update = asyncio.Event()
+        self.telegram._new_reply = asyncio.Condition()
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.telegram.handle)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.telegram.download)
+        app.router.add_post("/graphql", self.graphql.handle)
+        app.router.add_post("/v1/chat/completions", self.openai.chat_completions)
+        app.router.add_post("/v1/images/generations", self.openai.image_generations)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def start(self) -> "StubServers":
+        self._thread.start()
+        self.run(self._start())
+        return self
+
+    def run(self, coroutine) -> Any:
+        """
+        Run a coroutine in the stub loop and wait for its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def stop(self) -> None:
+        self.run(self._runner.cleanup())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def use_stubs(base_url: str) -> None:
+    """
+    Point the Telegram and OpenAI clients of this process to the stubs served on base_url.
+    """
+    apihelper.API_URL = asyncio_helper.API_URL = base_url + "/bot{0}/{1}"
+    apihelper.FILE_URL = asyncio_helper.FILE_URL = base_url + "/file/bot{0}/{1}"
+    openai.api_base = base_url + "/v1"
@@ -0,0 +1,73 @@
+"""
+Replay long conversations through the OpenAI client and compare the prompt tokens sent with the
+whole conversation window, as before, and with the rolling conversation summary.
+
+Usage: python -m benchmarks.summary_benchmark [--conversations 3] [--turns 60] [--words 8] [--answer-words 15]
+"""
+import argparse
+import random
+import statistics
+import openai
+from typing import Dict, List
+from benchmarks.stubs import GraphQLStub, OpenAIStub, StubServers, TelegramStub
+from src.conversation_summary import SUMMARY_INSTRUCTIONS
+from src.graph_ql_client import GraphQLClient
+from src.open_ai_api import OpenAIAPI
+from src.token_ledger import TokenLedger
+
+WORDS = "casa viagem receita futebol livro música trabalho escola cidade praia filme jogo código projeto " \
+        "banco conta saúde corrida jantar presente aniversário férias carro ônibus chuva sol café bolo".split()
+
+
+def conversation(seed: int, turns: int, words: int) -> List[str]:
+    generator = random.Random(seed)
+    return ["Pergunta {}: {}?".format(turn, " ".join(generator.choice(WORDS) for _ in range(words)))
+            for turn in range(turns)]
+
+
+def replay(servers: StubServers, args: argparse.Namespace, name: str, summary_every: int,
+           first_user: int) -> Dict[str, float]:
+    gql_client = GraphQLClient(servers.base_url + "/graphql", "stub")
+    openai_api = OpenAIAPI(gql_client, "stub", summary_every=summary_every)
+    ledger = TokenLedger()
+    first_prompt = len(servers.openai.prompts)
+    for user in range(args.conversations):
+        for question in conversation(user, args.turns, args.words):
+            openai_api.ask_gpt(str(first_user + user), question)
+    # the summaries still being refreshed are counted too
+    openai_api._summary_executor.shutdown(wait=True)
+    gql_client.close()
+
+    answers, summaries = [], []
+    for prompt in servers.openai.prompts[first_prompt:]:
+        num_tokens = sum(ledger.count_message_tokens(message) for message in prompt)
+        (summaries if prompt[0]["content"] == SUMMARY_INSTRUCTIONS else answers).append(num_tokens)
+    total = sum(answers) + sum(summaries)
+    print("{:<9} {:>4} answers  mean prompt {:>5.0f} tokens  max {:>5}  summaries {:>3} ({:>6} tokens)  "
+          "total {:>8} tokens".format(name, len(answers), statistics.mean(answers), max(answers),
+                                      len(summaries), sum(summaries), total))
+    return {"answers": sum(answers), "total": total}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conversations", type=int, default=3)
+    parser.add_argument("--turns", type=int, default=60)
+    parser.add_argument("--words", type=int, default=8, help="words per user message")
+    parser.add_argument("--answer-words", type=int, default=15, help="words per answer")
+    args = parser.parse_args()
+
+    servers = StubServers(TelegramStub(), GraphQLStub(), OpenAIStub(0.01, answer_words=args.answer_words)).start()
+    openai.api_base = servers.base_url + "/v1"
+
+    print("{} conversations x {} turns, {} words per question and about {} per answer".format(
+        args.conversations, args.turns, args.words, args.answer_words))
+    window = replay(servers, args, "window", 0, 1000)
+    summary = replay(servers, args, "summary", 10, 2000)
+    print("prompt tokens of the answers reduced by {:.0f}%, {:.0f}% counting the summaries".format(
+        100 * (1 - summary["answers"] / window["answers"]), 100 * (1 - summary["total"] / window["total"])))
+    servers.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Compare the per-turn cost of trimming the conversation history with the token ledger
+against the previous implementation, which re-encoded the whole history on every turn.
+
+Usage: python -m benchmarks.token_ledger_benchmark
+"""
+import random
+import time
+import tiktoken
+from typing import Dict, List
+from src.token_ledger import TokenLedger
+
+WORDS = "olá tudo bem como posso ajudar você hoje gepeto amigo conversa mensagem resposta".split()
+TURNS = 20
+
+
+def legacy_fit_messages_to_token_limit(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    def count_message_tokens(message: Dict[str, str]) -> int:
+        num_tokens = 0
+        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo-0301")
+        for key, value in message.items():
+            num_tokens += len(encoding.encode(value))
+            if key == "name":
+                num_tokens += -1
+        return num_tokens
+
+    max_tokens = 4096
+    num_tokens = 0
+    for message in messages:
+        num_tokens += 4
+        num_tokens += count_message_tokens(message)
+    num_tokens += 2
+    num_tokens *= 1.1
+
+    # the original loop had no emptiness check and raised IndexError on long histories
+    while num_tokens > max_tokens and messages:
+        message = messages.pop(0)
+        num_tokens -= count_message_tokens(message)
+    return messages
+
+
+def random_message(role: str, index: int) -> Dict[str, str]:
+    return {
+        "role": role,
+        "content": " ".join(random.choices(WORDS, k=random.randint(5, 60))),
+        "created_at": "{:012d}".format(index)
+    }
+
+
+def run(history_size: int) -> None:
+    history = [random_message("user" if i % 2 == 0 else "assistant", i) for i in range(history_size)]
+    new_messages = [random_message("user", history_size + i) for i in range(TURNS)]
+
+    # the previous implementation only received role and content from the API
+    plain_history = [{"role": m["role"], "content": m["content"]} for m in history]
+    start = time.perf_counter()
+    for message in new_messages:
+        plain_history.append({"role": message["role"], "content": message["content"]})
+        legacy_fit_messages_to_token_limit(list(plain_history))
+    legacy = (time.perf_counter() - start) / TURNS
+
+    ledger = TokenLedger()
+    ledger.fill("bench", [history])  # cold start, paid once per user
+    start = time.perf_counter()
+    for message in new_messages:
+        ledger.extend("bench", [message])
+    incremental = (time.perf_counter() - start) / TURNS
+
+    print("{:>6} messages: legacy {:9.3f} ms/turn, ledger {:7.3f} ms/turn ({:.0f}x)".format(
+        history_size, legacy * 1000, incremental * 1000, legacy / incremental))
+
+
+if __name__ == "__main__":
+    random.seed(42)
+    for size in (1000, 10000):
+        run(size)
@@ -0,0 +1,69 @@
+"""
+Measure the throughput and latency of decoding bursts of concurrent voice messages, as the voice
+lane does: with pydub writing a WAV file, as done at first, with an ffmpeg process started for
+each message, as done before, and with the transcoder capping the ffmpeg processes running at
+the same time. Needs ffmpeg on the PATH, and ffprobe for the pydub pipeline, which is skipped without it.
+
+Usage: python -m benchmarks.transcode_benchmark [--seconds 30] [--burst 4,8,16] [--processes 1,2,4]
+"""
+import argparse
+import io
+import os
+import shutil
+import statistics
+import threading
+import time
+from pydub import AudioSegment
+from typing import Callable, List
+from benchmarks.audio_pipeline_benchmark import voice_message
+from src.audio import Transcoder, decode_to_pcm
+
+
+def with_pydub(data: bytes) -> None:
+    AudioSegment.from_file(io.BytesIO(data), format="ogg").export(io.BytesIO(), format="wav")
+
+
+def burst(decode: Callable[[bytes], object], data: bytes, size: int) -> List[float]:
+    # every message of the burst arrives at once, each one handled by its own worker thread
+    latencies = [0.0] * size
+    start = time.perf_counter()
+
+    def handle(index: int) -> None:
+        decode(data)
+        latencies[index] = time.perf_counter() - start
+
+    threads = [threading.Thread(target=handle, args=(index,)) for index in range(size)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+def measure(name: str, decode: Callable[[bytes], object], data: bytes, size: int) -> None:
+    latencies = burst(decode, data, size)
+    total = max(latencies)
+    print("{:<24} {:3} messages  {:5.1f} messages/s  first {:6.0f} ms  p50 {:6.0f} ms  last {:6.0f} ms".format(
+        name, size, size / total, min(latencies) * 1000, statistics.median(latencies) * 1000, total * 1000))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=30, help="duration of each voice message")
+    parser.add_argument("--burst", default="4,8,16", help="numbers of messages arriving at once")
+    parser.add_argument("--processes", default="1,2,4", help="caps of the ffmpeg processes to compare")
+    args = parser.parse_args()
+
+    data = voice_message(args.seconds)
+    print("{} s voice messages, {} bytes, {} CPUs".format(args.seconds, len(data), os.cpu_count()))
+    for size in (int(size) for size in args.burst.split(",")):
+        if shutil.which("ffprobe") is not None:
+            measure("pydub WAV", with_pydub, data, size)
+        measure("ffmpeg per message", decode_to_pcm, data, size)
+        for processes in (int(processes) for processes in args.processes.split(",")):
+            measure("transcoder, {} process{}".format(processes, "" if processes == 1 else "es"),
+                    Transcoder(processes).decode_to_pcm, data, size)
+
+
+if __name__ == "__main__":
+    main()
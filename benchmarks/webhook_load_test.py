@@ -0,0 +1,107 @@
+"""
+Post simulated updates to the webhook receiver and measure the throughput of the bot with a
+growing number of worker processes.
+
+Usage: python -m benchmarks.webhook_load_test [--workers 1,2,4] [--users 64] [--messages 5]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import aiohttp
+import openai
+import telebot
+from aiohttp import web
+from telebot import apihelper
+from typing import Dict, List, Tuple
+from app import run_webhook_worker
+from benchmarks.stubs import GraphQLStub, OpenAIStub, StubServers, TelegramStub
+from src.webhook import WebhookReceiver
+
+
+def stub_worker(config: Dict[str, Dict[str, str]], base_url: str, shard: int, updates) -> None:
+    # the workers are spawned, so they are pointed to the stubs here
+    telebot.logger.setLevel("CRITICAL")
+    apihelper.API_URL = base_url + "/bot{0}/{1}"
+    openai.api_base = base_url + "/v1"
+    run_webhook_worker(config, shard, updates)
+
+
+async def serve(receiver: WebhookReceiver) -> Tuple[web.AppRunner, str]:
+    runner = web.AppRunner(receiver.application("/webhook"), access_log=None)
+    # starts the workers too
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, "http://127.0.0.1:{}/webhook".format(site._server.sockets[0].getsockname()[1])
+
+
+async def simulate_users(telegram: TelegramStub, url: str, args: argparse.Namespace, workers: int,
+                         first_chat_id: int) -> Tuple[float, List[float]]:
+    latencies = []
+
+    async with aiohttp.ClientSession() as session:
+        async def send(chat_id: int, text: str) -> int:
+            update = telegram.make_update(chat_id, text)
+            async with session.post(url, json=update) as response:
+                response.raise_for_status()
+            return update["message"]["message_id"]
+
+        async def user(chat_id: int) -> None:
+            for i in range(args.messages):
+                start = time.perf_counter()
+                await telegram.wait_reply(await send(chat_id, "mensagem {}".format(i)), timeout=120)
+                latencies.append(time.perf_counter() - start)
+
+        # the workers take a while to start, so each one answers a message before the clock starts
+        message_ids = [await send(first_chat_id - 1 - shard, "olá") for shard in range(workers)]
+        await asyncio.gather(*(telegram.wait_reply(message_id, timeout=120) for message_id in message_ids))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(user(first_chat_id + i) for i in range(args.users)))
+        return time.perf_counter() - start, latencies
+
+
+def run(servers: StubServers, args: argparse.Namespace, workers: int, first_chat_id: int) -> float:
+    config = {
+        "CHAT_GPT": {"API_KEY": "stub", "SUMMARY_EVERY": "0"},
+        "TELEGRAM": {"TOKEN": "123:stub"},
+        "MONGO": {"API_URL": servers.base_url + "/graphql", "API_KEY": "stub"},
+        "AZURE": {"SPEECH_KEY": "stub", "SPEECH_REGION": "stub"},
+        "BOT": {"TEXT_WORKERS": str(args.text_workers), "COALESCE_INTERVAL": "0", "LOG_LEVEL": "CRITICAL"},
+        "WEBHOOK": {"WORKERS": str(workers)},
+    }
+    receiver = WebhookReceiver(stub_worker, (config, servers.base_url), workers)
+    runner, url = servers.run(serve(receiver))
+    elapsed, latencies = servers.run(simulate_users(servers.telegram, url, args, workers, first_chat_id))
+    # stops the workers too
+    servers.run(runner.cleanup())
+    throughput = len(latencies) / elapsed
+    print("{} worker(s)  {:>4} messages in {:>5.1f} s  {:>6.1f} messages/s  p50 {:>6.0f} ms  p90 {:>6.0f} ms".format(
+        workers, len(latencies), elapsed, throughput, statistics.median(latencies) * 1000,
+        statistics.quantiles(latencies, n=10)[8] * 1000))
+    return throughput
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated numbers of worker processes")
+    parser.add_argument("--users", type=int, default=64)
+    parser.add_argument("--messages", type=int, default=5)
+    parser.add_argument("--text-workers", type=int, default=8, help="text lane threads of each worker process")
+    parser.add_argument("--latency", type=float, default=0.5, help="OpenAI stub chat latency in seconds")
+    args = parser.parse_args()
+
+    servers = StubServers(TelegramStub(0.005), GraphQLStub(0.005), OpenAIStub(args.latency)).start()
+
+    print("{} users x {} text messages, {} text threads per worker ({} s per completion)".format(
+        args.users, args.messages, args.text_workers, args.latency))
+    workers = [int(count) for count in args.workers.split(",")]
+    throughputs = [run(servers, args, count, 1000 * (i + 1)) for i, count in enumerate(workers)]
+    print("throughput relative to {} worker(s): {}".format(
+        workers[0], "  ".join("{:.2f}x".format(throughput / throughputs[0]) for throughput in throughputs)))
+    servers.stop()
+
+
+if __name__ == "__main__":
+    main()
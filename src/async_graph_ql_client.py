@@ -0,0 +1,150 @@
+import asyncio
+import threading
+from graphql import DocumentNode
+from src.graph_ql_client import GraphQLClient
+from src.message_store import AsyncMessageStore, MessageArchive
+from src.metrics import stage
+from typing import Any, Dict, List, Optional
+
+
+class AsyncGraphQLClient(GraphQLClient, AsyncMessageStore):
+    """
+    An asyncio client for interacting with a GraphQL API, sharing one session between requests.
+    Its blocking methods send their requests through the event loop, so they are called from other threads.
+    """
+
+    def __init__(self, url: str, api_key: str, cache_size: int = 50000, fetch_schema: bool = False,
+                 schema_path: Optional[str] = None, write_batch_size: int = 50, write_interval: float = 0.5,
+                 archive: Optional[MessageArchive] = None) -> None:
+        """
+        Initialize the async GraphQL client. The session is opened by connect().
+
+        Args:
+            url: The URL of the GraphQL API.
+            api_key: The API key for authentication.
+            cache_size: The maximum number of messages kept in the history cache.
+            fetch_schema: Whether to fetch the schema from the API to validate the requests.
+            schema_path: The path of a local schema file used to validate the requests instead.
+            write_batch_size: The number of queued messages that triggers a write.
+            write_interval: The maximum time in seconds a queued message waits to be written.
+            archive: Where the old messages are archived, by default in the MessageArchive collection.
+        """
+        super().__init__(url, api_key, cache_size, fetch_schema, schema_path, write_batch_size, write_interval,
+                         archive)
+        self._connected = threading.Event()
+
+    async def connect(self) -> None:
+        """
+        Open the session used by every request.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._session = await self._client.connect_async(reconnecting=True, retry_execute=False)
+        self._connected.set()
+
+    async def aflush(self) -> None:
+        """
+        Write the queued messages and wait for it.
+        """
+        await self._flush_async()
+
+    def close(self) -> None:
+        """
+        Finish the bulk operations and write the queued messages, then close the session, from another thread.
+        """
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self.aclose(), self._loop).result()
+
+    async def aclose(self) -> None:
+        """
+        Finish the bulk operations and write the queued messages, then close the session.
+        """
+        # the bulk operations send their requests through the event loop, so it keeps running meanwhile
+        await asyncio.get_running_loop().run_in_executor(None, self._stop_maintenance)
+        await self._flush_async()
+        await self._client.close_async()
+        self._session = None
+
+    async def ainsert_message(self, user_sid: str, role: str, content: str, content_source: str) -> Dict[str, str]:
+        """
+        Insert a new message into the GraphQL API.
+
+        Args:
+            user_sid: The user session ID.
+            role: The role of the message.
+            content: The content of the message.
+            content_source: The content source of the message (text or audio).
+
+        Returns:
+            The inserted message.
+        """
+        insert_query, variables = self._insert_request(user_sid, role, content, content_source)
+
+        try:
+            with stage("graphql_insert"):
+                response = await self._session.execute(insert_query, variable_values=variables)
+            return self._on_message_inserted(user_sid, response)
+        except Exception as e:
+            # Handle any GraphQL API or network-related errors
+            raise Exception("Failed to insert message: {}".format(str(e)))
+
+    async def aget_messages(self, user_sid: str, limit: Optional[int] = None, before: Optional[str] = None,
+                           after: Optional[str] = None) -> List[Dict[str, str]]:
+        """
+        Retrieve messages from the GraphQL API for a given user, or from the cache when they are known.
+
+        Args:
+            user_sid: The user session ID.
+            limit: The maximum number of messages to retrieve, keeping the newest ones.
+            before: Only retrieve messages created before this date.
+            after: Only retrieve messages created after this date.
+
+        Returns:
+            The list of messages sorted by creation date.
+        """
+        after = self._visible_after(user_sid, after)
+        messages = self._history_cache.get(user_sid, limit, before, after)
+        if messages is not None:
+            return messages
+
+        if self._has_unsaved_messages(user_sid):
+            await self._flush_async()
+        get_query, variables = self._get_request(user_sid, limit, before, after)
+
+        try:
+            with stage("graphql_get"):
+                response = await self._session.execute(get_query, variable_values=variables)
+            return self._on_messages_fetched(user_sid, response, limit, before, after)
+        except Exception as e:
+            # Handle any GraphQL API or network-related errors
+            raise Exception("Failed to retrieve messages: {}".format(str(e)))
+
+    async def adelete_user_messages(self, user_sid: str) -> Dict[str, int]:
+        """
+        Delete messages for a given user from the GraphQL API.
+
+        Args:
+            user_sid: The user session ID.
+
+        Returns:
+            The deletion result.
+        """
+        if self._has_unsaved_messages(user_sid):
+            await self._flush_async()
+        delete_query, variables = self._delete_request(user_sid)
+
+        try:
+            with stage("graphql_delete"):
+                response = await self._session.execute(delete_query, variable_values=variables)
+            return response['deleteManyMessages']
+        except Exception as e:
+            # Handle any GraphQL API or network-related errors
+            raise Exception("Failed to delete user messages: {}".format(str(e)))
+        finally:
+            # the messages may be partially deleted even if the request failed
+            self._history_cache.invalidate(user_sid)
+
+    def _execute(self, document: DocumentNode, variables: Dict[str, Any]) -> Dict[str, Any]:
+        # the bulk operations run in a thread, and may start before the session is opened on the event loop
+        if not self._connected.wait(60):
+            raise Exception("The session was not opened")
+        return super()._execute(document, variables)
@@ -0,0 +1,312 @@
+import aiohttp
+import asyncio
+import openai
+from concurrent.futures import ThreadPoolExecutor
+from openai import api_requestor, util
+from src.message_store import MessageStore
+from src.conversation_summary import summary_sid
+from src.metrics import stage
+from src.open_ai_api import OpenAIAPI
+from src.rate_limiter import RateLimiter
+from typing import TYPE_CHECKING, Any, AsyncContextManager, AsyncIterator, Callable, List, Dict, Optional, Tuple
+import logging
+
+if TYPE_CHECKING:
+    from src.conversation_memory import ConversationMemory
+
+
+class AsyncCompletionStream:
+    """
+    The chunks of a streamed chat completion, read from its HTTP response, which closing stops.
+    """
+
+    def __init__(self, context: AsyncContextManager, result: aiohttp.ClientResponse, lines: AsyncIterator,
+                 api_key: Optional[str]) -> None:
+        self._context = context
+        self._result = result
+        self._lines = lines
+        self._api_key = api_key
+
+    def __aiter__(self) -> "AsyncCompletionStream":
+        return self
+
+    async def __anext__(self) -> Any:
+        return util.convert_to_openai_object(await self._lines.__anext__(), self._api_key)
+
+    async def aclose(self) -> None:
+        """
+        Close the HTTP response, so the server stops generating the completion, and release the session.
+        """
+        self._result.close()
+        await self._context.__aexit__(None, None, None)
+
+
+class AsyncOpenAIAPI(OpenAIAPI):
+    """
+    An asyncio API client for interacting with OpenAI services.
+    """
+
+    def __init__(self, message_store: MessageStore, api_key: str, history_page_size: int = 50,
+                 chat_limiter: Optional[RateLimiter] = None, image_limiter: Optional[RateLimiter] = None,
+                 max_retries: int = 5, completion_tokens: int = 500, summary_every: int = 0,
+                 recent_messages: int = 6, summary_tokens: int = 250, memory: Optional["ConversationMemory"] = None,
+                 recall_tokens: int = 500) -> None:
+        """
+        Initialize the async OpenAI API client.
+
+        Args:
+            message_store: The async store of the messages, such as the async GraphQL client.
+            api_key: The API key for authentication.
+            history_page_size: The number of messages fetched per page when loading a user history.
+            chat_limiter: The rate limiter of the chat completions, by default the limits of a paid account.
+            image_limiter: The rate limiter of the image generations, by default the limits of a paid account.
+            max_retries: The maximum number of times a failed request is retried.
+            completion_tokens: The number of tokens expected in an answer, reserved with its request.
+            summary_every: The number of new messages that triggers a refresh of the conversation summary,
+                or 0, the default, to send the whole window instead of a summary.
+            recent_messages: The number of most recent messages sent along with the summary.
+            summary_tokens: The maximum number of tokens of a summary.
+            memory: The memory of the conversations, to send the older turns relevant to each message,
+                or None to send only the window.
+            recall_tokens: The maximum number of tokens of the turns recalled from the memory.
+        """
+        super().__init__(message_store, api_key, history_page_size, chat_limiter, image_limiter, max_retries,
+                         completion_tokens, summary_every, recent_messages, summary_tokens, memory, recall_tokens)
+        self._summary_tasks = set()
+
+    def _create_executors(self) -> Tuple[Optional[ThreadPoolExecutor], Optional[ThreadPoolExecutor]]:
+        # the summaries are refreshed and the images generated in tasks of the event loop
+        return None, None
+
+    async def aclose(self) -> None:
+        """
+        Wait for the summaries being refreshed, so they are queued before the message store is closed.
+        """
+        if self._summary_tasks:
+            await asyncio.gather(*self._summary_tasks, return_exceptions=True)
+
+    async def _chat_completion(self, **params) -> Any:
+        """
+        Request a chat completion with the session set in openai.aiosession, or a new one if none is set,
+        following the rate limit headers of the response, which openai.ChatCompletion.acreate() does not return.
+
+        Args:
+            params: The parameters of the completion.
+
+        Returns:
+            The completion, or an AsyncCompletionStream over its chunks if it is streamed.
+        """
+        # the requestor methods used here are internals of openai 0.27.6, which requirements.txt pins exactly
+        requestor = api_requestor.APIRequestor()
+        stream = params.get("stream", False)
+        context = api_requestor.aiohttp_session()
+        session = await context.__aenter__()
+        try:
+            result = await requestor.arequest_raw("post", "/chat/completions", session, params=params)
+            self._observe(result.url, result.headers)
+            response, got_stream = await requestor._interpret_async_response(result, stream)
+        except Exception:
+            await context.__aexit__(None, None, None)
+            raise
+        if got_stream:
+            # the session stays open until the stream is closed
+            return AsyncCompletionStream(context, result, response, requestor.api_key)
+        await context.__aexit__(None, None, None)
+        return util.convert_to_openai_object(response, requestor.api_key)
+
+    async def _create(self, limiter: RateLimiter, tokens: int, create: Callable,
+                      stage_name: str = "openai_completion", **params) -> Any:
+        """
+        Send a request within the rate limit, retrying it if it fails for a transient reason.
+
+        Args:
+            limiter: The rate limiter of the request.
+            tokens: The estimated number of tokens of the request.
+            create: The coroutine function sending the request.
+            stage_name: The stage each attempt is measured as. A streamed response is measured until it starts.
+            params: The parameters of the request.
+
+        Returns:
+            The response.
+        """
+        attempt = 0
+        while True:
+            with stage("openai_rate_limit_wait"):
+                await asyncio.sleep(limiter.reserve(tokens))
+            try:
+                with stage(stage_name):
+                    return await create(**params)
+            except Exception as e:
+                delay = self._retry_delay(limiter, e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _insert_initial_data(self, user_sid: str, message: str, content_source: str, role: str = "user") -> List[Dict[str, str]]:
+        """
+        Insert initial data into the message store.
+
+        Args:
+            user_sid: The user session ID.
+            message: The message to insert.
+            role: The role of the message.
+            content_source: The content source of the message (text or audio).
+
+        Returns:
+            The list of messages after inserting initial data.
+        """
+        try:
+            self._queue(user_sid, role, message, content_source)
+            cursor = self._token_ledger.cursor(user_sid)
+            if cursor is None:
+                self._token_ledger.reset(user_sid)
+                async for page in self._message_store.aiter_message_pages(user_sid, self._history_page_size):
+                    if self._token_ledger.prepend(user_sid, page):
+                        break
+                messages = self._token_ledger.messages(user_sid)
+            else:
+                new_messages = await self._message_store.aget_messages(user_sid, after=cursor)
+                messages = self._token_ledger.extend(user_sid, new_messages)
+            messages = await self._compact(user_sid, messages)
+            before = self._recall_before(user_sid)
+            turns = []
+            if before is not None:
+                # the index is read from files
+                turns = await asyncio.to_thread(self._memory.recall, user_sid, message, before)
+            return self._prompt(messages, turns)
+        except Exception as e:
+            logging.error("Error inserting the user message inital data: {}".format(str(e)))
+
+    async def _compact(self, user_sid: str, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """
+        Replace the older messages of a conversation with its summary, refreshing it in the background when due.
+
+        Args:
+            user_sid: The user session ID.
+            messages: The messages in the conversation window.
+
+        Returns:
+            The summary followed by the messages newer than it.
+        """
+        if self._summaries is None:
+            return messages
+        if not self._summaries.known(user_sid):
+            self._summaries.load(user_sid, await self._message_store.aget_messages(summary_sid(user_sid), limit=1))
+        return self._summary_prompt(user_sid)
+
+    def _start_refresh(self, user_sid: str, cutoff: str, request: List[Dict[str, str]]) -> None:
+        # a reference is kept so the task is not garbage collected while it runs
+        task = asyncio.get_running_loop().create_task(self._refresh_summary(user_sid, cutoff, request))
+        self._summary_tasks.add(task)
+        task.add_done_callback(self._summary_tasks.discard)
+
+    async def _summarize(self, request: List[Dict[str, str]]) -> Optional[str]:
+        try:
+            tokens, params = self._chat_request(request, max_tokens=self._summary_tokens)
+            completion = await self._create(self._chat_limiter, tokens, self._chat_completion, **params)
+            self._record_usage(tokens, completion.usage, "summary")
+            return completion.choices[0].message.content
+        except Exception as e:
+            logging.error("Error summarizing the conversation: {}".format(str(e)))
+
+    async def _refresh_summary(self, user_sid: str, cutoff: str, request: List[Dict[str, str]]) -> None:
+        previous = self._summaries.cutoff(user_sid)
+        self._store_summary(user_sid, previous,
+                            self._summaries.finish_refresh(user_sid, cutoff, await self._summarize(request)))
+
+    async def _get_gpt_answer(self, user_sid: str, messages: List[str],
+                              superseded: Optional[Callable[[], bool]] = None) -> List[str]:
+        try:
+            tokens, params = self._chat_request(messages)
+            completion = await self._create(self._chat_limiter, tokens, self._chat_completion, **params)
+            return self._answer(user_sid, tokens, completion, superseded)
+        except Exception as e:
+            logging.error("Error trying to insert choices from gpt: {}".format(str(e)))
+
+    async def ask_gpt(self, user_sid: str, user_msg: str, content_source: str = "text",
+                      superseded: Optional[Callable[[], bool]] = None) -> List[str]:
+        """
+        Ask the OpenAI GPT-3 model for a response.
+
+        Args:
+            user_sid: The user session ID.
+            user_msg: The user message.
+            content_source: The content source of the message (text or audio).
+            superseded: Checks if a newer message made the response unnecessary, in which case it is
+                neither requested nor stored and no responses are returned.
+
+        Returns:
+            The list of responses from the GPT model.
+        """
+        if self._skip_superseded(user_sid, user_msg, content_source, superseded):
+            return []
+        messages = await self._insert_initial_data(user_sid, user_msg, content_source=content_source)
+        return await self._get_gpt_answer(user_sid, messages, superseded)
+
+    async def ask_gpt_stream(self, user_sid: str, user_msg: str, content_source: str = "text",
+                             superseded: Optional[Callable[[], bool]] = None) -> AsyncIterator[str]:
+        """
+        Ask the OpenAI GPT-3 model for a response, yielding its parts as they are generated.
+        The response is stored once it is complete.
+
+        Args:
+            user_sid: The user session ID.
+            user_msg: The user message.
+            content_source: The content source of the message (text or audio).
+            superseded: Checks if a newer message made the response unnecessary, in which case its
+                generation is stopped and it is not stored.
+
+        Returns:
+            An async iterator over the parts of the response.
+        """
+        if self._skip_superseded(user_sid, user_msg, content_source, superseded):
+            return
+        messages = await self._insert_initial_data(user_sid, user_msg, content_source=content_source)
+        try:
+            parts = []
+            tokens, params = self._chat_request(messages, stream=True)
+            chunks = await self._create(self._chat_limiter, tokens, self._chat_completion, **params)
+            try:
+                async for chunk in chunks:
+                    if superseded is not None and superseded():
+                        # the tokens generated so far are used all the same
+                        self._finish_stream(user_sid, tokens, parts, store=False)
+                        return
+                    content = self._chunk_content(chunk)
+                    if content:
+                        parts.append(content)
+                        yield content
+            finally:
+                # closing the connection stops the generation when the stream is left early
+                await chunks.aclose()
+            self._finish_stream(user_sid, tokens, parts)
+        except Exception as e:
+            logging.error("Error trying to stream the answer from gpt: {}".format(str(e)))
+
+    async def iter_images(self, prompt: str, sizes: List[str]) -> AsyncIterator[Tuple[int, Optional[str]]]:
+        """
+        Generate an image of each size based on a prompt, requesting them all at once.
+
+        Args:
+            prompt: The prompt to generate images.
+            sizes: The size of each image.
+
+        Returns:
+            An async iterator over the index of each image in sizes and its URL, or None if it failed,
+            in the order they are generated.
+        """
+        async def generate(index: int, size: str) -> Tuple[int, Optional[str]]:
+            return index, await self._generate_image(prompt, size)
+
+        for image in asyncio.as_completed([generate(index, size) for index, size in enumerate(sizes)]):
+            yield await image
+
+    async def _generate_image(self, prompt: str, size: str) -> Optional[str]:
+        try:
+            response = await self._create(self._image_limiter, 0, openai.Image.acreate, "openai_image",
+                                          prompt=prompt, n=1, size=size)
+            return response['data'][0]['url']
+        except Exception as e:
+            logging.error("Error generating an image: {}".format(str(e)))
+            return None
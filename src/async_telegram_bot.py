@@ -0,0 +1,282 @@
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+from src.async_open_ai_api import AsyncOpenAIAPI
+from src.message_store import MessageStore
+from src.conversation_summary import summary_sid
+from src.azure_speech_recognizer import AzureSpeechRecognizer
+from src.telegram_bot import TelegramBot, DELETING_MESSAGE, STREAM_PLACEHOLDER, StreamedReply
+from src.audio import Transcoder
+from src.speech_cache import CachedSpeech, SpeechCache
+from src.image_cache import ImageCache, normalize_prompt
+from src.message_coalescer import MessageBatch
+from src.metrics import report_error, stage
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import asyncio
+import logging
+
+
+class AsyncTelegramBot(TelegramBot):
+    """
+    An asyncio Telegram bot for handling user requests, serving many chats concurrently. How many
+    requests run at the same time is up to the scheduler the handlers are submitted to.
+    """
+
+    def __init__(self, bot: AsyncTeleBot, openai_api: AsyncOpenAIAPI, stream: bool = False,
+                 edit_interval: float = 1.0, speech_cache: Optional[SpeechCache] = None,
+                 max_voice_duration: float = 600.0, transcoder: Optional[Transcoder] = None,
+                 image_cache: Optional[ImageCache] = None, image_sets: Optional[List[Tuple[str, int]]] = None) -> None:
+        """
+        Initialize the async Telegram bot.
+
+        Args:
+            bot: An instance of AsyncTeleBot.
+            openai_api: An instance of the AsyncOpenAIAPI.
+            stream: Whether to show the answers while they are generated, by editing the reply.
+            edit_interval: The minimum time in seconds between two edits of a streamed reply.
+            speech_cache: A cache of synthesized audio, or None to always synthesize it.
+            max_voice_duration: The maximum duration in seconds of the voice messages answered.
+            transcoder: Decodes the voice messages, by default with at most 2 ffmpeg processes at a time.
+            image_cache: A cache of the images sent for each prompt, or None to always generate them.
+            image_sets: The size and number of the images sent for a prompt, such as cheap previews
+                before the full images, which come last. By default two images of 1024x1024.
+        """
+        super().__init__(bot, openai_api, stream, edit_interval, speech_cache, max_voice_duration, transcoder,
+                         image_cache, image_sets)
+        self._deletion_reports: Set[asyncio.Future] = set()
+
+    async def generate_images(self, message: types.Message) -> None:
+        """
+        Generates images and sends them as a media group to the user.
+
+        Args:
+            message: The incoming message from the user.
+        """
+        try:
+            prompt = normalize_prompt(message.text)
+            if prompt == "":
+                await self._bot.reply_to(message, "Você precisa digitar uma frase para gerar imagens.")
+                return
+
+            # with the full images cached, the previews are not needed
+            if await self._send_cached_images(message, prompt, len(self._image_sets) - 1):
+                return
+            missing = [index for index in range(len(self._image_sets) - 1)
+                       if not await self._send_cached_images(message, prompt, index)] + [len(self._image_sets) - 1]
+
+            # every image is requested at once, and sent as soon as it is generated
+            sets, sizes = self._image_requests(missing)
+            file_ids: Dict[int, List[str]] = {index: [] for index in missing}
+            async for request, url in self._openai_api.iter_images(prompt, sizes):
+                if url is None:
+                    continue
+                with stage("telegram_send"):
+                    sent = await self._bot.send_photo(message.chat.id, url, reply_to_message_id=message.message_id)
+                file_ids[sets[request]].append(sent.photo[-1].file_id)
+            if not any(file_ids.values()):
+                await self._bot.reply_to(message, "Desculpe, não foi possível gerar as imagens agora, tente novamente em alguns instantes.")
+                return
+            self._cache_images(prompt, file_ids)
+        except Exception as e:
+            report_error("generate_images", e)
+            await self._bot.reply_to(message, "Desculpe, ocorreu um erro ao gerar as imagens.")
+
+    async def _send_cached_images(self, message: types.Message, prompt: str, index: int) -> bool:
+        """
+        Send the images of a set from the image cache, by their Telegram file IDs.
+
+        Args:
+            message: The incoming message from the user.
+            prompt: The normalized prompt.
+            index: The index of the set of images in image_sets.
+
+        Returns:
+            True if the images were cached and sent.
+        """
+        key, file_ids = self._cached_images(prompt, index)
+        if file_ids is None:
+            return False
+        try:
+            with stage("telegram_send"):
+                if len(file_ids) == 1:
+                    await self._bot.send_photo(message.chat.id, file_ids[0], reply_to_message_id=message.message_id)
+                else:
+                    await self._bot.send_media_group(message.chat.id,
+                                                     [types.InputMediaPhoto(file_id) for file_id in file_ids],
+                                                     reply_to_message_id=message.message_id)
+            return True
+        except Exception as e:
+            logging.error("Error sending the cached images: {}".format(str(e)))
+            self._image_cache.invalidate(key)
+            return False
+
+    async def convert_text_to_speech(self, message: types.Message, speech_recognizer: AzureSpeechRecognizer) -> None:
+        """
+        Convert text to speech and send it as a voice message to the user.
+
+        Args:
+            message: The incoming message from the user.
+            speech_recognizer: An instance of the AzureSpeechRecognizer.
+        """
+        try:
+            refusal = self._speech_refusal(message)
+            if refusal is not None:
+                await self._bot.reply_to(message, refusal)
+                return
+
+            # the speech SDK blocks until the synthesis is done, so it runs in a worker thread
+            key, speech = await asyncio.to_thread(self._synthesize, message.reply_to_message.text, speech_recognizer)
+            if speech == None:
+                await self._bot.reply_to(message, "Ocorreu um erro e não foi possível gerar o áudio.")
+                return
+            await self._send_speech(message, key, speech)
+        except Exception as e:
+            report_error("convert_text_to_speech", e)
+            await self._bot.reply_to(message, "Desculpe, ocorreu um erro ao gerar o áudio.")
+
+    async def handle_voice_message(self, message: types.Message, speech_recognizer: AzureSpeechRecognizer) -> None:
+        """
+        Handle user voice messages and generate responses.
+
+        Args:
+            message: The incoming message from the user.
+            speech_recognizer: An instance of the AzureSpeechRecognizer.
+        """
+        try:
+            data = await self._download_file(message.voice.file_id)
+            refusal = self._voice_refusal(data)
+            if refusal is not None:
+                await self._bot.reply_to(message, refusal)
+                return
+            # the audio is recognized while it is decoded, and the wait for an ffmpeg process is in the thread too
+            text = await asyncio.to_thread(speech_recognizer.convert_speech_to_text,
+                                           self._transcoder.iter_pcm(data))
+            if text == "" or text == None:
+                await self._bot.reply_to(message, "Não entendi o que você falou.")
+            else:
+                await self._reply_with_answer(message, text, "audio")
+        except Exception as e:
+            report_error("handle_voice_message", e)
+            await self._bot.reply_to(message, "Desculpe, ocorreu um erro ao processar a mensagem de voz.")
+
+    async def _send_speech(self, message: types.Message, key: Optional[str], speech: CachedSpeech) -> None:
+        if speech.file_id is not None:
+            try:
+                # the audio was already uploaded, so Telegram can send it again without the upload
+                with stage("telegram_send"):
+                    await self._bot.send_voice(message.chat.id, speech.file_id)
+                return
+            except Exception as e:
+                logging.error("Error sending the cached voice message: {}".format(str(e)))
+        with stage("telegram_send"):
+            sent = await self._bot.send_voice(message.chat.id, speech.audio)
+        if key is not None and sent.voice is not None:
+            self._speech_cache.set_file_id(key, sent.voice.file_id)
+
+    async def _download_file(self, file_id: str) -> bytes:
+        with stage("telegram_download"):
+            file_info = await self._bot.get_file(file_id)
+            return await self._bot.download_file(file_info.file_path)
+
+    async def _reply_with_answer(self, message: types.Message, text: str, content_source: str,
+                                  superseded: Optional[Callable[[], bool]] = None) -> None:
+        """
+        Ask GPT and reply with its answer. When streaming, a placeholder reply is sent right away
+        and edited with the answer as it is generated.
+
+        Args:
+            message: The incoming message from the user.
+            text: The text sent to GPT.
+            content_source: The content source of the message (text or audio).
+            superseded: Checks if a newer message made the answer unnecessary, in which case no reply is left.
+        """
+        if not self._stream:
+            gpt_response = await self._openai_api.ask_gpt(str(message.chat.id), text, content_source, superseded)
+            if superseded is not None and superseded():
+                return
+            for reply in self._answer_replies(gpt_response):
+                with stage("telegram_send"):
+                    await self._bot.reply_to(message, reply)
+            return
+
+        with stage("telegram_send"):
+            reply = await self._bot.reply_to(message, STREAM_PLACEHOLDER)
+        streamed = StreamedReply(self._edit_interval)
+        async for part in self._openai_api.ask_gpt_stream(str(message.chat.id), text, content_source, superseded):
+            edit = streamed.add(part)
+            if edit is not None:
+                with stage("telegram_send"):
+                    await self._bot.edit_message_text(edit, message.chat.id, reply.message_id)
+                streamed.edited()
+
+        if superseded is not None and superseded():
+            await self._bot.delete_message(message.chat.id, reply.message_id)
+            return
+        if streamed.answer.strip() == "":
+            await self._bot.delete_message(message.chat.id, reply.message_id)
+            raise Exception("Empty answer from gpt")
+        edit = streamed.final_edit()
+        if edit is not None:
+            with stage("telegram_send"):
+                await self._bot.edit_message_text(edit, message.chat.id, reply.message_id)
+        for overflow in streamed.overflow():
+            with stage("telegram_send"):
+                await self._bot.reply_to(message, overflow)
+
+    async def handle_text_message(self, message: types.Message) -> None:
+        """
+        Handle user text messages and generate responses.
+
+        Args:
+            message: The incoming message from the user.
+        """
+        try:
+            if "private" == message.chat.type:
+                await self._reply_with_answer(message, message.text, "text")
+        except Exception as e:
+            report_error("handle_text_message", e)
+            await self._bot.reply_to(message, "Desculpe, ocorreu um erro ao processar a mensagem de texto.")
+
+    async def handle_message_batch(self, batch: MessageBatch) -> None:
+        """
+        Handle a burst of user text messages with a single response, unless newer messages supersede it.
+
+        Args:
+            batch: The messages sent by the user in a burst.
+        """
+        try:
+            if "private" == batch.last.chat.type:
+                await self._reply_with_answer(batch.last, batch.text, "text", batch.superseded)
+        except Exception as e:
+            report_error("handle_message_batch", e)
+            await self._bot.reply_to(batch.last, "Desculpe, ocorreu um erro ao processar a mensagem de texto.")
+
+    async def delete_user_messages(self, message: types.Message, client: MessageStore) -> None:
+        """
+        Delete all messages from a user in the background, replying right away and again once they are deleted.
+
+        Args:
+            message: The incoming message from the user.
+            client: The async store of the messages.
+        """
+        try:
+            # the messages are no longer read from now on, while the deletion runs
+            deletion = client.clear_user_messages(str(message.chat.id))
+            # the memory waits for its writes and deletes its files, so it is forgotten in a worker thread
+            await asyncio.to_thread(self._openai_api.forget_user, str(message.chat.id))
+            # like the messages, the summary is deleted on the maintenance thread of the store
+            client.clear_user_messages(summary_sid(str(message.chat.id)))
+            await self._bot.reply_to(message, DELETING_MESSAGE)
+            # the chat goes on while the messages are deleted
+            report = asyncio.ensure_future(self._report_deletion(message, asyncio.wrap_future(deletion)))
+            self._deletion_reports.add(report)
+            report.add_done_callback(self._deletion_reports.discard)
+        except Exception as e:
+            report_error("delete_user_messages", e)
+            await self._bot.reply_to(message, "Desculpe, ocorreu um erro ao deletar as mensagens.")
+
+    async def _report_deletion(self, message: types.Message, deletion: "asyncio.Future[Dict[str, int]]") -> None:
+        try:
+            await self._bot.reply_to(message, self._deletion_reply(await deletion))
+        except Exception as e:
+            report_error("delete_user_messages", e)
+            await self._bot.reply_to(message, "Desculpe, ocorreu um erro ao deletar as mensagens.")
@@ -0,0 +1,184 @@
+from src.metrics import stage
+from typing import BinaryIO, Iterator, Optional
+import subprocess
+import threading
+
+# Opus always counts the granule position in samples at 48 kHz
+OPUS_GRANULE_RATE = 48000
+# the fixed part of an OGG page header, followed by its segment table
+OGG_PAGE_HEADER_SIZE = 27
+
+
+def ogg_opus_duration(data: bytes) -> float:
+    """
+    Read the duration of an OGG/Opus file from its headers, without decoding it.
+
+    Args:
+        data: The content of the file.
+
+    Returns:
+        The duration in seconds.
+    """
+    pre_skip = None
+    serial = None
+    granule_position = -1
+    offset = 0
+    # the pages are walked from the start, as their capture pattern may also appear inside the audio
+    while len(data) >= offset + OGG_PAGE_HEADER_SIZE:
+        if data[offset:offset + 4] != b"OggS" or data[offset + 4] != 0:
+            break
+        num_segments = data[offset + 26]
+        body = offset + OGG_PAGE_HEADER_SIZE + num_segments
+        end = body + sum(data[offset + OGG_PAGE_HEADER_SIZE:body])
+        if end > len(data):
+            break
+        page_serial = data[offset + 14:offset + 18]
+        if pre_skip is None:
+            if data[body:body + 8] != b"OpusHead" or end < body + 12:
+                break
+            pre_skip = int.from_bytes(data[body + 10:body + 12], "little")
+            serial = page_serial
+        elif page_serial == serial:
+            position = int.from_bytes(data[offset + 6:offset + 14], "little", signed=True)
+            # a page where no packet ends has no granule position
+            if position != -1:
+                granule_position = position
+        offset = end
+    if pre_skip is None:
+        raise ValueError("Not an OGG/Opus file")
+    return max(granule_position - pre_skip, 0) / OPUS_GRANULE_RATE
+
+
+def _write_input(pipe: BinaryIO, data: bytes) -> None:
+    try:
+        pipe.write(data)
+        pipe.close()
+    except (BrokenPipeError, ValueError):
+        # the decoder was stopped before reading the whole input
+        pass
+
+
+def iter_pcm(data: bytes, frame_rate: int = 16000, chunk_size: int = 32000) -> Iterator[bytes]:
+    """
+    Decode an OGG/Opus file in memory to the PCM format expected by the speech recognition,
+    mono with 16-bit samples, yielding the samples as soon as ffmpeg decodes them.
+
+    Args:
+        data: The content of the file.
+        frame_rate: The sample rate of the decoded audio.
+        chunk_size: The maximum size of each chunk of samples.
+
+    Returns:
+        An iterator over the chunks of PCM samples.
+    """
+    # the decoding overlaps the recognition reading it, so the stage lasts until ffmpeg is done
+    with stage("transcode"):
+        yield from _decode_pcm(data, frame_rate, chunk_size)
+
+
+def _decode_pcm(data: bytes, frame_rate: int, chunk_size: int, timeout: Optional[float] = None) -> Iterator[bytes]:
+    # pydub looks for ffmpeg on the PATH when imported, so it is only imported for voice messages
+    from pydub import AudioSegment
+
+    process = subprocess.Popen(
+        [AudioSegment.converter, "-loglevel", "error", "-f", "ogg", "-i", "pipe:0",
+         "-f", "s16le", "-ac", "1", "-ar", str(frame_rate), "pipe:1"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    # the input is written from another thread, so ffmpeg never blocks on a full output pipe
+    writer = threading.Thread(target=_write_input, args=(process.stdin, data), daemon=True)
+    writer.start()
+    # a decode that hangs is killed, which ends the output and fails the job
+    watchdog = None if timeout is None else threading.Timer(timeout, process.kill)
+    if watchdog is not None:
+        watchdog.daemon = True
+        watchdog.start()
+    try:
+        while True:
+            chunk = process.stdout.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        if process.wait() != 0:
+            if watchdog is not None and watchdog.finished.is_set():
+                raise TimeoutError("Failed to decode the audio: ffmpeg took longer than {} s".format(timeout))
+            raise Exception("Failed to decode the audio: ffmpeg exited with code {}".format(process.returncode))
+    finally:
+        if watchdog is not None:
+            watchdog.cancel()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        writer.join()
+
+
+def decode_to_pcm(data: bytes, frame_rate: int = 16000) -> bytes:
+    """
+    Decode an OGG/Opus file in memory to the PCM format expected by the speech recognition,
+    mono with 16-bit samples.
+
+    Args:
+        data: The content of the file.
+        frame_rate: The sample rate of the decoded audio.
+
+    Returns:
+        The PCM samples.
+    """
+    return b"".join(iter_pcm(data, frame_rate))
+
+
+class Transcoder:
+    """
+    Decodes the voice messages with at most a given number of ffmpeg processes at a time, so a burst
+    of voice messages does not start a process for each one and slow them all down on the CPUs,
+    and kills the decodes that take longer than a timeout.
+    """
+
+    def __init__(self, max_processes: int = 2, timeout: float = 60.0) -> None:
+        """
+        Initialize the transcoder.
+
+        Args:
+            max_processes: The maximum number of ffmpeg processes running at the same time.
+            timeout: The maximum time in seconds to wait for a free process, and then for each decode.
+        """
+        self._timeout = timeout
+        self._processes = threading.BoundedSemaphore(max_processes)
+
+    def iter_pcm(self, data: bytes, frame_rate: int = 16000, chunk_size: int = 32000) -> Iterator[bytes]:
+        """
+        Decode an OGG/Opus file in memory to the PCM format expected by the speech recognition,
+        once a process is free, yielding the samples as soon as ffmpeg decodes them. The wait for a
+        process starts when the first chunk is read.
+
+        Args:
+            data: The content of the file.
+            frame_rate: The sample rate of the decoded audio.
+            chunk_size: The maximum size of each chunk of samples.
+
+        Returns:
+            An iterator over the chunks of PCM samples.
+        """
+        with stage("transcode_wait"):
+            if not self._processes.acquire(timeout=self._timeout):
+                raise TimeoutError("Failed to decode the audio: no ffmpeg process free after {} s".format(
+                    self._timeout))
+        try:
+            with stage("transcode"):
+                yield from _decode_pcm(data, frame_rate, chunk_size, self._timeout)
+        finally:
+            self._processes.release()
+
+    def decode_to_pcm(self, data: bytes, frame_rate: int = 16000) -> bytes:
+        """
+        Decode an OGG/Opus file in memory to the PCM format expected by the speech recognition,
+        once a process is free.
+
+        Args:
+            data: The content of the file.
+            frame_rate: The sample rate of the decoded audio.
+
+        Returns:
+            The PCM samples.
+        """
+        return b"".join(self.iter_pcm(data, frame_rate))
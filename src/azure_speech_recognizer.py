@@ -1,78 +1,245 @@
-import azure.cognitiveservices.speech as speechsdk
+import importlib
+import itertools
 import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from src.metrics import stage
+from src.rate_limiter import RateLimiter, backoff_delay
+from typing import TYPE_CHECKING, Iterable, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    import azure.cognitiveservices.speech as speechsdk
+
+VOICE_NAME = "pt-BR-AntonioNeural"
+# Telegram plays OGG/Opus as a voice message, so the synthesized audio is sent as is
+OUTPUT_FORMAT = "Ogg16Khz16BitMonoOpus"
+
+
+def _speechsdk():
+    # the speech SDK loads a large native library, and most updates never need it, so it is imported on first use
+    return importlib.import_module("azure.cognitiveservices.speech")
+
+
+def _retryable_cancellations() -> Tuple:
+    # the cancellations worth retrying, as the same synthesis may succeed later
+    speechsdk = _speechsdk()
+    return (speechsdk.CancellationErrorCode.TooManyRequests,
+            speechsdk.CancellationErrorCode.ServiceUnavailable,
+            speechsdk.CancellationErrorCode.ServiceTimeout,
+            speechsdk.CancellationErrorCode.ConnectionFailure)
 
 
 class AzureSpeechRecognizer:
     """
     A class for performing speech recognition and speech synthesis using Azure Speech Service.
+
+    Synthesizers are reused between requests, while a recognizer is bound to the stream it reads,
+    so each request takes a fresh one and another is prepared in the background. Both are kept
+    in pools with their connections already open. The speech SDK is loaded on the first request,
+    or when the pools are warmed up.
     """
 
-    def __init__(self, speech_key: str, speech_region: str):
+    def __init__(self, speech_key: str, speech_region: str, pool_size: int = 2, recognition_timeout: float = 300.0,
+                 rate_limiter: Optional[RateLimiter] = None, max_retries: int = 3):
         """
         Initialize the Azure Speech Recognizer.
 
         Args:
             speech_key: The Azure Speech Service subscription key.
             speech_region: The Azure region for the Speech Service.
+            pool_size: The number of idle synthesizers and recognizers kept ready.
+            recognition_timeout: The maximum time in seconds to wait for a recognition.
+            rate_limiter: The rate limiter of the requests, by default the 20 per second of a standard resource.
+            max_retries: The maximum number of times a failed synthesis is retried.
         """
-        self._speech_config = speechsdk.SpeechConfig(
-            subscription=speech_key, region=speech_region)
-        self._speech_config.speech_recognition_language = "pt-BR"
-        self._speech_config.speech_synthesis_voice_name = "pt-BR-AntonioNeural"
+        self._speech_key = speech_key
+        self._speech_region = speech_region
+        self._speech_config_lock = threading.Lock()
+        self._speech_config: Optional["speechsdk.SpeechConfig"] = None
+        self._pool_size = pool_size
+        self._recognition_timeout = recognition_timeout
+        self._synthesizers: "queue.Queue[speechsdk.SpeechSynthesizer]" = queue.Queue()
+        self._recognizers: "queue.Queue[Tuple[speechsdk.SpeechRecognizer, speechsdk.audio.PushAudioInputStream]]" = queue.Queue()
+        self._refill_executor = ThreadPoolExecutor(max_workers=1)
+        self._rate_limiter = rate_limiter or RateLimiter(1200)
+        self._max_retries = max_retries
 
-    def convert_text_to_speech(self, text: str, filename: str) -> bool:
+    @property
+    def voice_name(self) -> str:
+        """
+        The name of the voice used by the speech synthesis.
+        """
+        return VOICE_NAME
+
+    @property
+    def output_format(self) -> str:
+        """
+        The name of the audio format produced by the speech synthesis.
+        """
+        return OUTPUT_FORMAT
+
+    def _config(self) -> "speechsdk.SpeechConfig":
+        with self._speech_config_lock:
+            if self._speech_config is None:
+                speechsdk = _speechsdk()
+                speech_config = speechsdk.SpeechConfig(subscription=self._speech_key, region=self._speech_region)
+                speech_config.speech_recognition_language = "pt-BR"
+                speech_config.speech_synthesis_voice_name = VOICE_NAME
+                speech_config.set_speech_synthesis_output_format(
+                    getattr(speechsdk.SpeechSynthesisOutputFormat, OUTPUT_FORMAT))
+                self._speech_config = speech_config
+            return self._speech_config
+
+    def warm_up(self) -> None:
+        """
+        Fill the pools, opening the connections of the synthesizers and recognizers ahead of the requests.
         """
-        Convert text to speech audio file using Azure Speech Service.
+        try:
+            while self._synthesizers.qsize() < self._pool_size:
+                self._synthesizers.put(self._create_synthesizer())
+            while self._recognizers.qsize() < self._pool_size:
+                self._recognizers.put(self._create_recognizer())
+        except Exception as e:
+            logging.error("Error warming up the speech service connections: {}".format(str(e)))
+
+    def _create_synthesizer(self) -> "speechsdk.SpeechSynthesizer":
+        speechsdk = _speechsdk()
+        # without an audio config the audio is kept in the result instead of played
+        speech_synthesizer = speechsdk.SpeechSynthesizer(speech_config=self._config(), audio_config=None)
+        speechsdk.Connection.from_speech_synthesizer(speech_synthesizer).open(True)
+        return speech_synthesizer
+
+    def _create_recognizer(self) -> Tuple["speechsdk.SpeechRecognizer", "speechsdk.audio.PushAudioInputStream"]:
+        speechsdk = _speechsdk()
+        speech_config = self._config()
+        stream = speechsdk.audio.PushAudioInputStream()
+        audio_config = speechsdk.audio.AudioConfig(stream=stream)
+        speech_recognizer = speechsdk.SpeechRecognizer(
+            language=speech_config.speech_recognition_language,
+            speech_config=speech_config, audio_config=audio_config)
+        speechsdk.Connection.from_recognizer(speech_recognizer).open(True)
+        return speech_recognizer, stream
+
+    def _add_recognizer(self) -> None:
+        try:
+            if self._recognizers.qsize() < self._pool_size:
+                self._recognizers.put(self._create_recognizer())
+        except Exception as e:
+            logging.error("Error preparing a speech recognizer: {}".format(str(e)))
+
+    @staticmethod
+    def _write_stream(stream: "speechsdk.audio.PushAudioInputStream", audio: Iterable[bytes]) -> None:
+        try:
+            for chunk in audio:
+                stream.write(chunk)
+        finally:
+            # closing the stream ends the recognition once the audio written is recognized
+            stream.close()
+
+    def convert_text_to_speech(self, text: str) -> Optional[bytes]:
+        """
+        Convert text to speech audio using Azure Speech Service.
 
         Args:
             text: The text to be converted to speech.
-            filename: The audio filename.
 
         Returns:
-            True if the speech synthesis is successful, False otherwise.
+            The OGG/Opus audio, or None if the speech synthesis fails.
         """
-        audio_config = speechsdk.audio.AudioOutputConfig(filename=filename)
-        speech_synthesizer = speechsdk.SpeechSynthesizer(
-            speech_config=self._speech_config, audio_config=audio_config)
-
-        result = speech_synthesizer.speak_text_async(text).get()
-
-        if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
-            return True
-        elif result.reason == speechsdk.ResultReason.Canceled:
-            cancellation_details = result.cancellation_details
-            logging.error("Speech synthesis canceled: {}".format(
-                cancellation_details.reason))
-            if cancellation_details.reason == speechsdk.CancellationReason.Error:
-                logging.error("Error details: {}".format(
-                    cancellation_details.error_details))
-        else:
-            logging.error("Unknown speech synthesis error.")
-        return False
+        speechsdk = _speechsdk()
+        attempt = 0
+        while True:
+            try:
+                speech_synthesizer = self._synthesizers.get_nowait()
+            except queue.Empty:
+                speech_synthesizer = speechsdk.SpeechSynthesizer(speech_config=self._config(), audio_config=None)
+
+            self._rate_limiter.acquire()
+            with stage("azure_tts"):
+                result = speech_synthesizer.speak_text_async(text).get()
 
-    def convert_speech_to_text(self, filename: str) -> str:
+            if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
+                if self._synthesizers.qsize() < self._pool_size:
+                    self._synthesizers.put(speech_synthesizer)
+                return result.audio_data
+            elif result.reason == speechsdk.ResultReason.Canceled:
+                cancellation_details = result.cancellation_details
+                if cancellation_details.reason == speechsdk.CancellationReason.Error and \
+                        cancellation_details.error_code in _retryable_cancellations() and attempt < self._max_retries:
+                    delay = backoff_delay(attempt)
+                    if cancellation_details.error_code == speechsdk.CancellationErrorCode.TooManyRequests:
+                        self._rate_limiter.pause(delay)
+                    logging.warning("Retrying the speech synthesis in {:.1f} s: {}".format(
+                        delay, cancellation_details.error_details))
+                    time.sleep(delay)
+                    attempt += 1
+                    continue
+                logging.error("Speech synthesis canceled: {}".format(
+                    cancellation_details.reason))
+                if cancellation_details.reason == speechsdk.CancellationReason.Error:
+                    logging.error("Error details: {}".format(
+                        cancellation_details.error_details))
+            else:
+                logging.error("Unknown speech synthesis error.")
+            return None
+
+    def convert_speech_to_text(self, audio: Iterable[bytes]) -> str:
         """
-        Convert speech audio file to text using Azure Speech Service.
+        Convert speech audio to text using Azure Speech Service. The audio is recognized
+        continuously while it is written, one utterance at a time, so it has no length limit.
 
         Args:
-            filename: The audio filename.
+            audio: The chunks of PCM audio, 16 kHz mono with 16-bit samples.
 
         Returns:
             The text converted from speech, or None if the recognition fails.
         """
-        audio_config = speechsdk.audio.AudioConfig(filename=filename)
-        speech_recognizer = speechsdk.SpeechRecognizer(
-            language=self._speech_config.speech_recognition_language,
-            speech_config=self._speech_config, audio_config=audio_config)
+        speechsdk = _speechsdk()
+        # the decoding starts before the recognition, so the wait for a decoder and its first samples
+        # is not spent with a recognition session open
+        audio = iter(audio)
+        first = next(audio, None)
+        if first is not None:
+            audio = itertools.chain([first], audio)
+        try:
+            speech_recognizer, stream = self._recognizers.get_nowait()
+        except queue.Empty:
+            speech_recognizer, stream = self._create_recognizer()
+        self._refill_executor.submit(self._add_recognizer)
+        self._rate_limiter.acquire()
+
+        segments: List[str] = []
+        errors: List[str] = []
+        stopped = threading.Event()
+
+        def recognized(evt: "speechsdk.SpeechRecognitionEventArgs") -> None:
+            if evt.result.reason == speechsdk.ResultReason.RecognizedSpeech and evt.result.text:
+                segments.append(evt.result.text)
+
+        def canceled(evt: "speechsdk.SpeechRecognitionCanceledEventArgs") -> None:
+            # the recognition is also canceled when it reaches the end of the stream
+            if evt.cancellation_details.reason == speechsdk.CancellationReason.Error:
+                errors.append(evt.cancellation_details.error_details)
+            stopped.set()
 
-        result = speech_recognizer.recognize_once_async().get()
+        speech_recognizer.recognized.connect(recognized)
+        speech_recognizer.canceled.connect(canceled)
+        speech_recognizer.session_stopped.connect(lambda evt: stopped.set())
+        with stage("azure_stt"):
+            speech_recognizer.start_continuous_recognition_async().get()
+            try:
+                self._write_stream(stream, audio)
+                if not stopped.wait(self._recognition_timeout):
+                    logging.error("Speech recognition timed out.")
+            finally:
+                speech_recognizer.stop_continuous_recognition_async().get()
 
-        if result.reason == speechsdk.ResultReason.RecognizedSpeech:
-            return result.text
-        elif result.reason == speechsdk.ResultReason.NoMatch:
+        if len(errors) > 0:
+            logging.error("Speech recognition canceled: {}".format(errors[0]))
+        elif len(segments) == 0:
             logging.error("Speech not recognized.")
-        elif result.reason == speechsdk.ResultReason.Canceled:
-            logging.error("Speech recognition canceled.")
         else:
-            logging.error("Unknown speech recognition error.")
+            return " ".join(segments)
         return None
@@ -0,0 +1,227 @@
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from src.metrics import QUEUE_SECONDS, REQUEST_SECONDS
+from typing import Any, Callable, Deque, Dict, Optional
+
+
+class LaneStats:
+    """
+    The queue depth and wait time of the handlers of a lane.
+    """
+
+    def __init__(self) -> None:
+        self.depth = 0  # handlers queued or running
+        self.max_depth = 0
+        self.started = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "started": self.started,
+            "rejected": self.rejected,
+            "mean_wait": self.total_wait / self.started if self.started > 0 else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+class _Task:
+    def __init__(self, chat_id: int, lane: str, handler: Callable, args: tuple) -> None:
+        self.chat_id = chat_id
+        self.lane = lane
+        self.handler = handler
+        self.args = args
+        self.submitted = time.monotonic()
+        # the handler runs in the context it was submitted from, keeping its trace ID
+        self.context = contextvars.copy_context()
+
+
+class ChatScheduler:
+    """
+    Runs the handlers of each chat one at a time and in the order they were submitted, while the
+    handlers of different chats run in parallel on a bounded pool of workers per lane, so a slow
+    kind of request never takes the workers of the others.
+    """
+
+    def __init__(self, lanes: Dict[str, int], max_queue: int = 100, max_chat_queue: int = 10) -> None:
+        """
+        Initialize the scheduler.
+
+        Args:
+            lanes: The number of workers of each lane.
+            max_queue: The maximum number of handlers queued or running in a lane.
+            max_chat_queue: The maximum number of handlers queued or running for a chat.
+        """
+        self._max_queue = max_queue
+        self._max_chat_queue = max_chat_queue
+        self._stats = {lane: LaneStats() for lane in lanes}
+        # the handlers waiting for the running one of each chat
+        self._chats: Dict[int, Deque[_Task]] = {}
+        self._lock = threading.Lock()
+        self._workers = self._create_workers(lanes)
+
+    def _create_workers(self, lanes: Dict[str, int]) -> Dict[str, Any]:
+        return {lane: ThreadPoolExecutor(workers, thread_name_prefix="{}-lane".format(lane))
+                for lane, workers in lanes.items()}
+
+    def submit(self, chat_id: int, lane: str, handler: Callable, *args) -> bool:
+        """
+        Schedule a handler to run after the ones submitted before for the same chat.
+
+        Args:
+            chat_id: The chat ID.
+            lane: The lane the handler runs on.
+            handler: The handler.
+            args: The arguments of the handler.
+
+        Returns:
+            False if the handler was rejected because the lane or the chat has too many handlers waiting.
+        """
+        task = _Task(chat_id, lane, handler, args)
+        with self._lock:
+            stats = self._stats[lane]
+            waiting = self._chats.get(chat_id)
+            if stats.depth >= self._max_queue or (waiting is not None and len(waiting) + 1 >= self._max_chat_queue):
+                stats.rejected += 1
+                logging.warning("Rejected a handler in the {} lane: {}".format(lane, stats.as_dict()))
+                return False
+            stats.depth += 1
+            stats.max_depth = max(stats.max_depth, stats.depth)
+            if waiting is not None:
+                waiting.append(task)
+                return True
+            self._chats[chat_id] = deque()
+        self._start(task)
+        return True
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Get the queue depth and wait time metrics of each lane.
+
+        Returns:
+            The metrics of each lane, with the wait times in seconds.
+        """
+        with self._lock:
+            return {lane: stats.as_dict() for lane, stats in self._stats.items()}
+
+    def shutdown(self) -> None:
+        """
+        Wait for the handlers already submitted and stop the workers.
+        """
+        # a finished handler may still start the next one of its chat in another lane
+        while True:
+            with self._lock:
+                if len(self._chats) == 0:
+                    break
+            time.sleep(0.05)
+        for executor in self._workers.values():
+            executor.shutdown(wait=True)
+
+    def _start(self, task: _Task) -> None:
+        self._workers[task.lane].submit(task.context.run, self._run, task)
+
+    def _run(self, task: _Task) -> None:
+        self._on_started(task)
+        start = time.perf_counter()
+        try:
+            task.handler(*task.args)
+        except Exception as e:
+            logging.error("Error handling a message: {}".format(str(e)))
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, lane=task.lane)
+            next_task = self._on_finished(task)
+            if next_task is not None:
+                self._start(next_task)
+
+    def _on_started(self, task: _Task) -> None:
+        wait = time.monotonic() - task.submitted
+        QUEUE_SECONDS.observe(wait, lane=task.lane)
+        with self._lock:
+            stats = self._stats[task.lane]
+            stats.started += 1
+            stats.total_wait += wait
+            stats.max_wait = max(stats.max_wait, wait)
+
+    def _on_finished(self, task: _Task) -> Optional[_Task]:
+        with self._lock:
+            self._stats[task.lane].depth -= 1
+            waiting = self._chats[task.chat_id]
+            if len(waiting) == 0:
+                del self._chats[task.chat_id]
+                return None
+            return waiting.popleft()
+
+
+class AsyncChatScheduler(ChatScheduler):
+    """
+    An asyncio scheduler running the handlers of each chat one at a time and in order, with the
+    handlers of different chats running concurrently up to the limit of each lane.
+    """
+
+    def __init__(self, lanes: Dict[str, int], max_queue: int = 100, max_chat_queue: int = 10) -> None:
+        """
+        Initialize the async scheduler.
+
+        Args:
+            lanes: The maximum number of handlers running at the same time in each lane.
+            max_queue: The maximum number of handlers queued or running in a lane.
+            max_chat_queue: The maximum number of handlers queued or running for a chat.
+        """
+        super().__init__(lanes, max_queue, max_chat_queue)
+        self._tasks = set()
+
+    def _create_workers(self, lanes: Dict[str, int]) -> Dict[str, Any]:
+        return {lane: asyncio.Semaphore(workers) for lane, workers in lanes.items()}
+
+    def submit(self, chat_id: int, lane: str, handler: Callable, *args) -> bool:
+        """
+        Schedule a coroutine function to run after the ones submitted before for the same chat.
+        Must be called from the event loop.
+
+        Args:
+            chat_id: The chat ID.
+            lane: The lane the handler runs on.
+            handler: The coroutine function.
+            args: The arguments of the handler.
+
+        Returns:
+            False if the handler was rejected because the lane or the chat has too many handlers waiting.
+        """
+        return super().submit(chat_id, lane, handler, *args)
+
+    async def shutdown(self) -> None:
+        """
+        Wait for the handlers already submitted.
+        """
+        while len(self._tasks) > 0:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def _start(self, task: _Task) -> None:
+        # a reference is kept so the task is not garbage collected while it runs
+        running = asyncio.get_running_loop().create_task(self._run(task), context=task.context)
+        self._tasks.add(running)
+        running.add_done_callback(self._tasks.discard)
+
+    async def _run(self, task: _Task) -> None:
+        try:
+            async with self._workers[task.lane]:
+                self._on_started(task)
+                start = time.perf_counter()
+                try:
+                    await task.handler(*task.args)
+                finally:
+                    REQUEST_SECONDS.observe(time.perf_counter() - start, lane=task.lane)
+        except Exception as e:
+            logging.error("Error handling a message: {}".format(str(e)))
+        finally:
+            next_task = self._on_finished(task)
+            if next_task is not None:
+                self._start(next_task)
@@ -0,0 +1,369 @@
+import contextvars
+import datetime
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import unicodedata
+import zlib
+import numpy as np
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from src.message_store import MessageStore
+from src.metrics import stage
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# the words too common to tell the messages apart
+STOPWORDS = frozenset("""
+a ao aos as at e é o os da das de do dos em na nas no nos num numa um uma uns umas para pra pro por pelo pela
+pelos pelas com sem que se me te lhe nos vos eu tu ele ela eles elas você voce vocês voces meu minha meus minhas
+teu tua seu sua seus suas isso isto esse essa este esta aquele aquela mais menos muito muita ja já nao não sim
+mas ou como quando onde qual quais quem foi ser ter tem tenho está esta estou são sao era há ha vai vou the an
+of to and or is are was in on it for you i my me what
+""".split())
+
+
+def _normalize(text: str) -> str:
+    # the accents are dropped, so a word typed without them still matches
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+class HashingEmbedder:
+    """
+    Embeds texts locally, hashing their words and the character trigrams of the longer ones into a vector
+    of a fixed size, so similar wordings get close vectors without a model or a request to an API.
+    """
+
+    def __init__(self, dimensions: int = 512) -> None:
+        """
+        Initialize the embedder.
+
+        Args:
+            dimensions: The size of the vectors.
+        """
+        self.dimensions = dimensions
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed texts.
+
+        Args:
+            texts: The texts.
+
+        Returns:
+            A matrix with the unit vector of each text in a row, or a row of zeros for a text without words.
+        """
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            features, weights = self._features(text)
+            if len(features) == 0:
+                continue
+            # crc32 gives the same hashes in every process, unlike hash()
+            hashes = np.fromiter((zlib.crc32(feature.encode()) for feature in features), dtype=np.uint32,
+                                 count=len(features))
+            signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+            np.add.at(vectors[row], hashes % self.dimensions, signs * weights)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    @staticmethod
+    def _features(text: str) -> Tuple[List[str], np.ndarray]:
+        features = []
+        weights = []
+        for word in re.findall(r"\w+", _normalize(text)):
+            if word in STOPWORDS or len(word) < 2:
+                continue
+            features.append(word)
+            weights.append(1.0)
+            if len(word) >= 4:
+                # the trigrams match the other forms of a word, such as its plural
+                marked = "<{}>".format(word)
+                for i in range(len(marked) - 2):
+                    features.append("#" + marked[i:i + 3])
+                    weights.append(0.25)
+        return features, np.array(weights, dtype=np.float32)
+
+
+class _UserIndex:
+    """
+    The messages of a single user and their vectors, kept in a directory: the vectors as raw float32 rows,
+    mapped in memory when searched, and the messages as JSON lines, read only when recalled. Each message
+    is appended after its vector, so a vector whose message was not written is dropped when reopened.
+    """
+
+    def __init__(self, directory: str, dimensions: int) -> None:
+        self._directory = directory
+        self._vectors_path = os.path.join(directory, "vectors.f32")
+        self._messages_path = os.path.join(directory, "messages.jsonl")
+        self._row_bytes = dimensions * 4
+        self._dimensions = dimensions
+        self._offsets: List[int] = []
+        self._dates: List[str] = []
+        self._roles: List[str] = []
+        self._map: Optional[np.memmap] = None
+        self._deleted = False
+        self._lock = threading.Lock()
+        if os.path.exists(self._messages_path):
+            self._load()
+
+    def _load(self) -> None:
+        with open(self._messages_path, "rb") as messages_file:
+            offset = 0
+            for line in messages_file:
+                if not line.endswith(b"\n"):
+                    break
+                message = json.loads(line)
+                self._offsets.append(offset)
+                self._dates.append(message["created_at"])
+                self._roles.append(message["role"])
+                offset += len(line)
+        # drops what an interrupted append left behind
+        os.truncate(self._messages_path, offset)
+        os.truncate(self._vectors_path, len(self._offsets) * self._row_bytes)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def newest_date(self) -> Optional[str]:
+        return self._dates[-1] if self._dates else None
+
+    def append(self, messages: List[Dict[str, str]], vectors: np.ndarray) -> None:
+        with self._lock:
+            if self._deleted:
+                return
+            os.makedirs(self._directory, exist_ok=True)
+            with open(self._vectors_path, "ab") as vectors_file:
+                vectors_file.write(vectors.astype(np.float32).tobytes())
+            lines = [(json.dumps({"role": message["role"], "content": message["content"],
+                                  "created_at": message["created_at"]}, ensure_ascii=False) + "\n").encode()
+                     for message in messages]
+            with open(self._messages_path, "ab") as messages_file:
+                offset = messages_file.tell()
+                messages_file.write(b"".join(lines))
+            for message, line in zip(messages, lines):
+                self._offsets.append(offset)
+                self._dates.append(message["created_at"])
+                self._roles.append(message["role"])
+                offset += len(line)
+
+    def search(self, vector: np.ndarray, before: str, top_k: int, min_score: float) -> List[Tuple[float, int]]:
+        with self._lock:
+            if self._deleted:
+                return []
+            end = bisect_left(self._dates, before)
+            if end == 0:
+                return []
+            if self._map is None or len(self._map) < end:
+                # the vectors appended since the last search are mapped along with the others
+                self._map = np.memmap(self._vectors_path, dtype=np.float32, mode="r",
+                                      shape=(len(self._offsets), self._dimensions))
+            scores = self._map[:end] @ vector
+        top = np.argpartition(-scores, top_k - 1)[:top_k] if end > top_k else np.arange(end)
+        return sorted(((float(scores[row]), int(row)) for row in top if scores[row] >= min_score), reverse=True)
+
+    def turn(self, row: int, before: str) -> List[int]:
+        # a question is recalled with its answer, and an answer with its question, unless it is sent anyway
+        with self._lock:
+            end = bisect_left(self._dates, before)
+            if self._roles[row] == "user" and row + 1 < end and self._roles[row + 1] == "assistant":
+                return [row, row + 1]
+            if self._roles[row] == "assistant" and row > 0 and self._roles[row - 1] == "user":
+                return [row - 1, row]
+            return [row]
+
+    def read(self, rows: List[int]) -> List[Dict[str, str]]:
+        with self._lock:
+            if self._deleted:
+                return []
+            messages = []
+            with open(self._messages_path, "rb") as messages_file:
+                for row in rows:
+                    messages_file.seek(self._offsets[row])
+                    messages.append(json.loads(messages_file.readline()))
+            return messages
+
+    def close(self) -> None:
+        with self._lock:
+            self._map = None
+
+    def delete(self) -> None:
+        # the searches still holding the index find nothing from now on
+        with self._lock:
+            self._deleted = True
+            self._map = None
+
+
+class ConversationMemory:
+    """
+    Keeps the messages of each user along with their embeddings in local files, to recall the older
+    turns of a conversation relevant to a new message once they left the conversation window.
+
+    The messages are embedded and written in the background, one at a time in the order they are added,
+    and the files of the users recently recalled are kept open.
+    """
+
+    def __init__(self, directory: str, embedder: Optional[HashingEmbedder] = None, top_k: int = 3,
+                 min_score: float = 0.3, max_open_users: int = 256) -> None:
+        """
+        Initialize the conversation memory.
+
+        Args:
+            directory: The directory of the index, created if needed, with a directory per user.
+            embedder: The embedder of the messages, by default a HashingEmbedder. The index is rebuilt
+                if it is changed.
+            top_k: The maximum number of turns recalled for a message.
+            min_score: The minimum cosine similarity of a recalled message to the new one.
+            max_open_users: The number of users whose files are kept open.
+        """
+        self._directory = directory
+        self._embedder = embedder or HashingEmbedder()
+        self._top_k = top_k
+        self._min_score = min_score
+        self._max_open_users = max_open_users
+        self._indexes: OrderedDict[str, _UserIndex] = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory")
+
+    def _user_directory(self, user_sid: str) -> str:
+        return os.path.join(self._directory, re.sub(r"[^\w.-]", "_", user_sid))
+
+    def _index(self, user_sid: str) -> _UserIndex:
+        with self._lock:
+            index = self._indexes.get(user_sid)
+            if index is None:
+                index = _UserIndex(self._user_directory(user_sid), self._embedder.dimensions)
+                self._indexes[user_sid] = index
+                if len(self._indexes) > self._max_open_users:
+                    self._indexes.popitem(last=False)[1].close()
+            else:
+                self._indexes.move_to_end(user_sid)
+            return index
+
+    def add(self, user_sid: str, message: Dict[str, str]) -> None:
+        """
+        Embed and store a message of a user in the background.
+
+        Args:
+            user_sid: The user session ID.
+            message: The message, with its role, content and creation date.
+        """
+        self._executor.submit(contextvars.copy_context().run, self._add, user_sid, [message])
+
+    def _add(self, user_sid: str, messages: List[Dict[str, str]]) -> None:
+        try:
+            with stage("memory_add"):
+                self._index(user_sid).append(messages, self._embedder.embed([message["content"] for message in messages]))
+        except Exception as e:
+            logging.error("Error adding messages to the conversation memory: {}".format(str(e)))
+
+    def recall(self, user_sid: str, message: str, before: str) -> List[List[Dict[str, str]]]:
+        """
+        Find the turns of a conversation most similar to a new message.
+
+        Args:
+            user_sid: The user session ID.
+            message: The new message.
+            before: Only recall messages created before this date, such as the oldest message sent.
+
+        Returns:
+            The turns, most relevant first, each a question and its answer, or a single message,
+            with their roles, contents and creation dates.
+        """
+        try:
+            with stage("memory_recall"):
+                index = self._index(user_sid)
+                hits = index.search(self._embedder.embed([message])[0], before, self._top_k, self._min_score)
+                turns = []
+                seen = set()
+                for _, row in hits:
+                    rows = [turn_row for turn_row in index.turn(row, before) if turn_row not in seen]
+                    if rows:
+                        seen.update(rows)
+                        turns.append(index.read(rows))
+                return [turn for turn in turns if turn]
+        except Exception as e:
+            logging.error("Error recalling the conversation memory: {}".format(str(e)))
+            return []
+
+    def forget(self, user_sid: str) -> None:
+        """
+        Delete the messages of a user, once the messages being added are written.
+
+        Args:
+            user_sid: The user session ID.
+        """
+        self._executor.submit(self._forget, user_sid).result()
+
+    def _forget(self, user_sid: str) -> None:
+        with self._lock:
+            index = self._indexes.pop(user_sid, None)
+            if index is not None:
+                index.delete()
+            shutil.rmtree(self._user_directory(user_sid), ignore_errors=True)
+
+    def flush(self) -> None:
+        """
+        Wait for the messages being added to be written.
+        """
+        self._executor.submit(lambda: None).result()
+
+    def index_messages(self, message_store: MessageStore, page_size: int = 500) -> int:
+        """
+        Add the stored messages of every user to the memory, skipping the ones older than the newest
+        message already in the memory of their user, so it can be built again after it is interrupted.
+        The bot should be stopped meanwhile, so the messages are added in the order they were created.
+
+        Args:
+            message_store: The store of the messages. An async store works too, from another thread.
+            page_size: The number of messages read at once.
+
+        Returns:
+            The number of messages added.
+        """
+        added = 0
+        for page in self._export_pages(message_store, page_size):
+            messages: Dict[str, List[Dict[str, str]]] = {}
+            for message in page:
+                # the summaries are not part of the conversations
+                if message["content_source"] == "summary":
+                    continue
+                newest = self._index(message["user_sid"]).newest_date()
+                if newest is None or message["created_at"] > newest:
+                    messages.setdefault(message["user_sid"], []).append(message)
+            for user_sid, user_messages in messages.items():
+                self._executor.submit(self._add, user_sid, user_messages).result()
+                added += len(user_messages)
+        return added
+
+    @staticmethod
+    def _export_pages(message_store: MessageStore, page_size: int) -> Iterator[List[Dict[str, str]]]:
+        before = (datetime.datetime.utcnow() + datetime.timedelta(days=1)).isoformat()
+        after = None
+        while True:
+            page = message_store.run_maintenance(message_store.export_messages, before, after, None,
+                                                 page_size).result()
+            if len(page) < page_size:
+                if page:
+                    yield page
+                return
+            # the messages sharing the last date may go on in the next page, so they are left to it
+            last = page[-1]["created_at"]
+            kept = [message for message in page if message["created_at"] != last]
+            if not kept:
+                raise Exception("More than {} messages were created at {}".format(page_size, last))
+            yield kept
+            after = kept[-1]["created_at"]
+
+    def close(self) -> None:
+        """
+        Write the messages being added and close the files.
+        """
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for index in self._indexes.values():
+                index.close()
+            self._indexes.clear()
@@ -0,0 +1,178 @@
+import threading
+from typing import Dict, List, Optional, Tuple
+
+SUMMARY_INSTRUCTIONS = "Resuma a conversa a seguir entre um usuário e o chatbot Gepeto em poucos parágrafos, " \
+                       "mantendo os fatos, os pedidos e as preferências do usuário e o que já foi respondido. " \
+                       "Se houver um resumo anterior, incorpore-o ao novo resumo."
+
+ROLE_NAMES = {"user": "Usuário", "assistant": "Gepeto", "system": "Sistema"}
+
+
+def summary_sid(user_sid: str) -> str:
+    """
+    Get the session ID the summaries of a conversation are stored under, next to its messages.
+
+    Args:
+        user_sid: The user session ID.
+
+    Returns:
+        The session ID of the summaries.
+    """
+    return "{}:summary".format(user_sid)
+
+
+class Summary:
+    """
+    The summary of a conversation up to the creation date of the last message it covers.
+    """
+
+    def __init__(self, content: str, cutoff: str) -> None:
+        self.content = content
+        self.cutoff = cutoff
+
+
+class ConversationSummaries:
+    """
+    Keeps a running summary of each conversation, so only the messages newer than it are sent
+    along with it. Once enough messages pile up after the summary, all but the most recent ones
+    are handed out to be folded into a new summary, one refresh at a time per conversation.
+    """
+
+    def __init__(self, recent_messages: int = 6, refresh_every: int = 10) -> None:
+        """
+        Initialize the conversation summaries.
+
+        Args:
+            recent_messages: The number of most recent messages always sent as they are.
+            refresh_every: The number of messages, beyond the recent ones, that triggers a refresh.
+        """
+        self._recent_messages = recent_messages
+        self._refresh_every = refresh_every
+        self._summaries: Dict[str, Optional[Summary]] = {}
+        # the conversations being summarized, with the cutoff of the new summary
+        self._refreshing: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def known(self, user_sid: str) -> bool:
+        """
+        Check if the summary of a conversation was loaded, even if it has none yet.
+
+        Args:
+            user_sid: The user session ID.
+
+        Returns:
+            True if the summary was loaded.
+        """
+        with self._lock:
+            return user_sid in self._summaries
+
+    def load(self, user_sid: str, stored: List[Dict[str, str]]) -> None:
+        """
+        Remember the stored summary of a conversation.
+
+        Args:
+            user_sid: The user session ID.
+            stored: The latest stored summary message, or no message if the conversation has none.
+        """
+        summary = Summary(stored[-1]["content"], stored[-1]["created_at"]) if len(stored) > 0 else None
+        with self._lock:
+            self._summaries.setdefault(user_sid, summary)
+
+    def cutoff(self, user_sid: str) -> Optional[str]:
+        """
+        Get the creation date of the newest message folded into the summary of a conversation.
+
+        Args:
+            user_sid: The user session ID.
+
+        Returns:
+            The cutoff of the summary, or None if the conversation has no summary.
+        """
+        with self._lock:
+            summary = self._summaries.get(user_sid)
+        return None if summary is None else summary.cutoff
+
+    def prompt(self, user_sid: str, window: List[Tuple[Dict[str, str], str]]) -> List[Dict[str, str]]:
+        """
+        Get the messages to send for a conversation: its summary and the messages newer than it.
+
+        Args:
+            user_sid: The user session ID.
+            window: The messages of the conversation window with their creation dates.
+
+        Returns:
+            The messages to send after the system messages.
+        """
+        with self._lock:
+            summary = self._summaries.get(user_sid)
+        if summary is None:
+            return [message for message, _ in window]
+        return [{"role": "system", "content": "Resumo da conversa até aqui: {}".format(summary.content)}] + \
+            [message for message, created_at in window if created_at > summary.cutoff]
+
+    def start_refresh(self, user_sid: str,
+                      window: List[Tuple[Dict[str, str], str]]) -> Optional[Tuple[str, List[Dict[str, str]]]]:
+        """
+        Check if the summary of a conversation is due for a refresh and mark it as being refreshed.
+
+        Args:
+            user_sid: The user session ID.
+            window: The messages of the conversation window with their creation dates.
+
+        Returns:
+            The cutoff of the new summary and the summarization request, with the previous summary
+            and the messages to fold into it, or None if no refresh is due.
+        """
+        with self._lock:
+            if user_sid in self._refreshing:
+                return None
+            summary = self._summaries.get(user_sid)
+            pending = window if summary is None else [(message, created_at) for message, created_at in window
+                                                      if created_at > summary.cutoff]
+            if len(pending) < self._recent_messages + self._refresh_every:
+                return None
+            folded = pending[:len(pending) - self._recent_messages]
+            cutoff = folded[-1][1]
+            self._refreshing[user_sid] = cutoff
+        return cutoff, self._request(summary, [message for message, _ in folded])
+
+    def finish_refresh(self, user_sid: str, cutoff: str, content: Optional[str]) -> Optional[Summary]:
+        """
+        Store the new summary of a conversation.
+
+        Args:
+            user_sid: The user session ID.
+            cutoff: The cutoff returned by start_refresh().
+            content: The new summary, or None if the summarization failed.
+
+        Returns:
+            The new summary, or None if it failed or the conversation was forgotten meanwhile.
+        """
+        with self._lock:
+            if self._refreshing.get(user_sid) != cutoff:
+                return None
+            del self._refreshing[user_sid]
+            if content is None:
+                return None
+            summary = Summary(content, cutoff)
+            self._summaries[user_sid] = summary
+            return summary
+
+    def forget(self, user_sid: str) -> None:
+        """
+        Drop the summary of a conversation, discarding any refresh on its way.
+
+        Args:
+            user_sid: The user session ID.
+        """
+        with self._lock:
+            self._summaries.pop(user_sid, None)
+            self._refreshing.pop(user_sid, None)
+
+    @staticmethod
+    def _request(summary: Optional[Summary], messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        transcript = "\n".join("{}: {}".format(ROLE_NAMES.get(message["role"], message["role"]), message["content"])
+                               for message in messages)
+        if summary is not None:
+            transcript = "Resumo anterior: {}\n\n{}".format(summary.content, transcript)
+        return [{"role": "system", "content": SUMMARY_INSTRUCTIONS}, {"role": "user", "content": transcript}]
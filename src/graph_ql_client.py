@@ -1,24 +1,143 @@
-import datetime
+import asyncio
+import logging
+import threading
 from gql import gql, Client
+from gql.client import AsyncClientSession
 from gql.transport.aiohttp import AIOHTTPTransport
-from typing import List, Dict
+from graphql import DocumentNode, print_schema
+from src.message_store import MessageArchive, MessageStore, new_message
+from src.metrics import stage
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 
-class GraphQLClient:
+INSERT_MESSAGE_MUTATION = gql('''
+    mutation ($data: MessageInsertInput!) {
+        insertOneMessage(data: $data) {
+            _id
+            user_sid
+            role
+            content
+            content_source
+            created_at
+        }
+    }
+''')
+
+GET_MESSAGES_QUERY = gql('''
+    query ($query: MessageQueryInput!) {
+        messages(query: $query, sortBy: CREATED_AT_ASC) {
+            role
+            content
+            created_at
+        }
+    }
+''')
+
+GET_LATEST_MESSAGES_QUERY = gql('''
+    query ($query: MessageQueryInput!, $limit: Int!) {
+        messages(query: $query, limit: $limit, sortBy: CREATED_AT_DESC) {
+            role
+            content
+            created_at
+        }
+    }
+''')
+
+EXPORT_MESSAGES_QUERY = gql('''
+    query ($query: MessageQueryInput!, $limit: Int!) {
+        messages(query: $query, limit: $limit, sortBy: CREATED_AT_ASC) {
+            user_sid
+            role
+            content
+            content_source
+            created_at
+        }
+    }
+''')
+
+INSERT_MESSAGES_MUTATION = gql('''
+    mutation ($data: [MessageInsertInput!]!) {
+        insertManyMessages(data: $data) {
+            insertedIds
+        }
+    }
+''')
+
+DELETE_USER_MESSAGES_MUTATION = gql('''
+    mutation ($user_sid: String!) {
+        deleteManyMessages(query: { user_sid: $user_sid }) {
+            deletedCount
+        }
+    }
+''')
+
+GET_NEWEST_DATES_QUERY = gql('''
+    query ($query: MessageQueryInput!, $limit: Int!) {
+        messages(query: $query, limit: $limit, sortBy: CREATED_AT_DESC) {
+            created_at
+        }
+    }
+''')
+
+DELETE_MESSAGES_MUTATION = gql('''
+    mutation ($query: MessageQueryInput!) {
+        deleteManyMessages(query: $query) {
+            deletedCount
+        }
+    }
+''')
+
+INSERT_ARCHIVES_MUTATION = gql('''
+    mutation ($data: [MessageArchiveInsertInput!]!) {
+        insertManyMessageArchives(data: $data) {
+            insertedIds
+        }
+    }
+''')
+
+DELETE_ARCHIVES_MUTATION = gql('''
+    mutation ($user_sid: String!) {
+        deleteManyMessageArchives(query: { user_sid: $user_sid }) {
+            deletedCount
+        }
+    }
+''')
+
+
+class GraphQLClient(MessageStore):
     """
-    A client for interacting with a GraphQL API.
+    A client for interacting with a GraphQL API, storing the messages in MongoDB Atlas.
     """
 
-    def __init__(self, url: str, api_key: str) -> None:
+    def __init__(self, url: str, api_key: str, cache_size: int = 50000, fetch_schema: bool = False,
+                 schema_path: Optional[str] = None, write_batch_size: int = 50, write_interval: float = 0.5,
+                 archive: Optional[MessageArchive] = None) -> None:
         """
-        Initialize the GraphQL client.
+        Initialize the GraphQL client. The session is opened on the first request.
 
         Args:
             url: The URL of the GraphQL API.
             api_key: The API key for authentication.
+            cache_size: The maximum number of messages kept in the history cache.
+            fetch_schema: Whether to fetch the schema from the API to validate the requests.
+            schema_path: The path of a local schema file used to validate the requests instead.
+            write_batch_size: The number of queued messages that triggers a write.
+            write_interval: The maximum time in seconds a queued message waits to be written.
+            archive: Where the old messages are archived, by default in the MessageArchive collection.
         """
+        schema = None
+        if schema_path is not None:
+            with open(schema_path) as schema_file:
+                schema = schema_file.read()
         transport = AIOHTTPTransport(url=url, headers={'apiKey': api_key})
-        self._client = Client(transport=transport, fetch_schema_from_transport=True)
+        super().__init__(cache_size, write_batch_size, write_interval, archive)
+        self._client = Client(transport=transport, schema=schema,
+                              fetch_schema_from_transport=fetch_schema and schema is None)
+        self._session: Optional[AsyncClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._connect_lock = threading.Lock()
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._flush_timer: Optional[asyncio.TimerHandle] = None
 
     def insert_message(self, user_sid: str, role: str, content: str, content_source: str) -> Dict[str, str]:
         """
@@ -33,69 +152,76 @@ class GraphQLClient:
         Returns:
             The inserted message.
         """
-        insert_query = gql('''
-            mutation ($data: MessageInsertInput!) {
-                insertOneMessage(data: $data) {
-                    _id
-                    user_sid
-                    role
-                    content
-                    content_source
-                    created_at
-                }
-            }
-        ''')
-
-        variables = {
-            'data': {
-                'user_sid': user_sid,
-                'role': role,
-                'content': content,
-                'content_source': content_source,
-                'created_at': datetime.datetime.utcnow().isoformat()
-            }
-        }
+        insert_query, variables = self._insert_request(user_sid, role, content, content_source)
 
         try:
-            response = self._client.execute(insert_query, variable_values=variables)
-            return response['insertOneMessage']
+            with stage("graphql_insert"):
+                response = self._execute(insert_query, variables)
+            return self._on_message_inserted(user_sid, response)
         except Exception as e:
             # Handle any GraphQL API or network-related errors
             raise Exception("Failed to insert message: {}".format(str(e)))
 
-    def get_messages(self, user_sid: str) -> List[Dict[str, str]]:
+    def queue_message(self, user_sid: str, role: str, content: str, content_source: str,
+                      created_at: Optional[str] = None) -> Dict[str, str]:
         """
-        Retrieve messages from the GraphQL API for a given user.
+        Queue a new message to be inserted into the GraphQL API with other messages, without waiting for it.
 
         Args:
             user_sid: The user session ID.
+            role: The role of the message.
+            content: The content of the message.
+            content_source: The content source of the message (text or audio).
+            created_at: The creation date of the message, by default the current time.
 
         Returns:
-            The list of messages.
-        """
-        get_query = gql('''
-            query ($query: MessageQueryInput!) {
-                messages(query: $query, sortBy: CREATED_AT_ASC) {
-                    role
-                    content
-                }
-            }
-        ''')
+            The message to be inserted.
+        """
+        if self._session is None:
+            self._connect()
+        message = new_message(user_sid, role, content, content_source, created_at)
+        full = self._queue(message)
+        self._loop.call_soon_threadsafe(self._schedule_flush, 0 if full else self._write_interval)
+        return message
 
-        variables = {
-            'query': {
-                'user_sid': user_sid
-            }
-        }
+    def flush(self) -> None:
+        """
+        Write the queued messages and wait for it.
+        """
+        self._flush()
+
+    def get_messages(self, user_sid: str, limit: Optional[int] = None, before: Optional[str] = None,
+                     after: Optional[str] = None) -> List[Dict[str, str]]:
+        """
+        Retrieve messages from the GraphQL API for a given user, or from the cache when they are known.
+
+        Args:
+            user_sid: The user session ID.
+            limit: The maximum number of messages to retrieve, keeping the newest ones.
+            before: Only retrieve messages created before this date.
+            after: Only retrieve messages created after this date.
+
+        Returns:
+            The list of messages sorted by creation date.
+        """
+        after = self._visible_after(user_sid, after)
+        messages = self._history_cache.get(user_sid, limit, before, after)
+        if messages is not None:
+            return messages
+
+        if self._has_unsaved_messages(user_sid):
+            self._flush()
+        get_query, variables = self._get_request(user_sid, limit, before, after)
 
         try:
-            response = self._client.execute(get_query, variable_values=variables)
-            return response['messages']
+            with stage("graphql_get"):
+                response = self._execute(get_query, variables)
+            return self._on_messages_fetched(user_sid, response, limit, before, after)
         except Exception as e:
             # Handle any GraphQL API or network-related errors
             raise Exception("Failed to retrieve messages: {}".format(str(e)))
 
-    def delete_user_messages(self, user_sid: str) -> Dict[str, str]:
+    def delete_user_messages(self, user_sid: str) -> Dict[str, int]:
         """
         Delete messages for a given user from the GraphQL API.
 
@@ -105,21 +231,309 @@ class GraphQLClient:
         Returns:
             The deletion result.
         """
-        delete_query = gql('''
-            mutation ($user_sid: String!) {
-                deleteManyMessages(query: { user_sid: $user_sid }) {
-                    deletedCount
-                }
-            }
-        ''')
-
-        variables = {
-            'user_sid': user_sid
-        }
+        if self._has_unsaved_messages(user_sid):
+            self._flush()
+        delete_query, variables = self._delete_request(user_sid)
 
         try:
-            response = self._client.execute(delete_query, variable_values=variables)
+            with stage("graphql_delete"):
+                response = self._execute(delete_query, variables)
             return response['deleteManyMessages']
         except Exception as e:
             # Handle any GraphQL API or network-related errors
             raise Exception("Failed to delete user messages: {}".format(str(e)))
+        finally:
+            # the messages may be partially deleted even if the request failed
+            self._history_cache.invalidate(user_sid)
+
+    def iter_all_messages(self, page_size: int = 500) -> Iterator[List[Dict[str, str]]]:
+        """
+        Walk through the messages of every user in the GraphQL API, to export them.
+
+        Args:
+            page_size: The number of messages of each page.
+
+        Returns:
+            An iterator over the pages of messages, with all their fields, oldest first.
+        """
+        self._flush()
+        after = None
+        while True:
+            variables = {'query': {}, 'limit': page_size}
+            if after is not None:
+                variables['query']['created_at_gt'] = after
+            try:
+                with stage("graphql_get"):
+                    page = self._execute(EXPORT_MESSAGES_QUERY, variables)['messages']
+            except Exception as e:
+                raise Exception("Failed to export messages: {}".format(str(e)))
+            full = len(page) == page_size
+            if full:
+                # the page resumes after its last date, so the messages sharing that date are left to the next one
+                last = page[-1]['created_at']
+                tied = [message for message in page if message['created_at'] == last]
+                if len(tied) == len(page):
+                    logging.warning("More than {} messages were created at {}, some may be skipped".format(len(page), last))
+                else:
+                    page = page[:-len(tied)]
+            if len(page) > 0:
+                yield page
+                after = page[-1]['created_at']
+            if not full:
+                return
+
+    def insert_messages(self, messages: List[Dict[str, str]]) -> None:
+        """
+        Insert messages of any users into the GraphQL API at once and wait for it, to import them.
+
+        Args:
+            messages: The messages, with all their fields.
+        """
+        data = [new_message(message['user_sid'], message['role'], message['content'], message['content_source'],
+                            message['created_at']) for message in messages]
+        try:
+            with stage("graphql_insert"):
+                self._execute(INSERT_MESSAGES_MUTATION, {'data': data})
+        except Exception as e:
+            raise Exception("Failed to insert messages: {}".format(str(e)))
+        finally:
+            for user_sid in set(message['user_sid'] for message in data):
+                self._history_cache.invalidate(user_sid)
+
+    def export_messages(self, before: str, after: Optional[str] = None, user_sid: Optional[str] = None,
+                        limit: int = 500) -> List[Dict[str, str]]:
+        """
+        Retrieve the oldest messages created in a range from the GraphQL API, with all their fields, to archive them.
+
+        Args:
+            before: Only retrieve messages created before this date.
+            after: Only retrieve messages created after this date.
+            user_sid: Only retrieve the messages of this user, instead of every user.
+            limit: The maximum number of messages to retrieve, keeping the oldest ones.
+
+        Returns:
+            The list of messages sorted by creation date.
+        """
+        variables = {'query': {'created_at_lt': before}, 'limit': limit}
+        if after is not None:
+            variables['query']['created_at_gt'] = after
+        if user_sid is not None:
+            variables['query']['user_sid'] = user_sid
+        try:
+            with stage("graphql_get"):
+                return self._execute(EXPORT_MESSAGES_QUERY, variables)['messages']
+        except Exception as e:
+            raise Exception("Failed to export messages: {}".format(str(e)))
+
+    def get_nth_newest_date(self, user_sid: str, n: int) -> Optional[str]:
+        """
+        Get the creation date of the nth newest message of a user from the GraphQL API.
+
+        Args:
+            user_sid: The user session ID.
+            n: The position of the message, 1 for the newest.
+
+        Returns:
+            The creation date, or None if the user has fewer messages.
+        """
+        if self._has_unsaved_messages(user_sid):
+            self._flush()
+        try:
+            with stage("graphql_get"):
+                messages = self._execute(GET_NEWEST_DATES_QUERY, {'query': {'user_sid': user_sid}, 'limit': n})['messages']
+        except Exception as e:
+            raise Exception("Failed to retrieve messages: {}".format(str(e)))
+        return messages[-1]['created_at'] if len(messages) == n else None
+
+    def delete_messages(self, user_sids: List[str], until: str) -> Dict[str, int]:
+        """
+        Delete the messages of some users created up to a date from the GraphQL API and wait for it.
+
+        Args:
+            user_sids: The user session IDs.
+            until: Only delete messages created at or before this date.
+
+        Returns:
+            The deletion result.
+        """
+        if any(self._has_unsaved_messages(user_sid) for user_sid in user_sids):
+            self._flush()
+        try:
+            with stage("graphql_delete"):
+                response = self._execute(DELETE_MESSAGES_MUTATION,
+                                         {'query': {'user_sid_in': user_sids, 'created_at_lte': until}})
+            return response['deleteManyMessages']
+        except Exception as e:
+            raise Exception("Failed to delete messages: {}".format(str(e)))
+        finally:
+            for user_sid in user_sids:
+                self._history_cache.invalidate(user_sid)
+
+    def insert_archive_batches(self, batches: List[Dict[str, Any]]) -> None:
+        """
+        Store archived batches of messages in the MessageArchive collection and wait for it.
+
+        Args:
+            batches: The batches, as made by retention.pack_messages.
+        """
+        try:
+            with stage("graphql_archive"):
+                self._execute(INSERT_ARCHIVES_MUTATION, {'data': batches})
+        except Exception as e:
+            raise Exception("Failed to archive messages: {}".format(str(e)))
+
+    def delete_archive_batches(self, user_sid: str) -> int:
+        """
+        Delete the archived messages of a user from the MessageArchive collection and wait for it.
+
+        Args:
+            user_sid: The user session ID.
+
+        Returns:
+            The number of batches deleted.
+        """
+        try:
+            with stage("graphql_delete"):
+                response = self._execute(DELETE_ARCHIVES_MUTATION, {'user_sid': user_sid})
+            return response['deleteManyMessageArchives']['deletedCount']
+        except Exception as e:
+            raise Exception("Failed to delete archived messages: {}".format(str(e)))
+
+    def close(self) -> None:
+        """
+        Finish the bulk operations and write the queued messages, then close the session and stop its event loop.
+        """
+        self._stop_maintenance()
+        if self._session is None:
+            return
+        self._flush()
+        asyncio.run_coroutine_threadsafe(self._client.close_async(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._session = None
+
+    def _connect(self) -> None:
+        with self._connect_lock:
+            if self._session is not None:
+                return
+            # a single event loop thread keeps the session, and its keep-alive connections, open between calls
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+            self._loop = loop
+            self._session = asyncio.run_coroutine_threadsafe(
+                self._client.connect_async(reconnecting=True, retry_execute=False), loop).result()
+
+    def _flush(self) -> None:
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._flush_async(), self._loop).result()
+
+    def _schedule_flush(self, delay: float) -> None:
+        # runs in the event loop of the session
+        if delay == 0:
+            asyncio.ensure_future(self._flush_async())
+        elif self._flush_timer is None:
+            self._flush_timer = self._loop.call_later(delay, lambda: asyncio.ensure_future(self._flush_async()))
+
+    async def _flush_async(self) -> None:
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        # one batch at a time, so the messages are written in order
+        async with self._flush_lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            batch = self._take_pending()
+            if len(batch) == 0:
+                return
+            try:
+                with stage("graphql_insert"):
+                    await self._session.execute(INSERT_MESSAGES_MUTATION,
+                                                 variable_values={'data': [queued.message for queued in batch]})
+            except Exception as e:
+                dropped = self._retry_later(batch)
+                if len(dropped) > 0:
+                    logging.error("Failed to insert {} messages, dropping them: {}".format(len(dropped), str(e)))
+                if len(dropped) < len(batch):
+                    logging.error("Failed to insert {} messages, retrying: {}".format(len(batch) - len(dropped), str(e)))
+                    self._flush_timer = self._loop.call_later(
+                        self._write_interval, lambda: asyncio.ensure_future(self._flush_async()))
+                return
+            self._on_written(batch)
+
+    def _execute(self, document: DocumentNode, variables: Dict[str, Any]) -> Dict[str, Any]:
+        if self._session is None:
+            self._connect()
+        return asyncio.run_coroutine_threadsafe(
+            self._session.execute(document, variable_values=variables), self._loop).result()
+
+    @staticmethod
+    def _insert_request(user_sid: str, role: str, content: str, content_source: str,
+                        created_at: Optional[str] = None) -> Tuple[DocumentNode, Dict[str, Any]]:
+        variables = {
+            'data': new_message(user_sid, role, content, content_source, created_at)
+        }
+        return INSERT_MESSAGE_MUTATION, variables
+
+    def _on_message_inserted(self, user_sid: str, response: Dict[str, Any]) -> Dict[str, str]:
+        message = response['insertOneMessage']
+        self._history_cache.append(user_sid, {
+            'role': message['role'],
+            'content': message['content'],
+            'created_at': message['created_at']
+        })
+        return message
+
+    @staticmethod
+    def _get_request(user_sid: str, limit: Optional[int], before: Optional[str],
+                     after: Optional[str]) -> Tuple[DocumentNode, Dict[str, Any]]:
+        # the newest messages come first, so the limit keeps them
+        get_query = GET_MESSAGES_QUERY if limit is None else GET_LATEST_MESSAGES_QUERY
+
+        variables = {
+            'query': {
+                'user_sid': user_sid
+            }
+        }
+        if limit is not None:
+            variables['limit'] = limit
+        if before is not None:
+            variables['query']['created_at_lt'] = before
+        if after is not None:
+            variables['query']['created_at_gt'] = after
+        return get_query, variables
+
+    def _on_messages_fetched(self, user_sid: str, response: Dict[str, Any], limit: Optional[int],
+                             before: Optional[str], after: Optional[str]) -> List[Dict[str, str]]:
+        messages = response['messages']
+        if limit is not None:
+            messages.reverse()
+        messages = self._with_pending(user_sid, messages, limit, before, after)
+        self._history_cache.put(user_sid, messages, limit, before, after)
+        return messages
+
+    @staticmethod
+    def _delete_request(user_sid: str) -> Tuple[DocumentNode, Dict[str, Any]]:
+        variables = {
+            'user_sid': user_sid
+        }
+        return DELETE_USER_MESSAGES_MUTATION, variables
+
+
+def download_schema(url: str, api_key: str, schema_path: str) -> None:
+    """
+    Fetch the schema of a GraphQL API and save it to be used as a local schema file.
+
+    Args:
+        url: The URL of the GraphQL API.
+        api_key: The API key for authentication.
+        schema_path: The path of the schema file.
+    """
+    transport = AIOHTTPTransport(url=url, headers={'apiKey': api_key})
+    client = Client(transport=transport, fetch_schema_from_transport=True)
+
+    async def fetch_schema() -> None:
+        async with client:
+            pass
+
+    asyncio.run(fetch_schema())
+    with open(schema_path, "w") as schema_file:
+        schema_file.write(print_schema(client.schema))
@@ -0,0 +1,150 @@
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+
+def _created_at(message: Dict[str, str]) -> str:
+    return message["created_at"]
+
+
+class _Entry:
+    """
+    The newest messages of a user, with no gaps between them.
+    """
+
+    def __init__(self, messages: List[Dict[str, str]], complete: bool) -> None:
+        self.messages = messages
+        self.complete = complete  # True if the messages are the whole history
+
+
+class HistoryCache:
+    """
+    A least recently used cache of the message history of each user.
+
+    Each user entry holds the newest part of the history, which is enough to answer
+    windowed reads and reads of the messages newer than a cursor.
+    """
+
+    def __init__(self, max_messages: int = 50000) -> None:
+        """
+        Initialize the history cache.
+
+        Args:
+            max_messages: The maximum number of messages kept in memory across all users.
+        """
+        self._max_messages = max_messages
+        self._histories: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_sid: str, limit: Optional[int] = None, before: Optional[str] = None,
+            after: Optional[str] = None) -> Optional[List[Dict[str, str]]]:
+        """
+        Get cached messages of a user, with the same filters as MessageStore.get_messages.
+
+        Args:
+            user_sid: The user session ID.
+            limit: The maximum number of messages, keeping the newest ones.
+            before: Only messages created before this date.
+            after: Only messages created after this date.
+
+        Returns:
+            The cached messages sorted by creation date, or None if they are not all cached.
+        """
+        with self._lock:
+            entry = self._histories.get(user_sid)
+            messages = None if entry is None else self._select(entry, limit, before, after)
+            if messages is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._histories.move_to_end(user_sid)
+            return messages
+
+    def put(self, user_sid: str, messages: List[Dict[str, str]], limit: Optional[int] = None,
+            before: Optional[str] = None, after: Optional[str] = None) -> None:
+        """
+        Store messages fetched with the given filters, evicting the least recently used users if needed.
+
+        Args:
+            user_sid: The user session ID.
+            messages: The fetched messages, sorted by creation date.
+            limit: The limit used to fetch the messages.
+            before: The before filter used to fetch the messages.
+            after: The after filter used to fetch the messages.
+        """
+        reached_start = limit is None or len(messages) < limit
+        with self._lock:
+            entry = self._histories.get(user_sid)
+            if before is None:
+                # the newest messages, so they replace what is cached
+                self._remove(user_sid)
+                entry = _Entry(list(messages), complete=after is None and reached_start)
+            elif after is None and entry is not None and entry.messages and \
+                    entry.messages[0]["created_at"] < before:
+                # the page right before the cached messages, which hold every message from the before date on,
+                # as they hold every message newer than their oldest one
+                self._remove(user_sid)
+                newer = entry.messages[bisect_left(entry.messages, before, key=_created_at):]
+                entry = _Entry(list(messages) + newer, complete=reached_start)
+            else:
+                return
+            if len(entry.messages) > self._max_messages:
+                return
+            self._histories[user_sid] = entry
+            self._size += len(entry.messages)
+            self._evict()
+
+    def append(self, user_sid: str, message: Dict[str, str]) -> None:
+        """
+        Append a new message to the history of a user, if it is cached.
+
+        Args:
+            user_sid: The user session ID.
+            message: The message to append.
+        """
+        with self._lock:
+            entry = self._histories.get(user_sid)
+            if entry is None:
+                return
+            entry.messages.append(message)
+            self._size += 1
+            self._histories.move_to_end(user_sid)
+            self._evict()
+
+    def invalidate(self, user_sid: str) -> None:
+        """
+        Remove the history of a user from the cache.
+
+        Args:
+            user_sid: The user session ID.
+        """
+        with self._lock:
+            self._remove(user_sid)
+
+    @staticmethod
+    def _select(entry: _Entry, limit: Optional[int], before: Optional[str],
+                after: Optional[str]) -> Optional[List[Dict[str, str]]]:
+        messages = entry.messages
+        start = 0 if after is None else bisect_right(messages, after, key=_created_at)
+        end = len(messages) if before is None else bisect_left(messages, before, key=_created_at)
+        selected = messages[start:end]
+        if limit is not None and len(selected) >= limit:
+            return selected[len(selected) - limit:]
+        # otherwise every matching message must be cached
+        covered = entry.complete or (after is not None and len(messages) > 0 and
+                                     messages[0]["created_at"] <= after)
+        return selected if covered else None
+
+    def _remove(self, user_sid: str) -> None:
+        entry = self._histories.pop(user_sid, None)
+        if entry is not None:
+            self._size -= len(entry.messages)
+
+    def _evict(self) -> None:
+        while self._size > self._max_messages and self._histories:
+            _, entry = self._histories.popitem(last=False)
+            self._size -= len(entry.messages)
@@ -0,0 +1,99 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+# the command, with the bot name Telegram adds to it in groups
+IMAGE_COMMAND = re.compile(r"^\s*/imagem(@\w+)?(\s+|$)", re.IGNORECASE)
+
+
+def normalize_prompt(text: str) -> str:
+    """
+    Get the prompt of an image request, without the command and the extra whitespace.
+
+    Args:
+        text: The text of the message.
+
+    Returns:
+        The prompt, empty if there is none.
+    """
+    return " ".join(IMAGE_COMMAND.sub("", text, count=1).split())
+
+
+class ImageCache:
+    """
+    A least recently used cache of the Telegram file IDs of the images generated for a prompt,
+    so the same prompt is answered again without generating or uploading them.
+    """
+
+    def __init__(self, max_prompts: int = 1000) -> None:
+        """
+        Initialize the image cache.
+
+        Args:
+            max_prompts: The maximum number of prompts whose images are kept.
+        """
+        self._max_prompts = max_prompts
+        self._file_ids: "OrderedDict[str, List[str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(prompt: str, size: str) -> str:
+        """
+        Get the cache key of the images of a prompt.
+
+        Args:
+            prompt: The normalized prompt.
+            size: The size of the images.
+
+        Returns:
+            The key of the images.
+        """
+        return hashlib.sha256("\0".join((size, prompt.casefold())).encode()).hexdigest()
+
+    def get(self, key: str, count: int) -> Optional[List[str]]:
+        """
+        Get the file IDs of cached images.
+
+        Args:
+            key: The cache key.
+            count: The number of images needed.
+
+        Returns:
+            The file IDs, or None if fewer images are cached.
+        """
+        with self._lock:
+            file_ids = self._file_ids.get(key)
+            if file_ids is None or len(file_ids) < count:
+                self.misses += 1
+                return None
+            self._file_ids.move_to_end(key)
+            self.hits += 1
+            return file_ids[:count]
+
+    def put(self, key: str, file_ids: List[str]) -> None:
+        """
+        Store the file IDs of the images sent for a prompt, evicting the least recently used prompts if needed.
+
+        Args:
+            key: The cache key.
+            file_ids: The Telegram file IDs of the images.
+        """
+        with self._lock:
+            self._file_ids[key] = list(file_ids)
+            self._file_ids.move_to_end(key)
+            while len(self._file_ids) > self._max_prompts:
+                self._file_ids.popitem(last=False)
+
+    def invalidate(self, key: str) -> None:
+        """
+        Forget the images of a prompt, such as when Telegram no longer accepts their file IDs.
+
+        Args:
+            key: The cache key.
+        """
+        with self._lock:
+            self._file_ids.pop(key, None)
@@ -0,0 +1,255 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+from telebot import types
+from typing import Awaitable, Callable, Dict, List
+
+
+class MessageBatch:
+    """
+    The text messages a chat sent in a burst, answered together.
+    """
+
+    def __init__(self, coalescer: "MessageCoalescer", chat_id: int, messages: List[types.Message],
+                 generation: int) -> None:
+        self.chat_id = chat_id
+        self.messages = messages
+        self.generation = generation
+        self._coalescer = coalescer
+
+    @property
+    def last(self) -> types.Message:
+        """
+        The newest message of the batch, which the answer replies to.
+        """
+        return self.messages[-1]
+
+    @property
+    def text(self) -> str:
+        """
+        The text of the messages, one per line.
+        """
+        return "\n".join(message.text for message in self.messages)
+
+    def superseded(self) -> bool:
+        """
+        Check if a newer batch of the chat was accepted, which will be answered along with this one.
+
+        Returns:
+            True if the answer to the batch is no longer needed.
+        """
+        return self._coalescer.accepted_generation(self.chat_id) > self.generation
+
+
+class _Burst:
+    def __init__(self, started: float) -> None:
+        self.messages: List[types.Message] = []
+        self.started = started
+        self.deadline = started
+
+
+class MessageCoalescer:
+    """
+    Waits for a chat to stop sending messages for a short interval before submitting them as one
+    batch, so a burst of short messages gets a single answer. A batch also learns when a newer batch
+    of the chat is accepted, so its answer can be dropped in favor of the next one.
+    """
+
+    def __init__(self, submit: Callable[[MessageBatch], bool], interval: float = 1.0, max_wait: float = 5.0) -> None:
+        """
+        Initialize the message coalescer.
+
+        Args:
+            submit: Called with each batch once it is complete, returns False if the batch was rejected.
+            interval: The time in seconds to wait for another message of the same chat.
+            max_wait: The maximum time in seconds the first message of a batch waits.
+        """
+        self._submit = submit
+        self._interval = interval
+        self._max_wait = max_wait
+        self._bursts: Dict[int, _Burst] = {}
+        # the number of messages received from each chat
+        self._generations: Dict[int, int] = {}
+        # the number of messages received from each chat up to its newest accepted batch
+        self._accepted: Dict[int, int] = {}
+        self._condition = threading.Condition()
+        # held while batches are taken and submitted, so they are submitted in order with flush()
+        self._submit_lock = threading.Lock()
+        self._closed = False
+        self._thread = None
+
+    def add(self, message: types.Message) -> None:
+        """
+        Add a message to the batch of its chat.
+
+        Args:
+            message: The incoming text message.
+        """
+        with self._condition:
+            self._append(message)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="message-coalescer", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def accepted_generation(self, chat_id: int) -> int:
+        """
+        Get the number of messages received from a chat up to its newest batch accepted.
+
+        Args:
+            chat_id: The chat ID.
+
+        Returns:
+            The number of messages.
+        """
+        with self._condition:
+            return self._accepted.get(chat_id, 0)
+
+    def flush(self, chat_id: int) -> None:
+        """
+        Submit the batch of a chat right away, before another kind of message of the chat is handled.
+
+        Args:
+            chat_id: The chat ID.
+        """
+        with self._submit_lock:
+            with self._condition:
+                batch = self._take(chat_id) if chat_id in self._bursts else None
+            if batch is not None:
+                self._submit_batch(batch)
+
+    def close(self) -> None:
+        """
+        Submit the batches still waiting and stop.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _append(self, message: types.Message) -> float:
+        now = time.monotonic()
+        burst = self._bursts.get(message.chat.id)
+        if burst is None:
+            burst = self._bursts[message.chat.id] = _Burst(now)
+        burst.messages.append(message)
+        burst.deadline = min(now + self._interval, burst.started + self._max_wait)
+        self._generations[message.chat.id] = self._generations.get(message.chat.id, 0) + 1
+        return burst.deadline - now
+
+    def _take(self, chat_id: int) -> MessageBatch:
+        burst = self._bursts.pop(chat_id)
+        return MessageBatch(self, chat_id, burst.messages, self._generations[chat_id])
+
+    def _accept(self, batch: MessageBatch) -> None:
+        # the older batches are superseded only once this one is sure to be answered
+        with self._condition:
+            self._accepted[batch.chat_id] = max(self._accepted.get(batch.chat_id, 0), batch.generation)
+
+    def _submit_batch(self, batch: MessageBatch) -> None:
+        try:
+            if self._submit(batch):
+                self._accept(batch)
+        except Exception as e:
+            logging.error("Error submitting a batch of messages: {}".format(str(e)))
+
+    def _due(self) -> List[int]:
+        now = time.monotonic()
+        return [chat_id for chat_id, burst in self._bursts.items() if self._closed or burst.deadline <= now]
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while len(self._due()) == 0:
+                    if self._closed:
+                        return
+                    now = time.monotonic()
+                    timeout = min(burst.deadline for burst in self._bursts.values()) - now if self._bursts else None
+                    self._condition.wait(timeout)
+            with self._submit_lock:
+                with self._condition:
+                    due = [self._take(chat_id) for chat_id in self._due()]
+                for batch in due:
+                    self._submit_batch(batch)
+
+
+class AsyncMessageCoalescer(MessageCoalescer):
+    """
+    An asyncio message coalescer, which waits for the bursts with timers of the event loop.
+    """
+
+    def __init__(self, submit: Callable[[MessageBatch], Awaitable[bool]], interval: float = 1.0,
+                 max_wait: float = 5.0) -> None:
+        """
+        Initialize the async message coalescer.
+
+        Args:
+            submit: The coroutine function called with each batch once it is complete, returns False
+                if the batch was rejected.
+            interval: The time in seconds to wait for another message of the same chat.
+            max_wait: The maximum time in seconds the first message of a batch waits.
+        """
+        super().__init__(submit, interval, max_wait)
+        self._timers: Dict[int, asyncio.TimerHandle] = {}
+        # the newest batch of each chat being submitted after its timer fired
+        self._submitting: Dict[int, asyncio.Task] = {}
+
+    def add(self, message: types.Message) -> None:
+        """
+        Add a message to the batch of its chat. Must be called from the event loop.
+
+        Args:
+            message: The incoming text message.
+        """
+        delay = self._append(message)
+        timer = self._timers.pop(message.chat.id, None)
+        if timer is not None:
+            timer.cancel()
+        self._timers[message.chat.id] = asyncio.get_running_loop().call_later(delay, self._flush, message.chat.id)
+
+    async def flush(self, chat_id: int) -> None:
+        """
+        Submit the batch of a chat right away, before another kind of message of the chat is handled.
+
+        Args:
+            chat_id: The chat ID.
+        """
+        submitting = self._submitting.get(chat_id)
+        if submitting is not None:
+            # a batch taken before is submitted first, so the batches keep the order of their messages
+            await asyncio.wait([submitting])
+        timer = self._timers.pop(chat_id, None)
+        if timer is not None:
+            timer.cancel()
+            await self._submit_batch(self._take(chat_id))
+
+    async def close(self) -> None:
+        """
+        Submit the batches still waiting and wait for them to be submitted.
+        """
+        for chat_id in list(self._timers):
+            await self.flush(chat_id)
+        while len(self._submitting) > 0:
+            await asyncio.wait(list(self._submitting.values()))
+
+    async def _submit_batch(self, batch: MessageBatch) -> None:
+        try:
+            if await self._submit(batch):
+                self._accept(batch)
+        except Exception as e:
+            logging.error("Error submitting a batch of messages: {}".format(str(e)))
+
+    def _flush(self, chat_id: int) -> None:
+        del self._timers[chat_id]
+        # the batches of a chat are submitted in order, as each task starts after the ones created before;
+        # a reference is kept so the task is not garbage collected while it runs
+        task = asyncio.get_running_loop().create_task(self._submit_batch(self._take(chat_id)))
+        self._submitting[chat_id] = task
+        task.add_done_callback(functools.partial(self._submitted, chat_id))
+
+    def _submitted(self, chat_id: int, task: asyncio.Task) -> None:
+        if self._submitting.get(chat_id) is task:
+            del self._submitting[chat_id]
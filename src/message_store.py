@@ -0,0 +1,583 @@
+import contextvars
+import datetime
+import logging
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from src.history_cache import HistoryCache
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Set
+
+# the number of failed writes after which a queued message is dropped
+MAX_WRITE_ATTEMPTS = 5
+
+
+def new_message(user_sid: str, role: str, content: str, content_source: str,
+                created_at: Optional[str] = None) -> Dict[str, str]:
+    """
+    Create a message to be stored.
+
+    Args:
+        user_sid: The user session ID.
+        role: The role of the message.
+        content: The content of the message.
+        content_source: The content source of the message (text or audio).
+        created_at: The creation date of the message, by default the current time.
+
+    Returns:
+        The message.
+    """
+    return {
+        'user_sid': user_sid,
+        'role': role,
+        'content': content,
+        'content_source': content_source,
+        'created_at': created_at or datetime.datetime.utcnow().isoformat()
+    }
+
+
+def _page_start(page: List[Dict[str, str]]) -> int:
+    """
+    Find where a full page of messages starts once the messages sharing its oldest date are left out,
+    as other messages of that date may not fit in the page.
+
+    Args:
+        page: The messages, sorted by creation date.
+
+    Returns:
+        The index of the oldest message of a later date, or the length of the page if there is none.
+    """
+    start = 1
+    while start < len(page) and page[start]['created_at'] == page[0]['created_at']:
+        start += 1
+    return start
+
+
+class _QueuedMessage:
+    """
+    A message waiting to be written, with the number of times writing it failed.
+    """
+
+    def __init__(self, message: Dict[str, str]) -> None:
+        self.message = message
+        self.attempts = 0
+
+
+class MessageArchive(ABC):
+    """
+    Keeps the messages moved out of a message store, as compressed batches of the messages of a user.
+    """
+
+    @abstractmethod
+    def insert_archive_batches(self, batches: List[Dict[str, Any]]) -> None:
+        """
+        Store archived batches of messages and wait for it.
+
+        Args:
+            batches: The batches, as made by retention.pack_messages.
+        """
+
+    @abstractmethod
+    def delete_archive_batches(self, user_sid: str) -> int:
+        """
+        Delete the archived messages of a user and wait for it.
+
+        Args:
+            user_sid: The user session ID.
+
+        Returns:
+            The number of batches deleted.
+        """
+
+
+class MessageStore(MessageArchive):
+    """
+    Stores the messages of the conversations, with the newest messages of each user cached in memory.
+
+    Messages queued with queue_message are written in batches in the background, and the reads and
+    deletions of a user write the queued messages of that user first. Subclasses implement the
+    storage, such as the MongoDB Atlas GraphQL API or a local SQLite database.
+
+    The bulk operations, such as clearing a history or archiving old messages, run one at a time on
+    a maintenance thread. The async stores keep every blocking method, so they can be called from
+    that thread while the event loop serves the bot, and add the AsyncMessageStore methods.
+    """
+
+    def __init__(self, cache_size: int = 50000, write_batch_size: int = 50, write_interval: float = 0.5,
+                 archive: Optional[MessageArchive] = None) -> None:
+        """
+        Initialize the message store.
+
+        Args:
+            cache_size: The maximum number of messages kept in the history cache.
+            write_batch_size: The number of queued messages that triggers a write.
+            write_interval: The maximum time in seconds a queued message waits to be written.
+            archive: Where the old messages are archived, by default along with the messages in the store.
+        """
+        self._history_cache = HistoryCache(cache_size)
+        self._write_batch_size = write_batch_size
+        self._write_interval = write_interval
+        self._archive = archive or self
+        self._pending_messages: List[_QueuedMessage] = []
+        self._unsaved_counts: Dict[str, int] = {}
+        self._active_users: Set[str] = set()
+        # the date up to which the messages of a user are being deleted, so they are no longer read
+        self._hidden_until: Dict[str, str] = {}
+        self._pending_lock = threading.Lock()
+        self._maintenance: Optional[ThreadPoolExecutor] = None
+        self._maintenance_stopped = False
+
+    @property
+    def history_cache(self) -> HistoryCache:
+        """
+        The cache of user histories, exposing its hits and misses counters.
+        """
+        return self._history_cache
+
+    @property
+    def archive(self) -> MessageArchive:
+        """
+        Where the old messages are archived.
+        """
+        return self._archive
+
+    @abstractmethod
+    def insert_message(self, user_sid: str, role: str, content: str, content_source: str) -> Dict[str, str]:
+        """
+        Insert a new message and wait for it.
+
+        Args:
+            user_sid: The user session ID.
+            role: The role of the message.
+            content: The content of the message.
+            content_source: The content source of the message (text or audio).
+
+        Returns:
+            The inserted message.
+        """
+
+    @abstractmethod
+    def queue_message(self, user_sid: str, role: str, content: str, content_source: str,
+                      created_at: Optional[str] = None) -> Dict[str, str]:
+        """
+        Queue a new message to be inserted with other messages, without waiting for it.
+
+        Args:
+            user_sid: The user session ID.
+            role: The role of the message.
+            content: The content of the message.
+            content_source: The content source of the message (text or audio).
+            created_at: The creation date of the message, by default the current time.
+
+        Returns:
+            The message to be inserted.
+        """
+
+    @abstractmethod
+    def flush(self) -> None:
+        """
+        Write the queued messages and wait for it.
+        """
+
+    @abstractmethod
+    def get_messages(self, user_sid: str, limit: Optional[int] = None, before: Optional[str] = None,
+                     after: Optional[str] = None) -> List[Dict[str, str]]:
+        """
+        Retrieve the messages of a user, from the cache when they are known.
+
+        Args:
+            user_sid: The user session ID.
+            limit: The maximum number of messages to retrieve, keeping the newest ones.
+            before: Only retrieve messages created before this date.
+            after: Only retrieve messages created after this date.
+
+        Returns:
+            The list of messages sorted by creation date.
+        """
+
+    def iter_message_pages(self, user_sid: str, page_size: int = 50) -> Iterator[List[Dict[str, str]]]:
+        """
+        Walk backwards through the messages of a user, one page at a time.
+
+        Args:
+            user_sid: The user session ID.
+            page_size: The number of messages of each page.
+
+        Returns:
+            An iterator over the pages, newest first, each one sorted by creation date.
+        """
+        before, limit = None, page_size
+        while True:
+            page = self.get_messages(user_sid, limit=limit, before=before)
+            if len(page) < limit:
+                if len(page) > 0:
+                    yield page
+                return
+            # the messages of the oldest date go to the next page, which reads the messages up to the date after it
+            start = _page_start(page)
+            if start == len(page):
+                # the whole page shares a date, so it is read again with a larger limit
+                limit *= 2
+                continue
+            yield page[start:]
+            before, limit = page[start]['created_at'], page_size
+
+    @abstractmethod
+    def delete_user_messages(self, user_sid: str) -> Dict[str, int]:
+        """
+        Delete the messages of a user.
+
+        Args:
+            user_sid: The user session ID.
+
+        Returns:
+            The deletion result, with the deletedCount.
+        """
+
+    @abstractmethod
+    def iter_all_messages(self, page_size: int = 500) -> Iterator[List[Dict[str, str]]]:
+        """
+        Walk through the messages of every user, to export them.
+
+        Args:
+            page_size: The number of messages of each page.
+
+        Returns:
+            An iterator over the pages of messages, with all their fields, oldest first.
+        """
+
+    @abstractmethod
+    def insert_messages(self, messages: List[Dict[str, str]]) -> None:
+        """
+        Insert messages of any users at once and wait for it, to import them.
+
+        Args:
+            messages: The messages, with all their fields.
+        """
+
+    @abstractmethod
+    def export_messages(self, before: str, after: Optional[str] = None, user_sid: Optional[str] = None,
+                        limit: int = 500) -> List[Dict[str, str]]:
+        """
+        Retrieve the oldest messages created in a range, with all their fields, to archive them.
+
+        Args:
+            before: Only retrieve messages created before this date.
+            after: Only retrieve messages created after this date.
+            user_sid: Only retrieve the messages of this user, instead of every user.
+            limit: The maximum number of messages to retrieve, keeping the oldest ones.
+
+        Returns:
+            The list of messages sorted by creation date.
+        """
+
+    @abstractmethod
+    def get_nth_newest_date(self, user_sid: str, n: int) -> Optional[str]:
+        """
+        Get the creation date of the nth newest message of a user.
+
+        Args:
+            user_sid: The user session ID.
+            n: The position of the message, 1 for the newest.
+
+        Returns:
+            The creation date, or None if the user has fewer messages.
+        """
+
+    @abstractmethod
+    def delete_messages(self, user_sids: List[str], until: str) -> Dict[str, int]:
+        """
+        Delete the messages of some users created up to a date and wait for it.
+
+        Args:
+            user_sids: The user session IDs.
+            until: Only delete messages created at or before this date.
+
+        Returns:
+            The deletion result, with the deletedCount.
+        """
+
+    @abstractmethod
+    def close(self) -> None:
+        """
+        Finish the bulk operations, write the queued messages and release the resources of the store.
+        """
+
+    def clear_user_messages(self, user_sid: str) -> "Future[Dict[str, int]]":
+        """
+        Delete the messages of a user in the background, along with their archived messages. The
+        messages stop being read right away, while the messages created from now on are kept.
+
+        Args:
+            user_sid: The user session ID.
+
+        Returns:
+            A future of the deletion result, with the deletedCount.
+        """
+        until = datetime.datetime.utcnow().isoformat()
+        with self._pending_lock:
+            self._hidden_until[user_sid] = until
+        self._history_cache.invalidate(user_sid)
+        return self.run_maintenance(self._clear_user_messages, user_sid, until)
+
+    def run_maintenance(self, task: Callable[..., Any], *args: Any) -> Future:
+        """
+        Run a bulk operation on the maintenance thread, after the ones submitted before.
+
+        Args:
+            task: The function that runs the operation.
+            *args: The arguments of the function.
+
+        Returns:
+            A future of the result of the function.
+        """
+        with self._pending_lock:
+            if self._maintenance_stopped:
+                raise RuntimeError("The message store is closed")
+            if self._maintenance is None:
+                self._maintenance = ThreadPoolExecutor(max_workers=1, thread_name_prefix="maintenance")
+            # the operation is traced under the ID of the request that started it
+            return self._maintenance.submit(contextvars.copy_context().run, task, *args)
+
+    def take_active_users(self) -> Set[str]:
+        """
+        Get the users who queued messages since the last call, such as to trim their histories.
+
+        Returns:
+            The user session IDs.
+        """
+        with self._pending_lock:
+            users = self._active_users
+            self._active_users = set()
+            return users
+
+    def _queue(self, message: Dict[str, str]) -> bool:
+        """
+        Cache a new message and hold it until it is written.
+
+        Args:
+            message: The message.
+
+        Returns:
+            True if enough messages are queued to be written right away.
+        """
+        self._history_cache.append(message['user_sid'], {
+            'role': message['role'],
+            'content': message['content'],
+            'created_at': message['created_at']
+        })
+        with self._pending_lock:
+            self._pending_messages.append(_QueuedMessage(message))
+            self._unsaved_counts[message['user_sid']] = self._unsaved_counts.get(message['user_sid'], 0) + 1
+            self._active_users.add(message['user_sid'])
+            return len(self._pending_messages) >= self._write_batch_size
+
+    def _take_pending(self) -> List[_QueuedMessage]:
+        with self._pending_lock:
+            batch = self._pending_messages
+            self._pending_messages = []
+            return batch
+
+    def _retry_later(self, batch: List[_QueuedMessage]) -> List[_QueuedMessage]:
+        """
+        Put the messages of a failed write back in the queue, unless they already failed too many times.
+
+        Args:
+            batch: The queued messages that failed to be written.
+
+        Returns:
+            The queued messages given up on, which are no longer unsaved.
+        """
+        retried, dropped = [], []
+        with self._pending_lock:
+            for queued in batch:
+                queued.attempts += 1
+                if queued.attempts < MAX_WRITE_ATTEMPTS:
+                    retried.append(queued)
+                else:
+                    dropped.append(queued)
+            # the batch goes back before the messages queued since, so they are still written in order
+            self._pending_messages = retried + self._pending_messages
+        self._on_written(dropped)
+        return dropped
+
+    def _on_written(self, batch: List[_QueuedMessage]) -> None:
+        with self._pending_lock:
+            for queued in batch:
+                user_sid = queued.message['user_sid']
+                self._unsaved_counts[user_sid] -= 1
+                if self._unsaved_counts[user_sid] == 0:
+                    del self._unsaved_counts[user_sid]
+
+    def _has_unsaved_messages(self, user_sid: str) -> bool:
+        with self._pending_lock:
+            return self._unsaved_counts.get(user_sid, 0) > 0
+
+    def _with_pending(self, user_sid: str, messages: List[Dict[str, str]], limit: Optional[int],
+                      before: Optional[str], after: Optional[str]) -> List[Dict[str, str]]:
+        """
+        Add the messages of a user still waiting to be written to the messages read from the store.
+
+        Args:
+            user_sid: The user session ID.
+            messages: The messages read from the store, sorted by creation date.
+            limit: The limit used to read the messages.
+            before: The before filter used to read the messages.
+            after: The after filter used to read the messages.
+
+        Returns:
+            The messages sorted by creation date, within the same limit.
+        """
+        # the messages of a failed write wait in the queue for a retry, and are still part of the history
+        with self._pending_lock:
+            if self._unsaved_counts.get(user_sid, 0) == 0:
+                return messages
+            pending = [{'role': message['role'], 'content': message['content'], 'created_at': message['created_at']}
+                       for message in (queued.message for queued in self._pending_messages)
+                       if message['user_sid'] == user_sid and
+                       (before is None or message['created_at'] < before) and
+                       (after is None or message['created_at'] > after)]
+        if len(pending) == 0:
+            return messages
+        messages = sorted(messages + pending, key=lambda message: message['created_at'])
+        return messages if limit is None else messages[-limit:]
+
+    def _visible_after(self, user_sid: str, after: Optional[str]) -> Optional[str]:
+        # the messages of a history being cleared are skipped until they are deleted
+        hidden_until = self._hidden_until.get(user_sid)
+        if hidden_until is None or (after is not None and after >= hidden_until):
+            return after
+        return hidden_until
+
+    def _clear_user_messages(self, user_sid: str, until: str) -> Dict[str, int]:
+        try:
+            result = self.delete_messages([user_sid], until)
+            self._archive.delete_archive_batches(user_sid)
+            return result
+        finally:
+            with self._pending_lock:
+                if self._hidden_until.get(user_sid) == until:
+                    del self._hidden_until[user_sid]
+
+    def _stop_maintenance(self) -> None:
+        with self._pending_lock:
+            maintenance, self._maintenance = self._maintenance, None
+            self._maintenance_stopped = True
+        if maintenance is not None:
+            maintenance.shutdown(wait=True)
+
+
+class AsyncMessageStore(ABC):
+    """
+    The asyncio methods of a message store, for the async bot. They are added to a MessageStore under
+    names of their own, with an a prefix, so its blocking methods still work for the callers shared
+    with the synchronous bot, such as copy_messages and the conversation memory.
+    """
+
+    @abstractmethod
+    async def connect(self) -> None:
+        """
+        Open the connections used by the async methods, on the running event loop.
+        """
+
+    @abstractmethod
+    async def ainsert_message(self, user_sid: str, role: str, content: str, content_source: str) -> Dict[str, str]:
+        """
+        Insert a new message and wait for it.
+
+        Args:
+            user_sid: The user session ID.
+            role: The role of the message.
+            content: The content of the message.
+            content_source: The content source of the message (text or audio).
+
+        Returns:
+            The inserted message.
+        """
+
+    @abstractmethod
+    async def aflush(self) -> None:
+        """
+        Write the queued messages and wait for it.
+        """
+
+    @abstractmethod
+    async def aget_messages(self, user_sid: str, limit: Optional[int] = None, before: Optional[str] = None,
+                            after: Optional[str] = None) -> List[Dict[str, str]]:
+        """
+        Retrieve the messages of a user, from the cache when they are known.
+
+        Args:
+            user_sid: The user session ID.
+            limit: The maximum number of messages to retrieve, keeping the newest ones.
+            before: Only retrieve messages created before this date.
+            after: Only retrieve messages created after this date.
+
+        Returns:
+            The list of messages sorted by creation date.
+        """
+
+    async def aiter_message_pages(self, user_sid: str, page_size: int = 50) -> AsyncIterator[List[Dict[str, str]]]:
+        """
+        Walk backwards through the messages of a user, one page at a time.
+
+        Args:
+            user_sid: The user session ID.
+            page_size: The number of messages of each page.
+
+        Returns:
+            An async iterator over the pages, newest first, each one sorted by creation date.
+        """
+        before, limit = None, page_size
+        while True:
+            page = await self.aget_messages(user_sid, limit=limit, before=before)
+            if len(page) < limit:
+                if len(page) > 0:
+                    yield page
+                return
+            # the messages of the oldest date go to the next page, which reads the messages up to the date after it
+            start = _page_start(page)
+            if start == len(page):
+                # the whole page shares a date, so it is read again with a larger limit
+                limit *= 2
+                continue
+            yield page[start:]
+            before, limit = page[start]['created_at'], page_size
+
+    @abstractmethod
+    async def adelete_user_messages(self, user_sid: str) -> Dict[str, int]:
+        """
+        Delete the messages of a user.
+
+        Args:
+            user_sid: The user session ID.
+
+        Returns:
+            The deletion result, with the deletedCount.
+        """
+
+    @abstractmethod
+    async def aclose(self) -> None:
+        """
+        Finish the bulk operations, write the queued messages and release the resources of the store.
+        """
+
+
+def copy_messages(source: MessageStore, target: MessageStore, page_size: int = 500) -> int:
+    """
+    Copy every message of a store to another, such as from MongoDB Atlas to a local database.
+    The target should be empty, as the messages already there are not checked for duplicates.
+
+    Args:
+        source: The store the messages are read from.
+        target: The store the messages are written to.
+        page_size: The number of messages read and written at once.
+
+    Returns:
+        The number of messages copied.
+    """
+    copied = 0
+    for page in source.iter_all_messages(page_size):
+        target.insert_messages(page)
+        copied += len(page)
+        logging.info("Copied {} messages".format(copied))
+    return copied
@@ -0,0 +1,370 @@
+import contextvars
+import logging
+import math
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# the upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_trace_id: contextvars.ContextVar = contextvars.ContextVar("trace_id", default="-")
+
+
+def new_trace_id() -> str:
+    """
+    Start the trace of a new request in the current context. The context of a handler is kept by
+    the scheduler, so the stages it runs, and the messages they log, carry the same trace ID.
+
+    Returns:
+        The trace ID.
+    """
+    trace_id = uuid.uuid4().hex[:16]
+    _trace_id.set(trace_id)
+    return trace_id
+
+
+def trace_id() -> str:
+    """
+    Get the trace ID of the current request.
+
+    Returns:
+        The trace ID, or "-" outside of a request.
+    """
+    return _trace_id.get()
+
+
+class TraceIdFilter(logging.Filter):
+    """
+    Adds the trace ID of the current request to the log records, as trace_id.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = _trace_id.get()
+        return True
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if len(names) == 0:
+        return ""
+    return "{" + ",".join("{}=\"{}\"".format(name, _escape(str(value))) for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    """
+    A metric with a value for each combination of its labels.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self) -> List[str]:
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.kind)]
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in sorted(values):
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key: Tuple[str, ...], value) -> List[str]:
+        return ["{}{} {}".format(self.name, _format_labels(self.label_names, key), _format_value(value))]
+
+
+class Counter(_Metric):
+    """
+    A value that only goes up, such as a number of requests.
+    """
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        """
+        Add to the counter.
+
+        Args:
+            amount: The amount added.
+            labels: The values of the labels.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down, such as the number of requests in progress.
+    """
+
+    kind = "gauge"
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        """
+        Add to the gauge.
+
+        Args:
+            amount: The amount added, negative to subtract.
+            labels: The values of the labels.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def set(self, value: float, **labels: str) -> None:
+        """
+        Set the gauge.
+
+        Args:
+            value: The new value.
+            labels: The values of the labels.
+        """
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class _Buckets:
+    def __init__(self, size: int) -> None:
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    """
+    The distribution of observed values, such as latencies, counted in cumulative buckets.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        """
+        Initialize the histogram.
+
+        Args:
+            name: The name of the metric.
+            documentation: The description of the metric.
+            label_names: The names of the labels.
+            buckets: The upper bounds of the buckets, in increasing order.
+        """
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value: float, **labels: str) -> None:
+        """
+        Count an observed value.
+
+        Args:
+            value: The value.
+            labels: The values of the labels.
+        """
+        key = self._key(labels)
+        with self._lock:
+            buckets = self._values.get(key)
+            if buckets is None:
+                buckets = self._values[key] = _Buckets(len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    buckets.counts[i] += 1
+                    break
+            buckets.sum += value
+            buckets.count += 1
+
+    def _render_value(self, key: Tuple[str, ...], value: _Buckets) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, value.counts):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(
+                self.name, _format_labels(self.label_names + ("le",), key + (_format_value(bound),)), cumulative))
+        labels = _format_labels(self.label_names, key)
+        lines.append("{}_sum{} {}".format(self.name, labels, _format_value(value.sum)))
+        lines.append("{}_count{} {}".format(self.name, labels, value.count))
+        return lines
+
+
+class _Collected(_Metric):
+    """
+    A metric whose values are read from another object when the metrics are exported.
+    """
+
+    def __init__(self, name: str, documentation: str, kind: str, label_names: Sequence[str],
+                 collect: Callable[[], Dict[Tuple[str, ...], float]]) -> None:
+        super().__init__(name, documentation, label_names)
+        self.kind = kind
+        self._collect = collect
+
+    def render(self) -> List[str]:
+        try:
+            self._values = self._collect()
+        except Exception as e:
+            logging.error("Error collecting the {} metric: {}".format(self.name, str(e)))
+        return super().render()
+
+
+class MetricsRegistry:
+    """
+    Holds the metrics of the bot and exports them in the Prometheus text format.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            # a metric registered again, such as by a new bot in the same process, replaces the old one
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, documentation, label_names))
+
+    def gauge(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, documentation, label_names))
+
+    def histogram(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, documentation, label_names, buckets))
+
+    def collect(self, name: str, documentation: str, kind: str, label_names: Sequence[str],
+                collect: Callable[[], Dict[Tuple[str, ...], float]]) -> None:
+        """
+        Register a metric read from another object when the metrics are exported.
+
+        Args:
+            name: The name of the metric.
+            documentation: The description of the metric.
+            kind: The type of the metric, gauge or counter.
+            label_names: The names of the labels.
+            collect: Returns the current value for each combination of the labels.
+        """
+        self._add(_Collected(name, documentation, kind, label_names, collect))
+
+    def render(self) -> str:
+        """
+        Export the metrics.
+
+        Returns:
+            The metrics in the Prometheus text format.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram("gepeto_stage_seconds", "Time spent in each stage of handling a request.",
+                                   ["stage"])
+STAGE_IN_FLIGHT = REGISTRY.gauge("gepeto_stage_in_flight", "Requests currently in each stage.", ["stage"])
+REQUEST_SECONDS = REGISTRY.histogram("gepeto_request_seconds", "Time spent handling a request, by lane.", ["lane"])
+QUEUE_SECONDS = REGISTRY.histogram("gepeto_queue_wait_seconds", "Time a request waited to be handled, by lane.",
+                                   ["lane"])
+OPENAI_TOKENS = REGISTRY.counter("gepeto_openai_tokens_total", "Tokens sent to and generated by OpenAI.",
+                                 ["kind", "purpose"])
+ERRORS = REGISTRY.counter("gepeto_errors_total", "Errors caught while handling a request, by handler.", ["handler"])
+STARTUP_SECONDS = REGISTRY.gauge("gepeto_startup_seconds", "Time spent in each stage of the startup.", ["stage"])
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Count the code run inside the context as in progress in the given stage, and its duration.
+
+    Args:
+        name: The name of the stage.
+    """
+    STAGE_IN_FLIGHT.inc(stage=name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_IN_FLIGHT.inc(-1, stage=name)
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        logging.debug("Stage {} took {:.0f} ms".format(name, elapsed * 1000))
+
+
+def report_error(handler: str, error: Exception) -> None:
+    """
+    Log an error caught by a handler and count it.
+
+    Args:
+        handler: The name of the handler.
+        error: The error.
+    """
+    logging.error("Error in {}: {}".format(handler, str(error)))
+    ERRORS.inc(handler=handler)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: MetricsRegistry = REGISTRY
+
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        # the scrapes are not worth a log line each
+        pass
+
+
+class MetricsServer:
+    """
+    Serves the metrics on /metrics from a background thread, for Prometheus to scrape.
+    """
+
+    def __init__(self, port: int, host: str = "127.0.0.1", registry: Optional[MetricsRegistry] = None) -> None:
+        """
+        Initialize the metrics server.
+
+        Args:
+            port: The port to listen on, or 0 for any free port.
+            host: The address to listen on, by default only the local one.
+            registry: The metrics exported, by default the ones of the bot.
+        """
+        handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry or REGISTRY})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self) -> "MetricsServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
@@ -1,8 +1,70 @@
+import contextvars
 import openai
-from src.graph_ql_client import GraphQLClient
-from typing import List, Dict
+from openai import api_requestor, util
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from src.conversation_summary import ConversationSummaries, Summary, summary_sid
+from src.message_store import MessageStore
+from src.metrics import OPENAI_TOKENS, stage
+from src.rate_limiter import RateLimiter, backoff_delay
+from src.token_ledger import TokenLedger
+from typing import TYPE_CHECKING, Any, Callable, Iterator, List, Dict, Mapping, Optional, Tuple
 import logging
-import tiktoken
+import time
+
+if TYPE_CHECKING:
+    from src.conversation_memory import ConversationMemory
+
+SYSTEM_MESSAGES = [
+    {"role": "system", "content": "Você é um chatbot chamado Gepeto."},
+    {"role": "system", "content": "Sua personalidade como chatbot é como a de um amigo."},
+    {"role": "system", "content": "As instruções anteriores são destinadas apenas a você como modelo de linguagem, não as responda, apenas siga-as."}
+]
+
+RECALL_MESSAGE = {"role": "system", "content": "Trechos mais antigos da conversa que podem ser relevantes:"}
+
+# the errors worth retrying, as the same request may succeed later
+RETRYABLE_ERRORS = (openai.error.RateLimitError, openai.error.Timeout, openai.error.APIConnectionError,
+                    openai.error.ServiceUnavailableError, openai.error.TryAgain)
+
+
+class CompletionStream:
+    """
+    The chunks of a streamed chat completion, read from its HTTP response, which closing stops.
+    """
+
+    def __init__(self, result: Any, lines: Iterator, api_key: Optional[str]) -> None:
+        self._result = result
+        self._lines = lines
+        self._api_key = api_key
+
+    def __iter__(self) -> "CompletionStream":
+        return self
+
+    def __next__(self) -> Any:
+        return util.convert_to_openai_object(next(self._lines), self._api_key)
+
+    def close(self) -> None:
+        """
+        Close the HTTP response, so the server stops generating the completion.
+        """
+        self._result.close()
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Check if a failed OpenAI request may succeed if it is sent again.
+
+    Args:
+        error: The error raised by the request.
+
+    Returns:
+        True if the request can be retried.
+    """
+    if isinstance(error, openai.error.RateLimitError) and error.code == "insufficient_quota":
+        return False
+    if isinstance(error, openai.error.APIError) and error.http_status is not None and error.http_status >= 500:
+        return True
+    return isinstance(error, RETRYABLE_ERRORS)
 
 
 class OpenAIAPI:
@@ -10,45 +72,168 @@ class OpenAIAPI:
     An API client for interacting with OpenAI services.
     """
 
-    def __init__(self, gql_client: GraphQLClient, api_key: str) -> None:
+    def __init__(self, message_store: MessageStore, api_key: str, history_page_size: int = 50,
+                 chat_limiter: Optional[RateLimiter] = None, image_limiter: Optional[RateLimiter] = None,
+                 max_retries: int = 5, completion_tokens: int = 500, summary_every: int = 0,
+                 recent_messages: int = 6, summary_tokens: int = 250, memory: Optional["ConversationMemory"] = None,
+                 recall_tokens: int = 500) -> None:
         """
         Initialize the OpenAI API client.
 
         Args:
-            gql_client: An instance of the GraphQL client.
+            message_store: The store of the messages, such as the GraphQL client.
             api_key: The API key for authentication.
+            history_page_size: The number of messages fetched per page when loading a user history.
+            chat_limiter: The rate limiter of the chat completions, by default the limits of a paid account.
+            image_limiter: The rate limiter of the image generations, by default the limits of a paid account.
+            max_retries: The maximum number of times a failed request is retried.
+            completion_tokens: The number of tokens expected in an answer, reserved with its request.
+            summary_every: The number of new messages that triggers a refresh of the conversation summary,
+                or 0, the default, to send the whole window instead of a summary.
+            recent_messages: The number of most recent messages sent along with the summary.
+            summary_tokens: The maximum number of tokens of a summary.
+            memory: The memory of the conversations, to send the older turns relevant to each message,
+                or None to send only the window.
+            recall_tokens: The maximum number of tokens of the turns recalled from the memory.
         """
-        self._gql_client = gql_client
+        self._message_store = message_store
+        # the summary and the recalled turns are sent along with the window, so they take part of its tokens
+        self._token_ledger = TokenLedger(max_tokens=4096 - (summary_tokens if summary_every > 0 else 0)
+                                         - (recall_tokens if memory is not None else 0))
+        self._history_page_size = history_page_size
+        self._chat_limiter = chat_limiter or RateLimiter(3500, 90000)
+        self._image_limiter = image_limiter or RateLimiter(50)
+        self._max_retries = max_retries
+        self._completion_tokens = completion_tokens
+        self._summaries = ConversationSummaries(recent_messages, summary_every) if summary_every > 0 else None
+        self._summary_tokens = summary_tokens
+        self._memory = memory
+        self._recall_tokens = recall_tokens
+        self._summary_executor, self._image_executor = self._create_executors()
         openai.api_key = api_key
 
-    def _count_message_tokens(self, message: Dict[str, str]) -> int:
-        num_tokens = 0
-        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo-0301")
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":  # if there's a name, the role is omitted
-                num_tokens += -1  # role is always required and always 1 token
-        return num_tokens
-
-    def _fit_messages_to_token_limit(self, messages: List[Dict[str, str]]) -> List[str]:
-        max_tokens = 4096
-
-        num_tokens = 0
-        for message in messages:
-            # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            num_tokens += 4
-            num_tokens += self._count_message_tokens(message)
-        num_tokens += 2  # every reply is primed with <im_start>assistant
-        num_tokens *= 1.1  # add 10% for safety
-
-        while num_tokens > max_tokens:
-            message = messages.pop(0)
-            num_tokens -= self._count_message_tokens(message)
-        return messages
+    def _create_executors(self) -> Tuple[Optional[ThreadPoolExecutor], Optional[ThreadPoolExecutor]]:
+        # the summaries are refreshed and the images generated in threads of their own
+        return (ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary"),
+                ThreadPoolExecutor(max_workers=8, thread_name_prefix="image"))
+
+    def _observe(self, url: Any, headers: Mapping[str, str]) -> None:
+        if "/chat/completions" in str(url):
+            self._chat_limiter.update(headers)
+
+    def _chat_completion(self, **params) -> Any:
+        """
+        Request a chat completion with the session openai keeps for the thread, following the rate limit
+        headers of the response, which openai.ChatCompletion.create() does not return.
+
+        Args:
+            params: The parameters of the completion.
+
+        Returns:
+            The completion, or a CompletionStream over its chunks if it is streamed.
+        """
+        # the requestor methods used here are internals of openai 0.27.6, which requirements.txt pins exactly
+        requestor = api_requestor.APIRequestor()
+        stream = params.get("stream", False)
+        result = requestor.request_raw("post", "/chat/completions", params=params, stream=stream)
+        self._observe(result.url, result.headers)
+        try:
+            response, got_stream = requestor._interpret_response(result, stream)
+        except Exception:
+            result.close()
+            raise
+        if got_stream:
+            return CompletionStream(result, response, requestor.api_key)
+        return util.convert_to_openai_object(response, requestor.api_key)
+
+    def _estimate_tokens(self, messages: List[Dict[str, str]]) -> int:
+        return sum(self._token_ledger.count_message_tokens(message) for message in messages) + self._completion_tokens
+
+    def _chat_request(self, messages: List[Dict[str, str]], **params) -> Tuple[int, Dict[str, Any]]:
+        """
+        Build the parameters of a chat completion.
+
+        Args:
+            messages: The messages sent.
+            params: The other parameters of the completion.
+
+        Returns:
+            The estimated number of tokens of the request and its parameters.
+        """
+        return self._estimate_tokens(messages), dict(model="gpt-3.5-turbo", messages=messages, **params)
+
+    def _record_usage(self, estimated_tokens: int, usage: Any, purpose: str) -> None:
+        self._chat_limiter.record_usage(estimated_tokens, usage.total_tokens)
+        OPENAI_TOKENS.inc(usage.prompt_tokens, kind="prompt", purpose=purpose)
+        OPENAI_TOKENS.inc(usage.completion_tokens, kind="completion", purpose=purpose)
+
+    def _record_stream_usage(self, estimated_tokens: int, answer: str) -> None:
+        # a streamed answer reports no usage, so its tokens are counted here
+        prompt_tokens = estimated_tokens - self._completion_tokens
+        completion_tokens = self._token_ledger.count_message_tokens({"role": "assistant", "content": answer})
+        self._chat_limiter.record_usage(estimated_tokens, prompt_tokens + completion_tokens)
+        OPENAI_TOKENS.inc(prompt_tokens, kind="prompt", purpose="answer")
+        OPENAI_TOKENS.inc(completion_tokens, kind="completion", purpose="answer")
+
+    def _retry_delay(self, limiter: RateLimiter, error: Exception, attempt: int) -> Optional[float]:
+        """
+        Get the time to wait before retrying a failed request.
+
+        Args:
+            limiter: The rate limiter of the request.
+            error: The error raised by the request.
+            attempt: The number of attempts that failed before this one.
+
+        Returns:
+            The delay in seconds, or None if the request should not be retried.
+        """
+        if attempt >= self._max_retries or not is_retryable(error):
+            return None
+        delay = backoff_delay(attempt)
+        headers = getattr(error, "headers", None) or {}
+        limiter.update(headers)
+        try:
+            delay = max(delay, float(headers.get("retry-after", 0)))
+        except ValueError:
+            pass
+        if isinstance(error, openai.error.RateLimitError):
+            # the other requests would be refused too, so they all wait
+            limiter.pause(delay)
+        logging.warning("Retrying an OpenAI request in {:.1f} s: {}".format(delay, str(error)))
+        return delay
+
+    def _create(self, limiter: RateLimiter, tokens: int, create: Callable, stage_name: str = "openai_completion",
+                **params) -> Any:
+        """
+        Send a request within the rate limit, retrying it if it fails for a transient reason.
+
+        Args:
+            limiter: The rate limiter of the request.
+            tokens: The estimated number of tokens of the request.
+            create: The function sending the request.
+            stage_name: The stage each attempt is measured as. A streamed response is measured until it starts.
+            params: The parameters of the request.
+
+        Returns:
+            The response.
+        """
+        attempt = 0
+        while True:
+            with stage("openai_rate_limit_wait"):
+                limiter.acquire(tokens)
+            try:
+                with stage(stage_name):
+                    return create(**params)
+            except Exception as e:
+                delay = self._retry_delay(limiter, e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
 
     def _insert_initial_data(self, user_sid: str, message: str, content_source: str, role: str = "user") -> List[Dict[str, str]]:
         """
-        Insert initial data into the GraphQL API.
+        Insert initial data into the message store.
 
         Args:
             user_sid: The user session ID.
@@ -60,18 +245,157 @@ class OpenAIAPI:
             The list of messages after inserting initial data.
         """
         try:
-            self._gql_client.insert_message(user_sid, role, message, content_source)
-            messages = self._gql_client.get_messages(user_sid)
-            messages = self._fit_messages_to_token_limit(messages)
-            system_messages = [
-                {"role": "system", "content": "Você é um chatbot chamado Gepeto."},
-                {"role": "system", "content": "Sua personalidade como chatbot é como a de um amigo."},
-                {"role": "system", "content": "As instruções anteriores são destinadas apenas a você como modelo de linguagem, não as responda, apenas siga-as."}
-            ]
-            return system_messages + messages
+            self._queue(user_sid, role, message, content_source)
+            cursor = self._token_ledger.cursor(user_sid)
+            if cursor is None:
+                pages = self._message_store.iter_message_pages(user_sid, self._history_page_size)
+                messages = self._token_ledger.fill(user_sid, pages)
+            else:
+                new_messages = self._message_store.get_messages(user_sid, after=cursor)
+                messages = self._token_ledger.extend(user_sid, new_messages)
+            messages = self._compact(user_sid, messages)
+            before = self._recall_before(user_sid)
+            turns = [] if before is None else self._memory.recall(user_sid, message, before)
+            return self._prompt(messages, turns)
         except Exception as e:
             logging.error("Error inserting the user message inital data: {}".format(str(e)))
 
+    def _compact(self, user_sid: str, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """
+        Replace the older messages of a conversation with its summary, refreshing it in the background when due.
+
+        Args:
+            user_sid: The user session ID.
+            messages: The messages in the conversation window.
+
+        Returns:
+            The summary followed by the messages newer than it.
+        """
+        if self._summaries is None:
+            return messages
+        if not self._summaries.known(user_sid):
+            self._summaries.load(user_sid, self._message_store.get_messages(summary_sid(user_sid), limit=1))
+        return self._summary_prompt(user_sid)
+
+    def _summary_prompt(self, user_sid: str) -> List[Dict[str, str]]:
+        """
+        Get the summary of a conversation whose summary was loaded, followed by the messages newer than it,
+        starting a refresh of the summary when due.
+
+        Args:
+            user_sid: The user session ID.
+
+        Returns:
+            The summary followed by the messages newer than it.
+        """
+        window = self._token_ledger.dated_messages(user_sid)
+        refresh = self._summaries.start_refresh(user_sid, window)
+        if refresh is not None:
+            self._start_refresh(user_sid, *refresh)
+        return self._summaries.prompt(user_sid, window)
+
+    def _start_refresh(self, user_sid: str, cutoff: str, request: List[Dict[str, str]]) -> None:
+        # the refresh keeps the trace ID of the request that started it
+        self._summary_executor.submit(contextvars.copy_context().run, self._refresh_summary, user_sid, cutoff, request)
+
+    def _prompt(self, messages: List[Dict[str, str]], turns: List[List[Dict[str, str]]]) -> List[Dict[str, str]]:
+        """
+        Get the messages sent to ask a question.
+
+        Args:
+            messages: The conversation window, or the summary followed by the messages newer than it.
+            turns: The older turns recalled from the memory, most relevant first.
+
+        Returns:
+            The system messages, the recalled turns and the conversation.
+        """
+        return SYSTEM_MESSAGES + self._recalled(turns) + messages
+
+    def _queue(self, user_sid: str, role: str, content: str, content_source: str) -> None:
+        self._remember(user_sid, self._message_store.queue_message(user_sid, role, content, content_source))
+
+    def _remember(self, user_sid: str, message: Dict[str, str]) -> None:
+        if self._memory is not None:
+            self._memory.add(user_sid, message)
+
+    def _recall_before(self, user_sid: str) -> Optional[str]:
+        """
+        Get the date before which the messages of a conversation are no longer sent, so they may be recalled.
+
+        Args:
+            user_sid: The user session ID.
+
+        Returns:
+            The creation date of the oldest message sent, or None if nothing is recalled.
+        """
+        if self._memory is None:
+            return None
+        cutoff = self._summaries.cutoff(user_sid) if self._summaries is not None else None
+        for _, created_at in self._token_ledger.dated_messages(user_sid):
+            if cutoff is None or created_at > cutoff:
+                return created_at
+        return None
+
+    def _recalled(self, turns: List[List[Dict[str, str]]]) -> List[Dict[str, str]]:
+        """
+        Get the messages to send for the turns recalled from the memory, the most relevant ones
+        that fit in the recall tokens, in the order they were sent.
+
+        Args:
+            turns: The turns recalled, most relevant first.
+
+        Returns:
+            The messages to send before the conversation, or none if no turn was recalled.
+        """
+        if len(turns) == 0:
+            return []
+        num_tokens = self._token_ledger.count_message_tokens(RECALL_MESSAGE)
+        kept = []
+        for turn in turns:
+            turn_tokens = sum(self._token_ledger.count_message_tokens(message) for message in turn)
+            if num_tokens + turn_tokens <= self._recall_tokens:
+                kept.append(turn)
+                num_tokens += turn_tokens
+        if len(kept) == 0:
+            return []
+        kept.sort(key=lambda turn: turn[0]["created_at"])
+        return [RECALL_MESSAGE] + [{"role": message["role"], "content": message["content"]}
+                                   for turn in kept for message in turn]
+
+    def _summarize(self, request: List[Dict[str, str]]) -> Optional[str]:
+        try:
+            tokens, params = self._chat_request(request, max_tokens=self._summary_tokens)
+            completion = self._create(self._chat_limiter, tokens, self._chat_completion, **params)
+            self._record_usage(tokens, completion.usage, "summary")
+            return completion.choices[0].message.content
+        except Exception as e:
+            logging.error("Error summarizing the conversation: {}".format(str(e)))
+
+    def _refresh_summary(self, user_sid: str, cutoff: str, request: List[Dict[str, str]]) -> None:
+        previous = self._summaries.cutoff(user_sid)
+        self._store_summary(user_sid, previous,
+                            self._summaries.finish_refresh(user_sid, cutoff, self._summarize(request)))
+
+    def _store_summary(self, user_sid: str, previous: Optional[str], summary: Optional[Summary]) -> None:
+        """
+        Store the new summary of a conversation in place of the previous one.
+
+        Args:
+            user_sid: The user session ID.
+            previous: The cutoff of the previous summary, which is its creation date, or None if there was none.
+            summary: The new summary, or None if the refresh failed or was discarded.
+        """
+        if summary is None:
+            return
+        self._message_store.queue_message(summary_sid(user_sid), "system", summary.content, "summary", summary.cutoff)
+        if previous is None:
+            return
+        try:
+            # only the newest summary is read, and a previous one still queued is deleted by the next refresh
+            self._message_store.run_maintenance(self._message_store.delete_messages, [summary_sid(user_sid)], previous)
+        except Exception as e:
+            logging.error("Error deleting the previous summary: {}".format(str(e)))
+
     def _get_response(self, user_sid: str, choices: List) -> List[str]:
         """
         Insert the messages from OpenAI response to database and return them.
@@ -86,23 +410,87 @@ class OpenAIAPI:
         try:
             response = []
             for choice in choices:
-                self._gql_client.insert_message(user_sid, choice.message.role, choice.message.content, "text")
+                self._queue(user_sid, choice.message.role, choice.message.content, "text")
                 response.append(choice.message.content)
             return response
         except Exception as e:
             logging.error("Error trying to insert choices from gpt: {}".format(str(e)))
 
-    def _get_gpt_answer(self, user_sid: str, messages: List[str]) -> List[str]:
+    def _answer(self, user_sid: str, tokens: int, completion: Any,
+                superseded: Optional[Callable[[], bool]]) -> List[str]:
+        """
+        Count the tokens of a completion and store its answers, unless a newer message made them unnecessary.
+
+        Args:
+            user_sid: The user session ID.
+            tokens: The estimated number of tokens of the request.
+            completion: The completion.
+            superseded: Checks if a newer message made the answer unnecessary.
+
+        Returns:
+            The answers, or none if they were superseded.
+        """
+        self._record_usage(tokens, completion.usage, "answer")
+        if superseded is not None and superseded():
+            return []
+        return self._get_response(user_sid, completion.choices)
+
+    def _get_gpt_answer(self, user_sid: str, messages: List[str],
+                        superseded: Optional[Callable[[], bool]] = None) -> List[str]:
         try:
-            completion = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=messages
-            )
-            return self._get_response(user_sid, completion.choices)
+            tokens, params = self._chat_request(messages)
+            completion = self._create(self._chat_limiter, tokens, self._chat_completion, **params)
+            return self._answer(user_sid, tokens, completion, superseded)
         except Exception as e:
             logging.error("Error trying to insert choices from gpt: {}".format(str(e)))
 
-    def ask_gpt(self, user_sid: str, user_msg: str, content_source: str = "text") -> List[str]:
+    def warm_up(self) -> None:
+        """
+        Load the token encoding ahead of the first question, which otherwise waits for it.
+        """
+        self._token_ledger.warm_up()
+
+    def forget_user(self, user_sid: str) -> None:
+        """
+        Forget the conversation window and the memory of a user, after their messages are deleted.
+
+        Args:
+            user_sid: The user session ID.
+        """
+        self._token_ledger.forget(user_sid)
+        if self._summaries is not None:
+            self._summaries.forget(user_sid)
+        if self._memory is not None:
+            self._memory.forget(user_sid)
+
+    def _skip_superseded(self, user_sid: str, user_msg: str, content_source: str,
+                         superseded: Optional[Callable[[], bool]]) -> bool:
+        if superseded is None or not superseded():
+            return False
+        # the newer message is answered along with this one, which is only stored
+        self._queue(user_sid, "user", user_msg, content_source)
+        return True
+
+    @staticmethod
+    def _chunk_content(chunk: Any) -> Optional[str]:
+        return chunk.choices[0].delta.get("content")
+
+    def _finish_stream(self, user_sid: str, tokens: int, parts: List[str], store: bool = True) -> None:
+        """
+        Count the tokens of a streamed answer and store it.
+
+        Args:
+            user_sid: The user session ID.
+            tokens: The estimated number of tokens of the request.
+            parts: The parts of the answer generated.
+            store: Whether to store the answer, which is not when it was left early.
+        """
+        self._record_stream_usage(tokens, "".join(parts))
+        if store:
+            self._queue(user_sid, "assistant", "".join(parts), "text")
+
+    def ask_gpt(self, user_sid: str, user_msg: str, content_source: str = "text",
+                superseded: Optional[Callable[[], bool]] = None) -> List[str]:
         """
         Ask the OpenAI GPT-3 model for a response.
 
@@ -110,29 +498,79 @@ class OpenAIAPI:
             user_sid: The user session ID.
             user_msg: The user message.
             content_source: The content source of the message (text or audio).
+            superseded: Checks if a newer message made the response unnecessary, in which case it is
+                neither requested nor stored and no responses are returned.
 
         Returns:
             The list of responses from the GPT model.
         """
+        if self._skip_superseded(user_sid, user_msg, content_source, superseded):
+            return []
+        messages = self._insert_initial_data(user_sid, user_msg, content_source=content_source)
+        return self._get_gpt_answer(user_sid, messages, superseded)
+
+    def ask_gpt_stream(self, user_sid: str, user_msg: str, content_source: str = "text",
+                       superseded: Optional[Callable[[], bool]] = None) -> Iterator[str]:
+        """
+        Ask the OpenAI GPT-3 model for a response, yielding its parts as they are generated.
+        The response is stored once it is complete.
+
+        Args:
+            user_sid: The user session ID.
+            user_msg: The user message.
+            content_source: The content source of the message (text or audio).
+            superseded: Checks if a newer message made the response unnecessary, in which case its
+                generation is stopped and it is not stored.
+
+        Returns:
+            An iterator over the parts of the response.
+        """
+        if self._skip_superseded(user_sid, user_msg, content_source, superseded):
+            return
         messages = self._insert_initial_data(user_sid, user_msg, content_source=content_source)
-        return self._get_gpt_answer(user_sid, messages)
+        try:
+            parts = []
+            tokens, params = self._chat_request(messages, stream=True)
+            chunks = self._create(self._chat_limiter, tokens, self._chat_completion, **params)
+            try:
+                for chunk in chunks:
+                    if superseded is not None and superseded():
+                        # the tokens generated so far are used all the same
+                        self._finish_stream(user_sid, tokens, parts, store=False)
+                        return
+                    content = self._chunk_content(chunk)
+                    if content:
+                        parts.append(content)
+                        yield content
+            finally:
+                # closing the connection stops the generation when the stream is left early
+                chunks.close()
+            self._finish_stream(user_sid, tokens, parts)
+        except Exception as e:
+            logging.error("Error trying to stream the answer from gpt: {}".format(str(e)))
 
-    def generate_images(self, prompt: str) -> List[Dict[str, str]]:
+    def iter_images(self, prompt: str, sizes: List[str]) -> Iterator[Tuple[int, Optional[str]]]:
         """
-        Generate images based on a prompt.
+        Generate an image of each size based on a prompt, requesting them all at once.
 
         Args:
             prompt: The prompt to generate images.
+            sizes: The size of each image.
 
         Returns:
-            The list of images generated.
+            An iterator over the index of each image in sizes and its URL, or None if it failed,
+            in the order they are generated.
         """
+        futures = {self._image_executor.submit(contextvars.copy_context().run, self._generate_image, prompt, size): index
+                   for index, size in enumerate(sizes)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+    def _generate_image(self, prompt: str, size: str) -> Optional[str]:
         try:
-            response = openai.Image.create(
-                prompt=prompt,
-                n=2,
-                size="1024x1024"
-            )
-            return response['data']
+            response = self._create(self._image_limiter, 0, openai.Image.create, "openai_image",
+                                    prompt=prompt, n=1, size=size)
+            return response['data'][0]['url']
         except Exception as e:
-            logging.error("Error generating images: {}".format(str(e)))
+            logging.error("Error generating an image: {}".format(str(e)))
+            return None
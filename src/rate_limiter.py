@@ -0,0 +1,161 @@
+import random
+import threading
+import time
+from typing import Dict, Mapping, Optional
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """
+    Get the time to wait before retrying a request, growing exponentially with the attempts and
+    randomized over the whole interval, so the clients that failed together do not retry together.
+
+    Args:
+        attempt: The number of attempts that failed, starting at 0.
+        base: The maximum delay after the first failure in seconds.
+        cap: The maximum delay in seconds.
+
+    Returns:
+        The delay in seconds.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def _parse_header(headers: Mapping[str, str], name: str) -> Optional[float]:
+    # a missing or malformed header is skipped, as the response it came with already succeeded
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class _Budget:
+    """
+    A per minute budget, refilled continuously, that can be reserved ahead of time.
+    """
+
+    def __init__(self, per_minute: float) -> None:
+        self.per_minute = per_minute
+        self.available = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.available = min(self.per_minute, self.available + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        # the budget may go below zero, which queues the request until it is refilled
+        self.available -= min(amount, self.per_minute)
+        return max(0.0, -self.available * 60 / self.per_minute)
+
+
+class RateLimiter:
+    """
+    A client side limiter of the requests and tokens sent per minute to an API. Requests over the
+    budget are delayed in the order they arrive, and the budget follows the rate limit headers
+    and the rate limit errors of the API.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: Optional[float] = None, shares: int = 1) -> None:
+        """
+        Initialize the rate limiter.
+
+        Args:
+            requests_per_minute: The number of requests allowed per minute to the account.
+            tokens_per_minute: The number of tokens allowed per minute to the account, or None if they are not limited.
+            shares: The number of limiters splitting the limits of the account, such as the webhook workers,
+                each one getting an equal share of them and of the limits in the headers.
+        """
+        self._shares = shares
+        self._requests = _Budget(requests_per_minute / shares)
+        self._tokens = None if tokens_per_minute is None else _Budget(tokens_per_minute / shares)
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: int = 0) -> float:
+        """
+        Reserve the budget of a request.
+
+        Args:
+            tokens: The estimated number of tokens of the request.
+
+        Returns:
+            The time in seconds to wait before sending the request.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._requests.refill(now)
+            delay = self._requests.reserve(1)
+            if self._tokens is not None:
+                self._tokens.refill(now)
+                delay = max(delay, self._tokens.reserve(tokens))
+            return max(delay, self._paused_until - now)
+
+    def acquire(self, tokens: int = 0) -> None:
+        """
+        Reserve the budget of a request and wait until it can be sent.
+
+        Args:
+            tokens: The estimated number of tokens of the request.
+        """
+        time.sleep(self.reserve(tokens))
+
+    def record_usage(self, estimated_tokens: int, used_tokens: int) -> None:
+        """
+        Correct the budget with the number of tokens a request actually used.
+
+        Args:
+            estimated_tokens: The number of tokens reserved for the request.
+            used_tokens: The number of tokens reported by the API.
+        """
+        if self._tokens is None:
+            return
+        with self._lock:
+            self._tokens.available += estimated_tokens - used_tokens
+
+    def available(self) -> Dict[str, float]:
+        """
+        Get the budget left under each limit.
+
+        Returns:
+            The requests, and the tokens if they are limited, that can be sent right away.
+        """
+        with self._lock:
+            now = time.monotonic()
+            budgets = {}
+            for budget, kind in ((self._requests, "requests"), (self._tokens, "tokens")):
+                if budget is not None:
+                    budget.refill(now)
+                    budgets[kind] = budget.available
+            return budgets
+
+    def pause(self, seconds: float) -> None:
+        """
+        Delay every request for a while, after the API refused one.
+
+        Args:
+            seconds: The time to wait in seconds.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        """
+        Follow the limits and the remaining budget sent by the API in the rate limit headers,
+        which are those of the whole account, so only the share of this limiter is kept.
+
+        Args:
+            headers: The headers of a response.
+        """
+        with self._lock:
+            now = time.monotonic()
+            for budget, kind in ((self._requests, "requests"), (self._tokens, "tokens")):
+                if budget is None or "x-ratelimit-remaining-{}".format(kind) not in headers:
+                    continue
+                budget.refill(now)
+                limit = _parse_header(headers, "x-ratelimit-limit-{}".format(kind))
+                if limit is not None and limit > 0:
+                    budget.per_minute = limit / self._shares
+                remaining = _parse_header(headers, "x-ratelimit-remaining-{}".format(kind))
+                if remaining is not None:
+                    # the API has not seen the requests still on their way, so the lowest estimate is kept
+                    budget.available = min(budget.available, remaining / self._shares)
@@ -0,0 +1,216 @@
+import base64
+import datetime
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+from src.message_store import MessageArchive, MessageStore
+from src.metrics import report_error, stage
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def pack_messages(user_sid: str, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+    """
+    Pack messages of a user into a compressed batch, to be archived as a single document.
+
+    Args:
+        user_sid: The user session ID.
+        messages: The messages, with all their fields, sorted by creation date.
+
+    Returns:
+        The batch, with the dates of its first and last messages and the compressed messages in data.
+    """
+    data = gzip.compress(json.dumps(messages, ensure_ascii=False).encode())
+    return {
+        'user_sid': user_sid,
+        'first_created_at': messages[0]['created_at'],
+        'last_created_at': messages[-1]['created_at'],
+        'count': len(messages),
+        'data': base64.b64encode(data).decode()
+    }
+
+
+def unpack_messages(batch: Dict[str, Any]) -> List[Dict[str, str]]:
+    """
+    Get the messages of an archived batch.
+
+    Args:
+        batch: The batch, as made by pack_messages.
+
+    Returns:
+        The messages, with all their fields, sorted by creation date.
+    """
+    return json.loads(gzip.decompress(base64.b64decode(batch['data'])))
+
+
+class FileArchive(MessageArchive):
+    """
+    Archives the messages in local files, one gzipped JSON list of messages per batch, in a directory per user.
+    """
+
+    def __init__(self, directory: str) -> None:
+        """
+        Initialize the file archive.
+
+        Args:
+            directory: The directory of the archive, created if needed.
+        """
+        self._directory = directory
+
+    def insert_archive_batches(self, batches: List[Dict[str, Any]]) -> None:
+        """
+        Write archived batches of messages to their files.
+
+        Args:
+            batches: The batches, as made by pack_messages.
+        """
+        with stage("file_archive"):
+            for batch in batches:
+                directory = self._user_directory(batch['user_sid'])
+                os.makedirs(directory, exist_ok=True)
+                name = "{}_{}".format(batch['first_created_at'], batch['last_created_at']).replace(":", "-")
+                path = os.path.join(directory, name + ".json.gz")
+                # the batch is written whole or not at all
+                with open(path + ".tmp", "wb") as archive_file:
+                    archive_file.write(base64.b64decode(batch['data']))
+                os.replace(path + ".tmp", path)
+
+    def delete_archive_batches(self, user_sid: str) -> int:
+        """
+        Delete the archived messages of a user.
+
+        Args:
+            user_sid: The user session ID.
+
+        Returns:
+            The number of batches deleted.
+        """
+        directory = self._user_directory(user_sid)
+        if not os.path.isdir(directory):
+            return 0
+        count = len(os.listdir(directory))
+        shutil.rmtree(directory)
+        return count
+
+    def _user_directory(self, user_sid: str) -> str:
+        return os.path.join(self._directory, re.sub(r"[^\w.-]", "_", user_sid))
+
+
+class RetentionJob:
+    """
+    Keeps the message store small by moving the old messages to its archive in the background:
+    the messages older than a maximum age, and the messages of each user past the newest ones kept.
+
+    Everything runs on the maintenance thread of the store, a page at a time, so a page is deleted
+    right after it is archived, a history cleared meanwhile is not archived again, and the job stops
+    once the store is closed.
+    """
+
+    def __init__(self, message_store: MessageStore, max_age_days: Optional[float] = None,
+                 keep_latest: Optional[int] = None, interval: float = 3600.0, page_size: int = 500) -> None:
+        """
+        Initialize the retention job.
+
+        Args:
+            message_store: The store of the messages.
+            max_age_days: The age in days past which the messages are archived, or None to keep them.
+            keep_latest: The number of newest messages kept for each user who wrote since the last run,
+                or None to keep them all.
+            interval: The time in seconds between runs.
+            page_size: The number of messages archived at once.
+        """
+        self._message_store = message_store
+        self._max_age_days = max_age_days
+        self._keep_latest = keep_latest
+        self._interval = interval
+        self._page_size = page_size
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """
+        Run the job now and then at every interval, in a background thread, until the job or the store is closed.
+        """
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        """
+        Stop the job after the page being archived.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_once(self) -> int:
+        """
+        Archive the messages past the retention limits and wait for it.
+
+        Returns:
+            The number of messages archived.
+        """
+        archived = 0
+        if self._max_age_days is not None:
+            cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=self._max_age_days)
+            archived += self._archive_before(cutoff.isoformat())
+        if self._keep_latest is not None:
+            for user_sid in self._message_store.take_active_users():
+                if self._stopped.is_set():
+                    break
+                oldest_kept = self._message_store.run_maintenance(
+                    self._message_store.get_nth_newest_date, user_sid, self._keep_latest).result()
+                if oldest_kept is not None:
+                    archived += self._archive_before(oldest_kept, user_sid)
+        if archived > 0:
+            logging.info("Archived {} messages".format(archived))
+        return archived
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.run_once()
+            except RuntimeError:
+                # the store was closed
+                return
+            except Exception as e:
+                report_error("retention", e)
+            self._stopped.wait(self._interval)
+
+    def _archive_before(self, before: str, user_sid: Optional[str] = None) -> int:
+        archived = 0
+        after = None
+        while not self._stopped.is_set():
+            count, after = self._message_store.run_maintenance(self._archive_page, before, after, user_sid).result()
+            archived += count
+            if after is None:
+                break
+        return archived
+
+    def _archive_page(self, before: str, after: Optional[str], user_sid: Optional[str]) -> Tuple[int, Optional[str]]:
+        # runs on the maintenance thread of the store
+        page = self._message_store.export_messages(before, after, user_sid, self._page_size)
+        if len(page) == 0:
+            return 0, None
+        last = page[-1]['created_at']
+        full = len(page) == self._page_size
+        if full:
+            # the messages sharing the last date may go on in the next page, so they are left to it
+            tied = [message for message in page if message['created_at'] == last]
+            if len(tied) == len(page):
+                logging.warning("More than {} messages were created at {}, they are not archived".format(
+                    len(page), last))
+                return 0, last
+            page = page[:-len(tied)]
+            last = page[-1]['created_at']
+        messages: Dict[str, List[Dict[str, str]]] = {}
+        for message in page:
+            messages.setdefault(message['user_sid'], []).append(message)
+        self._message_store.archive.insert_archive_batches(
+            [pack_messages(batch_user_sid, batch) for batch_user_sid, batch in messages.items()])
+        # every message of these users up to the last date is in this page or was archived before
+        self._message_store.delete_messages(list(messages), last)
+        return len(page), last if full else None
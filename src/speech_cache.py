@@ -0,0 +1,191 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+class CachedSpeech:
+    """
+    A synthesized audio, with the Telegram file ID of its first upload when known.
+    """
+
+    def __init__(self, audio: bytes, file_id: Optional[str] = None) -> None:
+        self.audio = audio
+        self.file_id = file_id
+
+
+class SpeechCache:
+    """
+    A content-addressed cache of synthesized audio, with a least recently used tier in memory
+    and an optional one on disk, each limited by size.
+    """
+
+    def __init__(self, directory: Optional[str] = None, max_memory_bytes: int = 32 * 1024 * 1024,
+                 max_disk_bytes: int = 512 * 1024 * 1024) -> None:
+        """
+        Initialize the speech cache.
+
+        Args:
+            directory: The directory of the disk tier, or None to keep the audio only in memory.
+            max_memory_bytes: The maximum size of the audio kept in memory.
+            max_disk_bytes: The maximum size of the audio kept on disk.
+        """
+        self._directory = directory
+        self._max_memory_bytes = max_memory_bytes
+        self._max_disk_bytes = max_disk_bytes
+        self._memory: "OrderedDict[str, CachedSpeech]" = OrderedDict()
+        self._memory_size = 0
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._load_disk_index()
+
+    @staticmethod
+    def key(text: str, voice_name: str, output_format: str) -> str:
+        """
+        Get the cache key of a synthesis.
+
+        Args:
+            text: The synthesized text.
+            voice_name: The name of the voice.
+            output_format: The name of the audio format.
+
+        Returns:
+            The key of the synthesized audio.
+        """
+        return hashlib.sha256("\0".join((voice_name, output_format, text)).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[CachedSpeech]:
+        """
+        Get a cached audio, loading it to memory if it is only on disk.
+
+        Args:
+            key: The cache key.
+
+        Returns:
+            The cached audio, or None if it is not cached.
+        """
+        with self._lock:
+            speech = self._memory.get(key)
+            if speech is not None:
+                self._memory.move_to_end(key)
+            elif key in self._disk:
+                speech = self._read(key)
+                if speech is not None:
+                    self._store_in_memory(key, speech)
+            if speech is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return speech
+
+    def put(self, key: str, audio: bytes, file_id: Optional[str] = None) -> None:
+        """
+        Store a synthesized audio in both tiers, evicting the least recently used ones if needed.
+
+        Args:
+            key: The cache key.
+            audio: The synthesized audio.
+            file_id: The Telegram file ID of the audio, if it was uploaded.
+        """
+        speech = CachedSpeech(audio, file_id)
+        with self._lock:
+            self._store_in_memory(key, speech)
+            self._write(key, speech)
+
+    def set_file_id(self, key: str, file_id: str) -> None:
+        """
+        Remember the Telegram file ID of a cached audio, so it can be sent again without uploading it.
+
+        Args:
+            key: The cache key.
+            file_id: The Telegram file ID.
+        """
+        with self._lock:
+            speech = self._memory.get(key)
+            if speech is not None:
+                speech.file_id = file_id
+            if key in self._disk:
+                self._write_file(self._path(key, "file_id"), file_id.encode())
+
+    def _store_in_memory(self, key: str, speech: CachedSpeech) -> None:
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_size -= len(previous.audio)
+        if len(speech.audio) > self._max_memory_bytes:
+            return
+        self._memory[key] = speech
+        self._memory_size += len(speech.audio)
+        while self._memory_size > self._max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted.audio)
+
+    def _path(self, key: str, extension: str) -> str:
+        return os.path.join(self._directory, "{}.{}".format(key, extension))
+
+    def _load_disk_index(self) -> None:
+        entries = []
+        for name in os.listdir(self._directory):
+            if name.endswith(".ogg"):
+                stat = os.stat(os.path.join(self._directory, name))
+                entries.append((stat.st_mtime, name[:-len(".ogg")], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_size += size
+        self._evict_from_disk()
+
+    def _read(self, key: str) -> Optional[CachedSpeech]:
+        try:
+            with open(self._path(key, "ogg"), "rb") as file:
+                audio = file.read()
+            file_id = None
+            if os.path.exists(self._path(key, "file_id")):
+                with open(self._path(key, "file_id"), "rb") as file:
+                    file_id = file.read().decode()
+            # the modification time orders the files by use when the cache is loaded again
+            os.utime(self._path(key, "ogg"))
+            self._disk.move_to_end(key)
+            return CachedSpeech(audio, file_id)
+        except Exception as e:
+            logging.error("Error reading cached speech: {}".format(str(e)))
+            self._remove_from_disk(key)
+            return None
+
+    def _write(self, key: str, speech: CachedSpeech) -> None:
+        if self._directory is None or len(speech.audio) > self._max_disk_bytes:
+            return
+        try:
+            self._write_file(self._path(key, "ogg"), speech.audio)
+            if speech.file_id is not None:
+                self._write_file(self._path(key, "file_id"), speech.file_id.encode())
+        except Exception as e:
+            logging.error("Error writing cached speech: {}".format(str(e)))
+            return
+        self._disk_size += len(speech.audio) - self._disk.pop(key, 0)
+        self._disk[key] = len(speech.audio)
+        self._evict_from_disk()
+
+    @staticmethod
+    def _write_file(path: str, content: bytes) -> None:
+        # written to a temporary file first so a crash never leaves a truncated audio behind
+        with open(path + ".tmp", "wb") as file:
+            file.write(content)
+        os.replace(path + ".tmp", path)
+
+    def _evict_from_disk(self) -> None:
+        while self._disk_size > self._max_disk_bytes:
+            self._remove_from_disk(next(iter(self._disk)))
+
+    def _remove_from_disk(self, key: str) -> None:
+        self._disk_size -= self._disk.pop(key, 0)
+        for extension in ("ogg", "file_id"):
+            try:
+                os.remove(self._path(key, extension))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,513 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+from src.message_store import AsyncMessageStore, MessageArchive, MessageStore, new_message
+from src.metrics import stage
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY,
+        user_sid TEXT NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        content_source TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS messages_user_sid_created_at ON messages (user_sid, created_at);
+    CREATE INDEX IF NOT EXISTS messages_created_at ON messages (created_at);
+    CREATE TABLE IF NOT EXISTS message_archives (
+        id INTEGER PRIMARY KEY,
+        user_sid TEXT NOT NULL,
+        first_created_at TEXT NOT NULL,
+        last_created_at TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS message_archives_user_sid ON message_archives (user_sid);
+'''
+
+INSERT_MESSAGE = '''
+    INSERT INTO messages (user_sid, role, content, content_source, created_at)
+    VALUES (:user_sid, :role, :content, :content_source, :created_at)
+'''
+
+INSERT_ARCHIVE = '''
+    INSERT INTO message_archives (user_sid, first_created_at, last_created_at, count, data)
+    VALUES (:user_sid, :first_created_at, :last_created_at, :count, :data)
+'''
+
+
+def _dict_row(cursor: sqlite3.Cursor, row: Tuple[Any, ...]) -> Dict[str, Any]:
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+class SQLiteMessageStore(MessageStore):
+    """
+    Stores the messages in a local SQLite database, indexed by user and creation date, so reading
+    the newest messages of a user takes a lookup on disk instead of a request to MongoDB Atlas.
+    """
+
+    def __init__(self, path: str, cache_size: int = 50000, write_batch_size: int = 50,
+                 write_interval: float = 0.1, archive: Optional[MessageArchive] = None) -> None:
+        """
+        Initialize the SQLite message store, creating the database if needed.
+
+        Args:
+            path: The path of the database file.
+            cache_size: The maximum number of messages kept in the history cache.
+            write_batch_size: The number of queued messages that triggers a write.
+            write_interval: The maximum time in seconds a queued message waits to be written.
+            archive: Where the old messages are archived, by default in the message_archives table.
+        """
+        super().__init__(cache_size, write_batch_size, write_interval, archive)
+        self._path = path
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        # SQLite has a single writer at a time, so the writes wait here instead of retrying on a busy database
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._writer: Optional[threading.Thread] = None
+        self._closed = False
+        self._connection().executescript(SCHEMA)
+
+    def insert_message(self, user_sid: str, role: str, content: str, content_source: str) -> Dict[str, str]:
+        """
+        Insert a new message into the database.
+
+        Args:
+            user_sid: The user session ID.
+            role: The role of the message.
+            content: The content of the message.
+            content_source: The content source of the message (text or audio).
+
+        Returns:
+            The inserted message.
+        """
+        message = new_message(user_sid, role, content, content_source)
+        try:
+            with self._write_lock, stage("sqlite_insert"):
+                self._write_messages([message])
+        except Exception as e:
+            raise Exception("Failed to insert message: {}".format(str(e)))
+        self._history_cache.append(user_sid, {
+            'role': message['role'],
+            'content': message['content'],
+            'created_at': message['created_at']
+        })
+        return message
+
+    def queue_message(self, user_sid: str, role: str, content: str, content_source: str,
+                      created_at: Optional[str] = None) -> Dict[str, str]:
+        """
+        Queue a new message to be inserted into the database with other messages, without waiting for it.
+
+        Args:
+            user_sid: The user session ID.
+            role: The role of the message.
+            content: The content of the message.
+            content_source: The content source of the message (text or audio).
+            created_at: The creation date of the message, by default the current time.
+
+        Returns:
+            The message to be inserted.
+        """
+        if self._writer is None:
+            self._start_writer()
+        message = new_message(user_sid, role, content, content_source, created_at)
+        if self._queue(message):
+            self._wake.set()
+        return message
+
+    def flush(self) -> None:
+        """
+        Write the queued messages and wait for it.
+        """
+        self._flush()
+
+    def get_messages(self, user_sid: str, limit: Optional[int] = None, before: Optional[str] = None,
+                     after: Optional[str] = None) -> List[Dict[str, str]]:
+        """
+        Retrieve messages from the database for a given user, or from the cache when they are known.
+
+        Args:
+            user_sid: The user session ID.
+            limit: The maximum number of messages to retrieve, keeping the newest ones.
+            before: Only retrieve messages created before this date.
+            after: Only retrieve messages created after this date.
+
+        Returns:
+            The list of messages sorted by creation date.
+        """
+        after = self._visible_after(user_sid, after)
+        messages = self._history_cache.get(user_sid, limit, before, after)
+        if messages is not None:
+            return messages
+
+        if self._has_unsaved_messages(user_sid):
+            self._flush()
+        return self._read_messages(user_sid, limit, before, after)
+
+    def delete_user_messages(self, user_sid: str) -> Dict[str, int]:
+        """
+        Delete messages for a given user from the database.
+
+        Args:
+            user_sid: The user session ID.
+
+        Returns:
+            The deletion result.
+        """
+        if self._has_unsaved_messages(user_sid):
+            self._flush()
+        return self._delete_messages(user_sid)
+
+    def iter_all_messages(self, page_size: int = 500) -> Iterator[List[Dict[str, str]]]:
+        """
+        Walk through the messages of every user in the database, to export them.
+
+        Args:
+            page_size: The number of messages of each page.
+
+        Returns:
+            An iterator over the pages of messages, with all their fields, in insertion order.
+        """
+        self._flush()
+        last_id = 0
+        while True:
+            rows = self._connection().execute(
+                "SELECT id, user_sid, role, content, content_source, created_at FROM messages"
+                " WHERE id > ? ORDER BY id LIMIT ?", (last_id, page_size)).fetchall()
+            if len(rows) > 0:
+                last_id = rows[-1]['id']
+                for row in rows:
+                    del row['id']
+                yield rows
+            if len(rows) < page_size:
+                return
+
+    def insert_messages(self, messages: List[Dict[str, str]]) -> None:
+        """
+        Insert messages of any users into the database at once and wait for it, to import them.
+
+        Args:
+            messages: The messages, with all their fields.
+        """
+        try:
+            with self._write_lock, stage("sqlite_insert"):
+                self._write_messages(messages)
+        except Exception as e:
+            raise Exception("Failed to insert messages: {}".format(str(e)))
+        finally:
+            for user_sid in set(message['user_sid'] for message in messages):
+                self._history_cache.invalidate(user_sid)
+
+    def export_messages(self, before: str, after: Optional[str] = None, user_sid: Optional[str] = None,
+                        limit: int = 500) -> List[Dict[str, str]]:
+        """
+        Retrieve the oldest messages created in a range from the database, with all their fields, to archive them.
+
+        Args:
+            before: Only retrieve messages created before this date.
+            after: Only retrieve messages created after this date.
+            user_sid: Only retrieve the messages of this user, instead of every user.
+            limit: The maximum number of messages to retrieve, keeping the oldest ones.
+
+        Returns:
+            The list of messages sorted by creation date.
+        """
+        query = "SELECT user_sid, role, content, content_source, created_at FROM messages WHERE created_at < ?"
+        parameters: List[Any] = [before]
+        if after is not None:
+            query += " AND created_at > ?"
+            parameters.append(after)
+        if user_sid is not None:
+            query += " AND user_sid = ?"
+            parameters.append(user_sid)
+        query += " ORDER BY created_at, id LIMIT ?"
+        parameters.append(limit)
+        try:
+            with stage("sqlite_get"):
+                return self._connection().execute(query, parameters).fetchall()
+        except Exception as e:
+            raise Exception("Failed to export messages: {}".format(str(e)))
+
+    def get_nth_newest_date(self, user_sid: str, n: int) -> Optional[str]:
+        """
+        Get the creation date of the nth newest message of a user from the database.
+
+        Args:
+            user_sid: The user session ID.
+            n: The position of the message, 1 for the newest.
+
+        Returns:
+            The creation date, or None if the user has fewer messages.
+        """
+        if self._has_unsaved_messages(user_sid):
+            self._flush()
+        try:
+            with stage("sqlite_get"):
+                row = self._connection().execute(
+                    "SELECT created_at FROM messages WHERE user_sid = ? ORDER BY created_at DESC LIMIT 1 OFFSET ?",
+                    (user_sid, n - 1)).fetchone()
+        except Exception as e:
+            raise Exception("Failed to retrieve messages: {}".format(str(e)))
+        return None if row is None else row['created_at']
+
+    def delete_messages(self, user_sids: List[str], until: str) -> Dict[str, int]:
+        """
+        Delete the messages of some users created up to a date from the database and wait for it.
+
+        Args:
+            user_sids: The user session IDs.
+            until: Only delete messages created at or before this date.
+
+        Returns:
+            The deletion result.
+        """
+        if any(self._has_unsaved_messages(user_sid) for user_sid in user_sids):
+            self._flush()
+        try:
+            with self._write_lock, stage("sqlite_delete"):
+                connection = self._connection()
+                connection.execute("BEGIN")
+                try:
+                    deleted = sum(connection.execute("DELETE FROM messages WHERE user_sid = ? AND created_at <= ?",
+                                                     (user_sid, until)).rowcount for user_sid in user_sids)
+                    connection.execute("COMMIT")
+                except Exception:
+                    connection.execute("ROLLBACK")
+                    raise
+            return {'deletedCount': deleted}
+        except Exception as e:
+            raise Exception("Failed to delete messages: {}".format(str(e)))
+        finally:
+            for user_sid in user_sids:
+                self._history_cache.invalidate(user_sid)
+
+    def insert_archive_batches(self, batches: List[Dict[str, Any]]) -> None:
+        """
+        Store archived batches of messages in the message_archives table and wait for it.
+
+        Args:
+            batches: The batches, as made by retention.pack_messages.
+        """
+        try:
+            with self._write_lock, stage("sqlite_archive"):
+                connection = self._connection()
+                connection.execute("BEGIN")
+                try:
+                    connection.executemany(INSERT_ARCHIVE, batches)
+                    connection.execute("COMMIT")
+                except Exception:
+                    connection.execute("ROLLBACK")
+                    raise
+        except Exception as e:
+            raise Exception("Failed to archive messages: {}".format(str(e)))
+
+    def delete_archive_batches(self, user_sid: str) -> int:
+        """
+        Delete the archived messages of a user from the message_archives table and wait for it.
+
+        Args:
+            user_sid: The user session ID.
+
+        Returns:
+            The number of batches deleted.
+        """
+        try:
+            with self._write_lock, stage("sqlite_delete"):
+                return self._connection().execute("DELETE FROM message_archives WHERE user_sid = ?",
+                                                  (user_sid,)).rowcount
+        except Exception as e:
+            raise Exception("Failed to delete archived messages: {}".format(str(e)))
+
+    def close(self) -> None:
+        """
+        Finish the bulk operations and write the queued messages, then stop the writer and close the connections.
+        """
+        self._stop_maintenance()
+        self._closed = True
+        if self._writer is not None:
+            self._wake.set()
+            self._writer.join()
+            self._writer = None
+        self._flush()
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
+
+    def _flush(self) -> None:
+        # one batch at a time, so the messages are written in order
+        with self._write_lock:
+            batch = self._take_pending()
+            if len(batch) == 0:
+                return
+            try:
+                with stage("sqlite_insert"):
+                    self._write_messages([queued.message for queued in batch])
+            except Exception as e:
+                dropped = self._retry_later(batch)
+                if len(dropped) > 0:
+                    logging.error("Failed to insert {} messages, dropping them: {}".format(len(dropped), str(e)))
+                if len(dropped) < len(batch):
+                    # the writer retries at its next interval
+                    logging.error("Failed to insert {} messages, retrying: {}".format(len(batch) - len(dropped), str(e)))
+                return
+            self._on_written(batch)
+
+    def _connection(self) -> sqlite3.Connection:
+        # a connection per thread, as a connection runs one statement at a time
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=5, check_same_thread=False, isolation_level=None)
+            connection.row_factory = _dict_row
+            # the write-ahead log lets the reads go on while a batch is written, and only syncs at checkpoints
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with self._connections_lock:
+                self._connections.append(connection)
+            self._local.connection = connection
+        return connection
+
+    def _start_writer(self) -> None:
+        with self._connections_lock:
+            if self._writer is not None:
+                return
+            self._writer = threading.Thread(target=self._write_queued, name="sqlite-writer", daemon=True)
+            self._writer.start()
+
+    def _write_queued(self) -> None:
+        while not self._closed:
+            self._wake.wait(self._write_interval)
+            self._wake.clear()
+            self._flush()
+
+    def _write_messages(self, messages: List[Dict[str, str]]) -> None:
+        connection = self._connection()
+        connection.execute("BEGIN")
+        try:
+            connection.executemany(INSERT_MESSAGE, messages)
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def _read_messages(self, user_sid: str, limit: Optional[int], before: Optional[str],
+                       after: Optional[str]) -> List[Dict[str, str]]:
+        query = "SELECT role, content, created_at FROM messages WHERE user_sid = ?"
+        parameters: List[Any] = [user_sid]
+        if before is not None:
+            query += " AND created_at < ?"
+            parameters.append(before)
+        if after is not None:
+            query += " AND created_at > ?"
+            parameters.append(after)
+        if limit is None:
+            query += " ORDER BY created_at, id"
+        else:
+            # the newest messages come first, so the limit keeps them
+            query += " ORDER BY created_at DESC, id DESC LIMIT ?"
+            parameters.append(limit)
+
+        try:
+            with stage("sqlite_get"):
+                messages = self._connection().execute(query, parameters).fetchall()
+        except Exception as e:
+            raise Exception("Failed to retrieve messages: {}".format(str(e)))
+        if limit is not None:
+            messages.reverse()
+        messages = self._with_pending(user_sid, messages, limit, before, after)
+        self._history_cache.put(user_sid, messages, limit, before, after)
+        return messages
+
+    def _delete_messages(self, user_sid: str) -> Dict[str, int]:
+        try:
+            with self._write_lock, stage("sqlite_delete"):
+                cursor = self._connection().execute("DELETE FROM messages WHERE user_sid = ?", (user_sid,))
+            return {'deletedCount': cursor.rowcount}
+        except Exception as e:
+            raise Exception("Failed to delete user messages: {}".format(str(e)))
+        finally:
+            self._history_cache.invalidate(user_sid)
+
+
+class AsyncSQLiteMessageStore(SQLiteMessageStore, AsyncMessageStore):
+    """
+    An asyncio store of the messages in a local SQLite database. The indexed reads run on the event loop,
+    as they take a fraction of a millisecond, while the writes, which wait for each other, run in a thread.
+    """
+
+    async def connect(self) -> None:
+        """
+        Nothing to open, as the database is opened when the store is created.
+        """
+
+    async def aflush(self) -> None:
+        """
+        Write the queued messages and wait for it.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self._flush)
+
+    async def aclose(self) -> None:
+        """
+        Finish the bulk operations and write the queued messages, then stop the writer and close the connections.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    async def ainsert_message(self, user_sid: str, role: str, content: str, content_source: str) -> Dict[str, str]:
+        """
+        Insert a new message into the database.
+
+        Args:
+            user_sid: The user session ID.
+            role: The role of the message.
+            content: The content of the message.
+            content_source: The content source of the message (text or audio).
+
+        Returns:
+            The inserted message.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.insert_message, user_sid, role, content, content_source)
+
+    async def aget_messages(self, user_sid: str, limit: Optional[int] = None, before: Optional[str] = None,
+                           after: Optional[str] = None) -> List[Dict[str, str]]:
+        """
+        Retrieve messages from the database for a given user, or from the cache when they are known.
+
+        Args:
+            user_sid: The user session ID.
+            limit: The maximum number of messages to retrieve, keeping the newest ones.
+            before: Only retrieve messages created before this date.
+            after: Only retrieve messages created after this date.
+
+        Returns:
+            The list of messages sorted by creation date.
+        """
+        after = self._visible_after(user_sid, after)
+        messages = self._history_cache.get(user_sid, limit, before, after)
+        if messages is not None:
+            return messages
+
+        if self._has_unsaved_messages(user_sid):
+            await self.aflush()
+        return self._read_messages(user_sid, limit, before, after)
+
+    async def adelete_user_messages(self, user_sid: str) -> Dict[str, int]:
+        """
+        Delete messages for a given user from the database.
+
+        Args:
+            user_sid: The user session ID.
+
+        Returns:
+            The deletion result.
+        """
+        if self._has_unsaved_messages(user_sid):
+            await self.aflush()
+        return await asyncio.get_running_loop().run_in_executor(None, self._delete_messages, user_sid)
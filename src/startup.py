@@ -0,0 +1,81 @@
+import logging
+import threading
+import time
+from src.metrics import STARTUP_SECONDS
+from typing import Callable, Dict, List, Tuple
+
+
+class Startup:
+    """
+    Breaks down the time the bot takes to start serving updates, and holds the warm-ups that are
+    deferred until then, such as loading the token encoding and connecting to the speech service,
+    so they never delay the first poll.
+    """
+
+    def __init__(self) -> None:
+        self._started = self._last_mark = time.perf_counter()
+        self.timings: Dict[str, float] = {}
+        self._warm_ups: List[Tuple[str, Callable[[], None]]] = []
+        self._lock = threading.Lock()
+
+    def mark(self, name: str) -> None:
+        """
+        Count the time since the previous mark, or since the startup began, as the given stage.
+
+        Args:
+            name: The name of the stage that just ended.
+        """
+        now = time.perf_counter()
+        with self._lock:
+            self.timings[name] = self.timings.get(name, 0.0) + now - self._last_mark
+            self._last_mark = now
+        STARTUP_SECONDS.set(self.timings[name], stage=name)
+
+    def defer(self, name: str, warm_up: Callable[[], None]) -> None:
+        """
+        Run a warm-up in the background once the bot is ready to serve updates.
+
+        Args:
+            name: What is warmed up, for the logs.
+            warm_up: The function that warms it up.
+        """
+        with self._lock:
+            self._warm_ups.append((name, warm_up))
+
+    def ready(self, budget: float = 0.0) -> float:
+        """
+        Log the startup timings and start the deferred warm-ups, right before serving updates.
+
+        Args:
+            budget: The time in seconds the startup should take, warned about when exceeded, or 0 for none.
+
+        Returns:
+            The time in seconds since the startup began.
+        """
+        elapsed = time.perf_counter() - self._started
+        STARTUP_SECONDS.set(elapsed, stage="total")
+        timings = ", ".join("{} {:.0f} ms".format(name, seconds * 1000) for name, seconds in self.timings.items())
+        logging.info("Startup timings: {}; serving after {:.0f} ms".format(timings, elapsed * 1000))
+        if 0 < budget < elapsed:
+            logging.warning("The startup took {:.1f} s, over its budget of {:.1f} s".format(elapsed, budget))
+
+        with self._lock:
+            warm_ups, self._warm_ups = self._warm_ups, []
+        if len(warm_ups) > 0:
+            threading.Thread(target=self._warm_up, args=(warm_ups,), name="warm-up", daemon=True).start()
+        return elapsed
+
+    @staticmethod
+    def _warm_up(warm_ups: List[Tuple[str, Callable[[], None]]]) -> None:
+        for name, warm_up in warm_ups:
+            start = time.perf_counter()
+            try:
+                warm_up()
+            except Exception as e:
+                logging.error("Error warming up the {}: {}".format(name, str(e)))
+                continue
+            logging.info("Warmed up the {} in {:.0f} ms".format(name, (time.perf_counter() - start) * 1000))
+
+
+# the startup is timed from the first import of this module, which app.py imports first
+STARTUP = Startup()
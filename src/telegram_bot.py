@@ -1,10 +1,98 @@
 from telebot import TeleBot, types
 from src.open_ai_api import OpenAIAPI
-from src.graph_ql_client import GraphQLClient
+from src.message_store import MessageStore
+from src.conversation_summary import summary_sid
 from src.azure_speech_recognizer import AzureSpeechRecognizer
-from pydub import AudioSegment
-import os
-import wave
+from src.audio import Transcoder, ogg_opus_duration
+from src.speech_cache import CachedSpeech, SpeechCache
+from src.image_cache import ImageCache, normalize_prompt
+from src.message_coalescer import MessageBatch
+from src.metrics import report_error, stage
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+import logging
+import math
+import time
+
+# the maximum length of the text of a Telegram message
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+DELETING_MESSAGE = "Suas mensagens estão sendo deletadas, avisarei quando terminar."
+
+# the reply shown until the first part of a streamed answer
+STREAM_PLACEHOLDER = "..."
+
+
+def split_message(text: str) -> List[str]:
+    """
+    Split a text in Telegram messages.
+
+    Args:
+        text: The text.
+
+    Returns:
+        The consecutive parts of the text, of at most TELEGRAM_MESSAGE_LIMIT characters.
+    """
+    # an empty text is still sent, as a single empty message
+    return [text[start:start + TELEGRAM_MESSAGE_LIMIT]
+            for start in range(0, max(len(text), 1), TELEGRAM_MESSAGE_LIMIT)]
+
+
+class StreamedReply:
+    """
+    An answer shown while it is generated, by editing a reply with its first TELEGRAM_MESSAGE_LIMIT characters.
+    The rest of the answer is sent in more replies once it is complete.
+    """
+
+    def __init__(self, edit_interval: float) -> None:
+        """
+        Initialize the streamed reply.
+
+        Args:
+            edit_interval: The minimum time in seconds between two edits of the reply.
+        """
+        self.answer = ""
+        self._edit_interval = edit_interval
+        self._shown = STREAM_PLACEHOLDER
+        self._last_edit = 0.0
+
+    def add(self, part: str) -> Optional[str]:
+        """
+        Add a part of the answer.
+
+        Args:
+            part: The part generated.
+
+        Returns:
+            The text to edit the reply with now, or None if it is not edited.
+        """
+        self.answer += part
+        # Telegram limits how often a message can be edited, so the edits are spaced out
+        if time.monotonic() - self._last_edit < self._edit_interval:
+            return None
+        return self.final_edit()
+
+    def edited(self) -> None:
+        """
+        Record that the reply was edited, so the next edit is spaced out from now.
+        """
+        self._last_edit = time.monotonic()
+
+    def final_edit(self) -> Optional[str]:
+        """
+        Get the text to edit the reply with, or None if it already shows it.
+        """
+        text = self.answer[:TELEGRAM_MESSAGE_LIMIT]
+        if text == self._shown:
+            return None
+        self._shown = text
+        return text
+
+    def overflow(self) -> List[str]:
+        """
+        Get the parts of the answer that do not fit in the reply.
+        """
+        return split_message(self.answer)[1:]
 
 
 class TelegramBot:
@@ -12,16 +100,34 @@ class TelegramBot:
     A Telegram bot for handling user requests.
     """
 
-    def __init__(self, bot: TeleBot, openai_api: OpenAIAPI) -> None:
+    def __init__(self, bot: TeleBot, openai_api: OpenAIAPI, stream: bool = False, edit_interval: float = 1.0,
+                 speech_cache: Optional[SpeechCache] = None, max_voice_duration: float = 600.0,
+                 transcoder: Optional[Transcoder] = None, image_cache: Optional[ImageCache] = None,
+                 image_sets: Optional[List[Tuple[str, int]]] = None) -> None:
         """
         Initialize the Telegram bot.
 
         Args:
             bot: An instance of TeleBot.
             openai_api: An instance of the OpenAIAPI.
+            stream: Whether to show the answers while they are generated, by editing the reply.
+            edit_interval: The minimum time in seconds between two edits of a streamed reply.
+            speech_cache: A cache of synthesized audio, or None to always synthesize it.
+            max_voice_duration: The maximum duration in seconds of the voice messages answered.
+            transcoder: Decodes the voice messages, by default with at most 2 ffmpeg processes at a time.
+            image_cache: A cache of the images sent for each prompt, or None to always generate them.
+            image_sets: The size and number of the images sent for a prompt, such as cheap previews
+                before the full images, which come last. By default two images of 1024x1024.
         """
         self._bot = bot
         self._openai_api = openai_api
+        self._stream = stream
+        self._edit_interval = edit_interval
+        self._speech_cache = speech_cache
+        self._max_voice_duration = max_voice_duration
+        self._transcoder = transcoder or Transcoder()
+        self._image_cache = image_cache
+        self._image_sets = image_sets or [("1024x1024", 2)]
 
     def generate_images(self, message: types.Message) -> None:
         """
@@ -31,17 +137,93 @@ class TelegramBot:
             message: The incoming message from the user.
         """
         try:
-            prompt = message.text.replace("/imagem", "")
-            if prompt.strip() == "":
+            prompt = normalize_prompt(message.text)
+            if prompt == "":
                 self._bot.reply_to(message, "Você precisa digitar uma frase para gerar imagens.")
                 return
 
-            images = self._openai_api.generate_images(str(message.text))
-            photos = list(map(lambda img: types.InputMediaPhoto(img["url"]), images))
-            self._bot.send_media_group(message.chat.id, photos)
-        except:
+            # with the full images cached, the previews are not needed
+            if self._send_cached_images(message, prompt, len(self._image_sets) - 1):
+                return
+            missing = [index for index in range(len(self._image_sets) - 1)
+                       if not self._send_cached_images(message, prompt, index)] + [len(self._image_sets) - 1]
+
+            # every image is requested at once, and sent as soon as it is generated
+            sets, sizes = self._image_requests(missing)
+            file_ids: Dict[int, List[str]] = {index: [] for index in missing}
+            for request, url in self._openai_api.iter_images(prompt, sizes):
+                if url is None:
+                    continue
+                with stage("telegram_send"):
+                    sent = self._bot.send_photo(message.chat.id, url, reply_to_message_id=message.message_id)
+                file_ids[sets[request]].append(sent.photo[-1].file_id)
+            if not any(file_ids.values()):
+                self._bot.reply_to(message, "Desculpe, não foi possível gerar as imagens agora, tente novamente em alguns instantes.")
+                return
+            self._cache_images(prompt, file_ids)
+        except Exception as e:
+            report_error("generate_images", e)
             self._bot.reply_to(message, "Desculpe, ocorreu um erro ao gerar as imagens.")
 
+    def _send_cached_images(self, message: types.Message, prompt: str, index: int) -> bool:
+        """
+        Send the images of a set from the image cache, by their Telegram file IDs.
+
+        Args:
+            message: The incoming message from the user.
+            prompt: The normalized prompt.
+            index: The index of the set of images in image_sets.
+
+        Returns:
+            True if the images were cached and sent.
+        """
+        key, file_ids = self._cached_images(prompt, index)
+        if file_ids is None:
+            return False
+        try:
+            with stage("telegram_send"):
+                if len(file_ids) == 1:
+                    self._bot.send_photo(message.chat.id, file_ids[0], reply_to_message_id=message.message_id)
+                else:
+                    self._bot.send_media_group(message.chat.id, [types.InputMediaPhoto(file_id) for file_id in file_ids],
+                                               reply_to_message_id=message.message_id)
+            return True
+        except Exception as e:
+            logging.error("Error sending the cached images: {}".format(str(e)))
+            self._image_cache.invalidate(key)
+            return False
+
+    def _cached_images(self, prompt: str, index: int) -> Tuple[Optional[str], Optional[List[str]]]:
+        """
+        Get the Telegram file IDs of a set of images from the image cache.
+
+        Args:
+            prompt: The normalized prompt.
+            index: The index of the set of images in image_sets.
+
+        Returns:
+            The cache key, or None without a cache, and the file IDs, or None if the set is not cached.
+        """
+        if self._image_cache is None:
+            return None, None
+        size, count = self._image_sets[index]
+        key = ImageCache.key(prompt, size)
+        return key, self._image_cache.get(key, count)
+
+    def _image_requests(self, missing: List[int]) -> Tuple[List[int], List[str]]:
+        # one request per image, so each one is sent as soon as it is generated
+        sets = [index for index in missing for _ in range(self._image_sets[index][1])]
+        return sets, [self._image_sets[index][0] for index in sets]
+
+    def _cache_images(self, prompt: str, file_ids: Dict[int, List[str]]) -> None:
+        if self._image_cache is None:
+            return
+        for index, sent in file_ids.items():
+            size, count = self._image_sets[index]
+            # a set missing an image is generated again next time
+            if len(sent) == count:
+                self._image_cache.put(ImageCache.key(prompt, size), sent)
+
     def convert_text_to_speech(self, message: types.Message, speech_recognizer: AzureSpeechRecognizer) -> None:
         """
         Convert text to speech and send it as a voice message to the user.
@@ -51,25 +233,77 @@ class TelegramBot:
             speech_recognizer: An instance of the AzureSpeechRecognizer.
         """
         try:
-            reply = message.reply_to_message
-            if reply == None or reply.text == None or reply.text.strip() == "":
-                self._bot.reply_to(message, "Você precisa responder a uma mensagem para gerar o áudio dela.")
-                return
-            if len(reply.text) > 1500:
-                self._bot.reply_to(message, "Essa mensagem ultrapassa o limite de 1500 caracteres.")
+            refusal = self._speech_refusal(message)
+            if refusal is not None:
+                self._bot.reply_to(message, refusal)
                 return
 
-            filename = f"{message.chat.id}.wav"
-            audio_data = speech_recognizer.convert_text_to_speech(reply.text, filename)
-            if audio_data == None:
+            key, speech = self._synthesize(message.reply_to_message.text, speech_recognizer)
+            if speech == None:
                 self._bot.reply_to(message, "Ocorreu um erro e não foi possível gerar o áudio.")
                 return
-            with open(filename, "rb") as file:
-                self._bot.send_voice(message.chat.id, file)
-            os.remove(filename)
-        except:
+            self._send_speech(message, key, speech)
+        except Exception as e:
+            report_error("convert_text_to_speech", e)
             self._bot.reply_to(message, "Desculpe, ocorreu um erro ao gerar o áudio.")
 
+    @staticmethod
+    def _speech_refusal(message: types.Message) -> Optional[str]:
+        """
+        Check that a message asks for the audio of a text that can be synthesized.
+
+        Args:
+            message: The incoming message from the user, replying to the text.
+
+        Returns:
+            The reply refusing the request, or None if the audio is synthesized.
+        """
+        reply = message.reply_to_message
+        if reply == None or reply.text == None or reply.text.strip() == "":
+            return "Você precisa responder a uma mensagem para gerar o áudio dela."
+        if len(reply.text) > 1500:
+            return "Essa mensagem ultrapassa o limite de 1500 caracteres."
+        return None
+
+    def _synthesize(self, text: str, speech_recognizer: AzureSpeechRecognizer) -> Tuple[Optional[str], Optional[CachedSpeech]]:
+        """
+        Get the audio of a text from the speech cache, or synthesize it.
+
+        Args:
+            text: The text to be converted to speech.
+            speech_recognizer: An instance of the AzureSpeechRecognizer.
+
+        Returns:
+            The cache key, or None without a cache, and the audio, or None if the synthesis fails.
+        """
+        if self._speech_cache is None:
+            audio = speech_recognizer.convert_text_to_speech(text)
+            return None, None if audio is None else CachedSpeech(audio)
+
+        key = SpeechCache.key(text, speech_recognizer.voice_name, speech_recognizer.output_format)
+        speech = self._speech_cache.get(key)
+        if speech is None:
+            audio = speech_recognizer.convert_text_to_speech(text)
+            if audio is None:
+                return key, None
+            speech = CachedSpeech(audio)
+            self._speech_cache.put(key, audio)
+        return key, speech
+
+    def _send_speech(self, message: types.Message, key: Optional[str], speech: CachedSpeech) -> None:
+        if speech.file_id is not None:
+            try:
+                # the audio was already uploaded, so Telegram can send it again without the upload
+                with stage("telegram_send"):
+                    self._bot.send_voice(message.chat.id, speech.file_id)
+                return
+            except Exception as e:
+                logging.error("Error sending the cached voice message: {}".format(str(e)))
+        with stage("telegram_send"):
+            sent = self._bot.send_voice(message.chat.id, speech.audio)
+        if key is not None and sent.voice is not None:
+            self._speech_cache.set_file_id(key, sent.voice.file_id)
+
     def handle_voice_message(self, message: types.Message, speech_recognizer: AzureSpeechRecognizer) -> None:
         """
         Handle user voice messages and generate responses.
@@ -79,30 +313,108 @@ class TelegramBot:
             speech_recognizer: An instance of the AzureSpeechRecognizer.
         """
         try:
-            filename = self._download_file(message.voice.file_id)
-            AudioSegment.from_file(filename).export(filename, format="wav")
-            with wave.open(filename) as audio:
-                duration_seconds = audio.getnframes() / audio.getframerate()
-                if duration_seconds > 30:
-                    self._bot.reply_to(message, "Desculpe, não ouço áudio com mais de 30 segundos, tempo é dinheiro!")
-                    return
-            text = speech_recognizer.convert_speech_to_text(os.path.abspath(filename))
-            os.remove(filename)
+            data = self._download_file(message.voice.file_id)
+            refusal = self._voice_refusal(data)
+            if refusal is not None:
+                self._bot.reply_to(message, refusal)
+                return
+            # the audio is recognized while it is decoded
+            text = speech_recognizer.convert_speech_to_text(self._transcoder.iter_pcm(data))
             if text == "" or text == None:
                 self._bot.reply_to(message, "Não entendi o que você falou.")
             else:
-                gpt_response = self._openai_api.ask_gpt(str(message.chat.id), text, "audio")
-                self._bot.reply_to(message, "".join(gpt_response))
-        except:
+                self._reply_with_answer(message, text, "audio")
+        except Exception as e:
+            report_error("handle_voice_message", e)
             self._bot.reply_to(message, "Desculpe, ocorreu um erro ao processar a mensagem de voz.")
 
-    def _download_file(self, file_id: str) -> str:
-        file_info = self._bot.get_file(file_id)
-        file = self._bot.download_file(file_info.file_path)
-        filename = file_info.file_path.split("/")[-1]
-        with open(filename, "wb") as new_file:
-            new_file.write(file)
-        return filename
+    def _voice_refusal(self, data: bytes) -> Optional[str]:
+        """
+        Check that a voice message is short enough to be answered.
+
+        Args:
+            data: The Ogg Opus audio of the voice message.
+
+        Returns:
+            The reply refusing the voice message, or None if it is answered.
+        """
+        if ogg_opus_duration(data) > self._max_voice_duration:
+            return "Desculpe, não ouço áudio com mais de {}, tempo é dinheiro!".format(self._voice_limit())
+        return None
+
+    def _voice_limit(self) -> str:
+        # a limit that is not a whole number of minutes is told in seconds, so it is never understated
+        seconds = math.ceil(self._max_voice_duration)
+        if seconds % 60 != 0:
+            return "1 segundo" if seconds == 1 else "{} segundos".format(seconds)
+        minutes = seconds // 60
+        return "1 minuto" if minutes == 1 else "{} minutos".format(minutes)
+
+    def _download_file(self, file_id: str) -> bytes:
+        with stage("telegram_download"):
+            file_info = self._bot.get_file(file_id)
+            return self._bot.download_file(file_info.file_path)
+
+    def _reply_with_answer(self, message: types.Message, text: str, content_source: str,
+                            superseded: Optional[Callable[[], bool]] = None) -> None:
+        """
+        Ask GPT and reply with its answer. When streaming, a placeholder reply is sent right away
+        and edited with the answer as it is generated.
+
+        Args:
+            message: The incoming message from the user.
+            text: The text sent to GPT.
+            content_source: The content source of the message (text or audio).
+            superseded: Checks if a newer message made the answer unnecessary, in which case no reply is left.
+        """
+        if not self._stream:
+            gpt_response = self._openai_api.ask_gpt(str(message.chat.id), text, content_source, superseded)
+            if superseded is not None and superseded():
+                return
+            for reply in self._answer_replies(gpt_response):
+                with stage("telegram_send"):
+                    self._bot.reply_to(message, reply)
+            return
+
+        with stage("telegram_send"):
+            reply = self._bot.reply_to(message, STREAM_PLACEHOLDER)
+        streamed = StreamedReply(self._edit_interval)
+        for part in self._openai_api.ask_gpt_stream(str(message.chat.id), text, content_source, superseded):
+            edit = streamed.add(part)
+            if edit is not None:
+                with stage("telegram_send"):
+                    self._bot.edit_message_text(edit, message.chat.id, reply.message_id)
+                streamed.edited()
+
+        if superseded is not None and superseded():
+            self._bot.delete_message(message.chat.id, reply.message_id)
+            return
+        if streamed.answer.strip() == "":
+            self._bot.delete_message(message.chat.id, reply.message_id)
+            raise Exception("Empty answer from gpt")
+        edit = streamed.final_edit()
+        if edit is not None:
+            with stage("telegram_send"):
+                self._bot.edit_message_text(edit, message.chat.id, reply.message_id)
+        for overflow in streamed.overflow():
+            with stage("telegram_send"):
+                self._bot.reply_to(message, overflow)
+
+    @staticmethod
+    def _answer_replies(gpt_response: Optional[List[str]]) -> List[str]:
+        """
+        Get the replies of an answer that is not streamed.
+
+        Args:
+            gpt_response: The answers from GPT, or None if the request failed.
+
+        Returns:
+            The answer split in Telegram messages, or the reply telling the request failed.
+        """
+        if gpt_response == None:
+            # the request failed even after the retries
+            return ["Desculpe, não consegui uma resposta agora, tente novamente em alguns instantes."]
+        return split_message("".join(gpt_response))
 
     def handle_text_message(self, message: types.Message) -> None:
         """
@@ -113,29 +425,56 @@ class TelegramBot:
         """
         try:
             if "private" == message.chat.type:
-                gpt_response = self._openai_api.ask_gpt(str(message.chat.id), message.text)
-                self._bot.reply_to(message, "".join(gpt_response))
-        except:
+                self._reply_with_answer(message, message.text, "text")
+        except Exception as e:
+            report_error("handle_text_message", e)
             self._bot.reply_to(message, "Desculpe, ocorreu um erro ao processar a mensagem de texto.")
 
-    def delete_user_messages(self, message: types.Message, client: GraphQLClient) -> None:
+    def handle_message_batch(self, batch: MessageBatch) -> None:
+        """
+        Handle a burst of user text messages with a single response, unless newer messages supersede it.
+
+        Args:
+            batch: The messages sent by the user in a burst.
+        """
+        try:
+            if "private" == batch.last.chat.type:
+                self._reply_with_answer(batch.last, batch.text, "text", batch.superseded)
+        except Exception as e:
+            report_error("handle_message_batch", e)
+            self._bot.reply_to(batch.last, "Desculpe, ocorreu um erro ao processar a mensagem de texto.")
+
+    def delete_user_messages(self, message: types.Message, client: MessageStore) -> None:
         """
-        Delete all messages from a user.
+        Delete all messages from a user in the background, replying right away and again once they are deleted.
 
         Args:
             message: The incoming message from the user.
-            client: An instance of the GraphQLClient.
+            client: The store of the messages.
         """
         try:
-            response = client.delete_user_messages(str(message.chat.id))
-            deletedCount = response["deletedCount"]
-            reply_message = ""
-            if deletedCount == None:
-                reply_message = "Ocorreu um erro e não foi possível deletar as mensagens."
-            elif deletedCount == 0:
-                reply_message = "Não há mensagens para serem deletadas."
-            else:
-                reply_message = f"Todas as mensagens ({deletedCount}) foram deletadas com sucesso!"
-            self._bot.reply_to(message, reply_message)
-        except:
+            # the messages are no longer read from now on, while the deletion runs
+            deletion = client.clear_user_messages(str(message.chat.id))
+            self._openai_api.forget_user(str(message.chat.id))
+            client.clear_user_messages(summary_sid(str(message.chat.id)))
+            self._bot.reply_to(message, DELETING_MESSAGE)
+            deletion.add_done_callback(lambda future: self._report_deletion(message, future))
+        except Exception as e:
+            report_error("delete_user_messages", e)
+            self._bot.reply_to(message, "Desculpe, ocorreu um erro ao deletar as mensagens.")
+
+    def _report_deletion(self, message: types.Message, deletion: "Future[Dict[str, int]]") -> None:
+        try:
+            self._bot.reply_to(message, self._deletion_reply(deletion.result()))
+        except Exception as e:
+            report_error("delete_user_messages", e)
             self._bot.reply_to(message, "Desculpe, ocorreu um erro ao deletar as mensagens.")
+
+    @staticmethod
+    def _deletion_reply(response: Dict[str, int]) -> str:
+        deletedCount = response["deletedCount"]
+        if deletedCount == None:
+            return "Ocorreu um erro e não foi possível deletar as mensagens."
+        elif deletedCount == 0:
+            return "Não há mensagens para serem deletadas."
+        return f"Todas as mensagens ({deletedCount}) foram deletadas com sucesso!"
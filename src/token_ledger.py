@@ -0,0 +1,248 @@
+import threading
+from collections import OrderedDict, deque
+from src.metrics import stage
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+
+class _UserWindow:
+    """
+    The conversation window of a single user and its running token count.
+    """
+
+    def __init__(self) -> None:
+        # each message with its token count and creation date
+        self.messages: Deque[Tuple[Dict[str, str], int, str]] = deque()
+        self.num_tokens = 0
+        self.cursor: Optional[str] = None
+
+
+class TokenLedger:
+    """
+    Keeps, for each user, the most recent messages that fit in the model context
+    along with their token counts, so every message is encoded only once.
+
+    The windows of the users least recently active are dropped once the windows hold too many
+    messages, and built again from the store when they come back.
+    """
+
+    def __init__(self, model: str = "gpt-3.5-turbo-0301", max_tokens: int = 4096, max_messages: int = 100000) -> None:
+        """
+        Initialize the token ledger.
+
+        Args:
+            model: The model whose encoding is used to count tokens.
+            max_tokens: The maximum number of tokens in the conversation window.
+            max_messages: The maximum number of messages kept in memory across all windows.
+        """
+        self._model = model
+        self._encoding = None
+        self._encoding_lock = threading.Lock()
+        self._max_tokens = max_tokens
+        self._max_messages = max_messages
+        self._windows: "OrderedDict[str, _UserWindow]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def warm_up(self) -> None:
+        """
+        Load the encoding ahead of the first message, which otherwise waits for it.
+        """
+        self._get_encoding()
+
+    def _get_encoding(self):
+        with self._encoding_lock:
+            if self._encoding is None:
+                # tiktoken takes a while to import and to load the encoding, so both wait until they are needed
+                import tiktoken
+                self._encoding = tiktoken.encoding_for_model(self._model)
+            return self._encoding
+
+    def count_message_tokens(self, message: Dict[str, str]) -> int:
+        """
+        Count the tokens of a single message, including its formatting overhead.
+
+        Args:
+            message: The message with role and content.
+
+        Returns:
+            The number of tokens of the message.
+        """
+        # every message follows <im_start>{role/name}\n{content}<im_end>\n
+        num_tokens = 4
+        encoding = self._encoding or self._get_encoding()
+        for key in ("role", "content", "name"):
+            value = message.get(key)
+            if value is None:
+                continue
+            num_tokens += len(encoding.encode(value))
+            if key == "name":  # if there's a name, the role is omitted
+                num_tokens += -1  # role is always required and always 1 token
+        return num_tokens
+
+    def _fits(self, num_tokens: int) -> bool:
+        # every reply is primed with <im_start>assistant, plus 10% for safety
+        return (num_tokens + 2) * 1.1 <= self._max_tokens
+
+    def cursor(self, user_sid: str) -> Optional[str]:
+        """
+        Get the creation date of the newest message in the window of a user.
+
+        Args:
+            user_sid: The user session ID.
+
+        Returns:
+            The creation date of the newest message, or None if the user has no window yet.
+        """
+        with self._lock:
+            window = self._window(user_sid)
+            return None if window is None else window.cursor
+
+    def fill(self, user_sid: str, pages: Iterable[List[Dict[str, str]]]) -> List[Dict[str, str]]:
+        """
+        Build the window of a user from pages of messages, newest page first, stopping
+        as soon as the token limit is reached so older pages are never requested.
+
+        Args:
+            user_sid: The user session ID.
+            pages: The pages of messages, each one sorted by creation date.
+
+        Returns:
+            The most recent messages that fit in the token limit.
+        """
+        self.reset(user_sid)
+        for page in pages:
+            if self.prepend(user_sid, page):
+                break
+        return self.messages(user_sid)
+
+    def reset(self, user_sid: str) -> None:
+        """
+        Start an empty window for a user, to be filled with prepend().
+
+        Args:
+            user_sid: The user session ID.
+        """
+        with self._lock:
+            window = self._windows.pop(user_sid, None)
+            if window is not None:
+                self._size -= len(window.messages)
+            self._windows[user_sid] = _UserWindow()
+
+    def prepend(self, user_sid: str, page: List[Dict[str, str]]) -> bool:
+        """
+        Add a page of messages older than the ones in the window of a user, while they fit.
+
+        Args:
+            user_sid: The user session ID.
+            page: The messages, sorted by creation date.
+
+        Returns:
+            True if the window is full and no older messages are needed.
+        """
+        with stage("token_trim"):
+            counts = [self.count_message_tokens(message) for message in page]
+            with self._lock:
+                window = self._window(user_sid, create=True)
+                size = len(window.messages)
+                if window.cursor is None and len(page) > 0:
+                    window.cursor = page[-1]["created_at"]
+                full = False
+                for message, num_tokens in zip(reversed(page), reversed(counts)):
+                    if not self._fits(window.num_tokens + num_tokens):
+                        full = True
+                        break
+                    window.messages.appendleft((self._to_chat_message(message), num_tokens, message["created_at"]))
+                    window.num_tokens += num_tokens
+                self._resize(window, size)
+                return full
+
+    def messages(self, user_sid: str) -> List[Dict[str, str]]:
+        """
+        Get the messages in the window of a user.
+
+        Args:
+            user_sid: The user session ID.
+
+        Returns:
+            The most recent messages that fit in the token limit.
+        """
+        with self._lock:
+            window = self._window(user_sid)
+            return [] if window is None else self._window_messages(window)
+
+    def dated_messages(self, user_sid: str) -> List[Tuple[Dict[str, str], str]]:
+        """
+        Get the messages in the window of a user along with their creation dates.
+
+        Args:
+            user_sid: The user session ID.
+
+        Returns:
+            The most recent messages that fit in the token limit, each with its creation date.
+        """
+        with self._lock:
+            window = self._window(user_sid)
+            return [] if window is None else [(message, created_at) for message, _, created_at in window.messages]
+
+    def extend(self, user_sid: str, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """
+        Append new messages to the window of a user and trim it to the token limit.
+
+        Args:
+            user_sid: The user session ID.
+            messages: The messages newer than the cursor, sorted by creation date.
+
+        Returns:
+            The most recent messages that fit in the token limit.
+        """
+        with stage("token_trim"):
+            counts = [self.count_message_tokens(message) for message in messages]
+            with self._lock:
+                window = self._window(user_sid, create=True)
+                size = len(window.messages)
+                for message, num_tokens in zip(messages, counts):
+                    window.messages.append((self._to_chat_message(message), num_tokens, message["created_at"]))
+                    window.num_tokens += num_tokens
+                    window.cursor = message["created_at"]
+
+                while window.messages and not self._fits(window.num_tokens):
+                    _, num_tokens, _ = window.messages.popleft()
+                    window.num_tokens -= num_tokens
+                self._resize(window, size)
+                return self._window_messages(window)
+
+    def forget(self, user_sid: str) -> None:
+        """
+        Drop the window of a user.
+
+        Args:
+            user_sid: The user session ID.
+        """
+        with self._lock:
+            window = self._windows.pop(user_sid, None)
+            if window is not None:
+                self._size -= len(window.messages)
+
+    def _window(self, user_sid: str, create: bool = False) -> Optional[_UserWindow]:
+        # called with the lock held, marks the window as the most recently used
+        window = self._windows.get(user_sid)
+        if window is None and create:
+            window = self._windows[user_sid] = _UserWindow()
+        if window is not None:
+            self._windows.move_to_end(user_sid)
+        return window
+
+    def _resize(self, window: _UserWindow, size: int) -> None:
+        # called with the lock held after a window changed from size messages, evicts the least recently used ones
+        self._size += len(window.messages) - size
+        while self._size > self._max_messages and len(self._windows) > 1:
+            _, evicted = self._windows.popitem(last=False)
+            self._size -= len(evicted.messages)
+
+    @staticmethod
+    def _to_chat_message(message: Dict[str, str]) -> Dict[str, str]:
+        return {"role": message["role"], "content": message["content"]}
+
+    @staticmethod
+    def _window_messages(window: _UserWindow) -> List[Dict[str, str]]:
+        return [message for message, _, _ in window.messages]
@@ -0,0 +1,185 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import queue
+import signal
+from aiohttp import web
+from telebot import TeleBot, types
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def update_chat_id(update: Dict[str, Any]) -> int:
+    """
+    Get the ID of the chat an update belongs to.
+
+    Args:
+        update: The update sent by Telegram.
+
+    Returns:
+        The chat ID, the user ID for updates without a chat, such as inline queries, or 0 if it has neither.
+    """
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        if isinstance(value.get("chat"), dict):
+            return value["chat"]["id"]
+        if isinstance(value.get("message"), dict) and isinstance(value["message"].get("chat"), dict):
+            return value["message"]["chat"]["id"]
+        if isinstance(value.get("from"), dict):
+            return value["from"]["id"]
+    return 0
+
+
+def consume_updates(tele_bot: TeleBot, updates: multiprocessing.Queue) -> None:
+    """
+    Hand the updates of a shard to the bot, in the order they were received, until the receiver stops.
+
+    Args:
+        tele_bot: The bot of the shard.
+        updates: The queue of the shard, with the updates as JSON and None to stop.
+    """
+    while True:
+        body = updates.get()
+        if body is None:
+            return
+        try:
+            tele_bot.process_new_updates([types.Update.de_json(body)])
+        except Exception as e:
+            logging.error("Error processing an update: {}".format(str(e)))
+
+
+def _run_worker(target: Callable, args: Tuple) -> None:
+    # the receiver stops the workers once it is done, so they are not interrupted along with it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    target(*args)
+
+
+class WebhookReceiver:
+    """
+    Receives the updates Telegram posts to the webhook and hands each one to the worker process
+    of its shard. Updates are sharded by chat ID, so the updates of a chat are always handled in
+    order by the same worker, which owns all the cached state of its chats.
+    """
+
+    def __init__(self, target: Callable, args: Tuple = (), workers: int = 1, secret_token: Optional[str] = None,
+                 max_queue: int = 1000) -> None:
+        """
+        Initialize the webhook receiver.
+
+        Args:
+            target: The function run by each worker process, called with args, the shard number and the
+                queue of the shard. It must be importable, as the workers are spawned.
+            args: The first arguments of the target.
+            workers: The number of worker processes.
+            secret_token: The secret token set with the webhook, checked on every request, or None to accept any.
+            max_queue: The maximum number of updates waiting for each worker before the requests are refused,
+                so Telegram sends them again later.
+        """
+        self._target = target
+        self._args = args
+        self._secret_token = secret_token
+        self._max_queue = max_queue
+        self._context = multiprocessing.get_context("spawn")
+        self._queues: List[multiprocessing.Queue] = [self._context.Queue(max_queue) for _ in range(workers)]
+        self._processes: List[Optional[multiprocessing.Process]] = [None] * workers
+
+    @property
+    def workers(self) -> int:
+        return len(self._queues)
+
+    def shard(self, update: Dict[str, Any]) -> int:
+        """
+        Get the shard of an update.
+
+        Args:
+            update: The update sent by Telegram.
+
+        Returns:
+            The number of the worker that handles the update.
+        """
+        return update_chat_id(update) % self.workers
+
+    def start(self) -> None:
+        """
+        Start the worker processes.
+        """
+        for shard in range(self.workers):
+            self._start_worker(shard)
+
+    def stop(self, timeout: float = 30.0) -> None:
+        """
+        Stop the worker processes once they handle the updates already received.
+
+        Args:
+            timeout: The time in seconds to wait for each worker before terminating it.
+        """
+        for updates in self._queues:
+            updates.put(None)
+        for shard, process in enumerate(self._processes):
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                logging.warning("Terminating webhook worker {}".format(shard))
+                process.terminate()
+            self._processes[shard] = None
+
+    def application(self, path: str = "/webhook") -> web.Application:
+        """
+        Create the web application that receives the updates and runs the workers while it is up.
+
+        Args:
+            path: The path Telegram posts the updates to.
+
+        Returns:
+            The web application.
+        """
+        app = web.Application()
+        app.router.add_post(path, self.handle)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """
+        Queue an update for its worker. Telegram waits for the response before sending the next updates.
+
+        Args:
+            request: The request with the update.
+
+        Returns:
+            The response to Telegram.
+        """
+        if self._secret_token is not None and request.headers.get(SECRET_TOKEN_HEADER) != self._secret_token:
+            return web.Response(status=403)
+        body = await request.text()
+        try:
+            shard = self.shard(json.loads(body))
+        except (ValueError, TypeError, AttributeError) as e:
+            logging.error("Error reading an update: {}".format(str(e)))
+            return web.Response(status=400)
+        process = self._processes[shard]
+        if process is not None and not process.is_alive():
+            logging.error("Webhook worker {} exited with code {}, restarting it".format(shard, process.exitcode))
+            self._start_worker(shard)
+        try:
+            self._queues[shard].put_nowait(body)
+        except queue.Full:
+            logging.warning("Webhook worker {} has {} updates waiting, refusing more".format(shard, self._max_queue))
+            return web.Response(status=503)
+        return web.Response()
+
+    def _start_worker(self, shard: int) -> None:
+        process = self._context.Process(target=_run_worker, name="webhook-worker-{}".format(shard),
+                                        args=(self._target, self._args + (shard, self._queues[shard])))
+        process.start()
+        self._processes[shard] = process
+
+    async def _on_startup(self, app: web.Application) -> None:
+        self.start()
+
+    async def _on_cleanup(self, app: web.Application) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self.stop)
@@ -0,0 +1,51 @@
+import shutil
+import subprocess
+import pytest
+from src.audio import ogg_opus_duration
+
+
+def make_page(granule_position, body, serial=1):
+    segments = [255] * (len(body) // 255) + [len(body) % 255]
+    return (b"OggS" + bytes([0, 0]) + granule_position.to_bytes(8, "little", signed=True) +
+            serial.to_bytes(4, "little") + bytes(8) + bytes([len(segments)]) + bytes(segments) + body)
+
+
+def make_ogg_opus(granule_position, pre_skip, payload=bytes(300)):
+    head = b"OpusHead" + bytes([1, 1]) + pre_skip.to_bytes(2, "little") + (48000).to_bytes(4, "little") + bytes(3)
+    return (make_page(0, head) + make_page(0, b"OpusTags" + bytes(8)) +
+            make_page(granule_position // 2, payload) + make_page(granule_position, payload))
+
+
+def test_duration_from_the_last_granule_position():
+    assert ogg_opus_duration(make_ogg_opus(48000 * 3 + 312, 312)) == pytest.approx(3.0)
+
+
+def test_duration_is_never_negative():
+    assert ogg_opus_duration(make_ogg_opus(100, 312)) == 0.0
+
+
+def test_capture_pattern_inside_the_audio_is_ignored():
+    payload = bytes(100) + b"OggS" + bytes([0, 0]) + (48000 * 600).to_bytes(8, "little") + bytes(100)
+    assert ogg_opus_duration(make_ogg_opus(48000 * 3 + 312, 312, payload)) == pytest.approx(3.0)
+
+
+def test_pages_without_a_granule_position_and_truncated_pages_are_skipped():
+    data = make_ogg_opus(48000 * 3 + 312, 312) + make_page(-1, bytes(50))
+    assert ogg_opus_duration(data) == pytest.approx(3.0)
+    assert ogg_opus_duration(data + make_page(48000 * 9, bytes(300))[:-10]) == pytest.approx(3.0)
+
+
+def test_rejects_other_formats():
+    with pytest.raises(ValueError):
+        ogg_opus_duration(b"RIFF" + bytes(40))
+    with pytest.raises(ValueError):
+        ogg_opus_duration(b"OpusHead" + bytes(10) + b"OggS")
+    with pytest.raises(ValueError):
+        ogg_opus_duration(make_page(0, b"OpusTags" + bytes(8)))
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_duration_of_an_encoded_file():
+    data = subprocess.run(["ffmpeg", "-loglevel", "error", "-f", "lavfi", "-i", "sine=duration=2.5",
+                           "-c:a", "libopus", "-f", "ogg", "-"], capture_output=True, check=True).stdout
+    assert ogg_opus_duration(data) == pytest.approx(2.5, abs=0.03)
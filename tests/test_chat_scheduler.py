@@ -0,0 +1,72 @@
+import asyncio
+import threading
+import time
+from src.chat_scheduler import AsyncChatScheduler, ChatScheduler
+
+
+def test_handlers_of_a_chat_run_in_order():
+    scheduler = ChatScheduler({"text": 4})
+    handled = []
+    for i in range(5):
+        assert scheduler.submit(1, "text", lambda i=i: (time.sleep(0.01), handled.append(i)))
+    scheduler.shutdown()
+    assert handled == list(range(5))
+    assert scheduler.stats()["text"]["started"] == 5
+
+
+def test_chats_run_in_parallel():
+    scheduler = ChatScheduler({"text": 2})
+    both_started = threading.Barrier(2, timeout=5)
+    scheduler.submit(1, "text", both_started.wait)
+    scheduler.submit(2, "text", both_started.wait)
+    scheduler.shutdown()
+    assert not both_started.broken
+
+
+def test_rejects_handlers_over_the_queue_limits():
+    scheduler = ChatScheduler({"text": 1}, max_queue=4, max_chat_queue=2)
+    release = threading.Event()
+    try:
+        assert scheduler.submit(1, "text", release.wait, 5)
+        assert scheduler.submit(1, "text", release.wait, 5)
+        assert not scheduler.submit(1, "text", release.wait, 5)
+        assert scheduler.submit(2, "text", release.wait, 5)
+        assert scheduler.submit(3, "text", release.wait, 5)
+        assert not scheduler.submit(4, "text", release.wait, 5)
+    finally:
+        release.set()
+        scheduler.shutdown()
+    stats = scheduler.stats()["text"]
+    assert stats["rejected"] == 2
+    assert stats["max_depth"] == 4
+    assert stats["depth"] == 0
+
+
+def test_a_failing_handler_does_not_stop_its_chat():
+    scheduler = ChatScheduler({"text": 1})
+    handled = []
+    scheduler.submit(1, "text", lambda: 1 / 0)
+    scheduler.submit(1, "text", handled.append, "next")
+    scheduler.shutdown()
+    assert handled == ["next"]
+
+
+def test_async_handlers_of_a_chat_run_in_order():
+    handled = []
+
+    async def handle(chat_id, i):
+        await asyncio.sleep(0.01 * (5 - i))
+        handled.append((chat_id, i))
+
+    async def main():
+        scheduler = AsyncChatScheduler({"text": 2})
+        for i in range(5):
+            scheduler.submit(1, "text", handle, 1, i)
+            scheduler.submit(2, "text", handle, 2, i)
+        await scheduler.shutdown()
+        return scheduler.stats()
+
+    stats = asyncio.run(main())
+    assert [i for chat_id, i in handled if chat_id == 1] == list(range(5))
+    assert [i for chat_id, i in handled if chat_id == 2] == list(range(5))
+    assert stats["text"]["started"] == 10
@@ -0,0 +1,25 @@
+import numpy as np
+from src.conversation_memory import HashingEmbedder
+
+
+def test_vectors_are_unit_length():
+    vectors = HashingEmbedder(dimensions=64).embed(["the weather in Lisbon", "a recipe for bread"])
+    assert vectors.shape == (2, 64)
+    assert vectors.dtype == np.float32
+    assert np.allclose(np.linalg.norm(vectors, axis=1), 1.0)
+
+
+def test_text_without_words_gets_zeros():
+    vectors = HashingEmbedder(dimensions=64).embed(["", "a de que", "!!!"])
+    assert not vectors.any()
+
+
+def test_similar_wordings_are_closer():
+    query, similar, other = HashingEmbedder().embed(["receitas de pão", "uma receita de pao caseiro",
+                                                     "o jogo de futebol de ontem"])
+    assert query @ similar > query @ other
+
+
+def test_embeddings_are_deterministic():
+    embedder = HashingEmbedder()
+    assert np.array_equal(embedder.embed(["same text"]), embedder.embed(["same text"]))
@@ -0,0 +1,69 @@
+from src.conversation_summary import SUMMARY_INSTRUCTIONS, ConversationSummaries, summary_sid
+
+
+def window(count, start=0):
+    return [({"role": "user" if i % 2 == 0 else "assistant", "content": str(i)}, "2023-01-01T00:00:{:02d}".format(i))
+            for i in range(start, start + count)]
+
+
+def test_summaries_are_stored_next_to_the_messages():
+    assert summary_sid("42") == "42:summary"
+
+
+def test_conversation_without_a_summary_sends_its_window():
+    summaries = ConversationSummaries(recent_messages=2, refresh_every=3)
+    assert not summaries.known("user")
+    summaries.load("user", [])
+    assert summaries.known("user")
+    assert summaries.cutoff("user") is None
+    assert [message["content"] for message in summaries.prompt("user", window(3))] == ["0", "1", "2"]
+
+
+def test_loaded_summary_replaces_the_older_messages():
+    summaries = ConversationSummaries()
+    summaries.load("user", [{"content": "old", "created_at": "2023-01-01T00:00:00"},
+                            {"content": "resumo", "created_at": "2023-01-01T00:00:01"}])
+    prompt = summaries.prompt("user", window(4))
+    assert prompt[0] == {"role": "system", "content": "Resumo da conversa até aqui: resumo"}
+    assert [message["content"] for message in prompt[1:]] == ["2", "3"]
+    assert summaries.cutoff("user") == "2023-01-01T00:00:01"
+
+
+def test_refresh_folds_all_but_the_recent_messages():
+    summaries = ConversationSummaries(recent_messages=2, refresh_every=3)
+    summaries.load("user", [])
+    assert summaries.start_refresh("user", window(4)) is None
+
+    cutoff, request = summaries.start_refresh("user", window(5))
+    assert cutoff == "2023-01-01T00:00:02"
+    assert request[0] == {"role": "system", "content": SUMMARY_INSTRUCTIONS}
+    assert request[1] == {"role": "user", "content": "Usuário: 0\nGepeto: 1\nUsuário: 2"}
+    # one refresh at a time per conversation
+    assert summaries.start_refresh("user", window(6)) is None
+
+    summary = summaries.finish_refresh("user", cutoff, "resumo")
+    assert (summary.content, summary.cutoff) == ("resumo", cutoff)
+    assert [message["content"] for message in summaries.prompt("user", window(6))[1:]] == ["3", "4", "5"]
+
+
+def test_next_refresh_includes_the_previous_summary():
+    summaries = ConversationSummaries(recent_messages=2, refresh_every=3)
+    summaries.load("user", [{"content": "resumo", "created_at": "2023-01-01T00:00:02"}])
+    assert summaries.start_refresh("user", window(7)) is None
+    cutoff, request = summaries.start_refresh("user", window(8))
+    assert cutoff == "2023-01-01T00:00:05"
+    assert request[1]["content"] == "Resumo anterior: resumo\n\nGepeto: 3\nUsuário: 4\nGepeto: 5"
+
+
+def test_failed_or_forgotten_refreshes_keep_no_summary():
+    summaries = ConversationSummaries(recent_messages=2, refresh_every=3)
+    summaries.load("user", [])
+    cutoff, _ = summaries.start_refresh("user", window(5))
+    assert summaries.finish_refresh("user", cutoff, None) is None
+    assert summaries.cutoff("user") is None
+
+    # a failed refresh can start again
+    cutoff, _ = summaries.start_refresh("user", window(5))
+    summaries.forget("user")
+    assert summaries.finish_refresh("user", cutoff, "resumo") is None
+    assert not summaries.known("user")
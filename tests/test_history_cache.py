@@ -0,0 +1,78 @@
+from src.history_cache import HistoryCache
+
+
+def make_messages(start, stop):
+    return [{"role": "user", "content": str(i), "created_at": "2023-01-01T00:00:{:02d}".format(i)}
+            for i in range(start, stop)]
+
+
+def test_complete_history_answers_every_read():
+    cache = HistoryCache()
+    messages = make_messages(0, 5)
+    cache.put("user", messages)
+    assert cache.get("user") == messages
+    assert cache.get("user", limit=2) == messages[3:]
+    assert cache.get("user", after=messages[1]["created_at"]) == messages[2:]
+    assert cache.get("user", before=messages[2]["created_at"]) == messages[:2]
+    assert cache.hits == 4 and cache.misses == 0
+
+
+def test_partial_history_misses_older_reads():
+    cache = HistoryCache()
+    messages = make_messages(5, 10)
+    cache.put("user", messages, limit=5)
+    assert cache.get("user", limit=3) == messages[2:]
+    assert cache.get("user", after=messages[0]["created_at"]) == messages[1:]
+    assert cache.get("user") is None
+    assert cache.get("user", limit=10) is None
+    assert cache.get("other") is None
+    assert cache.misses == 3
+
+
+def test_older_page_is_joined_to_the_cached_messages():
+    cache = HistoryCache()
+    newest = make_messages(5, 10)
+    cache.put("user", newest, limit=5)
+    older = make_messages(2, 6)
+    cache.put("user", older, limit=5, before=newest[1]["created_at"])
+    assert cache.get("user") == older + newest[1:]
+
+
+def test_page_not_reaching_the_cached_messages_is_ignored():
+    cache = HistoryCache()
+    newest = make_messages(5, 10)
+    cache.put("user", newest, limit=5)
+    cache.put("user", make_messages(0, 2), limit=2, before=newest[0]["created_at"])
+    cache.put("user", make_messages(0, 2), limit=2, before=make_messages(3, 4)[0]["created_at"])
+    assert cache.get("user", limit=5) == newest
+    assert cache.get("user", limit=6) is None
+
+
+def test_append_and_invalidate():
+    cache = HistoryCache()
+    messages = make_messages(0, 2)
+    cache.put("user", messages)
+    new_message = make_messages(2, 3)[0]
+    cache.append("user", new_message)
+    assert cache.get("user") == messages + [new_message]
+    cache.append("other", new_message)
+    assert cache.get("other") is None
+    cache.invalidate("user")
+    assert cache.get("user") is None
+
+
+def test_evicts_the_least_recently_used_users():
+    cache = HistoryCache(max_messages=5)
+    cache.put("a", make_messages(0, 2))
+    cache.put("b", make_messages(0, 2))
+    cache.get("a")
+    cache.put("c", make_messages(0, 2))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+def test_history_larger_than_the_cache_is_not_kept():
+    cache = HistoryCache(max_messages=2)
+    cache.put("user", make_messages(0, 3))
+    assert cache.get("user") is None
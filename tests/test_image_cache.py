@@ -0,0 +1,49 @@
+import pytest
+from src.image_cache import ImageCache, normalize_prompt
+
+
+@pytest.mark.parametrize("text, prompt", [
+    ("/imagem um gato  de botas", "um gato de botas"),
+    ("  /IMAGEM@GepetoBot\tum gato\nde botas ", "um gato de botas"),
+    ("/imagem", ""),
+    ("/imagem   ", ""),
+    ("/imagemgato", "/imagemgato"),
+    ("um gato /imagem", "um gato /imagem"),
+])
+def test_normalize_prompt(text, prompt):
+    assert normalize_prompt(text) == prompt
+
+
+def test_key_ignores_the_case_of_the_prompt_but_not_the_size():
+    assert ImageCache.key("Um Gato", "1024x1024") == ImageCache.key("um gato", "1024x1024")
+    assert ImageCache.key("um gato", "1024x1024") != ImageCache.key("um gato", "256x256")
+    assert ImageCache.key("um gato", "1024x1024") != ImageCache.key("um cão", "1024x1024")
+
+
+def test_get_needs_enough_images():
+    cache = ImageCache()
+    cache.put("key", ["a", "b"])
+    assert cache.get("key", 1) == ["a"]
+    assert cache.get("key", 2) == ["a", "b"]
+    assert cache.get("key", 3) is None
+    assert cache.get("other", 1) is None
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_least_recently_used_prompts_are_evicted():
+    cache = ImageCache(max_prompts=2)
+    cache.put("a", ["a"])
+    cache.put("b", ["b"])
+    assert cache.get("a", 1) == ["a"]
+    cache.put("c", ["c"])
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 1) == ["a"]
+    assert cache.get("c", 1) == ["c"]
+
+
+def test_invalidated_images_are_generated_again():
+    cache = ImageCache()
+    cache.put("key", ["a"])
+    cache.invalidate("key")
+    cache.invalidate("missing")
+    assert cache.get("key", 1) is None
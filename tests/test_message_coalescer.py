@@ -0,0 +1,89 @@
+import asyncio
+import threading
+from src.message_coalescer import AsyncMessageCoalescer, MessageCoalescer
+from types import SimpleNamespace
+
+
+def make_message(chat_id, text):
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id), text=text)
+
+
+def test_burst_is_submitted_as_one_batch():
+    batches = []
+    submitted = threading.Event()
+
+    def submit(batch):
+        batches.append(batch)
+        submitted.set()
+        return True
+
+    coalescer = MessageCoalescer(submit, interval=0.05)
+    coalescer.add(make_message(1, "hello"))
+    coalescer.add(make_message(1, "there"))
+    assert submitted.wait(5)
+    coalescer.close()
+    assert len(batches) == 1
+    assert batches[0].text == "hello\nthere"
+    assert batches[0].last.text == "there"
+    assert batches[0].generation == 2
+
+
+def test_flush_submits_right_away():
+    batches = []
+    coalescer = MessageCoalescer(lambda batch: batches.append(batch) or True, interval=60)
+    coalescer.add(make_message(1, "hello"))
+    coalescer.add(make_message(2, "other chat"))
+    coalescer.flush(1)
+    assert [batch.text for batch in batches] == ["hello"]
+    coalescer.flush(1)
+    assert len(batches) == 1
+    coalescer.close()
+    assert [batch.text for batch in batches] == ["hello", "other chat"]
+
+
+def test_only_an_accepted_batch_supersedes_the_older_ones():
+    batches = []
+    accept = [True, False, True]
+    coalescer = MessageCoalescer(lambda batch: batches.append(batch) or accept[len(batches) - 1], interval=60)
+    for text in ("first", "second", "third"):
+        coalescer.add(make_message(1, text))
+        coalescer.flush(1)
+    coalescer.close()
+    first, second, third = batches
+    assert coalescer.accepted_generation(1) == 3
+    assert first.superseded()
+    assert second.superseded()
+    assert not third.superseded()
+
+
+def test_a_failing_submit_is_not_accepted():
+    def submit(batch):
+        raise RuntimeError("busy")
+
+    coalescer = MessageCoalescer(submit, interval=60)
+    coalescer.add(make_message(1, "hello"))
+    coalescer.close()
+    assert coalescer.accepted_generation(1) == 0
+
+
+def test_async_burst_is_submitted_as_one_batch():
+    batches = []
+
+    async def submit(batch):
+        batches.append(batch)
+        return True
+
+    async def main():
+        coalescer = AsyncMessageCoalescer(submit, interval=0.05)
+        coalescer.add(make_message(1, "hello"))
+        coalescer.add(make_message(1, "there"))
+        coalescer.add(make_message(2, "other chat"))
+        await coalescer.flush(2)
+        assert [batch.text for batch in batches] == ["other chat"]
+        await asyncio.sleep(0.2)
+        await coalescer.close()
+        return coalescer
+
+    coalescer = asyncio.run(main())
+    assert [batch.text for batch in batches] == ["other chat", "hello\nthere"]
+    assert coalescer.accepted_generation(1) == 2
@@ -0,0 +1,141 @@
+import asyncio
+import pytest
+import time
+from src.message_store import MAX_WRITE_ATTEMPTS
+from src.sqlite_message_store import AsyncSQLiteMessageStore, SQLiteMessageStore
+
+
+def store_with_ties(path, store_class=SQLiteMessageStore):
+    store = store_class(str(path), cache_size=0)
+    # messages written in the same batch may share a creation date
+    dates = ["2023-01-01T00:00:00"] * 3 + ["2023-01-01T00:00:01"] * 4 + ["2023-01-01T00:00:02"] * 2
+    store.insert_messages([{"user_sid": "user", "role": "user", "content": str(i), "content_source": "text",
+                            "created_at": created_at} for i, created_at in enumerate(dates)])
+    return store
+
+
+@pytest.mark.parametrize("page_size", [1, 2, 3, 4, 5, 9, 10])
+def test_pages_keep_the_messages_sharing_a_date(tmp_path, page_size):
+    store = store_with_ties(tmp_path / "messages.db")
+    pages = list(store.iter_message_pages("user", page_size))
+    store.close()
+    contents = [message["content"] for page in reversed(pages) for message in page]
+    assert sorted(contents, key=int) == [str(i) for i in range(9)]
+    assert len(contents) == 9
+    for page in pages:
+        assert [message["created_at"] for message in page] == sorted(message["created_at"] for message in page)
+
+
+def test_async_pages_keep_the_messages_sharing_a_date(tmp_path):
+    store = store_with_ties(tmp_path / "messages.db", AsyncSQLiteMessageStore)
+
+    async def read_pages():
+        return [page async for page in store.aiter_message_pages("user", 2)]
+
+    pages = asyncio.run(read_pages())
+    store.close()
+    assert sorted(message["content"] for page in pages for message in page) == [str(i) for i in range(9)]
+
+
+def test_cached_pages_keep_the_messages_sharing_a_date(tmp_path):
+    store = store_with_ties(tmp_path / "messages.db")
+    store._history_cache = type(store.history_cache)(100)
+    first = list(store.iter_message_pages("user", 3))
+    second = list(store.iter_message_pages("user", 3))
+    store.close()
+    assert first == second
+    assert sum(len(page) for page in second) == 9
+    assert store.history_cache.hits > 0
+
+
+def test_incomplete_backends_fail_when_created():
+    from src.message_store import MessageArchive, MessageStore
+
+    class Archive(MessageArchive):
+        def insert_archive_batches(self, batches):
+            pass
+
+    class Store(MessageStore):
+        def get_messages(self, user_sid, limit=None, before=None, after=None):
+            return []
+
+    with pytest.raises(TypeError):
+        Archive()
+    with pytest.raises(TypeError):
+        Store()
+
+
+def written_contents(store):
+    return [row["content"] for row in store._connection().execute("SELECT content FROM messages ORDER BY id")]
+
+
+def queue(store, contents):
+    for i, content in enumerate(contents):
+        store.queue_message("user", "user", content, "text", created_at="2023-01-01T00:00:0{}".format(i))
+
+
+def failing_writes(store, monkeypatch):
+    def fail(messages):
+        raise Exception("database unavailable")
+
+    monkeypatch.setattr(store, "_write_messages", fail)
+
+
+def test_queued_messages_are_written_in_batches(tmp_path):
+    store = SQLiteMessageStore(str(tmp_path / "messages.db"), write_batch_size=3, write_interval=60)
+    queue(store, ["0", "1"])
+    assert written_contents(store) == []
+    store.queue_message("user", "user", "2", "text")
+    # a full batch wakes the writer right away
+    deadline = time.monotonic() + 5
+    while written_contents(store) != ["0", "1", "2"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert written_contents(store) == ["0", "1", "2"]
+    store.close()
+
+
+def test_failed_writes_are_retried_in_order(tmp_path, monkeypatch):
+    store = SQLiteMessageStore(str(tmp_path / "messages.db"), write_batch_size=100, write_interval=60)
+    queue(store, ["0", "1"])
+    failing_writes(store, monkeypatch)
+    store.flush()
+    assert [queued.attempts for queued in store._pending_messages] == [1, 1]
+
+    store.queue_message("user", "user", "2", "text", created_at="2023-01-01T00:00:02")
+    monkeypatch.undo()
+    store.flush()
+    assert written_contents(store) == ["0", "1", "2"]
+    assert not store._has_unsaved_messages("user")
+    store.close()
+
+
+def test_reads_include_the_messages_waiting_for_a_retry(tmp_path, monkeypatch):
+    store = SQLiteMessageStore(str(tmp_path / "messages.db"), cache_size=0, write_batch_size=100,
+                               write_interval=60)
+    store.insert_messages([{"user_sid": "user", "role": "user", "content": "saved", "content_source": "text",
+                            "created_at": "2022-12-31T00:00:00"}])
+    queue(store, ["0", "1"])
+    failing_writes(store, monkeypatch)
+    messages = store.get_messages("user")
+    assert [message["content"] for message in messages] == ["saved", "0", "1"]
+    assert [message["content"] for message in store.get_messages("user", limit=2)] == ["0", "1"]
+    assert [message["content"] for message in store.get_messages("user", before="2023-01-01T00:00:01")] == [
+        "saved", "0"]
+    monkeypatch.undo()
+    store.close()
+
+
+def test_messages_failing_every_write_are_dropped(tmp_path, monkeypatch):
+    store = SQLiteMessageStore(str(tmp_path / "messages.db"), write_batch_size=100, write_interval=60)
+    queue(store, ["0"])
+    failing_writes(store, monkeypatch)
+    for attempt in range(1, MAX_WRITE_ATTEMPTS):
+        store.flush()
+        assert [queued.attempts for queued in store._pending_messages] == [attempt]
+        assert store._has_unsaved_messages("user")
+    store.flush()
+    assert store._pending_messages == []
+    assert not store._has_unsaved_messages("user")
+    assert written_contents(store) == []
+    monkeypatch.undo()
+    store.close()
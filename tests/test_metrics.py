@@ -0,0 +1,95 @@
+import contextvars
+import logging
+import urllib.error
+import urllib.request
+import pytest
+from src.metrics import (ERRORS, STAGE_IN_FLIGHT, STAGE_SECONDS, MetricsRegistry, MetricsServer, TraceIdFilter,
+                         new_trace_id, report_error, stage, trace_id)
+
+
+def test_counters_and_gauges_are_rendered_by_label():
+    registry = MetricsRegistry()
+    counter = registry.counter("requests_total", "Requests.", ["lane"])
+    gauge = registry.gauge("in_flight", "In flight.")
+    counter.inc(lane="text")
+    counter.inc(2, lane="text")
+    counter.inc(lane='a "quoted"\nlane')
+    gauge.inc(3)
+    gauge.inc(-1)
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests.",
+        "# TYPE requests_total counter",
+        'requests_total{lane="a \\"quoted\\"\\nlane"} 1',
+        'requests_total{lane="text"} 3',
+        "# HELP in_flight In flight.",
+        "# TYPE in_flight gauge",
+        "in_flight 2",
+    ]
+    gauge.set(0.5)
+    assert registry.render().splitlines()[-1] == "in_flight 0.5"
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("latency_seconds", "Latency.", ["stage"], buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value, stage="openai")
+    assert registry.render().splitlines()[2:] == [
+        'latency_seconds_bucket{stage="openai",le="0.1"} 2',
+        'latency_seconds_bucket{stage="openai",le="1"} 3',
+        'latency_seconds_bucket{stage="openai",le="+Inf"} 4',
+        'latency_seconds_sum{stage="openai"} 2.65',
+        'latency_seconds_count{stage="openai"} 4',
+    ]
+
+
+def test_collected_metrics_are_read_when_rendered():
+    registry = MetricsRegistry()
+    values = {("hits",): 1.0}
+    registry.collect("cache_total", "Cache lookups.", "counter", ["result"], lambda: dict(values))
+    values[("misses",)] = 2.0
+    assert registry.render().splitlines()[2:] == ['cache_total{result="hits"} 1', 'cache_total{result="misses"} 2']
+
+
+def test_stage_counts_its_duration_even_when_it_fails():
+    count = STAGE_SECONDS._values.get(("test_stage",))
+    count = 0 if count is None else count.count
+    with pytest.raises(ValueError):
+        with stage("test_stage"):
+            assert STAGE_IN_FLIGHT._values[("test_stage",)] == 1
+            raise ValueError()
+    assert STAGE_IN_FLIGHT._values[("test_stage",)] == 0
+    assert STAGE_SECONDS._values[("test_stage",)].count == count + 1
+
+
+def test_errors_are_counted_by_handler():
+    count = ERRORS._values.get(("test_handler",), 0)
+    report_error("test_handler", Exception("boom"))
+    assert ERRORS._values[("test_handler",)] == count + 1
+
+
+def test_trace_id_is_kept_in_its_context():
+    def request():
+        return new_trace_id(), trace_id()
+
+    started, current = contextvars.copy_context().run(request)
+    assert started == current
+    assert len(started) == 16
+    assert trace_id() == "-"
+    record = logging.LogRecord("test", logging.INFO, __file__, 1, "message", None, None)
+    assert TraceIdFilter().filter(record)
+    assert record.trace_id == "-"
+
+
+def test_server_exports_the_metrics():
+    registry = MetricsRegistry()
+    registry.counter("requests_total", "Requests.").inc()
+    server = MetricsServer(0, registry=registry).start()
+    try:
+        with urllib.request.urlopen("http://127.0.0.1:{}/metrics".format(server.port), timeout=5) as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            assert "requests_total 1" in response.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen("http://127.0.0.1:{}/other".format(server.port), timeout=5)
+    finally:
+        server.stop()
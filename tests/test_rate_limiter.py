@@ -0,0 +1,63 @@
+import pytest
+from src.rate_limiter import RateLimiter, backoff_delay
+
+
+def test_backoff_delay_is_capped(monkeypatch):
+    monkeypatch.setattr("random.uniform", lambda low, high: high)
+    assert backoff_delay(0) == 1.0
+    assert backoff_delay(3) == 8.0
+    assert backoff_delay(10, cap=60.0) == 60.0
+
+
+def test_reserve_waits_once_the_budget_is_spent():
+    limiter = RateLimiter(requests_per_minute=2)
+    assert limiter.reserve(0) == 0
+    assert limiter.reserve(0) == 0
+    assert limiter.reserve(0) > 0
+
+
+def test_budget_is_divided_by_shares():
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=6000, shares=3)
+    available = limiter.available()
+    assert available["requests"] == pytest.approx(20, abs=0.1)
+    assert available["tokens"] == pytest.approx(2000, abs=1)
+
+
+def test_record_usage_returns_the_unused_tokens():
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=1000)
+    limiter.reserve(500)
+    limiter.record_usage(500, 100)
+    assert limiter.available()["tokens"] == pytest.approx(900, abs=1)
+
+
+def test_update_follows_the_headers():
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=1000, shares=2)
+    limiter.update({
+        "x-ratelimit-limit-requests": "100",
+        "x-ratelimit-remaining-requests": "10",
+        "x-ratelimit-limit-tokens": "2000",
+        "x-ratelimit-remaining-tokens": "400",
+    })
+    available = limiter.available()
+    assert available["requests"] == pytest.approx(5, abs=0.1)
+    assert available["tokens"] == pytest.approx(200, abs=1)
+
+
+def test_pause_delays_the_next_request():
+    limiter = RateLimiter(requests_per_minute=60)
+    limiter.pause(5)
+    assert limiter.reserve(0) == pytest.approx(5, abs=0.1)
+
+
+def test_update_skips_malformed_headers():
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=1000)
+    limiter.update({
+        "x-ratelimit-limit-requests": "",
+        "x-ratelimit-remaining-requests": "10",
+        "x-ratelimit-limit-tokens": "2000",
+        "x-ratelimit-remaining-tokens": "n/a",
+    })
+    available = limiter.available()
+    assert available["requests"] == pytest.approx(10, abs=0.1)
+    assert available["tokens"] == pytest.approx(1000, abs=1)
+    assert limiter.reserve(0) == 0
@@ -0,0 +1,15 @@
+from src.retention import pack_messages, unpack_messages
+
+
+def test_pack_and_unpack_messages():
+    messages = [
+        {"role": "user", "content": "olá, tudo bem?", "created_at": "2023-01-01T00:00:00"},
+        {"role": "assistant", "content": "Tudo ótimo!", "created_at": "2023-01-01T00:00:05"},
+    ]
+    batch = pack_messages("user", messages)
+    assert batch["user_sid"] == "user"
+    assert batch["first_created_at"] == "2023-01-01T00:00:00"
+    assert batch["last_created_at"] == "2023-01-01T00:00:05"
+    assert batch["count"] == 2
+    assert isinstance(batch["data"], str)
+    assert unpack_messages(batch) == messages
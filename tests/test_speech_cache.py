@@ -0,0 +1,64 @@
+import os
+from src.speech_cache import SpeechCache
+
+
+def test_key_depends_on_the_text_voice_and_format():
+    key = SpeechCache.key("olá", "pt-BR-FranciscaNeural", "ogg-16khz-16bit-mono-opus")
+    assert key == SpeechCache.key("olá", "pt-BR-FranciscaNeural", "ogg-16khz-16bit-mono-opus")
+    assert key != SpeechCache.key("olá!", "pt-BR-FranciscaNeural", "ogg-16khz-16bit-mono-opus")
+    assert key != SpeechCache.key("olá", "pt-BR-AntonioNeural", "ogg-16khz-16bit-mono-opus")
+    assert key != SpeechCache.key("olá", "pt-BR-FranciscaNeural", "ogg-48khz-16bit-mono-opus")
+
+
+def test_memory_keeps_the_most_recently_used_audio():
+    cache = SpeechCache(max_memory_bytes=10)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    assert cache.get("a").audio == b"aaaa"
+    cache.put("c", b"cccc")
+    assert cache.get("b") is None
+    assert cache.get("a").audio == b"aaaa"
+    assert cache.get("c").audio == b"cccc"
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_audio_larger_than_the_memory_is_not_kept():
+    cache = SpeechCache(max_memory_bytes=4)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbbb")
+    assert cache.get("b") is None
+    assert cache.get("a").audio == b"aaaa"
+
+
+def test_disk_keeps_the_audio_and_file_id_across_restarts(tmp_path):
+    cache = SpeechCache(str(tmp_path), max_memory_bytes=0)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb", file_id="file-b")
+    cache.set_file_id("a", "file-a")
+
+    cache = SpeechCache(str(tmp_path))
+    speech = cache.get("a")
+    assert (speech.audio, speech.file_id) == (b"aaaa", "file-a")
+    speech = cache.get("b")
+    assert (speech.audio, speech.file_id) == (b"bbbb", "file-b")
+
+
+def test_disk_keeps_the_most_recently_used_audio(tmp_path):
+    cache = SpeechCache(str(tmp_path), max_memory_bytes=0, max_disk_bytes=10)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    assert cache.get("a").audio == b"aaaa"
+    cache.put("c", b"cccc")
+    assert sorted(os.listdir(tmp_path)) == ["a.ogg", "c.ogg"]
+    assert cache.get("b") is None
+
+
+def test_disk_is_trimmed_by_last_use_when_loaded(tmp_path):
+    cache = SpeechCache(str(tmp_path))
+    for age, key in enumerate(["new", "old"]):
+        cache.put(key, b"1234", file_id=key)
+        os.utime(tmp_path / "{}.ogg".format(key), (1000 - age, 1000 - age))
+
+    cache = SpeechCache(str(tmp_path), max_disk_bytes=4)
+    assert sorted(os.listdir(tmp_path)) == ["new.file_id", "new.ogg"]
+    assert cache.get("new").file_id == "new"
@@ -0,0 +1,122 @@
+import asyncio
+import json
+from src.sqlite_message_store import AsyncSQLiteMessageStore, SQLiteMessageStore
+
+
+def message(user_sid, content, created_at):
+    return {"user_sid": user_sid, "role": "user", "content": content, "content_source": "text",
+            "created_at": created_at}
+
+
+def filled_store(path, store_class=SQLiteMessageStore):
+    store = store_class(str(path), cache_size=0)
+    store.insert_messages([message("user", str(i), "2023-01-01T00:00:0{}".format(i)) for i in range(5)] +
+                          [message("other", "other", "2023-01-01T00:00:03")])
+    return store
+
+
+def contents(messages):
+    return [message["content"] for message in messages]
+
+
+def test_get_messages_filters_by_date_and_keeps_the_newest(tmp_path):
+    store = filled_store(tmp_path / "messages.db")
+    assert contents(store.get_messages("user")) == ["0", "1", "2", "3", "4"]
+    assert contents(store.get_messages("user", limit=2)) == ["3", "4"]
+    assert contents(store.get_messages("user", before="2023-01-01T00:00:03")) == ["0", "1", "2"]
+    assert contents(store.get_messages("user", after="2023-01-01T00:00:01")) == ["2", "3", "4"]
+    assert contents(store.get_messages("user", limit=1, before="2023-01-01T00:00:03",
+                                       after="2023-01-01T00:00:00")) == ["2"]
+    assert store.get_nth_newest_date("user", 2) == "2023-01-01T00:00:03"
+    assert store.get_nth_newest_date("user", 6) is None
+    store.close()
+
+
+def test_inserted_and_queued_messages_are_read_back(tmp_path):
+    store = SQLiteMessageStore(str(tmp_path / "messages.db"))
+    store.insert_message("user", "user", "first", "text")
+    store.queue_message("user", "assistant", "second", "text")
+    assert contents(store.get_messages("user")) == ["first", "second"]
+    store.close()
+
+    # the queued message was written when the store was closed
+    store = SQLiteMessageStore(str(tmp_path / "messages.db"), cache_size=0)
+    assert [(message["role"], message["content"]) for message in store.get_messages("user")] == [
+        ("user", "first"), ("assistant", "second")]
+    store.close()
+
+
+def test_cleared_messages_are_hidden_then_deleted(tmp_path):
+    store = filled_store(tmp_path / "messages.db")
+    store.insert_archive_batches([{"user_sid": "user", "first_created_at": "2022-01-01T00:00:00",
+                                   "last_created_at": "2022-01-01T00:00:01", "count": 2, "data": "[]"}])
+    deletion = store.clear_user_messages("user")
+    assert deletion.result(timeout=5) == {"deletedCount": 5}
+    assert store.get_messages("user") == []
+    assert contents(store.get_messages("other")) == ["other"]
+    assert store.delete_archive_batches("user") == 0
+    store.close()
+
+
+def test_messages_queued_while_clearing_are_kept(tmp_path):
+    store = filled_store(tmp_path / "messages.db")
+    store.clear_user_messages("user").result(timeout=5)
+    store.queue_message("user", "user", "new", "text", created_at="2099-01-01T00:00:00")
+    assert contents(store.get_messages("user")) == ["new"]
+    store.close()
+
+
+def test_export_and_delete_a_range_of_messages(tmp_path):
+    store = filled_store(tmp_path / "messages.db")
+    exported = store.export_messages("2023-01-01T00:00:04", limit=3)
+    assert [(message["user_sid"], message["content"]) for message in exported] == [
+        ("user", "0"), ("user", "1"), ("user", "2")]
+    exported = store.export_messages("2023-01-01T00:00:04", after="2023-01-01T00:00:02", user_sid="other")
+    assert contents(exported) == ["other"]
+
+    assert store.delete_messages(["user", "other"], "2023-01-01T00:00:03") == {"deletedCount": 5}
+    assert contents(store.get_messages("user")) == ["4"]
+    assert store.get_messages("other") == []
+    store.close()
+
+
+def test_all_messages_are_exported_in_pages(tmp_path):
+    store = filled_store(tmp_path / "messages.db")
+    pages = list(store.iter_all_messages(page_size=4))
+    assert [len(page) for page in pages] == [4, 2]
+    assert set(pages[0][0]) == {"user_sid", "role", "content", "content_source", "created_at"}
+    store.close()
+
+
+def test_archive_batches_are_stored_in_their_table(tmp_path):
+    store = filled_store(tmp_path / "messages.db")
+    assert store.archive is store
+    batch = {"user_sid": "user", "first_created_at": "2023-01-01T00:00:00",
+             "last_created_at": "2023-01-01T00:00:01", "count": 2, "data": json.dumps(["0", "1"])}
+    store.insert_archive_batches([batch, dict(batch, user_sid="other")])
+    rows = store._connection().execute("SELECT user_sid, count, data FROM message_archives").fetchall()
+    assert rows == [{"user_sid": "user", "count": 2, "data": '["0", "1"]'},
+                    {"user_sid": "other", "count": 2, "data": '["0", "1"]'}]
+    assert store.delete_archive_batches("user") == 1
+    assert store.delete_archive_batches("user") == 0
+    store.close()
+
+
+def test_async_store_reads_writes_and_deletes(tmp_path):
+    store = filled_store(tmp_path / "messages.db", AsyncSQLiteMessageStore)
+
+    async def use_store():
+        await store.connect()
+        await store.ainsert_message("user", "user", "5", "text")
+        store.queue_message("user", "assistant", "6", "text")
+        messages = await store.aget_messages("user", limit=3)
+        await store.aflush()
+        deleted = await store.adelete_user_messages("user")
+        remaining = await store.aget_messages("user")
+        await store.aclose()
+        return messages, deleted, remaining
+
+    messages, deleted, remaining = asyncio.run(use_store())
+    assert contents(messages) == ["4", "5", "6"]
+    assert deleted == {"deletedCount": 7}
+    assert remaining == []
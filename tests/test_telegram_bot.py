@@ -0,0 +1,120 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from src.async_telegram_bot import AsyncTelegramBot
+from src.telegram_bot import TELEGRAM_MESSAGE_LIMIT, StreamedReply, TelegramBot, split_message
+
+
+class Bot:
+    """
+    Records the replies and edits sent to Telegram.
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def reply_to(self, message, text):
+        self.sent.append(("reply", text))
+        return SimpleNamespace(message_id=len(self.sent))
+
+    def edit_message_text(self, text, chat_id, message_id):
+        self.sent.append(("edit", text))
+
+    def delete_message(self, chat_id, message_id):
+        self.sent.append(("delete", message_id))
+
+
+class AsyncBot(Bot):
+    async def reply_to(self, message, text):
+        return Bot.reply_to(self, message, text)
+
+    async def edit_message_text(self, text, chat_id, message_id):
+        Bot.edit_message_text(self, text, chat_id, message_id)
+
+    async def delete_message(self, chat_id, message_id):
+        Bot.delete_message(self, chat_id, message_id)
+
+
+class OpenAIAPI:
+    def __init__(self, parts):
+        self._parts = parts
+
+    def ask_gpt(self, user_sid, user_msg, content_source="text", superseded=None):
+        return None if self._parts is None else ["".join(self._parts)]
+
+    def ask_gpt_stream(self, user_sid, user_msg, content_source="text", superseded=None):
+        return iter(self._parts)
+
+
+class AsyncOpenAIAPI(OpenAIAPI):
+    async def ask_gpt(self, user_sid, user_msg, content_source="text", superseded=None):
+        return OpenAIAPI.ask_gpt(self, user_sid, user_msg, content_source, superseded)
+
+    async def ask_gpt_stream(self, user_sid, user_msg, content_source="text", superseded=None):
+        for part in self._parts:
+            yield part
+
+
+MESSAGE = SimpleNamespace(chat=SimpleNamespace(id=1, type="private"), message_id=1, text="oi")
+
+
+def reply(parts, stream=True, superseded=None):
+    bot = Bot()
+    TelegramBot(bot, OpenAIAPI(parts), stream=stream, edit_interval=0)._reply_with_answer(
+        MESSAGE, "oi", "text", superseded)
+    return bot.sent
+
+
+def async_reply(parts, stream=True, superseded=None):
+    bot = AsyncBot()
+    asyncio.run(AsyncTelegramBot(bot, AsyncOpenAIAPI(parts), stream=stream, edit_interval=0)._reply_with_answer(
+        MESSAGE, "oi", "text", superseded))
+    return bot.sent
+
+
+def test_split_message():
+    assert split_message("") == [""]
+    assert split_message("a" * TELEGRAM_MESSAGE_LIMIT) == ["a" * TELEGRAM_MESSAGE_LIMIT]
+    assert split_message("a" * TELEGRAM_MESSAGE_LIMIT + "bc") == ["a" * TELEGRAM_MESSAGE_LIMIT, "bc"]
+
+
+def test_streamed_reply_spaces_out_its_edits():
+    streamed = StreamedReply(edit_interval=60)
+    assert streamed.add("Olá") == "Olá"
+    streamed.edited()
+    assert streamed.add(", tudo") is None
+    assert streamed.final_edit() == "Olá, tudo"
+    assert streamed.final_edit() is None
+    assert streamed.overflow() == []
+
+
+@pytest.mark.parametrize("send", [reply, async_reply])
+def test_streamed_answer_edits_the_placeholder(send):
+    assert send(["Olá", "", ", tudo", " bem?"]) == [
+        ("reply", "..."), ("edit", "Olá"), ("edit", "Olá, tudo"), ("edit", "Olá, tudo bem?")]
+
+
+@pytest.mark.parametrize("send", [reply, async_reply])
+def test_long_streamed_answer_is_split(send):
+    sent = send(["a" * (TELEGRAM_MESSAGE_LIMIT - 1), "bb", "c" * TELEGRAM_MESSAGE_LIMIT])
+    answer = "a" * (TELEGRAM_MESSAGE_LIMIT - 1) + "bb" + "c" * TELEGRAM_MESSAGE_LIMIT
+    # the reply stops changing once it is full
+    assert sent == [("reply", "..."), ("edit", answer[:TELEGRAM_MESSAGE_LIMIT - 1]),
+                    ("edit", answer[:TELEGRAM_MESSAGE_LIMIT]),
+                    ("reply", answer[TELEGRAM_MESSAGE_LIMIT:2 * TELEGRAM_MESSAGE_LIMIT]),
+                    ("reply", answer[2 * TELEGRAM_MESSAGE_LIMIT:])]
+
+
+@pytest.mark.parametrize("send", [reply, async_reply])
+def test_superseded_or_empty_streamed_answer_leaves_no_reply(send):
+    assert send(["Olá"], superseded=lambda: True) == [("reply", "..."), ("edit", "Olá"), ("delete", 1)]
+    with pytest.raises(Exception, match="Empty answer"):
+        send([" "])
+
+
+@pytest.mark.parametrize("send", [reply, async_reply])
+def test_answer_not_streamed_is_split(send):
+    assert send(["a" * TELEGRAM_MESSAGE_LIMIT, "b"], stream=False) == [
+        ("reply", "a" * TELEGRAM_MESSAGE_LIMIT), ("reply", "b")]
+    assert send(None, stream=False) == [
+        ("reply", "Desculpe, não consegui uma resposta agora, tente novamente em alguns instantes.")]
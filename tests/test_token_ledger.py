@@ -0,0 +1,87 @@
+from src.token_ledger import TokenLedger
+
+
+class WordEncoding:
+    """
+    Counts a token per word, so the tests do not need to download the tiktoken encoding.
+    """
+
+    def encode(self, text):
+        return text.split()
+
+
+def make_ledger(max_tokens=100, max_messages=100000):
+    ledger = TokenLedger(max_tokens=max_tokens, max_messages=max_messages)
+    ledger._encoding = WordEncoding()
+    return ledger
+
+
+def make_message(index, words=5):
+    return {"role": "user", "content": " ".join(["word"] * words), "created_at": "2023-01-01T00:00:{:02d}".format(index)}
+
+
+def test_count_message_tokens():
+    ledger = make_ledger()
+    assert ledger.count_message_tokens({"role": "user", "content": "one two three"}) == 4 + 1 + 3
+    assert ledger.count_message_tokens({"role": "user", "content": "hi", "name": "bob"}) == 4 + 1 + 1 + 1 - 1
+
+
+def test_extend_trims_the_oldest_messages():
+    # each message has 10 tokens and the window holds (n + 2) * 1.1 <= 50, so 4 messages
+    ledger = make_ledger(max_tokens=50)
+    messages = [make_message(i) for i in range(6)]
+    window = ledger.extend("user", messages)
+    assert window == [{"role": "user", "content": m["content"]} for m in messages[2:]]
+    assert ledger.cursor("user") == messages[-1]["created_at"]
+    assert [created_at for _, created_at in ledger.dated_messages("user")] == \
+        [m["created_at"] for m in messages[2:]]
+
+
+def test_fill_stops_requesting_pages_once_full():
+    ledger = make_ledger(max_tokens=50)
+    requested = []
+
+    def pages():
+        for start in (6, 3, 0):
+            requested.append(start)
+            yield [make_message(i) for i in range(start, start + 3)]
+
+    window = ledger.fill("user", pages())
+    assert len(window) == 4
+    assert requested == [6, 3]
+    assert ledger.cursor("user") == make_message(8)["created_at"]
+
+
+def test_prepend_reports_a_full_window():
+    ledger = make_ledger(max_tokens=50)
+    ledger.reset("user")
+    assert not ledger.prepend("user", [make_message(i) for i in range(3)])
+    assert ledger.prepend("user", [make_message(i) for i in range(3)])
+    assert len(ledger.messages("user")) == 4
+
+
+def test_forget_and_reset():
+    ledger = make_ledger()
+    ledger.extend("user", [make_message(0)])
+    ledger.reset("user")
+    assert ledger.messages("user") == []
+    assert ledger.cursor("user") is None
+    ledger.forget("user")
+    assert ledger.cursor("user") is None
+
+
+def test_evicts_the_least_recently_used_windows():
+    ledger = make_ledger(max_messages=4)
+    ledger.extend("a", [make_message(0), make_message(1)])
+    ledger.extend("b", [make_message(0), make_message(1)])
+    ledger.messages("a")
+    ledger.extend("c", [make_message(0)])
+    assert ledger.cursor("b") is None
+    assert len(ledger.messages("a")) == 2
+    assert len(ledger.messages("c")) == 1
+
+
+def test_keeps_a_window_larger_than_the_limit():
+    ledger = make_ledger(max_messages=2)
+    window = ledger.extend("a", [make_message(i, words=1) for i in range(3)])
+    assert len(window) == 3
@@ -0,0 +1,74 @@
+import asyncio
+import json
+import queue
+from src.webhook import SECRET_TOKEN_HEADER, WebhookReceiver, consume_updates, update_chat_id
+
+
+def text_update(update_id, chat_id):
+    return {"update_id": update_id,
+            "message": {"message_id": update_id, "date": 0, "chat": {"id": chat_id, "type": "private"},
+                        "from": {"id": chat_id, "is_bot": False, "first_name": "user"}, "text": "oi"}}
+
+
+class Request:
+    def __init__(self, body, headers=None):
+        self.headers = headers or {}
+        self._body = body
+
+    async def text(self):
+        return self._body
+
+
+def post(receiver, update, headers=None):
+    return asyncio.run(receiver.handle(Request(json.dumps(update), headers))).status
+
+
+def test_chat_id_of_each_kind_of_update():
+    assert update_chat_id(text_update(1, 42)) == 42
+    assert update_chat_id({"update_id": 2, "callback_query": {"id": "1", "from": {"id": 7},
+                                                              "message": {"chat": {"id": 43}}}}) == 43
+    assert update_chat_id({"update_id": 3, "inline_query": {"id": "1", "from": {"id": 44}, "query": ""}}) == 44
+    assert update_chat_id({"update_id": 4}) == 0
+
+
+def test_updates_of_a_chat_go_to_the_same_worker():
+    receiver = WebhookReceiver(print, workers=3)
+    assert [receiver.shard(text_update(i, chat_id)) for i, chat_id in enumerate([10, 11, 12, 13, 10])] == [
+        1, 2, 0, 1, 1]
+    assert receiver.shard(text_update(1, -1001)) == -1001 % 3
+
+
+def test_updates_are_queued_in_order_for_their_shard():
+    receiver = WebhookReceiver(print, workers=2)
+    for update_id, chat_id in enumerate([1, 2, 3, 1]):
+        assert post(receiver, text_update(update_id, chat_id)) == 200
+    odd = [json.loads(receiver._queues[1].get(timeout=5))["update_id"] for _ in range(3)]
+    even = json.loads(receiver._queues[0].get(timeout=5))["update_id"]
+    assert odd == [0, 2, 3]
+    assert even == 1
+
+
+def test_requests_are_refused_without_the_secret_token_or_when_the_queue_is_full():
+    receiver = WebhookReceiver(print, secret_token="secret", max_queue=1)
+    assert post(receiver, text_update(1, 1)) == 403
+    assert post(receiver, text_update(1, 1), {SECRET_TOKEN_HEADER: "secret"}) == 200
+    assert post(receiver, text_update(2, 1), {SECRET_TOKEN_HEADER: "secret"}) == 503
+    status = asyncio.run(receiver.handle(Request("not json", {SECRET_TOKEN_HEADER: "secret"}))).status
+    assert status == 400
+
+
+def test_a_worker_handles_its_updates_until_stopped():
+    class Bot:
+        def __init__(self):
+            self.update_ids = []
+
+        def process_new_updates(self, updates):
+            self.update_ids.extend(update.update_id for update in updates)
+
+    bot = Bot()
+    updates = queue.Queue()
+    for update_id in range(3):
+        updates.put(json.dumps(text_update(update_id, 1)))
+    updates.put(None)
+    consume_updates(bot, updates)
+    assert bot.update_ids == [0, 1, 2]